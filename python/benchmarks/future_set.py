@@ -0,0 +1,101 @@
+"""Compares the memory used by a list of Futures and a FutureSet of the same tasks,
+and the time taken for the bulk status, priority, completion and cancel operations on them.
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    python benchmarks/future_set.py --host localhost --user eqsql_user --db_name EQ_SQL --port 5433
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import local_queue
+from eqsql.task_queues.core import Future
+from eqsql.task_queues.future_set import FutureSet
+
+EQ_TYPE = 0
+
+
+def container_memory(task_queue, n):
+    tracemalloc.start()
+    fts = [Future(task_queue, eq_task_id) for eq_task_id in range(n)]
+    list_mem = tracemalloc.get_traced_memory()[0]
+    del fts
+    tracemalloc.stop()
+    tracemalloc.start()
+    fs = FutureSet(task_queue, range(n))
+    set_mem = tracemalloc.get_traced_memory()[0]
+    del fs
+    tracemalloc.stop()
+    return list_mem, set_mem
+
+
+def measure(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def list_ops(task_queue, fts, n_complete):
+    task_queue.get_status(fts)
+    task_queue.get_priorities(fts)
+    task_queue.update_priorities(fts, 1)
+    # pop the completed futures, as an ME would
+    for _ in task_queue.as_completed(fts, pop=True, n=n_complete, sleep=0):
+        pass
+    task_queue.cancel_tasks(fts)
+
+
+def set_ops(fs, n_complete):
+    fs.statuses()
+    fs.priorities()
+    fs.update_priorities(1)
+    for _ in fs.as_completed(n=n_complete, sleep=0):
+        pass
+    fs.cancel()
+
+
+def complete(task_queue, n):
+    tasks = task_queue.query_task(EQ_TYPE, n=n, timeout=0.0)
+    task_queue.report_tasks([(task['eq_task_id'], EQ_TYPE, '{}') for task in tasks])
+
+
+def run(args):
+    payloads = [json.dumps({'x': i}) for i in range(args.tasks)]
+    n_complete = args.tasks // 2
+    print(f'{"container":>10} {"MB":>8} {"ops s":>8}')
+    for container in ('list', 'FutureSet'):
+        reset_db(args.user, args.db_name, args.host, args.port, args.password)
+        task_queue = local_queue.init_task_queue(args.host, args.user, args.port, args.db_name, args.password)
+        try:
+            mem = container_memory(task_queue, args.tasks)[0 if container == 'list' else 1]
+            if container == 'list':
+                _, fts = task_queue.submit_tasks('bench', EQ_TYPE, payloads)
+                complete(task_queue, n_complete)
+                elapsed = measure(list_ops, task_queue, fts, n_complete)
+            else:
+                _, fs = FutureSet.submit(task_queue, 'bench', EQ_TYPE, payloads)
+                complete(task_queue, n_complete)
+                elapsed = measure(set_ops, fs, n_complete)
+                assert np.count_nonzero(fs.completed()) == n_complete
+            print(f'{container:>10} {mem / 2**20:>8.1f} {elapsed:>8.2f}', flush=True)
+        finally:
+            task_queue.close()
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark a list of Futures against a FutureSet')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--tasks', type=int, default=100000, help='number of tasks to submit')
+    run(parser.parse_args())
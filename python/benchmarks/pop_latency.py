@@ -0,0 +1,82 @@
+"""Measures the latency of popping tasks off of the output queue as the queue depth
+grows. With the indexes added in schema version 1, the pop latency should stay
+roughly flat from 1k to 1M queued tasks.
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    python benchmarks/pop_latency.py --host localhost --user eqsql_user --db_name EQ_SQL --port 5433
+"""
+import argparse
+import statistics
+import time
+
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import local_queue
+
+EQ_TYPE = 0
+
+fill_sql = """
+insert into eq_tasks (eq_task_id, eq_task_type, json_out, eq_status, eq_priority, time_created)
+select id, %(eq_type)s, '{"x": ' || id || '}', 0, (id %% 10), now()
+from (select nextval('emews_id_generator') as id from generate_series(1, %(n)s)) as ids;
+
+insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, aging_key)
+select eq_task_type, eq_task_id, eq_priority, eq_priority - aging_offset
+from eq_tasks, (select eq_aging_offset(%(eq_type)s)) as a (aging_offset)
+where eq_task_id > %(last_id)s;
+"""
+
+
+def fill_queue(task_queue, n: int):
+    with task_queue.db.conn:
+        with task_queue.db.conn.cursor() as cur:
+            cur.execute('select coalesce(max(eq_task_id), 0) from eq_tasks')
+            last_id = cur.fetchone()[0]
+            cur.execute(fill_sql, {'eq_type': EQ_TYPE, 'n': n, 'last_id': last_id})
+            cur.execute('analyze emews_queue_OUT')
+
+
+def time_pops(task_queue, n_pops: int, batch_size: int):
+    latencies = []
+    for _ in range(n_pops):
+        start = time.perf_counter()
+        result = task_queue.query_task(EQ_TYPE, n=batch_size, timeout=0.0)
+        latencies.append(time.perf_counter() - start)
+        if batch_size == 1 and result['type'] != 'work':
+            raise ValueError(f'Unexpected pop result: {result}')
+    return latencies
+
+
+def run(args):
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+    task_queue = local_queue.init_task_queue(args.host, args.user, args.port, args.db_name, args.password)
+    depth = 0
+    print(f'{"depth":>10} {"median ms":>10} {"p99 ms":>10}')
+    try:
+        for target in args.depths:
+            fill_queue(task_queue, target - depth)
+            depth = target
+            latencies = time_pops(task_queue, args.pops, args.batch_size)
+            # refill what was popped so the next depth is accurate
+            fill_queue(task_queue, args.pops * args.batch_size)
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f'{depth:>10} {statistics.median(latencies) * 1000:>10.3f} {p99 * 1000:>10.3f}', flush=True)
+    finally:
+        task_queue.close()
+        reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark output queue pop latency against queue depth')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--pops', type=int, default=200, help='number of timed pops at each depth')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of tasks per pop')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    run(parser.parse_args())
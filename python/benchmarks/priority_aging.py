@@ -0,0 +1,97 @@
+"""Simulates a worker pool under a continuous load of high priority tasks, with a trickle of
+low priority tasks, and reports the distribution of the time the tasks wait in the output
+queue with and without priority aging. Without aging, the low priority tasks only run when
+the high priority load lulls, so their wait time tail is long, and tasks still queued at the
+end of the simulation have starved for much of it.
+
+Each tick of the simulation submits a random number of high and low priority tasks, and the
+worker pool then queries for up to its capacity of tasks. The simulation runs in real time,
+as the effective priority of an aged task depends on the time it has been queued.
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    python benchmarks/priority_aging.py --host localhost --user eqsql_user --db_name EQ_SQL --port 5433
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import local_queue
+
+EQ_TYPE = 0
+HIGH = 5
+LOW = 0
+
+
+def simulate(args, rate: float):
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+    task_queue = local_queue.init_task_queue(args.host, args.user, args.port, args.db_name, args.password)
+    rng = random.Random(args.seed)
+    submitted = {}
+    waits = {HIGH: [], LOW: []}
+    try:
+        if rate > 0:
+            task_queue.set_aging_rates({EQ_TYPE: rate})
+        start = time.monotonic()
+        for tick in range(int(args.duration / args.tick)):
+            for priority, n_max in ((HIGH, args.high), (LOW, args.low)):
+                # binomial arrivals with a mean of half of n_max
+                n = sum(rng.random() < 0.5 for _ in range(n_max))
+                if n > 0:
+                    _, fts = task_queue.submit_tasks('bench', EQ_TYPE, ['{}'] * n, priority=priority)
+                    now = time.monotonic()
+                    submitted.update((ft.eq_task_id, (priority, now)) for ft in fts)
+
+            tasks = task_queue.query_task(EQ_TYPE, n=args.capacity, timeout=0.0)
+            now = time.monotonic()
+            for task in tasks if isinstance(tasks, list) else []:
+                priority, t = submitted.pop(task['eq_task_id'])
+                waits[priority].append(now - t)
+
+            time.sleep(max(0, start + (tick + 1) * args.tick - time.monotonic()))
+
+        now = time.monotonic()
+        queued = {HIGH: [], LOW: []}
+        for priority, t in submitted.values():
+            queued[priority].append(now - t)
+        return waits, queued
+    finally:
+        task_queue.close()
+
+
+def run(args):
+    print(f'{"aging rate":>10} {"priority":>8} {"run":>6} {"p50 s":>7} {"p90 s":>7} {"p99 s":>7} '
+          f'{"max s":>7} {"queued":>6} {"oldest s":>8}')
+    for rate in (0.0, args.rate):
+        waits, queued = simulate(args, rate)
+        for priority in (HIGH, LOW):
+            w = np.array(waits[priority]) if len(waits[priority]) > 0 else np.zeros(1)
+            p50, p90, p99 = np.percentile(w, [50, 90, 99])
+            oldest = max(queued[priority], default=0.0)
+            print(f'{rate:>10} {priority:>8} {len(waits[priority]):>6} {p50:>7.2f} {p90:>7.2f} {p99:>7.2f} '
+                  f'{w.max():>7.2f} {len(queued[priority]):>6} {oldest:>8.2f}', flush=True)
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the wait times of tasks with and without priority aging')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to simulate for each policy')
+    parser.add_argument('--tick', type=float, default=0.1, help='seconds per tick')
+    parser.add_argument('--capacity', type=int, default=10, help='tasks run by the worker pool per tick')
+    parser.add_argument('--high', type=int, default=19,
+                        help='maximum high priority tasks submitted per tick, the mean is half of this')
+    parser.add_argument('--low', type=int, default=2,
+                        help='maximum low priority tasks submitted per tick, the mean is half of this')
+    parser.add_argument('--rate', type=float, default=1.0, help='aging rate in priority per second')
+    parser.add_argument('--seed', type=int, default=42)
+    run(parser.parse_args())
@@ -0,0 +1,129 @@
+"""Compares the number of statements, transactions and network round trips, and the
+throughput of the submit, query task, report and query result operations when
+performed by the client-side statements in LocalTaskQueue against the server-side
+functions (eq_submit, eq_pop_out, eq_report, eq_pop_in) added in schema version 2.
+LocalTaskQueue now always queries for and reports tasks with the server-side functions, so the
+query task and report operations are the same in both modes.
+
+Transactions are counted as the number of transactions begun by the client plus
+the number of statements executed in autocommit mode. Round trips are estimated as
+the number of executed statements plus a BEGIN and COMMIT for each transaction
+begun by the client.
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    python benchmarks/server_functions.py --host localhost --user eqsql_user --db_name EQ_SQL --port 5433
+"""
+import argparse
+import json
+import time
+
+from psycopg2 import extensions
+
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import local_queue
+from eqsql.task_queues.core import ResultStatus
+
+EQ_TYPE = 0
+
+
+class Counts:
+
+    def __init__(self):
+        self.statements = 0
+        self.begins = 0
+        self.autocommits = 0
+
+
+class CountingCursor(extensions.cursor):
+    """Counts the statements executed by, and the transactions
+    begun by, the cursors of a connection."""
+    counts = Counts()
+
+    def execute(self, query, vars=None):
+        conn = self.connection
+        if conn.autocommit:
+            CountingCursor.counts.autocommits += 1
+        elif conn.status == extensions.STATUS_READY:
+            CountingCursor.counts.begins += 1
+        CountingCursor.counts.statements += 1
+        return super().execute(query, vars)
+
+
+def submit(task_queue, n):
+    fts = []
+    for i in range(n):
+        status, ft = task_queue.submit_task('bench', EQ_TYPE, json.dumps({'x': i}))
+        if status != ResultStatus.SUCCESS:
+            raise ValueError('submit_task failed')
+        fts.append(ft)
+    return fts
+
+
+def query(task_queue, n):
+    tasks = []
+    for _ in range(n):
+        result = task_queue.query_task(EQ_TYPE, timeout=0.0)
+        if result['type'] != 'work':
+            raise ValueError(f'Unexpected pop result: {result}')
+        tasks.append(result['eq_task_id'])
+    return tasks
+
+
+def report(task_queue, task_ids):
+    for task_id in task_ids:
+        if task_queue.report_task(task_id, EQ_TYPE, json.dumps({'y': task_id})) != ResultStatus.SUCCESS:
+            raise ValueError('report_task failed')
+
+
+def results(task_queue, task_ids):
+    for task_id in task_ids:
+        status, _ = task_queue.query_result(task_id, timeout=0.0)
+        if status != ResultStatus.SUCCESS:
+            raise ValueError('query_result failed')
+
+
+def measure(task_queue, f, *args):
+    counts = CountingCursor.counts = Counts()
+    start = time.perf_counter()
+    result = f(task_queue, *args)
+    elapsed = time.perf_counter() - start
+    xacts = counts.begins + counts.autocommits
+    return result, (counts.statements, xacts, counts.statements + 2 * counts.begins, elapsed)
+
+
+def run(args):
+    print(f'{"mode":>10} {"op":>14} {"stmts/op":>9} {"xacts/op":>9} {"rtrips/op":>10} {"ops/s":>10}')
+    for server_functions in (False, True):
+        reset_db(args.user, args.db_name, args.host, args.port, args.password)
+        task_queue = local_queue.init_task_queue(args.host, args.user, args.port, args.db_name, args.password,
+                                                 server_functions=server_functions)
+        task_queue.db.conn.cursor_factory = CountingCursor
+        mode = 'functions' if server_functions else 'client'
+        try:
+            n = args.tasks
+            _, submit_stats = measure(task_queue, submit, n)
+            task_ids, query_stats = measure(task_queue, query, n)
+            _, report_stats = measure(task_queue, report, task_ids)
+            _, result_stats = measure(task_queue, results, task_ids)
+            for op, (statements, xacts, round_trips, elapsed) in zip(
+                    ('submit_task', 'query_task', 'report_task', 'query_result'),
+                    (submit_stats, query_stats, report_stats, result_stats)):
+                print(f'{mode:>10} {op:>14} {statements / n:>9.1f} {xacts / n:>9.1f} {round_trips / n:>10.1f} '
+                      f'{n / elapsed:>10.0f}', flush=True)
+        finally:
+            task_queue.close()
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark client-side statements against server-side functions')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--tasks', type=int, default=2000, help='number of tasks to submit, query and report')
+    run(parser.parse_args())
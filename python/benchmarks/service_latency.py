@@ -0,0 +1,149 @@
+"""Load tests the emews_service by running concurrent ServiceTaskQueue clients against it,
+and reports the p50 and p99 latency and the rate of the requests to each endpoint. A worker
+pool thread queries for and reports the submitted tasks, so that the clients' result queries
+find results.
+
+The service is started on the specified service port with the specified number of worker
+processes, and its /metrics are reported after the load test. With --no_cache,
+the service's remote functions create a task queue per request, rather than reusing the
+cached task queues (see eqsql.task_queues.remote_funcs._task_queue).
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    python benchmarks/service_latency.py --host localhost --user eqsql_user --db_name EQ_SQL --port 5433
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from multiprocessing import Process
+
+import numpy as np
+import requests
+
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import emews_service, local_queue, remote_funcs, service_queue
+
+EQ_TYPE = 0
+
+
+def wait_for_service(service_url: str, timeout: float = 30.0):
+    start = time.time()
+    while True:
+        try:
+            requests.get(f'{service_url}/ping')
+            return
+        except requests.ConnectionError:
+            if time.time() - start > timeout:
+                raise
+            time.sleep(0.1)
+
+
+def client(args, service_url: str, latencies: dict, lock: threading.Lock):
+    task_queue = service_queue.init_task_queue(service_url, args.host, args.user, args.port, args.db_name,
+                                               args.password)
+    times = defaultdict(list)
+
+    def timed(name, f, *f_args, **f_kwargs):
+        t = time.perf_counter()
+        result = f(*f_args, **f_kwargs)
+        times[name].append(time.perf_counter() - t)
+        return result
+
+    for _ in range(args.rounds):
+        payloads = [json.dumps({'x': i}) for i in range(args.batch)]
+        _, fts = timed('submit_tasks', task_queue.submit_tasks, 'bench', EQ_TYPE, payloads)
+        timed('get_status', task_queue.get_status, fts)
+        timed('get_priorities', task_queue.get_priorities, fts)
+        timed('get_worker_pools', task_queue.get_worker_pools, fts)
+        timed('get_results', task_queue.get_results, fts)
+        timed('are_queues_empty', task_queue.are_queues_empty, EQ_TYPE)
+
+    with lock:
+        for name, ts in times.items():
+            latencies[name].extend(ts)
+
+
+def worker_pool(args, done: threading.Event):
+    task_queue = local_queue.init_task_queue(args.host, args.user, args.port, args.db_name, args.password)
+    while not done.is_set():
+        tasks = task_queue.query_task(EQ_TYPE, n=100, timeout=0.0)
+        if isinstance(tasks, list):
+            task_queue.report_tasks([(task['eq_task_id'], EQ_TYPE, task['payload']) for task in tasks])
+        else:
+            time.sleep(0.01)
+    task_queue.close()
+
+
+def run(args):
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+    if args.no_cache:
+        # inherited by the forked service process
+        remote_funcs.QUEUE_CACHE_SIZE = 0
+    # don't log each request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    service_url = f'http://127.0.0.1:{args.service_port}'
+    service = Process(target=emews_service.start, args=('127.0.0.1', args.service_port, args.workers))
+    service.start()
+    done = threading.Event()
+    pool = threading.Thread(target=worker_pool, args=(args, done))
+    try:
+        wait_for_service(service_url)
+        pool.start()
+        latencies = defaultdict(list)
+        lock = threading.Lock()
+        clients = [threading.Thread(target=client, args=(args, service_url, latencies, lock))
+                   for _ in range(args.clients)]
+        start = time.perf_counter()
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        duration = time.perf_counter() - start
+
+        print(f'{"endpoint":>17} {"requests":>8} {"p50 ms":>7} {"p99 ms":>7} {"req/s":>7}')
+        for name, ts in latencies.items():
+            p50, p99 = np.percentile(np.array(ts) * 1000, [50, 99])
+            print(f'{name:>17} {len(ts):>8} {p50:>7.2f} {p99:>7.2f} {len(ts) / duration:>7.1f}')
+        n_requests = sum(len(ts) for ts in latencies.values())
+        print(f'{"total":>17} {n_requests:>8} {"":>7} {"":>7} {n_requests / duration:>7.1f}')
+
+        metrics = requests.get(f'{service_url}/metrics', params={'format': 'json'}).json()
+        served = sum(m['requests'] for m in metrics['endpoints'].values())
+        errors = sum(m['errors'] for m in metrics['endpoints'].values())
+        print(f'\nservice: {metrics["workers"]} workers, {served} requests, {errors} errors')
+        for worker, stats in enumerate(metrics['db_pools']):
+            print(f'  worker {worker}: db connections {stats["in_use"]} in use, {stats["idle"]} idle, '
+                  f'max {stats["max_size"]}')
+    finally:
+        done.set()
+        if pool.is_alive():
+            pool.join()
+        try:
+            requests.get(f'{service_url}/shutdown')
+        except requests.RequestException:
+            # the service can terminate before responding
+            pass
+        service.join()
+        reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the emews_service endpoints')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--service_port', type=int, default=11218)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--rounds', type=int, default=200, help='rounds of requests per client')
+    parser.add_argument('--batch', type=int, default=10, help='tasks submitted per round')
+    parser.add_argument('--workers', type=int, default=1, help='service worker processes')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='create a task queue per request in the service, rather than reusing cached ones')
+    run(parser.parse_args())
@@ -0,0 +1,82 @@
+"""Measures the number of task results per second a single Swift/T rank can report
+through eqsql_swift.report_task, compared to opening and closing a new, unpooled
+task queue connection for each report, as eqsql_swift previously did.
+
+eqsql_swift must be importable, e.g., by adding swift-t/ext to the PYTHONPATH.
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    PYTHONPATH=../swift-t/ext python benchmarks/swift_reports.py --host localhost --user eqsql_user \\
+        --db_name EQ_SQL --port 5433
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from eqsql import db_tools
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import local_queue
+from eqsql.task_queues.core import ResultStatus
+
+import eqsql_swift
+
+EQ_TYPE = 0
+
+
+def running_tasks(task_queue, n):
+    task_queue.submit_tasks('bench', EQ_TYPE, [json.dumps({'x': i}) for i in range(n)])
+    return [task['eq_task_id'] for task in task_queue.query_task(EQ_TYPE, n=n, timeout=0.0)]
+
+
+def report_unpooled(args, task_ids):
+    for task_id in task_ids:
+        db = db_tools.WorkflowSQL(host=args.host, user=args.user, port=args.port, dbname=args.db_name,
+                                  password=args.password, pooled=False)
+        db.connect()
+        task_queue = local_queue.LocalTaskQueue(db, logging.getLogger(__name__))
+        if task_queue.report_task(task_id, EQ_TYPE, json.dumps({'y': task_id})) != ResultStatus.SUCCESS:
+            raise ValueError('report_task failed')
+        task_queue.close()
+
+
+def report_swift(args, task_ids):
+    for task_id in task_ids:
+        eqsql_swift.report_task(task_id, EQ_TYPE, json.dumps({'y': task_id}))
+
+
+def run(args):
+    os.environ['DB_HOST'] = args.host
+    os.environ['DB_USER'] = args.user
+    os.environ['DB_NAME'] = args.db_name
+    os.environ['DB_PORT'] = '' if args.port is None else str(args.port)
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+    task_queue = local_queue.init_task_queue(args.host, args.user, args.port, args.db_name, args.password)
+    print(f'{"mode":>20} {"reports/s":>10}')
+    try:
+        for mode, f in (('connection per call', report_unpooled), ('persistent', report_swift)):
+            task_ids = running_tasks(task_queue, args.reports)
+            start = time.perf_counter()
+            f(args, task_ids)
+            elapsed = time.perf_counter() - start
+            status, rows = task_queue._get('delete from emews_queue_IN returning eq_task_id')
+            if len(rows) != len(task_ids):
+                raise ValueError(f'expected {len(task_ids)} reported results, found {len(rows)}')
+            print(f'{mode:>20} {len(task_ids) / elapsed:>10.0f}', flush=True)
+    finally:
+        task_queue.close()
+        reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark eqsql_swift report_task throughput')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--reports', type=int, default=2000, help='number of reports in each mode')
+    run(parser.parse_args())
@@ -0,0 +1,125 @@
+"""Compares the wire formats of the ServiceTaskQueue requests to the emews_service, reporting
+the bytes sent and received per request, and the rate of the requests, for each format.
+Concurrent clients submit batches of tasks, and get the status and the results of the tasks, which
+a worker pool thread reports with the task payload as the result. The formats are the JSON encoded
+JSON strings sent to services that predate the wire format ("legacy"), and JSON, and msgpack if
+it is installed, each with and without compression (zstd if zstandard is installed, otherwise gzip).
+
+The service is started on the specified service port in a separate process.
+
+The benchmark deletes the contents of the EQSQL tables, so it should be run against
+a scratch database.
+
+Example:
+    python benchmarks/wire_format.py --host localhost --user eqsql_user --db_name EQ_SQL --port 5433
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from multiprocessing import Process
+
+import requests
+
+from eqsql.db_tools import reset_db
+from eqsql.task_queues import emews_service, service_queue, wire
+
+from service_latency import EQ_TYPE, wait_for_service, worker_pool
+
+
+def client(args, service_url: str, content_type: str, compress: bool, totals: dict, lock: threading.Lock):
+    task_queue = service_queue.init_task_queue(service_url, args.host, args.user, args.port, args.db_name,
+                                               args.password, content_type=content_type, compress=compress)
+    if content_type is None:
+        task_queue._wire = (None, None)
+    counts = {'requests': 0, 'sent': 0, 'received': 0}
+
+    def count(response, *_args, **_kwargs):
+        counts['requests'] += 1
+        counts['sent'] += len(response.request.body or b'')
+        counts['received'] += len(response.content)
+
+    task_queue.session.hooks['response'].append(count)
+    pad = 'x' * args.payload_size
+    for _ in range(args.rounds):
+        payloads = [json.dumps({'x': i, 'pad': pad}) for i in range(args.batch)]
+        _, fts = task_queue.submit_tasks('bench', EQ_TYPE, payloads)
+        task_queue.get_status(fts)
+        while len(fts) > 0:
+            completed = task_queue.get_results(fts)
+            fts = [ft for ft in fts if ft._result is None]
+            if len(completed) == 0:
+                time.sleep(0.01)
+    task_queue.close()
+
+    with lock:
+        for k, v in counts.items():
+            totals[k] += v
+
+
+def run_format(args, service_url: str, content_type: str, compress: bool):
+    totals = {'requests': 0, 'sent': 0, 'received': 0}
+    lock = threading.Lock()
+    clients = [threading.Thread(target=client, args=(args, service_url, content_type, compress, totals, lock))
+               for _ in range(args.clients)]
+    start = time.perf_counter()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    duration = time.perf_counter() - start
+    return totals, duration
+
+
+def run(args):
+    reset_db(args.user, args.db_name, args.host, args.port, args.password)
+    # don't log each request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    service_url = f'http://127.0.0.1:{args.service_port}'
+    service = Process(target=emews_service.start, args=('127.0.0.1', args.service_port))
+    service.start()
+    done = threading.Event()
+    pool = threading.Thread(target=worker_pool, args=(args, done))
+    try:
+        wait_for_service(service_url)
+        pool.start()
+        formats = [('legacy', None, False)]
+        for content_type in reversed(wire.content_types()):
+            name = content_type.split('/')[1]
+            formats.append((name, content_type, False))
+            formats.append((f'{name}+{wire.compressions()[0]}', content_type, True))
+
+        print(f'{"format":>14} {"requests":>8} {"sent B/req":>10} {"recv B/req":>10} {"total MB":>8} {"req/s":>7}')
+        for name, content_type, compress in formats:
+            totals, duration = run_format(args, service_url, content_type, compress)
+            n = totals['requests']
+            mb = (totals['sent'] + totals['received']) / 1e6
+            print(f'{name:>14} {n:>8} {totals["sent"] / n:>10.0f} {totals["received"] / n:>10.0f} '
+                  f'{mb:>8.2f} {n / duration:>7.1f}')
+    finally:
+        done.set()
+        if pool.is_alive():
+            pool.join()
+        try:
+            requests.get(f'{service_url}/shutdown')
+        except requests.RequestException:
+            # the service can terminate before responding
+            pass
+        service.join()
+        reset_db(args.user, args.db_name, args.host, args.port, args.password)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the wire formats of the emews_service requests')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='eqsql_user')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--db_name', default='EQ_SQL')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--service_port', type=int, default=11218)
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--rounds', type=int, default=20, help='rounds of requests per client')
+    parser.add_argument('--batch', type=int, default=200, help='tasks submitted per round')
+    parser.add_argument('--payload_size', type=int, default=200, help='size of the padding in each payload')
+    run(parser.parse_args())
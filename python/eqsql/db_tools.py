@@ -2,24 +2,309 @@ import logging
 import os
 import subprocess
 import socket
+import threading
+import time
 from typing import Union
 from importlib import resources
-from typing import List
+from typing import Dict, List, Tuple
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+# The schema version created by workflow.sql, and the version that
+# migrate_eqsql_tables brings existing databases up to.
+SCHEMA_VERSION = 10
 
 
 def setup_log(log_name, log_level, procname=""):
     logger = logging.getLogger(log_name)
-    handlr = logging.StreamHandler()
-    formtr = logging.Formatter("%(asctime)s " + procname
-                               + " %(name)-9s %(message)s",
-                               datefmt="%Y-%m-%d %H:%M:%S")
-    handlr.setFormatter(formtr)
-    logger.addHandler(handlr)
+    # loggers are shared by name, so add the handler only once, otherwise each
+    # setup (e.g., each WorkflowSQL) adds another, and messages are repeated per handler
+    if not logger.handlers:
+        handlr = logging.StreamHandler()
+        formtr = logging.Formatter("%(asctime)s " + procname
+                                   + " %(name)-9s %(message)s",
+                                   datefmt="%Y-%m-%d %H:%M:%S")
+        handlr.setFormatter(formtr)
+        logger.addHandler(handlr)
     logger.setLevel(log_level)
     return logger
 
 
+# Default ConnectionPool settings
+# The number of connections a pool keeps open even when idle
+POOL_MIN_SIZE = 0
+# The maximum number of connections, idle or in use, a pool will open
+POOL_MAX_SIZE = 32
+# Idle connections (beyond the min size) are closed after this many seconds
+POOL_MAX_IDLE = 300.0
+# Connections that have been idle for more than this many seconds are
+# checked before being handed out
+POOL_CHECK_AFTER = 30.0
+# The number of seconds to wait for a connection when the pool is at its max size
+POOL_TIMEOUT = 30.0
+
+
+class ConnectionPool:
+
+    def __init__(self, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                 max_idle: float = POOL_MAX_IDLE, check_after: float = POOL_CHECK_AFTER,
+                 **conn_kwargs):
+        """A thread-safe pool of connections to a database.
+
+        Connections are opened as needed up to max_size. When at max_size, :py:meth:`getconn`
+        waits for a connection to be returned. Connections that have been idle for longer than
+        max_idle are closed, down to min_size, and those that have been idle for longer than
+        check_after are checked, and replaced if broken, before being handed out.
+
+        The pool is fork-safe: in a forked child the pool starts empty, and connections
+        inherited from the parent are never used or closed by the child, as that would
+        disrupt the parent's use of them.
+
+        Args:
+            min_size: the number of connections to keep open when idle.
+            max_size: the maximum number of open connections.
+            max_idle: the number of seconds after which idle connections are closed.
+            check_after: the number of seconds after which idle connections are checked before use.
+            conn_kwargs: the psycopg2.connect keyword arguments used to open connections.
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.conn_kwargs = conn_kwargs
+        self._closed = False
+        self._reset()
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.time()))
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        # (connection, time returned) with the most recently returned last
+        self._idle = []
+        self._used = set()
+        self._opening = 0
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # the child must not use, nor close (which would terminate the parent's
+        # session), the connections it inherits, so keep them referenced forever
+        _orphaned.extend(conn for conn, _ in self._idle)
+        _orphaned.extend(self._used)
+        self._reset()
+
+    def _connect(self):
+        try:
+            return psycopg2.connect(**self.conn_kwargs)
+        except psycopg2.OperationalError as e:
+            raise ConnectionException(e)
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('select 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _evict(self):
+        # assumes the lock is held
+        now = time.time()
+        keep = []
+        n_evictable = len(self._idle) + len(self._used) - self.min_size
+        # the least recently returned connections are first
+        for conn, returned in self._idle:
+            if n_evictable > 0 and now - returned > self.max_idle:
+                n_evictable -= 1
+                _close(conn)
+            else:
+                keep.append((conn, returned))
+        self._idle = keep
+
+    def getconn(self, timeout: float = POOL_TIMEOUT):
+        """Gets a connection from the pool, opening a new one if there are no idle connections,
+        and the pool is not at its max size.
+
+        Args:
+            timeout: the number of seconds to wait for a connection if the pool
+                is at its max size.
+
+        Returns:
+            A psycopg2 connection.
+
+        Raises:
+            ConnectionException: if a new connection cannot be opened, or none becomes
+                available within the timeout.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._after_fork()
+                self._evict()
+                conn = None
+                while self._idle and conn is None:
+                    conn, returned = self._idle.pop()
+                    if conn.closed:
+                        conn = None
+                if conn is None:
+                    if len(self._used) + self._opening < self.max_size:
+                        self._opening += 1
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise ConnectionException(
+                                PoolError(f'no connection available after {timeout} seconds'))
+                        self._cond.wait(remaining)
+                        continue
+                else:
+                    self._used.add(conn)
+
+            if conn is not None:
+                if time.time() - returned <= self.check_after or self._is_healthy(conn):
+                    return conn
+                self.putconn(conn, close=True)
+                continue
+
+            try:
+                conn = self._connect()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+                    if conn is None:
+                        self._cond.notify()
+                    else:
+                        self._used.add(conn)
+            return conn
+
+    def putconn(self, conn, close: bool = False):
+        """Returns the specified connection to the pool, rolling back any open
+        transaction. Connections that were not gotten from this pool in this process
+        are ignored.
+
+        Args:
+            conn: the connection to return.
+            close: if True, close the connection rather than keeping it for reuse.
+        """
+        with self._cond:
+            if self._pid != os.getpid() or conn not in self._used:
+                return
+        if not (close or conn.closed):
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = False
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed or self._closed:
+            _close(conn)
+        with self._cond:
+            self._used.discard(conn)
+            if not (close or conn.closed or self._closed):
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of connections in use, idle, and being opened by this pool in
+        this process, and the pool's max size.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                return {'in_use': 0, 'idle': 0, 'opening': 0, 'max_size': self.max_size}
+            return {'in_use': len(self._used), 'idle': len(self._idle), 'opening': self._opening,
+                    'max_size': self.max_size}
+
+    def closeall(self):
+        """Closes all the idle connections in this pool. In use connections are
+        closed when they are returned. New connections can still be gotten from the pool,
+        but are closed rather than kept when returned.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                self._after_fork()
+            for conn, _ in self._idle:
+                _close(conn)
+            self._idle = []
+            self._closed = True
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+_pools: Dict[Tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+# Connections inherited from a parent process
+_orphaned = []
+
+
+def _after_fork_in_child():
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    for pool in _pools.values():
+        pool._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_pool(host: str, user: str, dbname: str, port: int = None, password: str = None,
+             **pool_kwargs) -> ConnectionPool:
+    """Gets the process-wide :py:class:`ConnectionPool` for the specified database connection
+    parameters, creating it if necessary.
+
+    Args:
+        host: the database host
+        user: the database user
+        dbname: the database name
+        port: the database port
+        password: the database password
+        pool_kwargs: :py:class:`ConnectionPool` keyword arguments (e.g., max_size) used if the
+            pool is created.
+
+    Returns:
+        The ConnectionPool.
+    """
+    key = (host, port, user, dbname, password)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            conn_kwargs = {'dbname': dbname, 'host': host, 'user': user}
+            if port is not None:
+                conn_kwargs['port'] = port
+            if password is not None:
+                conn_kwargs['password'] = password
+            pool = ConnectionPool(**pool_kwargs, **conn_kwargs)
+            _pools[key] = pool
+        return pool
+
+
+def pool_stats() -> Dict[str, int]:
+    """Returns the :py:meth:`ConnectionPool.stats` summed over all the process-wide connection pools."""
+    totals = {'in_use': 0, 'idle': 0, 'opening': 0, 'max_size': 0}
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        for k, v in pool.stats().items():
+            totals[k] += v
+    return totals
+
+
+def close_pools():
+    """Closes the idle connections in all the process-wide connection pools, and removes
+    the pools.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
 class WorkflowSQL:
 
     def __init__(self, host="127.0.0.1", port=5432,
@@ -28,14 +313,26 @@ class WorkflowSQL:
                  dbname="EQ_SQL",
                  envs=False,
                  log_level=logging.WARN,
-                 procname=""):
+                 procname="",
+                 pooled=False):
         """
         Sets up a wrapper around the SQL connection and cursor objects
         Also caches dicts that convert between names and ids for the
         features and studies tables
         envs: If True, self-configure based on the environment
+        pooled: If True, borrow the connection from the process-wide
+        connection pool for these connection parameters (see get_pool),
+        and return it on close. A pooled connection counts against the
+        pool's max size (POOL_MAX_SIZE) until it is returned, so connect
+        waits, for up to POOL_TIMEOUT seconds, when that many pooled
+        WorkflowSQLs are connected. If False (the default), the
+        WorkflowSQL opens its own connection, with no limit.
         """
         self.conn = None
+        self.listen_conn = None
+        self.pooled = pooled
+        self.pool = None
+        self._pid = os.getpid()
         self.host = host
         self.port = port
         self.dbname = dbname
@@ -79,6 +376,16 @@ class WorkflowSQL:
         import psycopg2
         if self.conn is None:
             self.info(f"connect(): connecting to {self.host} {self.port} as {self.user}")
+            if self.pooled:
+                self.pool = get_pool(self.host, self.user, self.dbname, self.port, self.password)
+                try:
+                    self.conn = self.pool.getconn()
+                except ConnectionException:
+                    self.info("connect(): could not connect!")
+                    raise
+                self.info("connect(): connected.")
+                self.debug(f"connect(): {self.conn}")
+                return "OK"
             try:
                 if self.port is None:
                     if self.password is None:
@@ -114,9 +421,52 @@ class WorkflowSQL:
                 self.info("connect(): Already connected.")
         return "OK"
 
+    def connect_listener(self):
+        """Opens, if necessary, and returns a second autocommit connection to the database
+        for LISTENing for notifications. Notifications are only delivered between
+        transactions so they cannot be received on the main connection while a
+        task queue operation is in progress.
+
+        Returns:
+            The listener connection.
+        """
+        if self.listen_conn is None:
+            self.info(f"connect_listener(): connecting to {self.host} {self.port} as {self.user}")
+            kwargs = {'host': self.host, 'user': self.user}
+            if self.port is not None:
+                kwargs['port'] = self.port
+            if self.password is not None:
+                kwargs['password'] = self.password
+            try:
+                self.listen_conn = psycopg2.connect(f"dbname={self.dbname}", **kwargs)
+            except psycopg2.OperationalError as e:
+                self.info("connect_listener(): could not connect!")
+                raise ConnectionException(e)
+            self.listen_conn.autocommit = True
+        return self.listen_conn
+
+    def close_listener(self):
+        if self.listen_conn is not None and self._pid != os.getpid():
+            # inherited from the parent process, so closing would end the parent's session
+            _orphaned.append(self.listen_conn)
+            self.listen_conn = None
+        if self.listen_conn is not None:
+            try:
+                self.listen_conn.close()
+            except:  # noqa E722
+                pass
+            self.listen_conn = None
+
+    def _release(self):
+        if self.pool is not None:
+            self.pool.putconn(self.conn)
+        else:
+            self.conn.close()
+
     def close(self):
         self.autoclose = False
-        self.conn.close()
+        self.close_listener()
+        self._release()
         self.conn = None
 
     def debug(self, message):
@@ -134,13 +484,19 @@ class WorkflowSQL:
             print(message)
 
     def __del__(self):
+        if self._pid != os.getpid():
+            # inherited from the parent process, so keep the connections
+            # from being closed when garbage collected
+            _orphaned.extend(c for c in (self.conn, self.listen_conn) if c is not None)
+            return
         if not self.autoclose:
             return
         try:
             self.conn.commit()
-            self.conn.close()
+            self._release()
         except:  # noqa E722
             pass
+        self.close_listener()
         self.info("DB auto-closed.")
 
 
@@ -263,6 +619,95 @@ def _exec_sql(sql_file: Union[str, bytes, os.PathLike], db_user: str = 'eqsql_us
     conn.close()
 
 
+def _sql_resource(name: str) -> Union[str, bytes, os.PathLike]:
+    """Gets the path to the named SQL file that is packaged with eqsql.
+
+    Args:
+        name: the path of the file relative to the eqsql package directory
+    """
+    try:
+        return resources.files('eqsql').joinpath(name)
+    except AttributeError:
+        # py3.8 doesn't have resources.files
+        return os.path.join(os.path.dirname(__file__), name)
+
+
+def _migrations() -> List[Tuple[int, Union[str, bytes, os.PathLike]]]:
+    """Gets the packaged migration scripts as a list of (version, path) tuples
+    sorted by version. Migration scripts are named NNN_description.sql where
+    NNN is the schema version the script migrates to.
+    """
+    migrations_dir = _sql_resource('migrations')
+    migrations = []
+    for f in os.listdir(migrations_dir):
+        if f.endswith('.sql'):
+            migrations.append((int(f.split('_')[0]), os.path.join(migrations_dir, f)))
+    return sorted(migrations)
+
+
+def _schema_version(cur) -> int:
+    """Gets the schema version of the database, using the specified cursor. Databases
+    created before the schema was versioned are version 0.
+    """
+    cur.execute("select to_regclass('eq_schema_version')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute('select max(version) from eq_schema_version')
+    version = cur.fetchone()[0]
+    return 0 if version is None else version
+
+
+def _has_eqsql_tables(db_user: str, db_name: str, db_host: str, db_port: int, db_password: str = None) -> bool:
+    conn = psycopg2.connect(f'dbname={db_name}', user=db_user, host=db_host, port=db_port, password=db_password)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("select to_regclass('eq_tasks')")
+                return cur.fetchone()[0] is not None
+    finally:
+        conn.close()
+
+
+def migrate_eqsql_tables(db_user: str = 'eqsql_user', db_name: str = 'EQ_SQL', db_host: str = 'localhost',
+                         db_port: int = None, db_password: str = None) -> int:
+    """Migrates the EQSQL tables in an existing database to the current schema version
+    by applying, in order, each migration script whose version is greater than the
+    database's current schema version. Each migration is applied in its own transaction.
+    The database server must be running.
+
+    Args:
+        db_user: the database user name
+        db_name: the name of the database
+        db_host: the hostname where the database server is located
+        db_port: the port of the database server.
+        db_password: the database password (if there is one)
+
+    Returns:
+        The schema version of the database after migration.
+    """
+    conn = psycopg2.connect(f'dbname={db_name}', user=db_user, host=db_host, port=db_port, password=db_password)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                version = _schema_version(cur)
+
+        for migration_version, sql_file in _migrations():
+            if migration_version <= version:
+                continue
+            print(f'Applying schema migration {migration_version}')
+            with conn:
+                with conn.cursor() as cur:
+                    with open(sql_file, 'r') as sql:
+                        cur.execute(sql.read())
+                    cur.execute('delete from eq_schema_version')
+                    cur.execute('insert into eq_schema_version values (%s)', (migration_version,))
+            version = migration_version
+    finally:
+        conn.close()
+
+    return version
+
+
 def start_db(db_path: Union[str, bytes, os.PathLike], pg_bin_path: Union[str, bytes, os.PathLike] = '',
              db_port: int = None):
     """Starts the postgresql database cluster on the specified path
@@ -325,6 +770,11 @@ def reset_db(db_user: str = 'eqsql_user', db_name: str = 'EQ_SQL', db_host: str
         delete from emews_queue_OUT;
         delete from emews_queue_IN;
         delete from eq_task_tags;
+        delete from eq_exp_weights;
+        delete from eq_task_aging;
+        delete from eq_result_cache;
+        delete from eq_watches;
+        delete from eq_watch_tasks;
         alter sequence emews_id_generator restart;
     """
 
@@ -443,6 +893,9 @@ def create_eqsql_tables(db_path: str, db_user='eqsql_user', db_name='EQ_SQL', db
     """Create the EQSQL database tables, in the specified database.
 
     If the database server is not running it will be started prior to creating the tables etc.
+    If the database already contains the EQSQL tables and no create_db_sql_file is specified,
+    the existing tables are migrated to the current schema version via
+    :py:func:`migrate_eqsql_tables`.
 
     Args:
         db_path: the file path for the database cluster
@@ -460,11 +913,10 @@ def create_eqsql_tables(db_path: str, db_user='eqsql_user', db_name='EQ_SQL', db
 
     try:
         if create_db_sql_file is None:
-            try:
-                create_db_sql_file = resources.files('eqsql').joinpath('workflow.sql')
-            except AttributeError:
-                # py3.8 doesn't have resources.files
-                create_db_sql_file = os.path.join(os.path.dirname(__file__), 'workflow.sql')
+            if _has_eqsql_tables(db_user, db_name, 'localhost', db_port):
+                migrate_eqsql_tables(db_user, db_name, db_port=db_port)
+                return
+            create_db_sql_file = _sql_resource('workflow.sql')
         _exec_sql(create_db_sql_file, db_name=db_name, db_user=db_user, db_port=db_port)
 
     finally:
@@ -0,0 +1,36 @@
+/**
+    MIGRATION 001
+    Adds primary keys to the queue tables, an index matching the
+    out queue pop ordering, and indexes on eq_tasks.eq_status and
+    eq_exp_id_tasks.exp_id.
+*/
+
+create table if not exists eq_schema_version (
+       version integer
+);
+
+/* Remove any duplicate queue entries so that the primary keys can be added */
+delete from emews_queue_OUT a using emews_queue_OUT b
+where a.eq_task_id = b.eq_task_id and a.ctid > b.ctid;
+
+delete from emews_queue_IN a using emews_queue_IN b
+where a.eq_task_id = b.eq_task_id and a.ctid > b.ctid;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'emews_queue_out'::regclass AND contype = 'p') THEN
+        ALTER TABLE emews_queue_OUT ADD PRIMARY KEY (eq_task_id);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'emews_queue_in'::regclass AND contype = 'p') THEN
+        ALTER TABLE emews_queue_IN ADD PRIMARY KEY (eq_task_id);
+    END IF;
+END $$;
+
+create index if not exists emews_queue_out_pop_idx on emews_queue_OUT
+       (eq_task_type, eq_priority DESC, eq_task_id ASC);
+
+create index if not exists eq_tasks_status_idx on eq_tasks (eq_status);
+
+create index if not exists eq_exp_id_tasks_exp_id_idx on eq_exp_id_tasks (exp_id);
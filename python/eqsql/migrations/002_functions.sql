@@ -0,0 +1,96 @@
+/**
+    MIGRATION 002
+    Server-side functions that perform each of the task queue's hot operations
+    (submit, pop out, report, pop in) atomically in a single call.
+    Status values are those of eqsql.task_queues.core.TaskStatus and ResultStatus.
+*/
+
+/* Submits a task, returning its id */
+create or replace function eq_submit(p_exp_id text, p_eq_type integer, p_payload text,
+                                     p_priority integer, p_tag text, p_notify boolean)
+returns integer as $$
+declare
+    task_id integer;
+begin
+    task_id := nextval('emews_id_generator');
+    insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status)
+        values (task_id, p_eq_type, p_payload, localtimestamp, p_priority, 0);
+    insert into eq_exp_id_tasks (exp_id, eq_task_id) values (p_exp_id, task_id);
+    if p_tag is not null then
+        insert into eq_task_tags (eq_task_id, tag) values (task_id, p_tag);
+    end if;
+    insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority)
+        values (p_eq_type, task_id, p_priority);
+    if p_notify then
+        perform pg_notify('eq_out_' || p_eq_type, '');
+    end if;
+    return task_id;
+end;
+$$ language plpgsql;
+
+/* Pops up to p_n of the highest priority tasks of the specified type off of the
+   output queue, marks them as running on the specified worker pool, and returns
+   their ids and payloads */
+create or replace function eq_pop_out(p_eq_type integer, p_n integer, p_worker_pool text)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            select eq_task_id from emews_queue_OUT
+            where eq_task_type = p_eq_type
+            order by eq_priority desc, eq_task_id asc
+            for update skip locked
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* Reports the result of a task and pushes it onto the input queue. The push is
+   in its own subtransaction so that if it fails the result is not lost.
+   Returns 0 on success, and 1 if the push fails. */
+create or replace function eq_report(p_eq_task_id integer, p_eq_type integer, p_result text,
+                                     p_notify boolean)
+returns integer as $$
+begin
+    update eq_tasks set json_in = p_result, eq_status = 2, time_stop = localtimestamp
+        where eq_task_id = p_eq_task_id;
+    begin
+        insert into emews_queue_IN (eq_task_type, eq_task_id) values (p_eq_type, p_eq_task_id);
+        if p_notify then
+            perform pg_notify('eq_in_' || p_eq_task_id, '');
+        end if;
+    exception when others then
+        raise warning 'eq_report: push to input queue failed for task %: %', p_eq_task_id, SQLERRM;
+        return 1;
+    end;
+    return 0;
+end;
+$$ language plpgsql;
+
+/* Pops the specified task off of the input queue, returning its id and result,
+   or no rows if the task is not in the input queue */
+create or replace function eq_pop_in(p_eq_task_id integer)
+returns table (eq_task_id integer, json_in text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_IN
+        where eq_task_id = (
+            select eq_task_id from emews_queue_IN
+            where eq_task_id = p_eq_task_id
+            for update skip locked)
+        returning eq_task_id
+    )
+    select t.eq_task_id, t.json_in from eq_tasks t join popped on t.eq_task_id = popped.eq_task_id;
+end;
+$$ language plpgsql;
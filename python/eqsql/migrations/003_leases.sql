@@ -0,0 +1,75 @@
+/**
+    MIGRATION 003
+    Adds task leases. A popped task can be given a lease expiry that its
+    worker pool renews while it runs. Running tasks whose leases have
+    expired are pushed back onto the output queue by eq_requeue_expired.
+    Status values are those of eqsql.task_queues.core.TaskStatus.
+*/
+
+alter table eq_tasks add column if not exists lease_expiry timestamptz;
+
+create index if not exists eq_tasks_lease_idx on eq_tasks (lease_expiry) where eq_status = 1;
+
+/* eq_pop_out gains the lease duration parameter */
+drop function if exists eq_pop_out(integer, integer, text);
+
+/* Pops up to p_n of the highest priority tasks of the specified type off of the
+   output queue, marks them as running on the specified worker pool, and returns
+   their ids and payloads. If p_lease is not null, the tasks are leased
+   for p_lease seconds. */
+create or replace function eq_pop_out(p_eq_type integer, p_n integer, p_worker_pool text,
+                                      p_lease double precision default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            select eq_task_id from emews_queue_OUT
+            where eq_task_type = p_eq_type
+            order by eq_priority desc, eq_task_id asc
+            for update skip locked
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* Pushes the running tasks whose leases have expired back onto the output
+   queue with their stored priority, marking them as requeued, and returns
+   their ids and types. If p_eq_type is not null, only tasks of that type
+   are requeued. */
+create or replace function eq_requeue_expired(p_eq_type integer, p_notify boolean)
+returns table (eq_task_id integer, eq_task_type integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id, eq_task_type in
+        with expired as (
+            update eq_tasks t set eq_status = 4, worker_pool = null, lease_expiry = null
+            where t.eq_task_id = any(array(
+                select eq_task_id from eq_tasks
+                where eq_status = 1 and lease_expiry < now()
+                    and (p_eq_type is null or eq_task_type = p_eq_type)
+                for update skip locked))
+            returning t.eq_task_id, t.eq_task_type, t.eq_priority
+        )
+        insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority)
+        select expired.eq_task_type, expired.eq_task_id, expired.eq_priority from expired
+        on conflict do nothing
+        returning emews_queue_OUT.eq_task_id, emews_queue_OUT.eq_task_type
+    loop
+        if p_notify then
+            /* identical notifications are delivered once per transaction */
+            perform pg_notify('eq_out_' || eq_task_type, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
@@ -0,0 +1,41 @@
+/**
+    MIGRATION 004
+    Adds eq_pop_out_types, which pops the highest priority tasks of any of
+    several task types in a single call.
+*/
+
+/* Pops up to p_n of the highest priority tasks of any of the specified types off
+   of the output queue, marks them as running on the specified worker pool, and
+   returns their ids and payloads. Each type's weight, from the corresponding
+   element of p_weights, is added to the priority of the tasks of that type. The
+   highest priority tasks of each type are found with the emews_queue_out_pop_idx
+   index. If p_lease is not null, the tasks are leased for p_lease seconds. */
+create or replace function eq_pop_out_types(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                            p_worker_pool text, p_lease double precision default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            select q.eq_task_id
+            from unnest(p_eq_types, p_weights) as t(eq_type, weight)
+            cross join lateral (
+                select eq_task_id, eq_priority from emews_queue_OUT
+                where eq_task_type = t.eq_type
+                order by eq_priority desc, eq_task_id asc
+                for update skip locked
+                limit p_n) q
+            order by q.eq_priority + t.weight desc, q.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
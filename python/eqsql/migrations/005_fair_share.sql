@@ -0,0 +1,158 @@
+/**
+    MIGRATION 005
+    Adds weighted fair share scheduling across experiments. The output queue
+    records the experiment id of each queued task, so that a pop can select
+    the highest priority tasks of each experiment with an index scan, and
+    eq_exp_weights stores the per experiment weights.
+*/
+
+alter table emews_queue_OUT add column if not exists exp_id text;
+
+update emews_queue_OUT q set exp_id = e.exp_id
+from eq_exp_id_tasks e where e.eq_task_id = q.eq_task_id and q.exp_id is null;
+
+create index if not exists emews_queue_out_exp_pop_idx on emews_queue_OUT
+       (eq_task_type, exp_id, eq_priority DESC, eq_task_id ASC);
+
+create index if not exists eq_exp_id_tasks_task_id_idx on eq_exp_id_tasks (eq_task_id);
+
+create table if not exists eq_exp_weights (
+       exp_id text PRIMARY KEY,
+       /* the experiment's share relative to the other experiments, experiments
+          without a weight have a weight of 1 */
+       weight double precision not null check (weight > 0)
+);
+
+/* eq_submit records the experiment id of the queued task */
+create or replace function eq_submit(p_exp_id text, p_eq_type integer, p_payload text,
+                                     p_priority integer, p_tag text, p_notify boolean)
+returns integer as $$
+declare
+    task_id integer;
+begin
+    task_id := nextval('emews_id_generator');
+    insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status)
+        values (task_id, p_eq_type, p_payload, localtimestamp, p_priority, 0);
+    insert into eq_exp_id_tasks (exp_id, eq_task_id) values (p_exp_id, task_id);
+    if p_tag is not null then
+        insert into eq_task_tags (eq_task_id, tag) values (task_id, p_tag);
+    end if;
+    insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id)
+        values (p_eq_type, task_id, p_priority, p_exp_id);
+    if p_notify then
+        perform pg_notify('eq_out_' || p_eq_type, '');
+    end if;
+    return task_id;
+end;
+$$ language plpgsql;
+
+/* Pops up to p_n tasks of any of the specified types off of the output queue,
+   sharing the tasks between the experiments that have queued tasks in proportion
+   to their weights in eq_exp_weights, marks them as running on the specified
+   worker pool, and returns their ids and payloads. The next task goes to the
+   experiment with the fewest running tasks, of the specified types, relative to
+   its weight, and an experiment's tasks are popped in order of priority plus the
+   weight, from p_weights, of their type. Queued tasks with no experiment, e.g.,
+   EQ_STOP, are popped last. If p_lease is not null, the tasks are leased for
+   p_lease seconds. */
+create or replace function eq_pop_out_fair(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                           p_worker_pool text, p_lease double precision default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            with recursive types as (
+                select * from unnest(p_eq_types, p_weights) as t(eq_type, weight)
+            ),
+            /* the experiments with queued tasks of each type, found with
+               one index probe per experiment */
+            exps as (
+                select t.eq_type, f.exp_id from types t cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is not null
+                    order by exp_id limit 1) f
+                union all
+                select e.eq_type, f.exp_id from exps e cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id > e.exp_id
+                    order by exp_id limit 1) f
+            ),
+            candidates as (
+                select c.eq_task_id, c.eq_priority + t.weight as priority, e.exp_id
+                from exps e join types t on t.eq_type = e.eq_type
+                cross join lateral (
+                    select eq_task_id, eq_priority from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id = e.exp_id
+                    order by eq_priority desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+            ),
+            usage as (
+                select x.exp_id, count(*) as running
+                from eq_tasks s join eq_exp_id_tasks x on x.eq_task_id = s.eq_task_id
+                where s.eq_status = 1 and s.eq_task_type = any(p_eq_types)
+                group by x.exp_id
+            )
+            select ranked.eq_task_id from (
+                select c.eq_task_id, c.priority,
+                    (coalesce(u.running, 0) + row_number() over (partition by c.exp_id
+                                                                 order by c.priority desc, c.eq_task_id asc))
+                    / coalesce(w.weight, 1) as share
+                from candidates c
+                left join usage u on u.exp_id = c.exp_id
+                left join eq_exp_weights w on w.exp_id = c.exp_id
+                union all
+                select s.eq_task_id, s.eq_priority + t.weight, 'Infinity'
+                from types t cross join lateral (
+                    select eq_task_id, eq_priority from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is null
+                    order by eq_priority desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) s
+            ) ranked
+            order by ranked.share asc, ranked.priority desc, ranked.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* eq_requeue_expired records the experiment id of the requeued tasks */
+create or replace function eq_requeue_expired(p_eq_type integer, p_notify boolean)
+returns table (eq_task_id integer, eq_task_type integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id, eq_task_type in
+        with expired as (
+            update eq_tasks t set eq_status = 4, worker_pool = null, lease_expiry = null
+            where t.eq_task_id = any(array(
+                select eq_task_id from eq_tasks
+                where eq_status = 1 and lease_expiry < now()
+                    and (p_eq_type is null or eq_task_type = p_eq_type)
+                for update skip locked))
+            returning t.eq_task_id, t.eq_task_type, t.eq_priority
+        )
+        insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id)
+        select expired.eq_task_type, expired.eq_task_id, expired.eq_priority,
+            (select x.exp_id from eq_exp_id_tasks x where x.eq_task_id = expired.eq_task_id limit 1)
+        from expired
+        on conflict do nothing
+        returning emews_queue_OUT.eq_task_id, emews_queue_OUT.eq_task_type
+    loop
+        if p_notify then
+            /* identical notifications are delivered once per transaction */
+            perform pg_notify('eq_out_' || eq_task_type, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
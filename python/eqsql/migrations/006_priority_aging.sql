@@ -0,0 +1,219 @@
+/**
+    MIGRATION 006
+    Adds priority aging. The effective priority of a queued task of a type
+    with an aging rate in eq_task_aging grows by that rate per second spent in
+    the output queue. The output queue's aging_key is the task's priority
+    minus rate * the epoch time at which it was enqueued, so that
+    effective priority = aging_key + rate * now, and the tasks of a type are
+    popped in aging_key order using an index, without rewriting the queue.
+    Types without an aging rate have an aging_key equal to their priority.
+*/
+
+create table if not exists eq_task_aging (
+       eq_task_type integer PRIMARY KEY,
+       /* the increase in the effective priority of a queued task per second */
+       rate double precision not null check (rate >= 0)
+);
+
+alter table emews_queue_OUT add column if not exists time_enqueued timestamptz not null default now();
+alter table emews_queue_OUT add column if not exists aging_key double precision;
+update emews_queue_OUT q set aging_key = q.eq_priority -
+    coalesce((select rate from eq_task_aging a where a.eq_task_type = q.eq_task_type), 0) * extract(epoch from q.time_enqueued)
+where q.aging_key is null;
+alter table emews_queue_OUT alter column aging_key set not null;
+
+/* the pops order by aging_key rather than eq_priority */
+drop index if exists emews_queue_out_pop_idx;
+create index emews_queue_out_pop_idx on emews_queue_OUT
+       (eq_task_type, aging_key DESC, eq_task_id ASC);
+drop index if exists emews_queue_out_exp_pop_idx;
+create index emews_queue_out_exp_pop_idx on emews_queue_OUT
+       (eq_task_type, exp_id, aging_key DESC, eq_task_id ASC);
+
+/* The aging rate of the specified type times the current time in epoch seconds.
+   A task pushed onto the output queue now has an aging_key of its priority minus this. */
+create or replace function eq_aging_offset(p_eq_type integer) returns double precision as $$
+    select coalesce((select rate from eq_task_aging where eq_task_type = p_eq_type), 0) * extract(epoch from now());
+$$ language sql stable;
+
+/* The pushes onto the output queue set the aging_key, and the pops order by it */
+create or replace function eq_submit(p_exp_id text, p_eq_type integer, p_payload text,
+                                     p_priority integer, p_tag text, p_notify boolean)
+returns integer as $$
+declare
+    task_id integer;
+begin
+    task_id := nextval('emews_id_generator');
+    insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status)
+        values (task_id, p_eq_type, p_payload, localtimestamp, p_priority, 0);
+    insert into eq_exp_id_tasks (exp_id, eq_task_id) values (p_exp_id, task_id);
+    if p_tag is not null then
+        insert into eq_task_tags (eq_task_id, tag) values (task_id, p_tag);
+    end if;
+    insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key)
+        values (p_eq_type, task_id, p_priority, p_exp_id, p_priority - eq_aging_offset(p_eq_type));
+    if p_notify then
+        perform pg_notify('eq_out_' || p_eq_type, '');
+    end if;
+    return task_id;
+end;
+$$ language plpgsql;
+
+create or replace function eq_pop_out(p_eq_type integer, p_n integer, p_worker_pool text,
+                                      p_lease double precision default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            select eq_task_id from emews_queue_OUT
+            where eq_task_type = p_eq_type
+            order by aging_key desc, eq_task_id asc
+            for update skip locked
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+create or replace function eq_pop_out_types(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                            p_worker_pool text, p_lease double precision default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            select q.eq_task_id
+            from (select u.eq_type, u.weight + eq_aging_offset(u.eq_type) as boost
+                  from unnest(p_eq_types, p_weights) as u(eq_type, weight)) t
+            cross join lateral (
+                select eq_task_id, aging_key from emews_queue_OUT
+                where eq_task_type = t.eq_type
+                order by aging_key desc, eq_task_id asc
+                for update skip locked
+                limit p_n) q
+            order by q.aging_key + t.boost desc, q.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+create or replace function eq_pop_out_fair(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                           p_worker_pool text, p_lease double precision default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            with recursive types as (
+                select u.eq_type, u.weight + eq_aging_offset(u.eq_type) as boost
+                from unnest(p_eq_types, p_weights) as u(eq_type, weight)
+            ),
+            /* the experiments with queued tasks of each type, found with
+               one index probe per experiment */
+            exps as (
+                select t.eq_type, f.exp_id from types t cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is not null
+                    order by exp_id limit 1) f
+                union all
+                select e.eq_type, f.exp_id from exps e cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id > e.exp_id
+                    order by exp_id limit 1) f
+            ),
+            candidates as (
+                select c.eq_task_id, c.aging_key + t.boost as priority, e.exp_id
+                from exps e join types t on t.eq_type = e.eq_type
+                cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id = e.exp_id
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+            ),
+            usage as (
+                select x.exp_id, count(*) as running
+                from eq_tasks s join eq_exp_id_tasks x on x.eq_task_id = s.eq_task_id
+                where s.eq_status = 1 and s.eq_task_type = any(p_eq_types)
+                group by x.exp_id
+            )
+            select ranked.eq_task_id from (
+                select c.eq_task_id, c.priority,
+                    (coalesce(u.running, 0) + row_number() over (partition by c.exp_id
+                                                                 order by c.priority desc, c.eq_task_id asc))
+                    / coalesce(w.weight, 1) as share
+                from candidates c
+                left join usage u on u.exp_id = c.exp_id
+                left join eq_exp_weights w on w.exp_id = c.exp_id
+                union all
+                select s.eq_task_id, s.aging_key + t.boost, 'Infinity'
+                from types t cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) s
+            ) ranked
+            order by ranked.share asc, ranked.priority desc, ranked.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+create or replace function eq_requeue_expired(p_eq_type integer, p_notify boolean)
+returns table (eq_task_id integer, eq_task_type integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id, eq_task_type in
+        with expired as (
+            update eq_tasks t set eq_status = 4, worker_pool = null, lease_expiry = null
+            where t.eq_task_id = any(array(
+                select eq_task_id from eq_tasks
+                where eq_status = 1 and lease_expiry < now()
+                    and (p_eq_type is null or eq_task_type = p_eq_type)
+                for update skip locked))
+            returning t.eq_task_id, t.eq_task_type, t.eq_priority
+        )
+        insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key)
+        select expired.eq_task_type, expired.eq_task_id, expired.eq_priority,
+            (select x.exp_id from eq_exp_id_tasks x where x.eq_task_id = expired.eq_task_id limit 1),
+            expired.eq_priority - eq_aging_offset(expired.eq_task_type)
+        from expired
+        on conflict do nothing
+        returning emews_queue_OUT.eq_task_id, emews_queue_OUT.eq_task_type
+    loop
+        if p_notify then
+            /* identical notifications are delivered once per transaction */
+            perform pg_notify('eq_out_' || eq_task_type, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
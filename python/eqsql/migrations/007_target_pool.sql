@@ -0,0 +1,218 @@
+/**
+    MIGRATION 007
+    Adds targeted routing. A task can be submitted with a target, the id or
+    a label of the worker pool that should run it, and is then only popped by
+    a worker pool querying with that id or label. Untargeted tasks can be
+    popped by any worker pool. The untargeted and targeted tasks are in
+    separate partial indexes, so that a pop is an index scan of the
+    untargeted tasks and of the tasks of each of the caller's targets.
+*/
+
+alter table eq_tasks add column if not exists target_pool text;
+alter table emews_queue_OUT add column if not exists target_pool text;
+
+drop index if exists emews_queue_out_pop_idx;
+create index emews_queue_out_pop_idx on emews_queue_OUT
+       (eq_task_type, aging_key DESC, eq_task_id ASC) where target_pool is null;
+drop index if exists emews_queue_out_exp_pop_idx;
+create index emews_queue_out_exp_pop_idx on emews_queue_OUT
+       (eq_task_type, exp_id, aging_key DESC, eq_task_id ASC) where target_pool is null;
+create index if not exists emews_queue_out_target_idx on emews_queue_OUT
+       (target_pool, eq_task_type, aging_key DESC, eq_task_id ASC) where target_pool is not null;
+
+/* the functions gain a target or labels parameter, so the old signatures are
+   dropped rather than overloaded */
+drop function if exists eq_submit(text, integer, text, integer, text, boolean);
+drop function if exists eq_pop_out(integer, integer, text, double precision);
+drop function if exists eq_pop_out_types(integer[], double precision[], integer, text, double precision);
+drop function if exists eq_pop_out_fair(integer[], double precision[], integer, text, double precision);
+
+create or replace function eq_submit(p_exp_id text, p_eq_type integer, p_payload text,
+                                     p_priority integer, p_tag text, p_notify boolean,
+                                     p_target_pool text default null)
+returns integer as $$
+declare
+    task_id integer;
+begin
+    task_id := nextval('emews_id_generator');
+    insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status, target_pool)
+        values (task_id, p_eq_type, p_payload, localtimestamp, p_priority, 0, p_target_pool);
+    insert into eq_exp_id_tasks (exp_id, eq_task_id) values (p_exp_id, task_id);
+    if p_tag is not null then
+        insert into eq_task_tags (eq_task_id, tag) values (task_id, p_tag);
+    end if;
+    insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key, target_pool)
+        values (p_eq_type, task_id, p_priority, p_exp_id, p_priority - eq_aging_offset(p_eq_type), p_target_pool);
+    if p_notify then
+        perform pg_notify('eq_out_' || p_eq_type, '');
+    end if;
+    return task_id;
+end;
+$$ language plpgsql;
+
+create or replace function eq_pop_out_types(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                            p_worker_pool text, p_lease double precision default null,
+                                            p_labels text[] default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            with types as (
+                select u.eq_type, u.weight + eq_aging_offset(u.eq_type) as boost
+                from unnest(p_eq_types, p_weights) as u(eq_type, weight)
+            )
+            select q.eq_task_id from (
+                select c.eq_task_id, c.aging_key + t.boost as priority
+                from types t cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = t.eq_type and target_pool is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+                union all
+                select c.eq_task_id, c.aging_key + t.boost
+                from types t cross join unnest(array_append(p_labels, p_worker_pool)) as g(target)
+                cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where target_pool = g.target and eq_task_type = t.eq_type
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+            ) q
+            order by q.priority desc, q.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+create or replace function eq_pop_out(p_eq_type integer, p_n integer, p_worker_pool text,
+                                      p_lease double precision default null, p_labels text[] default null)
+returns table (eq_task_id integer, json_out text) as $$
+    select * from eq_pop_out_types(array[p_eq_type], array[0::double precision], p_n, p_worker_pool,
+                                   p_lease, p_labels);
+$$ language sql;
+
+create or replace function eq_pop_out_fair(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                           p_worker_pool text, p_lease double precision default null,
+                                           p_labels text[] default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            with recursive types as (
+                select u.eq_type, u.weight + eq_aging_offset(u.eq_type) as boost
+                from unnest(p_eq_types, p_weights) as u(eq_type, weight)
+            ),
+            /* the experiments with queued untargeted tasks of each type, found
+               with one index probe per experiment */
+            exps as (
+                select t.eq_type, f.exp_id from types t cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is not null and target_pool is null
+                    order by exp_id limit 1) f
+                union all
+                select e.eq_type, f.exp_id from exps e cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id > e.exp_id and target_pool is null
+                    order by exp_id limit 1) f
+            ),
+            candidates as (
+                select c.eq_task_id, c.aging_key + t.boost as priority, e.exp_id
+                from exps e join types t on t.eq_type = e.eq_type
+                cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id = e.exp_id and target_pool is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+                union all
+                select c.eq_task_id, c.aging_key + t.boost, null
+                from types t cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is null and target_pool is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+                union all
+                select c.eq_task_id, c.aging_key + t.boost, c.exp_id
+                from types t cross join unnest(array_append(p_labels, p_worker_pool)) as g(target)
+                cross join lateral (
+                    select eq_task_id, aging_key, exp_id from emews_queue_OUT
+                    where target_pool = g.target and eq_task_type = t.eq_type
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+            ),
+            usage as (
+                select x.exp_id, count(*) as running
+                from eq_tasks s join eq_exp_id_tasks x on x.eq_task_id = s.eq_task_id
+                where s.eq_status = 1 and s.eq_task_type = any(p_eq_types)
+                group by x.exp_id
+            )
+            select ranked.eq_task_id from (
+                select c.eq_task_id, c.priority,
+                    case when c.exp_id is null then 'Infinity'::double precision
+                    else (coalesce(u.running, 0) + row_number() over (partition by c.exp_id
+                                                                      order by c.priority desc, c.eq_task_id asc))
+                         / coalesce(w.weight, 1) end as share
+                from candidates c
+                left join usage u on u.exp_id = c.exp_id
+                left join eq_exp_weights w on w.exp_id = c.exp_id
+            ) ranked
+            order by ranked.share asc, ranked.priority desc, ranked.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* requeued tasks keep their target */
+create or replace function eq_requeue_expired(p_eq_type integer, p_notify boolean)
+returns table (eq_task_id integer, eq_task_type integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id, eq_task_type in
+        with expired as (
+            update eq_tasks t set eq_status = 4, worker_pool = null, lease_expiry = null
+            where t.eq_task_id = any(array(
+                select eq_task_id from eq_tasks
+                where eq_status = 1 and lease_expiry < now()
+                    and (p_eq_type is null or eq_task_type = p_eq_type)
+                for update skip locked))
+            returning t.eq_task_id, t.eq_task_type, t.eq_priority, t.target_pool
+        )
+        insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key, target_pool)
+        select expired.eq_task_type, expired.eq_task_id, expired.eq_priority,
+            (select x.exp_id from eq_exp_id_tasks x where x.eq_task_id = expired.eq_task_id limit 1),
+            expired.eq_priority - eq_aging_offset(expired.eq_task_type), expired.target_pool
+        from expired
+        on conflict do nothing
+        returning emews_queue_OUT.eq_task_id, emews_queue_OUT.eq_task_type
+    loop
+        if p_notify then
+            /* identical notifications are delivered once per transaction */
+            perform pg_notify('eq_out_' || eq_task_type, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
@@ -0,0 +1,41 @@
+/**
+    MIGRATION 008
+    Adds task result memoization. A task submitted with result caching
+    enabled records its cache key, a hash of its type and normalized payload,
+    and, when its result is reported, a trigger stores the result in
+    eq_result_cache under that key. A later submission with the same key is
+    completed with the cached result rather than queued.
+*/
+
+alter table eq_tasks add column if not exists cache_key text;
+
+create table if not exists eq_result_cache (
+       /* hash of the task type, the scope, and the normalized payload */
+       cache_key text PRIMARY KEY,
+       eq_task_type integer not null,
+       /* the experiment of the task whose result this is */
+       exp_id text,
+       json_in text not null,
+       time_cached timestamptz not null default now()
+);
+
+/* The oldest entries, for ttl and size eviction */
+create index if not exists eq_result_cache_time_idx on eq_result_cache (time_cached);
+
+/* Stores the reported result of a task that has a cache key in eq_result_cache,
+   replacing any existing result for the key */
+create or replace function eq_cache_result() returns trigger as $$
+begin
+    insert into eq_result_cache (cache_key, eq_task_type, exp_id, json_in)
+        values (new.cache_key, new.eq_task_type,
+                (select x.exp_id from eq_exp_id_tasks x where x.eq_task_id = new.eq_task_id limit 1), new.json_in)
+        on conflict (cache_key) do update
+        set json_in = excluded.json_in, exp_id = excluded.exp_id, time_cached = now();
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists eq_tasks_cache_result on eq_tasks;
+create trigger eq_tasks_cache_result after update of json_in on eq_tasks
+    for each row when (new.cache_key is not null and new.json_in is not null and new.eq_status = 2)
+    execute function eq_cache_result();
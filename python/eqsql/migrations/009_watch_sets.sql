@@ -0,0 +1,22 @@
+/**
+    MIGRATION 009
+    Adds watch sets. A watch set is a set of task ids, registered once, whose
+    completed tasks are then popped off of the input queue by watch id, so that
+    a remote client checking many tasks for completion does not resend the ids
+    with every check.
+*/
+
+create sequence if not exists eq_watch_id_generator start 1 no cycle;
+
+create table if not exists eq_watches (
+       watch_id integer PRIMARY KEY,
+       /* the time the watch set was created or last popped from, for the
+          eviction of abandoned watch sets */
+       time_polled timestamptz not null default now()
+);
+
+create table if not exists eq_watch_tasks (
+       watch_id integer,
+       eq_task_id integer,
+       PRIMARY KEY (watch_id, eq_task_id)
+);
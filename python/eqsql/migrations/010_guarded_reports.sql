@@ -0,0 +1,66 @@
+/**
+    MIGRATION 010
+    Guards task reports with the task's status: only the reports of running tasks,
+    optionally of tasks running on the reporting worker pool, and of requeued tasks that
+    have not been popped again, are accepted, so that the late report of a task whose
+    lease has expired neither completes a task that is running elsewhere, nor leaves a
+    completed task on the output queue. The result is stored and the task pushed onto the input queue in
+    a single transaction by eq_report_tasks, which eq_report now calls.
+    Status values are those of eqsql.task_queues.core.TaskStatus.
+*/
+
+/* eq_report gains the worker pool parameter */
+drop function if exists eq_report(integer, integer, text, boolean);
+
+/* Reports the results of the specified tasks and pushes the tasks onto the input
+   queue, in a single transaction, returning the ids of the tasks whose reports were
+   accepted. The reports of running tasks, and, if p_worker_pool is not null, of tasks
+   running on that worker pool, are accepted. So are the late reports of tasks whose
+   leases expired and that were requeued, but not yet popped again: these are deleted from
+   the output queue in the same transaction, so that they don't run twice. The reports
+   of other tasks, e.g., a requeued task that has been popped by another worker pool,
+   or a task that has already been reported or canceled, are rejected and their
+   results discarded, so that a late report neither completes a task that is running
+   elsewhere nor pushes a task onto the input queue twice. If the push fails,
+   no reports are accepted, and the tasks can be reported again. */
+create or replace function eq_report_tasks(p_eq_task_ids integer[], p_results text[], p_worker_pool text,
+                                           p_notify boolean)
+returns table (eq_task_id integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id in
+        with reclaimed as (
+            delete from emews_queue_OUT o using eq_tasks t
+            where o.eq_task_id = any(p_eq_task_ids) and t.eq_task_id = o.eq_task_id and t.eq_status = 4
+            returning o.eq_task_id
+        ), reported as (
+            update eq_tasks t set json_in = v.json_in, eq_status = 2, time_stop = localtimestamp,
+                lease_expiry = null
+            from unnest(p_eq_task_ids, p_results) as v (eq_task_id, json_in)
+            where t.eq_task_id = v.eq_task_id
+                and ((t.eq_status = 1 and (p_worker_pool is null or t.worker_pool = p_worker_pool))
+                     or t.eq_task_id in (select reclaimed.eq_task_id from reclaimed))
+            returning t.eq_task_id, t.eq_task_type
+        )
+        insert into emews_queue_IN (eq_task_type, eq_task_id)
+        select reported.eq_task_type, reported.eq_task_id from reported
+        returning emews_queue_IN.eq_task_id
+    loop
+        if p_notify then
+            perform pg_notify('eq_in_' || eq_task_id, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
+
+/* Reports the result of a task with eq_report_tasks. p_eq_type is unused, the task's
+   stored type is pushed onto the input queue. Returns 0 if the report is accepted,
+   and 1 if it is rejected. */
+create or replace function eq_report(p_eq_task_id integer, p_eq_type integer, p_result text,
+                                     p_notify boolean, p_worker_pool text default null)
+returns integer as $$
+    select case when exists (select 1 from eq_report_tasks(array[p_eq_task_id], array[p_result],
+                                                            p_worker_pool, p_notify))
+           then 0 else 1 end;
+$$ language sql;
@@ -0,0 +1,926 @@
+"""Asyncio task queue implementation. Like a local task queue, this
+communicates directly with the database, but through the psycopg (version 3)
+async driver, so that task queue calls do not block the event loop. Waits for
+tasks and results are driven by Postgres notifications when in notify mode.
+
+psycopg 3 is an optional dependency and must be installed to use this module,
+e.g., ``pip install "psycopg[binary]"``.
+"""
+import asyncio
+import logging
+import random
+import time
+import traceback
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import AsyncGenerator, Awaitable, Callable, Dict, Iterable, List, Set, Tuple, Union
+
+try:
+    import psycopg
+    from psycopg import sql
+except ImportError as e:
+    raise ImportError('AsyncLocalTaskQueue requires psycopg 3, e.g., pip install "psycopg[binary]"') from e
+
+from eqsql import db_tools
+from eqsql.task_queues.core import ResultStatus, TaskStatus, TimeoutError
+from eqsql.task_queues.core import EQ_ABORT, EQ_STOP, EQ_TIMEOUT
+from eqsql.task_queues.local_queue import MAX_NOTIFY_WAIT, _in_channel, _out_channel, _sql_pop_out, _type_weights
+
+_log_id = 1
+
+
+class AsyncFuture:
+
+    def __init__(self, task_queue: 'AsyncLocalTaskQueue', eq_task_id: int, tag: str = None):
+        """Represents the eventual result of an AsyncLocalTaskQueue task. AsyncFuture
+        instances are returned by the :py:class:`AsyncLocalTaskQueue.submit_task`, and
+        :py:class:`AsyncLocalTaskQueue.submit_tasks` methods. Awaiting an AsyncFuture
+        waits, without a timeout, for its result.
+
+        Args:
+            task_queue: the AsyncLocalTaskQueue instance that created this AsyncFuture.
+            eq_task_id: the task id
+            tag: an optional metadata tag
+        """
+        self.eq_task_id = eq_task_id
+        self.tag = tag
+        self.eq_sql = task_queue
+        self._result = None
+        self._task_status: Union[TaskStatus, None] = None
+        self._pool = None
+
+    def __await__(self):
+        return self.result(timeout=None).__await__()
+
+    async def result(self, delay: float = 0.5, timeout: float = 2.0) -> Tuple[ResultStatus, str]:
+        """Gets the result of this future task.
+
+        Args:
+            delay: the initial polling delay value, if the task queue is not in notify mode
+            timeout: the duration after which the query will timeout.
+                If timeout is None, there is no limit to the wait time.
+
+        Returns:
+            A tuple whose first element indicates the status of the query:
+            :py:class:`ResultStatus.SUCCESS` or :py:class:`ResultStatus.FAILURE`, and whose second element
+            is either the result of the task, or in the case of failure the reason
+            for the failure (``EQ_TIMEOUT``, or ``EQ_ABORT``)
+        """
+        # retry after an abort
+        if self._result is None or self._result[1] == EQ_ABORT:
+            status_result = await self.eq_sql.query_result(self.eq_task_id, delay, timeout=timeout)
+            if status_result[0] == ResultStatus.SUCCESS or status_result[1] == EQ_ABORT:
+                self._result = status_result
+
+            return status_result
+
+        return self._result
+
+    async def status(self) -> TaskStatus:
+        """Gets the current status of this AsyncFuture, one of :py:class:`TaskStatus.QUEUED`,
+        :py:class:`TaskStatus.RUNNING`, :py:class:`TaskStatus.COMPLETE`, or :py:class:`TaskStatus.CANCELED`.
+
+        Returns:
+            One of :py:class:`TaskStatus.QUEUED`, :py:class:`TaskStatus.RUNNING`, :py:class:`TaskStatus.COMPLETE`,
+            :py:class:`TaskStatus.CANCELED`, or ``None`` if the status query fails.
+        """
+        if self._task_status is None:
+            result = await self.eq_sql.get_status([self])
+            if result is None:
+                return result
+            ts = result[0][1]
+            if ts == TaskStatus.COMPLETE or ts == TaskStatus.CANCELED:
+                self._task_status = ts
+            return ts
+
+        return self._task_status
+
+    async def worker_pool(self) -> Union[str, None]:
+        """Gets the id of the worker pool, if any, that this AsyncFuture task is
+        running on, or ``None`` if the task hasn't been selected by a worker pool yet.
+        """
+        if self._pool is None:
+            _, self._pool = (await self.eq_sql.get_worker_pools([self]))[0]
+        return self._pool
+
+    async def cancel(self) -> bool:
+        """Cancels this AsyncFuture's task by removing it from the output queue.
+
+        Returns:
+            True if the task is canceled, otherwise False.
+        """
+        if await self.status() == TaskStatus.CANCELED:
+            return True
+
+        status, ids = await self.eq_sql.cancel_tasks([self])
+        return status == ResultStatus.SUCCESS and self.eq_task_id in ids
+
+    async def done(self) -> bool:
+        """Returns True if this AsyncFuture task has been completed or canceled, otherwise
+        False
+        """
+        status = await self.status()
+        return status == TaskStatus.CANCELED or status == TaskStatus.COMPLETE
+
+    async def priority(self) -> int:
+        """Gets the priority of this AsyncFuture task.
+        """
+        result = await self.eq_sql.get_priorities([self])
+        return result if result == ResultStatus.FAILURE else result[0][1]
+
+    async def set_priority(self, new_priority: int) -> ResultStatus:
+        """Updates the priority of this AsyncFuture task.
+
+        Returns:
+            ResultStatus.SUCCESS if the priority has been successfully updated, otherwise
+            ResultStatus.FAILURE.
+        """
+        status, _ = await self.eq_sql.update_priorities([self], new_priority)
+        return status
+
+
+class AsyncLocalTaskQueue:
+
+    def __init__(self, conn: 'psycopg.AsyncConnection', logger: logging.Logger,
+                 listen_conn: 'psycopg.AsyncConnection' = None, pool_labels: List[str] = None,
+                 fair_share: bool = False):
+        """Asyncio task queue that communicates directly with the database. This implements
+        the :py:class:`TaskQueue <eqsql.task_queues.core.TaskQueue>` protocol with async methods,
+        and the worker side query_task and report_task methods. Instances should be
+        created with :py:func:`init_task_queue`.
+
+        Operations are serialized on the single database connection, but waits for tasks
+        and results do not hold the connection, so many coroutines can concurrently wait
+        on the same queue.
+
+        Args:
+            conn: an autocommit connection to the database.
+            logger: the logger.
+            listen_conn: an autocommit connection to LISTEN on for notifications. If
+                this is not None, the task queue is in notify mode: pushes onto the
+                queues send notifications, and waits for tasks and results are woken by them.
+                Both the pushing and popping task queues should be in notify mode.
+            pool_labels: the labels, in addition to the querying worker pool's id, of the targeted
+                tasks queried for by this task queue.
+            fair_share: if True, tasks queried for by this task queue are shared between the experiments
+                with queued tasks in proportion to the experiments' weights. See
+                :py:class:`LocalTaskQueue <eqsql.task_queues.local_queue.LocalTaskQueue>`.
+        """
+        self.conn = conn
+        self.logger = logger
+        self.listen_conn = listen_conn
+        self.notify = listen_conn is not None
+        self.pool_labels = [] if pool_labels is None else list(pool_labels)
+        self.fair_share = fair_share
+        self._lock = asyncio.Lock()
+        # channel -> the events of the coroutines waiting on that channel
+        self._waiters: Dict[str, Set[asyncio.Event]] = {}
+        self._listen_lock = asyncio.Lock()
+        self._dispatcher = None
+        if self.notify:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def close(self):
+        """Closes the DB connections, and terminates this :py:class:`AsyncLocalTaskQueue` instance.
+        """
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        if self.listen_conn is not None:
+            await self.listen_conn.close()
+            self.listen_conn = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+        self._waiters.clear()
+
+    @asynccontextmanager
+    async def _transaction(self):
+        """Async context manager for a cursor whose statements are executed in a single
+        transaction, with exclusive use of the connection.
+        """
+        async with self._lock:
+            async with self.conn.transaction():
+                async with self.conn.cursor() as cur:
+                    yield cur
+
+    async def _dispatch(self):
+        """Sets the events of the coroutines waiting on a channel when a notification
+        arrives on that channel."""
+        try:
+            async for notify in self.listen_conn.notifies():
+                for event in self._waiters.get(notify.channel, ()):
+                    event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.error(f'notification dispatch error {traceback.format_exc()}')
+
+    async def _update_listens(self, listens: List[str], unlistens: List[str]):
+        # notifies() holds the listener connection, so pause the dispatcher while
+        # changing the LISTENs. Notifications received in the meantime are delivered
+        # when it restarts.
+        async with self._listen_lock:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            try:
+                stmts = [f'LISTEN {sql.Identifier(c).as_string(self.listen_conn)}' for c in listens]
+                stmts += [f'UNLISTEN {sql.Identifier(c).as_string(self.listen_conn)}' for c in unlistens]
+                if len(stmts) > 0:
+                    await self.listen_conn.execute('; '.join(stmts))
+            finally:
+                self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _listen(self, channels: Iterable[str]) -> Union[asyncio.Event, None]:
+        """Starts listening on the specified channels, returning an event that is set when a
+        notification arrives on any of them, or None if this is not in notify mode.
+        """
+        if not self.notify:
+            return None
+        event = asyncio.Event()
+        new_channels = []
+        for channel in channels:
+            waiters = self._waiters.setdefault(channel, set())
+            if len(waiters) == 0:
+                new_channels.append(channel)
+            waiters.add(event)
+        try:
+            await self._update_listens(new_channels, [])
+        except Exception:
+            self.logger.error(f'listen error {traceback.format_exc()}')
+            await self._unlisten(channels, event)
+            return None
+        return event
+
+    async def _unlisten(self, channels: Iterable[str], event: asyncio.Event):
+        if event is None:
+            return
+        unused = []
+        for channel in channels:
+            waiters = self._waiters.get(channel)
+            if waiters is not None:
+                waiters.discard(event)
+                if len(waiters) == 0:
+                    del self._waiters[channel]
+                    unused.append(channel)
+        if len(unused) > 0 and self.listen_conn is not None:
+            try:
+                await self._update_listens([], unused)
+            except Exception:
+                self.logger.error(f'unlisten error {traceback.format_exc()}')
+
+    async def _wait(self, event: Union[asyncio.Event, None], delay: float, timeout: float, start: float):
+        """Waits for the event to be set, or, if event is None, for delay seconds."""
+        if event is None:
+            await asyncio.sleep(delay)
+            return
+        wait = MAX_NOTIFY_WAIT
+        if timeout is not None:
+            wait = min(wait, max(0, timeout - (time.time() - start)) + 0.01)
+        try:
+            await asyncio.wait_for(event.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _queue_pop(self, pop: Callable[[], Awaitable[List]], channels: List[str], delay: float,
+                         timeout: float) -> Tuple[ResultStatus, Union[List, str]]:
+        """Repeatedly performs the pop until it returns a non-empty list or the timeout
+        has passed. Between pops this waits for a notification on the specified channels if
+        in notify mode, otherwise it sleeps for a delay that increases after each pop.
+
+        Returns: A two element tuple where the first elements is one of
+            ResultStatus.SUCCESS or ResultStatus.FAILURE. On success the
+            second element will be the list returned by the pop. On failure, the second
+            element will be EQ_TIMEOUT.
+        """
+        start = time.time()
+        # listen before the first pop so a push between the pop and the
+        # wait is not missed
+        event = await self._listen(channels)
+        try:
+            while True:
+                if event is not None:
+                    event.clear()
+                results = await pop()
+                if len(results) > 0:
+                    return (ResultStatus.SUCCESS, results)
+                if timeout is not None and time.time() - start > timeout:
+                    return (ResultStatus.FAILURE, EQ_TIMEOUT)
+                await self._wait(event, delay, timeout, start)
+                if delay < 30:
+                    delay += 0.25
+        finally:
+            await self._unlisten(channels, event)
+
+    async def _notify(self, cur, channels: List[str]):
+        if self.notify and len(channels) > 0:
+            await cur.execute("select pg_notify(c, '') from unnest(%s::text[]) as c", (channels,))
+
+    async def _insert_tasks(self, cur, exp_id: str, eq_type: int, payloads: List[str], priority: int,
+                            tag: str = None, target_pool: str = None) -> List[int]:
+        """Inserts the specified payloads into the database as tasks, pushing them onto the output
+        queue, and returning their ids in payload order."""
+        await cur.execute("select nextval('emews_id_generator') from generate_series(1, %s)", (len(payloads),))
+        eq_task_ids = sorted(rs[0] for rs in await cur.fetchall())
+        ts = datetime.now(timezone.utc).astimezone().isoformat()
+        await cur.execute("""
+            with inserted as (
+                insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status,
+                                      target_pool)
+                select id, %(eq_type)s, payload, %(ts)s, %(priority)s, %(status)s, %(target_pool)s
+                from unnest(%(ids)s::integer[], %(payloads)s::text[]) as p (id, payload)
+                returning eq_task_id
+            ),
+            exp_ids as (insert into eq_exp_id_tasks (exp_id, eq_task_id)
+                        select %(exp_id)s, eq_task_id from inserted),
+            tags as (insert into eq_task_tags (eq_task_id, tag)
+                     select eq_task_id, %(tag)s from inserted where %(tag)s::text is not null)
+            insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key, target_pool)
+            select %(eq_type)s, eq_task_id, %(priority)s, %(exp_id)s, %(priority)s - aging_offset, %(target_pool)s
+            from inserted, (select eq_aging_offset(%(eq_type)s)) as a (aging_offset)
+            """, {'eq_type': eq_type, 'ts': ts, 'priority': priority, 'status': TaskStatus.QUEUED.value,
+                  'ids': eq_task_ids, 'payloads': payloads, 'exp_id': exp_id, 'tag': tag,
+                  'target_pool': target_pool})
+        await self._notify(cur, [_out_channel(eq_type)])
+        return eq_task_ids
+
+    async def submit_task(self, exp_id: str, eq_type: int, payload: str, priority: int = 0,
+                          tag: str = None, target_pool: str = None) -> Tuple[ResultStatus, Union[AsyncFuture, None]]:
+        """Submits work of the specified type and priority with the specified
+        payload, returning the status and the :py:class:`AsyncFuture` encapsulating the submission.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: the work payload
+            priority: the priority of this work
+            tag: an optional metadata tag for the task
+            target_pool: the optional id or label of the worker pool to run the task. See
+                :py:func:`LocalTaskQueue.submit_task <eqsql.task_queues.local_queue.LocalTaskQueue.submit_task>`.
+
+        Returns:
+            A tuple containing the status (:py:class:`ResultStatus.FAILURE` or :py:class:`ResultStatus.SUCCESS`)
+            of the submission and if successful, an :py:class:`AsyncFuture` representing the submitted task
+            otherwise None.
+        """
+        status, fts = await self.submit_tasks(exp_id, eq_type, [payload], priority, tag, target_pool)
+        return (status, fts[0] if status == ResultStatus.SUCCESS else None)
+
+    async def submit_tasks(self, exp_id: str, eq_type: int, payload: List[str], priority: int = 0,
+                           tag: str = None, target_pool: str = None) -> Tuple[ResultStatus, List[AsyncFuture]]:
+        """Submits work of the specified type and priority with the specified
+        payloads in a single transaction, returning the status and the :py:class:`futures <AsyncFuture>`
+        encapsulating the submission.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: a list of the work payloads
+            priority: the priority of this work
+            tag: an optional metadata tag for the tasks
+            target_pool: the optional id or label of the worker pool to run the tasks.
+
+        Returns:
+            A tuple containing the status (:py:class:`ResultStatus.FAILURE` or :py:class:`ResultStatus.SUCCESS`)
+            of the submission and the list of :py:class:`futures <AsyncFuture>` for the submitted tasks.
+            The list is empty if the submission fails.
+        """
+        if len(payload) == 0:
+            return (ResultStatus.SUCCESS, [])
+        try:
+            async with self._transaction() as cur:
+                eq_task_ids = await self._insert_tasks(cur, exp_id, eq_type, payload, priority, tag, target_pool)
+        except Exception:
+            self.logger.error(f'submit_tasks error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+        return (ResultStatus.SUCCESS, [AsyncFuture(self, eq_task_id, tag) for eq_task_id in eq_task_ids])
+
+    async def stop_worker_pool(self, eq_type: int) -> ResultStatus:
+        """Stops any workers pools associated with the specified work type by
+        pushing ``EQ_STOP`` into the queue.
+
+        Args:
+            eq_type: the work type for the pools to stop
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the stop message was successfully pushed, otherwise
+            :py:class:`ResultStatus.FAILURE`.
+        """
+        try:
+            async with self._transaction() as cur:
+                await cur.execute("""
+                    with inserted as (
+                        insert into eq_tasks (eq_task_id, eq_task_type, json_out)
+                        values (nextval('emews_id_generator'), %s, %s) returning eq_task_id
+                    )
+                    insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, aging_key)
+                    select %s, eq_task_id, -1, -1 - eq_aging_offset(%s) from inserted
+                    """, (eq_type, EQ_STOP, eq_type, eq_type))
+                await self._notify(cur, [_out_channel(eq_type)])
+            return ResultStatus.SUCCESS
+        except Exception:
+            self.logger.error(f'stop_worker_pool error {traceback.format_exc()}')
+            return ResultStatus.FAILURE
+
+    async def _pop_out(self, eq_type: Union[int, List[int]], n: int, worker_pool: str,
+                       weights: Dict[int, float] = None) -> List[Tuple[int, str]]:
+        sql_pop, params = _sql_pop_out(eq_type, n, weights, worker_pool, pool_labels=self.pool_labels,
+                                       fair_share=self.fair_share)
+        async with self._transaction() as cur:
+            await cur.execute(sql_pop, params)
+            return await cur.fetchall()
+
+    async def query_task(self, eq_type: Union[int, List[int]], n: int = 1, worker_pool: str = 'default',
+                         delay: float = 0.5, timeout: float = 2.0,
+                         weights: Dict[int, float] = None) -> Union[List[Dict], Dict]:
+        """Queries for the highest priority task of the specified type or types. The tasks are popped
+        by the same server-side functions, and so in the same order, as
+        :py:func:`LocalTaskQueue.query_task <eqsql.task_queues.local_queue.LocalTaskQueue.query_task>`,
+        which also describes the format of the returned messages.
+
+        Args:
+            eq_type: the type of the task to query for, or a list of types.
+            n: the maximum number of tasks to return.
+            worker_pool: the id of the worker pool querying for the tasks. Only untargeted tasks, and
+                tasks targeted at this id or one of this task queue's pool labels, are returned.
+            delay: the initial polling delay value, if not in notify mode.
+            timeout: the duration after which the query will timeout. If timeout is None, there is no limit to
+                the wait time.
+            weights: an optional dictionary of task type to the weight added to the priority of the tasks of
+                that type, when querying for several types.
+
+        Returns:
+            A dictionary, or if n > 1 a list of dictionaries, describing the tasks or a status message.
+        """
+        # invalid types or weights raise a ValueError rather than aborting the query
+        eq_types, _ = _type_weights(eq_type, weights)
+        try:
+            status, result = await self._queue_pop(lambda: self._pop_out(eq_type, n, worker_pool, weights),
+                                                   [_out_channel(t) for t in eq_types], delay, timeout)
+        except Exception:
+            self.logger.error(f'query_task error {traceback.format_exc()}')
+            return {'type': 'status', 'payload': EQ_ABORT}
+
+        if status != ResultStatus.SUCCESS:
+            return {'type': 'status', 'payload': result}
+
+        results = []
+        for task_id, payload in result:
+            if payload == EQ_STOP:
+                results.append({'type': 'status', 'payload': EQ_STOP})
+            else:
+                results.append({'type': 'work', 'eq_task_id': task_id, 'payload': payload})
+        return results[0] if n == 1 else results
+
+    async def report_task(self, eq_task_id: int, eq_type: int, result: str, worker_pool: str = None) -> ResultStatus:
+        """Reports the result of the specified task of the specified type. The report is only
+        accepted if the task is running, on the specified worker pool if one is specified.
+
+        Args:
+            eq_task_id: the id of the task whose results are being reported.
+            eq_type: the type of the task whose results are being reported.
+            result: the result of the task.
+            worker_pool: if not None, the id of the worker pool reporting the task.
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the task was successfully reported, otherwise
+            :py:class:`ResultStatus.FAILURE`, including when the report is rejected.
+        """
+        status, rejected = await self.report_tasks([(eq_task_id, eq_type, result)], worker_pool)
+        return ResultStatus.FAILURE if len(rejected) > 0 else status
+
+    async def report_tasks(self, results: Iterable[Tuple[int, int, str]],
+                           worker_pool: str = None) -> Tuple[ResultStatus, List[int]]:
+        """Reports the results of the specified tasks. As with
+        :py:func:`LocalTaskQueue.report_tasks <eqsql.task_queues.local_queue.LocalTaskQueue.report_tasks>`
+        the results are stored and the tasks pushed onto the input queue by the eq_report_tasks
+        server-side function, which rejects the reports of tasks that are no longer running.
+
+        Args:
+            results: the results to report as (eq_task_id, eq_type, result) tuples.
+            worker_pool: if not None, the id of the worker pool reporting the tasks.
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` of the report, and the ids of the tasks
+            whose reports were rejected.
+        """
+        results = list(results)
+        if len(results) == 0:
+            return (ResultStatus.SUCCESS, [])
+        ids = [eq_task_id for eq_task_id, _, _ in results]
+        try:
+            async with self._transaction() as cur:
+                await cur.execute('select eq_task_id from eq_report_tasks(%s::integer[], %s::text[], %s, %s)',
+                                  (ids, [result for _, _, result in results], worker_pool, self.notify))
+                accepted = set(row[0] for row in await cur.fetchall())
+        except Exception:
+            self.logger.error(f'report_tasks error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+        rejected = [eq_task_id for eq_task_id in ids if eq_task_id not in accepted]
+        if len(rejected) > 0:
+            self.logger.warning(f'report_tasks: rejected the reports of {len(rejected)} tasks that are no longer '
+                                f'running{"" if worker_pool is None else " on " + worker_pool}: {rejected}')
+        return (ResultStatus.SUCCESS, rejected)
+
+    async def _pop_results(self, eq_task_ids: List[int], limit: int = None) -> List[Tuple[int, str]]:
+        """Pops any of the specified tasks that are in the input queue off of the queue,
+        returning their results. This is a single query regardless of the number of tasks.
+        """
+        async with self._transaction() as cur:
+            await cur.execute("""
+                with popped as (
+                    delete from emews_queue_IN
+                    where eq_task_id = any(array(
+                        select eq_task_id from emews_queue_IN
+                        where eq_task_id = any(%s)
+                        order by eq_task_id
+                        for update skip locked
+                        limit %s))
+                    returning eq_task_id
+                )
+                select t.eq_task_id, t.json_in from popped
+                join eq_tasks t on t.eq_task_id = popped.eq_task_id
+                """, (list(eq_task_ids), limit))
+            return await cur.fetchall()
+
+    async def query_result(self, eq_task_id: int, delay: float = 0.5, timeout: float = 2.0) -> Tuple[ResultStatus, str]:
+        """Queries for the result of the specified task.
+
+        Args:
+            eq_task_id: the id of the task to query
+            delay: the initial polling delay value, if not in notify mode
+            timeout: the duration after which the query will timeout. If timeout is None, there is no limit to
+                the wait time.
+
+        Returns:
+            A tuple whose first element indicates the status of the query:
+            ``ResultStatus.SUCCESS`` or ``ResultStatus.FAILURE``, and whose second element
+            is either the result of the task, or in the case of failure the reason
+            for the failure (``EQ_TIMEOUT``, or ``EQ_ABORT``)
+        """
+        try:
+            status, result = await self._queue_pop(lambda: self._pop_results([eq_task_id]),
+                                                   [_in_channel(eq_task_id)], delay, timeout)
+        except Exception:
+            self.logger.error(f'query_result error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, EQ_ABORT)
+
+        if status != ResultStatus.SUCCESS:
+            return (status, result)
+        return (ResultStatus.SUCCESS, result[0][1])
+
+    async def as_completed(self, futures: List[AsyncFuture], pop: bool = False, timeout: float = None,
+                           n: int = None, batch_size: int = 1, sleep: float = 0.5) -> AsyncGenerator[AsyncFuture, None]:
+        """Returns an async generator over the :py:class:`AsyncFutures <AsyncFuture>` in the ``futures``
+        argument that yields them as they complete. The futures are checked for completion by
+        querying for the results of all the ones that have not yet completed with a single query.
+        Between queries, this waits for a notification that one of the futures has completed
+        if in notify mode, otherwise it sleeps. A :py:class:`TimeoutError` will be raised if
+        the futures do not complete within the specified ``timeout`` duration.
+
+        Args:
+            futures: the List of :py:class:`AsyncFutures <AsyncFuture>` to iterate over and return as
+                they complete.
+            pop: if true, completed futures will be popped off of the futures argument List.
+            timeout: if the time taken for futures to completed is greater than this value, then
+                raise :py:class:`TimeoutError`.
+            n: yield this many completed futures and then stop iteration.
+            batch_size: retrieve this many completed futures, before yielding.
+            sleep: the time, in seconds, to sleep between each query if not in notify mode.
+
+        Yields:
+            :py:class:`AsyncFutures <AsyncFuture>` in the ``futures`` argument as they complete.
+
+        Examples:
+            >>> async for ft in task_queue.as_completed(futures, timeout=5):
+                    status, result = await ft.result()
+        """
+        start_time = time.time()
+        completed_tasks = set()
+        wk_futures = [f for f in futures]
+        n_futures = len(wk_futures)
+        batch = []
+        channels = [_in_channel(f.eq_task_id) for f in wk_futures if f._result is None or f._result[0] != ResultStatus.SUCCESS]
+        event = await self._listen(channels)
+
+        try:
+            while True:
+                if event is not None:
+                    event.clear()
+                pending = [f for f in wk_futures if f.eq_task_id not in completed_tasks]
+                # futures with a result already complete, the rest are checked
+                # for a result with a single query
+                to_query = [f.eq_task_id for f in pending if f._result is None or f._result[0] != ResultStatus.SUCCESS]
+                limit = None
+                if n is not None:
+                    limit = n - len(completed_tasks) - (len(pending) - len(to_query))
+                results = {}
+                aborted = False
+                if len(to_query) > 0 and (limit is None or limit > 0):
+                    try:
+                        results = dict(await self._pop_results(to_query, limit))
+                    except Exception:
+                        self.logger.error(f'as_completed error {traceback.format_exc()}')
+                        aborted = True
+
+                for f in pending:
+                    if f.eq_task_id in results:
+                        f._result = (ResultStatus.SUCCESS, results[f.eq_task_id])
+                    elif aborted and (f._result is None or f._result[0] != ResultStatus.SUCCESS):
+                        f._result = (ResultStatus.FAILURE, EQ_ABORT)
+                    elif f._result is None or f._result[0] != ResultStatus.SUCCESS:
+                        continue
+
+                    completed_tasks.add(f.eq_task_id)
+                    batch.append(f)
+                    n_completed = len(completed_tasks)
+                    done = n_completed == n_futures or n_completed == n
+                    if len(batch) == batch_size or done:
+                        for ft in batch:
+                            if pop:
+                                futures.remove(ft)
+                            yield ft
+                        batch.clear()
+
+                    if done:
+                        return
+
+                if timeout is not None and time.time() - start_time > timeout:
+                    raise TimeoutError(f'as_completed timed out after {timeout} seconds')
+
+                await self._wait(event, sleep, timeout, start_time)
+        finally:
+            await self._unlisten(channels, event)
+
+    async def pop_completed(self, futures: List[AsyncFuture], timeout=None, sleep: float = 0.5) -> AsyncFuture:
+        """Pops and returns the first completed future from the specified List
+        of futures.
+
+        Args:
+            futures: the List of :py:class:`AsyncFutures <AsyncFuture>` to check for a completed one.
+                The completed future will be popped from this list.
+            timeout: a :py:class:`TimeoutError` will be raised if a completed future cannot be returned
+                by after this amount time.
+            sleep: the time, in seconds, to sleep between each query if not in notify mode.
+
+        Returns:
+            The first completed :py:class:`AsyncFuture` from the specified List.
+        """
+        agen = self.as_completed(futures, pop=True, timeout=timeout, n=1, sleep=sleep)
+        try:
+            return await agen.__anext__()
+        finally:
+            await agen.aclose()
+
+    async def _select(self, query: str, params) -> Union[List[Tuple], None]:
+        try:
+            async with self._transaction() as cur:
+                await cur.execute(query, params)
+                return await cur.fetchall()
+        except Exception:
+            self.logger.error(f'select error: {traceback.format_exc()}')
+            return None
+
+    async def get_status(self, futures: Iterable[AsyncFuture]) -> List[Tuple[AsyncFuture, TaskStatus]]:
+        """Gets the status (queued, running, etc.) of the specified tasks
+
+        Args:
+            futures: the futures of the tasks to get the status of.
+
+        Returns:
+            A List of Tuples containing the future and the status of that task as a :py:class:`TaskStatus`,
+            or None if the query fails.
+        """
+        id_map = {ft.eq_task_id: ft for ft in futures}
+        rows = await self._select('select eq_task_id, eq_status from eq_tasks where eq_task_id = any(%s)',
+                                  (list(id_map.keys()),))
+        if rows is None:
+            return None
+        return [(id_map[eq_task_id], TaskStatus(status)) for eq_task_id, status in rows]
+
+    async def get_results(self, futures: Iterable[AsyncFuture], consume: bool = True) -> List[Tuple[AsyncFuture, str]]:
+        """Gets the results of those of the specified tasks whose results are available, with a
+        single query, without waiting for the results. See
+        :py:func:`LocalTaskQueue.get_results <eqsql.task_queues.local_queue.LocalTaskQueue.get_results>`.
+
+        Args:
+            futures: the futures of the tasks to get the results of.
+            consume: if True, the results are popped off of the input queue and cached in their
+                futures, otherwise they are left in the input queue.
+
+        Returns:
+            A List of (AsyncFuture, result) tuples, in the order of the specified futures, for the futures
+            whose results are available, or None if the query fails.
+        """
+        futures = list(futures)
+        to_query = [ft.eq_task_id for ft in futures if ft._result is None or ft._result[0] != ResultStatus.SUCCESS]
+        results = {}
+        if len(to_query) > 0:
+            if consume:
+                try:
+                    rows = await self._pop_results(to_query)
+                except Exception:
+                    self.logger.error(f'get_results error: {traceback.format_exc()}')
+                    return None
+            else:
+                rows = await self._select("""select t.eq_task_id, t.json_in from emews_queue_IN q
+                                             join eq_tasks t on t.eq_task_id = q.eq_task_id
+                                             where q.eq_task_id = any(%s)""", (to_query,))
+                if rows is None:
+                    return None
+            results = dict(rows)
+
+        found = []
+        for ft in futures:
+            if ft.eq_task_id in results:
+                if consume:
+                    ft._result = (ResultStatus.SUCCESS, results[ft.eq_task_id])
+                found.append((ft, results[ft.eq_task_id]))
+            elif ft._result is not None and ft._result[0] == ResultStatus.SUCCESS:
+                found.append((ft, ft._result[1]))
+        return found
+
+    async def get_priorities(self, futures: Iterable[AsyncFuture]) -> List[Tuple[AsyncFuture, int]]:
+        """Gets the priorities of the specified tasks.
+
+        Args:
+            futures: the futures of the tasks whose priorities are returned.
+
+        Returns:
+            A List of tuples containing the future and priorty for each task, or ResultStatus.FAILURE
+            if the query has failed.
+        """
+        id_map = {ft.eq_task_id: ft for ft in futures}
+        rows = await self._select('select eq_task_id, eq_priority from eq_tasks where eq_task_id = any(%s)',
+                                  (list(id_map.keys()),))
+        if rows is None:
+            return ResultStatus.FAILURE
+        return [(id_map[eq_task_id], priority) for eq_task_id, priority in rows]
+
+    async def get_worker_pools(self, futures: List[AsyncFuture]) -> List[Tuple[AsyncFuture, Union[str, None]]]:
+        """Gets the worker pools on which the specified list of futures are running, if any.
+
+        Returns:
+            A list of two element tuples. The first element is an :py:class:`AsyncFuture`, and the
+            second is that future's worker pool, or None, if the future hasn't been
+            selected for execution yet. None is returned if the query fails.
+        """
+        id_map = {ft.eq_task_id: ft for ft in futures}
+        rows = await self._select('select eq_task_id, worker_pool from eq_tasks where eq_task_id = any(%s)',
+                                  (list(id_map.keys()),))
+        if rows is None:
+            return None
+        return [(id_map[eq_task_id], pool) for eq_task_id, pool in rows]
+
+    async def update_priorities(self, futures: List[AsyncFuture],
+                                new_priority: Union[int, List[int]]) -> Tuple[ResultStatus, List[int]]:
+        """Updates the priority of the specified futures to the new_priority.
+
+        Args:
+            futures: the futures to update.
+            new_priority: the priority to update to. If this is a single integer then
+                all the specified tasks are updated to that priority. If this is a
+                List of ints then each task is updated with the corresponding priority.
+
+        Returns:
+            If the update is successful, the Tuple will contain ResultStatus.SUCCESS and
+                the eq_task_ids of the tasks whose priority was successfully updated,
+                otherwise (ResultStatus.FAILURE, []).
+        """
+        ids = [ft.eq_task_id for ft in futures]
+        priorities = [new_priority] * len(ids) if isinstance(new_priority, int) else list(new_priority)
+        if len(ids) != len(priorities):
+            raise ValueError("Number of task ids and updated priorities must be equal")
+        try:
+            async with self._transaction() as cur:
+                await cur.execute("""
+                    with updated as (
+                        update emews_queue_OUT as q set eq_priority = u.priority,
+                            aging_key = q.aging_key + u.priority - q.eq_priority
+                        from unnest(%s::integer[], %s::integer[]) as u (eq_task_id, priority)
+                        where q.eq_task_id = u.eq_task_id
+                        returning q.eq_task_id, q.eq_priority
+                    ), tasks as (
+                        update eq_tasks as t set eq_priority = updated.eq_priority
+                        from updated where t.eq_task_id = updated.eq_task_id
+                    )
+                    select eq_task_id from updated
+                    """, (ids, priorities))
+                return (ResultStatus.SUCCESS, [row[0] for row in await cur.fetchall()])
+        except Exception:
+            self.logger.error(f'update_priority error: {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+    async def cancel_tasks(self, futures: List[AsyncFuture]) -> Tuple[ResultStatus, List[int]]:
+        """Cancels the specified futures.
+
+        Args:
+            futures: the :py:class:`AsyncFutures <AsyncFuture>` to cancel.
+
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` and the ids of the successfully canceled tasks.
+        """
+        ft_map = {ft.eq_task_id: ft for ft in futures}
+        try:
+            async with self._transaction() as cur:
+                # delete should lock all the rows, so they can't be selected
+                await cur.execute("""
+                    with deleted as (
+                        delete from emews_queue_OUT where eq_task_id = any(%s) returning eq_task_id
+                    )
+                    update eq_tasks t set eq_status = %s from deleted
+                    where t.eq_task_id = deleted.eq_task_id returning t.eq_task_id
+                    """, (list(ft_map.keys()), TaskStatus.CANCELED.value))
+                canceled = [row[0] for row in await cur.fetchall()]
+        except Exception:
+            self.logger.error(f'cancel task error: {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+        for eq_task_id in canceled:
+            ft_map[eq_task_id]._task_status = TaskStatus.CANCELED
+        return (ResultStatus.SUCCESS, canceled)
+
+    async def are_queues_empty(self, eq_type: int = None) -> bool:
+        """Returns whether or not either of the input or output queues are empty,
+        optionally of a specified task type.
+
+        Args:
+            eq_type: the optional task type to check for.
+
+        Returns:
+            True if the queues are empty, otherwise False.
+        """
+        async with self._transaction() as cur:
+            await cur.execute("""
+                select (select count(*) from emews_queue_IN where %(t)s::integer is null or eq_task_type = %(t)s)
+                     + (select count(*) from emews_queue_OUT where %(t)s::integer is null or eq_task_type = %(t)s)
+                """, {'t': eq_type})
+            return (await cur.fetchone())[0] == 0
+
+    async def clear_queues(self):
+        """Clears the input and output queues, setting the status of the
+        tasks in them to :py:class:`TaskStatus.CANCELED`.
+
+        **NOTE**: this is only a convenience method for resetting the queues to a coherent
+        starting state, and should **NOT** be used to cancel tasks.
+        """
+        async with self._transaction() as cur:
+            for table in ('emews_queue_in', 'emews_queue_out'):
+                await cur.execute(f'update eq_tasks set eq_status = %s from (select eq_task_id from {table}) '
+                                  'as cleared_tasks where eq_tasks.eq_task_id = cleared_tasks.eq_task_id',
+                                  (TaskStatus.CANCELED.value,))
+                await cur.execute(f'delete from {table}')
+
+
+async def init_task_queue(host: str, user: str, port: int, db_name: str, password: str = None, retry_threshold=0,
+                          log_level=logging.WARN, notify: bool = False, pool_labels: List[str] = None,
+                          fair_share: bool = False) -> AsyncLocalTaskQueue:
+    """Initializes and returns an :py:class:`AsyncLocalTaskQueue` class instance with the specified parameters.
+
+    Args:
+        host: the eqsql database host
+        user: the eqsql database user
+        port: the eqsql database port
+        db_name: the eqsql database name
+        password: the eqdql database password (if there is one)
+        retry_threshold: if a DB connection cannot be established
+            (e.g, there are currently too many connections),
+            then retry ``retry_threshold`` many times to establish a connection. There
+            will be random few second delay betwen each retry.
+        log_level: the logging threshold level.
+        notify: if True, use Postgres LISTEN / NOTIFY to wake waits for tasks and results,
+            rather than sleep polling. Both the pushing and popping task queues should be
+            in notify mode.
+        pool_labels: the labels, in addition to the querying worker pool's id, of the targeted tasks
+            queried for by the task queue.
+        fair_share: if True, tasks queried for by the task queue are shared between experiments in proportion
+            to their weights.
+    Returns:
+        An :py:class:`AsyncLocalTaskQueue` instance
+    """
+    global _log_id
+    log_name = f'{__name__}-{_log_id}'
+    _log_id += 1
+    logger = db_tools.setup_log(log_name, log_level)
+
+    kwargs = {'dbname': db_name, 'host': host, 'user': user, 'autocommit': True}
+    if port is not None:
+        kwargs['port'] = port
+    if password is not None:
+        kwargs['password'] = password
+
+    retries = 0
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(**kwargs)
+            listen_conn = None
+            if notify:
+                listen_conn = await psycopg.AsyncConnection.connect(**kwargs)
+            break
+        except psycopg.OperationalError as e:
+            retries += 1
+            if retries > retry_threshold:
+                raise db_tools.ConnectionException(e)
+            await asyncio.sleep(random.random() * 4)
+
+    return AsyncLocalTaskQueue(conn, logger, listen_conn, pool_labels, fair_share)
@@ -1,9 +1,12 @@
 """Task Queue protocol and implementations"""
-from typing import Protocol, Tuple, Union, List, Generator, Iterable
+from typing import Protocol, Tuple, Union, List, Generator, Iterable, Callable, Dict
 from typing import runtime_checkable
 
+from collections import deque
 from enum import IntEnum
+from itertools import islice
 import json
+import time
 
 
 class ResultStatus(IntEnum):
@@ -310,6 +313,20 @@ class TaskQueue(Protocol):
             for the failure (``EQ_TIMEOUT``, or ``EQ_ABORT``)
         """
 
+    def get_results(self, futures: Iterable[Future], consume: bool = True) -> List[Tuple[Future, str]]:
+        """Gets the results of those of the specified tasks whose results are available, with a
+        single query, without waiting for the results.
+
+        Args:
+            futures: the futures of the tasks to get the results of.
+            consume: if True, the results are popped off of the input queue and cached in their
+                futures, otherwise they are left in the input queue.
+
+        Returns:
+            A List of (Future, result) tuples, in the order of the specified futures, for the futures
+            whose results are available, or None if the query fails.
+        """
+
     def get_priorities(self, futures: Iterable[Future]) -> List[Tuple[Future, int]]:
         """Gets the priorities of the specified tasks.
 
@@ -418,6 +435,131 @@ class TaskQueue(Protocol):
             status of that task as a :py:class:`TaskStatus` object.
         """
 
+    def map(self, exp_id: str, eq_type: int, payload: Iterable[str], window: int = 1000, ordered: bool = True,
+            priority: int = 0, tag: str = None, timeout: float = None,
+            sleep: float = 0.5) -> Generator[Union[str, Tuple[int, str]], None, None]:
+        """Returns a generator that submits a task for each of the payloads, and yields the task results.
+        At most ``window`` tasks are in flight (submitted and not yet yielded) at a time, so memory
+        use is bounded for arbitrarily long iterables of payloads. Tasks are submitted with
+        :py:func:`submit_tasks` as the window frees up, and the in flight tasks are checked for completion
+        with a single :py:func:`get_results` query every ``sleep`` seconds. If the generator is closed before
+        it is exhausted, the tasks still in flight are canceled.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: an iterable of the work payloads
+            window: the maximum number of tasks in flight.
+            ordered: if True, the results are yielded in payload order, otherwise they are yielded
+                as the tasks complete.
+            priority: the priority of the tasks
+            tag: an optional metadata tag for the tasks
+            timeout: if not None, a :py:class:`TimeoutError` is raised if all the results have not been
+                yielded this many seconds after the first result is requested.
+            sleep: the time, in seconds, to sleep between checks for completed tasks.
+
+        Yields:
+            If ordered is True, the task results in payload order, otherwise (index, result) tuples,
+            where index is the position of the task's payload in the payloads, as the tasks complete.
+
+        Raises:
+            RuntimeError: if the submission of the tasks fails.
+            TimeoutError: if the results are not available within the timeout.
+
+        Examples:
+            >>> for result in task_queue.map('exp1', 0, (json.dumps(p) for p in params), window=100):
+                    // do something with result
+        """
+
+
+def _get_future_results(futures: Iterable[Future], query: Callable[[List[int]], Union[Dict[int, str], None]],
+                        consume: bool) -> Union[List[Tuple[Future, str]], None]:
+    """Implements :py:func:`TaskQueue.get_results` using the specified query function, which
+    gets the results of the specified task ids as a dictionary of task id to result, or None
+    if the query fails. Only the tasks whose futures do not already have a result are queried.
+    """
+    futures = list(futures)
+    to_query = [ft.eq_task_id for ft in futures if ft._result is None or ft._result[0] != ResultStatus.SUCCESS]
+    results = {}
+    if len(to_query) > 0:
+        results = query(to_query)
+        if results is None:
+            return None
+
+    found = []
+    for ft in futures:
+        if ft.eq_task_id in results:
+            if consume:
+                ft._result = (ResultStatus.SUCCESS, results[ft.eq_task_id])
+            found.append((ft, results[ft.eq_task_id]))
+        elif ft._result is not None and ft._result[0] == ResultStatus.SUCCESS:
+            found.append((ft, ft._result[1]))
+    return found
+
+
+def _map_tasks(task_queue: 'TaskQueue', exp_id: str, eq_type: int, payload: Iterable[str], window: int = 1000,
+               ordered: bool = True, priority: int = 0, tag: str = None, timeout: float = None,
+               sleep: float = 0.5) -> Generator[Union[str, Tuple[int, str]], None, None]:
+    """Implements :py:func:`TaskQueue.map` using the specified task queue's submit_tasks,
+    get_results and cancel_tasks.
+    """
+    if window < 1:
+        raise ValueError(f'Invalid window: window must be greater than 0: window = {window}')
+
+    payloads = iter(payload)
+    start = time.time()
+    # (index, future) of the in flight tasks, in payload order
+    in_flight = deque()
+    # index -> result of the completed in flight tasks
+    results = {}
+    n_submitted = 0
+    exhausted = False
+    try:
+        while True:
+            if not exhausted and len(in_flight) < window:
+                chunk = list(islice(payloads, window - len(in_flight)))
+                if len(chunk) == 0:
+                    exhausted = True
+                else:
+                    status, fts = task_queue.submit_tasks(exp_id, eq_type, chunk, priority=priority, tag=tag)
+                    if status != ResultStatus.SUCCESS:
+                        raise RuntimeError(f'task submission failed, {len(fts)} of {len(chunk)} tasks submitted')
+                    in_flight.extend(enumerate(fts, n_submitted))
+                    n_submitted += len(fts)
+
+            if len(in_flight) == 0:
+                return
+
+            pending = [(idx, ft) for idx, ft in in_flight if idx not in results]
+            indices = {ft.eq_task_id: idx for idx, ft in pending}
+            ready = task_queue.get_results([ft for _, ft in pending])
+            # a failed query is retried on the next check
+            for ft, result in ready if ready is not None else []:
+                results[indices[ft.eq_task_id]] = result
+
+            n_yielded = 0
+            if ordered:
+                while len(in_flight) > 0 and in_flight[0][0] in results:
+                    idx, _ = in_flight.popleft()
+                    n_yielded += 1
+                    yield results.pop(idx)
+            elif len(results) > 0:
+                done = [(idx, ft) for idx, ft in in_flight if idx in results]
+                in_flight = deque((idx, ft) for idx, ft in in_flight if idx not in results)
+                for idx, _ in done:
+                    n_yielded += 1
+                    yield (idx, results.pop(idx))
+
+            if n_yielded == 0:
+                if timeout is not None and time.time() - start > timeout:
+                    raise TimeoutError(f'map timed out after {timeout} seconds')
+                if sleep > 0:
+                    time.sleep(sleep)
+    finally:
+        canceled = [ft for idx, ft in in_flight if idx not in results]
+        if len(canceled) > 0:
+            task_queue.cancel_tasks(canceled)
+
 
 class StopConditionException(Exception):
     def __init__(self, msg='StopIterationException', *args, **kwargs):
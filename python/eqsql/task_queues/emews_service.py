@@ -1,101 +1,247 @@
-from flask import Flask, request
+from flask import Flask, Response, g, request
+import argparse
 import json
+import signal
+import socket
+import threading
+import time
 from multiprocessing import Process, Queue
 
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+from eqsql import db_tools
+
 from eqsql.task_queues.core import TimeoutError, ResultStatus
 from eqsql.task_queues.remote_funcs import _submit_tasks, _get_status, _get_priorities, _get_worker_pools
 from eqsql.task_queues.remote_funcs import _update_priorities, _query_result, _cancel_tasks
-from eqsql.task_queues.remote_funcs import _are_queues_empty, _as_completed, DBParameters
+from eqsql.task_queues.remote_funcs import _are_queues_empty, _as_completed, _get_results, DBParameters
+from eqsql.task_queues.remote_funcs import _watch_tasks, _next_watched, _close_watch
+from eqsql.task_queues.remote_funcs import _query_tasks, _query_more_tasks, _report_tasks, _heartbeat
+from eqsql.task_queues import wire
+from eqsql.task_queues.service_metrics import OTHER, ServiceMetrics
+
+# the maximum time, in seconds, that a worker waits for its requests in flight to
+# complete on shutdown
+DRAIN_TIMEOUT = 30.0
+# the maximum number of connections queued on the service socket
+LISTEN_BACKLOG = 1024
 
 app = Flask(__name__)
 q: Queue = None
+# shared by the worker processes, see start
+_metrics: ServiceMetrics = None
+# the index of this worker process
+_worker = 0
+
+
+def _message():
+    """Decodes the body of the current request. See :py:mod:`eqsql.task_queues.wire`."""
+    msg = wire.decode(request.get_data(), request.mimetype or wire.JSON,
+                      request.headers.get(wire.COMPRESSION_HEADER))
+    if isinstance(msg, str):
+        # clients that predate the wire format send the message as a JSON encoded JSON string
+        msg = json.loads(msg)
+    return msg
+
+
+def _respond(obj) -> Response:
+    """Encodes the specified object as the response to the current request, in the
+    preferred content type and compression accepted by the client.
+    """
+    content_type = wire.negotiate(wire.parse_header_list(request.headers.get('Accept')),
+                                  wire.content_types())
+    if content_type is None:
+        content_type = wire.JSON
+    compression = wire.negotiate(wire.parse_header_list(request.headers.get(wire.ACCEPT_COMPRESSION_HEADER)),
+                                 wire.compressions())
+    body, compression = wire.encode(obj, content_type, compression)
+    response = Response(body, content_type=content_type)
+    if compression is not None:
+        response.headers[wire.COMPRESSION_HEADER] = compression
+    return response
+
+
+# the content types and compressions that clients can negotiate
+@app.get('/wire')
+def wire_formats():
+    return {'content_types': wire.content_types(), 'compressions': wire.compressions()}
 
 
 @app.post('/submit_tasks')
 def submit_tasks():
     # msg = {'exp_id': exp_id, 'eq_type': eq_type, 'payload': [payload], 'priority': priority,
     #        'tag': tag}
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _submit_tasks(db_params, msg['exp_id'], msg['eq_type'], msg['payload'],
                            msg['priority'], msg['tag'])
-    return list(result)
+    return _respond(list(result))
 
 
 @app.post('/get_status')
 def get_status():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _get_status(db_params, msg['task_ids'])
-    return result
+    return _respond(result)
 
 
 @app.post('/get_worker_pools')
 def get_worker_pools():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _get_worker_pools(db_params, msg['task_ids'])
-    return result
+    return _respond(result)
 
 
 @app.post('/get_priorities')
 def get_priorities():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _get_priorities(db_params, msg['task_ids'])
     if result == ResultStatus.FAILURE:
-        return {'status': 'fail'}
-    return {'status': 'ok', 'result': result}
+        return _respond({'status': 'fail'})
+    return _respond({'status': 'ok', 'result': result})
 
 
 @app.post('/update_priorities')
 def update_priorities():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _update_priorities(db_params, msg['task_ids'], msg['new_priority'])
     if result[0] == ResultStatus.FAILURE:
-        return {'status': 'fail'}
-    return {'status': 'ok', 'result': result}
+        return _respond({'status': 'fail'})
+    return _respond({'status': 'ok', 'result': result})
 
 
 @app.post('/cancel_tasks')
 def cancel_tasks():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _cancel_tasks(db_params, msg['task_ids'])
-    return list(result)
+    return _respond(list(result))
 
 
 @app.post('/as_completed')
 def as_completed():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     try:
         result = _as_completed(db_params, msg['task_ids'], msg['completed_tasks'],
                                msg['timeout'], msg['n_required'], msg['batch_size'], msg['sleep'])
     except TimeoutError:
-        return {'status': 'timeout_error'}
-    return {'status': 'ok', 'result': result}
+        return _respond({'status': 'timeout_error'})
+    return _respond({'status': 'ok', 'result': result})
+
+
+@app.post('/watch_tasks')
+def watch_tasks():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    watch_id = _watch_tasks(db_params, msg['task_ids'])
+    if watch_id is None:
+        return _respond({'status': 'fail'})
+    return _respond({'status': 'ok', 'watch_id': watch_id})
+
+
+@app.post('/next_watched')
+def next_watched():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    result = _next_watched(db_params, msg['watch_id'], msg['n'], msg['timeout'], msg['sleep'])
+    if result is None:
+        return _respond({'status': 'fail'})
+    return _respond({'status': 'ok', 'result': result})
+
+
+@app.post('/close_watch')
+def close_watch():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    result = _close_watch(db_params, msg['watch_id'])
+    return _respond([result])
 
 
 @app.post('/query_result')
 def query_result():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _query_result(db_params, msg['eq_task_id'], msg['delay'], msg['timeout'])
-    return [result]
+    return _respond([result])
+
+
+@app.post('/get_results')
+def get_results():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    result = _get_results(db_params, msg['task_ids'], msg['consume'])
+    if result is None:
+        return _respond({'status': 'fail'})
+    return _respond({'status': 'ok', 'result': result})
 
 
 @app.post('/are_queues_empty')
 def are_queues_empty():
-    msg = json.loads(request.json)
+    msg = _message()
     db_params = DBParameters.from_dict(msg['db_params'])
     result = _are_queues_empty(db_params, msg['eq_type'])
-    return [1 if result else 0]
+    return _respond([1 if result else 0])
+
+
+def _weights(msg):
+    # JSON object keys are strings
+    weights = msg.get('weights')
+    return None if weights is None else {int(eq_type): weight for eq_type, weight in weights.items()}
+
+
+# worker pool endpoints
+@app.post('/query_tasks')
+def query_tasks():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    try:
+        result = _query_tasks(db_params, msg['eq_type'], msg['n'], msg['worker_pool'], msg['timeout'],
+                              msg['sleep'], _weights(msg), msg['lease_duration'], msg['fair_share'],
+                              msg['pool_labels'])
+    except ValueError as e:
+        return _respond({'status': 'invalid', 'error': str(e)})
+    return _respond({'status': 'ok', 'result': result})
+
+
+@app.post('/query_more_tasks')
+def query_more_tasks():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    try:
+        result = _query_more_tasks(db_params, msg['eq_type'], msg['task_ids'], msg['batch_size'], msg['threshold'],
+                                   msg['worker_pool'], msg['timeout'], msg['sleep'], _weights(msg),
+                                   msg['lease_duration'], msg['fair_share'], msg['pool_labels'])
+    except ValueError as e:
+        return _respond({'status': 'invalid', 'error': str(e)})
+    return _respond({'status': 'ok', 'result': result})
+
+
+@app.post('/report_tasks')
+def report_tasks():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    result = _report_tasks(db_params, msg['results'], msg.get('worker_pool'))
+    return _respond(list(result))
+
+
+@app.post('/heartbeat')
+def heartbeat():
+    msg = _message()
+    db_params = DBParameters.from_dict(msg['db_params'])
+    result = _heartbeat(db_params, msg['task_ids'], msg['worker_pool'], msg['lease_duration'])
+    return _respond(list(result))
 
 
 @app.get("/shutdown")
 def shutdown():
+    if q is None:
+        return 'Server not started with start()', 404
     q.put(1)
     return 'Server shutting down ...'
 
@@ -105,17 +251,156 @@ def ping():
     return 'pong'
 
 
-def start(host, port):
-    global q
+@app.get('/metrics')
+def metrics():
+    # Prometheus text format, or JSON with ?format=json
+    if request.args.get('format') == 'json':
+        return _get_metrics().snapshot()
+    return Response(_get_metrics().render(), content_type='text/plain; version=0.0.4')
+
+
+def _get_metrics() -> ServiceMetrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = ServiceMetrics([rule.rule for rule in app.url_map.iter_rules() if rule.endpoint != 'static'])
+    return _metrics
+
+
+@app.before_request
+def _start_timer():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response: Response) -> Response:
+    elapsed = time.perf_counter() - g.get('start_time', time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule is not None else OTHER
+    m = _get_metrics()
+    m.record(endpoint, elapsed, response.status_code)
+    m.set_pool_stats(_worker, db_tools.pool_stats())
+    return response
+
+
+class _Drain:
+    """WSGI middleware that counts the requests in flight in this worker, until their responses
+    have been sent, and, once draining, rejects new requests with a 503.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.draining = False
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def _done(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+        _get_metrics().add_in_flight(_worker, -1)
+
+    def __call__(self, environ, start_response):
+        if self.draining:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain'), ('Connection', 'close')])
+            return [b'Server shutting down ...']
+        with self._cond:
+            self._in_flight += 1
+        _get_metrics().add_in_flight(_worker, 1)
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return ClosingIterator(response, self._done)
+
+    def wait(self, timeout: float) -> bool:
+        """Waits for the requests in flight to complete, returning True if they complete
+        within the timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._in_flight == 0, timeout)
+
+
+_drain = _Drain(app.wsgi_app)
+app.wsgi_app = _drain
+
+
+def _serve(sock: socket.socket, worker: int, drain_timeout: float, metrics: ServiceMetrics, shutdown: Queue):
+    """Serves requests on the specified listening socket, handling each request in its own thread,
+    until SIGTERM, and then drains the requests in flight."""
+    global q, _worker, _metrics
+    # passed explicitly, rather than inherited, so that this also works when the
+    # workers are spawned rather than forked
+    q = shutdown
+    _worker = worker
+    _metrics = metrics
+    # each request is handled in its own thread, and the remote functions share the
+    # warm task queues and pooled connections of this process
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+
+    def drain(signum, frame):
+        _drain.draining = True
+        # shutdown waits for serve_forever to return, so it cannot be called in
+        # the serving thread that runs this handler
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, drain)
+    server.serve_forever()
+    _drain.wait(drain_timeout)
+
+
+def start(host, port, workers: int = 1, drain_timeout: float = DRAIN_TIMEOUT):
+    """Starts the service with the specified number of worker processes, each handling
+    requests in multiple threads, and returns when the service has been shut down with a
+    request to /shutdown. The workers are started after the service socket is bound, and
+    accept connections on that socket. On shutdown, each worker stops accepting
+    connections, and rejects any further requests on its open connections, and then waits
+    for up to drain_timeout seconds for the requests in flight to complete.
+
+    The request counts and latencies, and the database connection pool utilization, of all
+    the workers are reported by the /metrics endpoint.
+
+    Args:
+        host: the host address to bind to.
+        port: the port to bind to.
+        workers: the number of worker processes.
+        drain_timeout: the maximum time, in seconds, that a worker waits for its requests in flight
+            to complete on shutdown. This should be greater than the
+            maximum long poll time of the requests, e.g., ``WATCH_POLL_TIMEOUT``.
+
+    Returns:
+        The host and port.
+    """
+    global q, _metrics
+    if workers < 1:
+        raise ValueError(f'Invalid workers: workers must be greater than 0: workers = {workers}')
     q = Queue()
-    p = Process(target=app.run, args=(host, port))
-    # app.run(host=host, port=port)
-    p.start()
-    q.get()
-    p.terminate()
-    p.join()
+    _metrics = ServiceMetrics([rule.rule for rule in app.url_map.iter_rules() if rule.endpoint != 'static'],
+                              workers)
+    sock = socket.create_server((host, port), backlog=LISTEN_BACKLOG)
+    procs = [Process(target=_serve, args=(sock, worker, drain_timeout, _metrics, q)) for worker in range(workers)]
+    for p in procs:
+        p.start()
+    try:
+        q.get()
+    finally:
+        for p in procs:
+            # SIGTERM, which drains the worker
+            p.terminate()
+        for p in procs:
+            p.join(drain_timeout + 5)
+            if p.is_alive():
+                p.kill()
+                p.join()
+        sock.close()
     return host, port
 
 
 if __name__ == '__main__':
-    start('127.0.0.1', 11218)
+    parser = argparse.ArgumentParser(description='Start the emews_service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11218)
+    parser.add_argument('--workers', type=int, default=1, help='the number of worker processes')
+    parser.add_argument('--drain_timeout', type=float, default=DRAIN_TIMEOUT,
+                        help='the maximum time, in seconds, to wait for the requests in flight on shutdown')
+    args = parser.parse_args()
+    start(args.host, args.port, args.workers, args.drain_timeout)
@@ -0,0 +1,251 @@
+"""concurrent.futures Executor for submitting tasks to a task queue.
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterable, List
+
+from eqsql.task_queues.core import Future, ResultStatus, TaskQueue, TimeoutError
+from eqsql.task_queues.core import EQ_ABORT
+
+
+class EQSQLFuture(concurrent.futures.Future):
+
+    def __init__(self, eq_future: Future):
+        """A ``concurrent.futures.Future`` representing the eventual result of a task
+        submitted with an :py:class:`EQSQLExecutor`.
+
+        Args:
+            eq_future: the task queue :py:class:`Future <eqsql.task_queues.core.Future>` of the task.
+        """
+        super().__init__()
+        self.eq_future = eq_future
+
+    @property
+    def eq_task_id(self) -> int:
+        """Gets the id of this future's task."""
+        return self.eq_future.eq_task_id
+
+
+class EQSQLExecutor(concurrent.futures.Executor):
+
+    def __init__(self, task_queue: TaskQueue, exp_id: str, eq_type: int, priority: int = 0,
+                 decode: Callable[[str], Any] = None, sleep: float = 0.5,
+                 logger: logging.Logger = None):
+        """A ``concurrent.futures.Executor`` that submits tasks of a single type to a task queue, so
+        that EQSQL tasks can be used with ``concurrent.futures.wait``, ``add_done_callback``
+        and libraries that accept an Executor.
+
+        A single watcher thread resolves the futures of all the outstanding tasks, checking
+        them for completion with one :py:func:`as_completed <eqsql.task_queues.core.TaskQueue.as_completed>`
+        sweep every ``sleep`` seconds. Done callbacks are called from the watcher thread.
+        Calls to the task queue are serialized by the executor, but the task queue should not be
+        used concurrently by other threads while the executor is running.
+
+        A task can be canceled with the future's ``cancel`` method until its result is available. The
+        task is canceled in the task queue if it has not yet been selected by a worker pool.
+        A task that fails with ``EQ_ABORT`` (e.g., because the database cannot be reached) remains
+        outstanding and is checked again on the next sweep.
+
+        Args:
+            task_queue: the task queue to submit the tasks to.
+            exp_id: the id of the experiment of which the tasks are part.
+            eq_type: the type of the submitted tasks.
+            priority: the default priority of the submitted tasks.
+            decode: an optional function applied to a task's result payload to produce the future's
+                result, e.g., ``json.loads``. Any exception raised by this function is set as the
+                future's exception.
+            sleep: the time, in seconds, to wait between checking the outstanding tasks for completion.
+            logger: an optional logger. If this is None, the task queue's logger is used.
+        """
+        self.task_queue = task_queue
+        self.exp_id = exp_id
+        self.eq_type = eq_type
+        self.priority = priority
+        self.decode = decode
+        self.sleep = sleep
+        self.logger = logger if logger is not None else getattr(task_queue, 'logger', logging.getLogger(__name__))
+
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._pending: Dict[int, EQSQLFuture] = {}
+        self._shutdown = False
+        self._cancel_futures = False
+        self._watcher = threading.Thread(target=self._watch, name='eqsql-executor', daemon=True)
+        self._watcher.start()
+
+    def submit(self, fn: Callable[..., str], /, *args, **kwargs) -> EQSQLFuture:
+        """Submits a task whose payload is the result of ``fn(*args, **kwargs)``, e.g.,
+        ``executor.submit(json.dumps, {'x': 1})``. ``fn`` is called immediately in the calling thread;
+        the task itself is run by the worker pools that query for the executor's task type.
+
+        Returns:
+            The :py:class:`EQSQLFuture` representing the task.
+        """
+        return self.submit_payload(fn(*args, **kwargs))
+
+    def submit_payload(self, payload: str, priority: int = None, tag: str = None) -> EQSQLFuture:
+        """Submits a task with the specified payload.
+
+        Args:
+            payload: the task payload.
+            priority: the priority of the task. If this is None, the executor's default priority is used.
+            tag: an optional metadata tag for the task.
+
+        Returns:
+            The :py:class:`EQSQLFuture` representing the task.
+        """
+        return self.submit_payloads([payload], priority, tag)[0]
+
+    def submit_payloads(self, payloads: List[str], priority: int = None, tag: str = None) -> List[EQSQLFuture]:
+        """Submits tasks with the specified payloads with a single
+        :py:func:`submit_tasks <eqsql.task_queues.core.TaskQueue.submit_tasks>` call.
+
+        Args:
+            payloads: the task payloads.
+            priority: the priority of the tasks. If this is None, the executor's default priority is used.
+            tag: an optional metadata tag for the tasks.
+
+        Returns:
+            The :py:class:`EQSQLFutures <EQSQLFuture>` representing the tasks, in payload order.
+
+        Raises:
+            RuntimeError: if the executor has been shutdown or the submission fails.
+        """
+        priority = self.priority if priority is None else priority
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit tasks after shutdown')
+            status, fts = self.task_queue.submit_tasks(self.exp_id, self.eq_type, payloads, priority=priority,
+                                                       tag=tag)
+            futures = [EQSQLFuture(ft) for ft in fts]
+            for future in futures:
+                self._pending[future.eq_task_id] = future
+        self._wake.set()
+        if status != ResultStatus.SUCCESS:
+            raise RuntimeError(f'task submission failed, {len(fts)} of {len(payloads)} tasks submitted')
+        return futures
+
+    def map(self, fn: Callable[..., str], *iterables, timeout: float = None, chunksize: int = 1):
+        """Returns an iterator equivalent to ``map(fn, *iterables)``, where each call to ``fn``
+        produces the payload of a task and the iterator yields the task results in order. The
+        tasks are submitted with a single :py:func:`submit_payloads` call.
+
+        Args:
+            fn: the function producing the task payload from the arguments.
+            iterables: the iterables of arguments.
+            timeout: the maximum number of seconds to wait, from the time of this call,
+                for the results. If this is None, there is no limit to the wait time.
+            chunksize: ignored, the tasks are always submitted together.
+
+        Returns:
+            An iterator over the task results.
+
+        Raises:
+            concurrent.futures.TimeoutError: if a result is not available before the timeout.
+        """
+        end_time = None if timeout is None else time.monotonic() + timeout
+        futures = self.submit_payloads([fn(*args) for args in zip(*iterables)])
+
+        def result_iterator():
+            try:
+                for future in futures:
+                    if end_time is None:
+                        yield future.result()
+                    else:
+                        yield future.result(end_time - time.monotonic())
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return result_iterator()
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        """Signals the executor that it should stop watching for task completion once all the
+        outstanding tasks have completed. The task queue is not closed.
+
+        Args:
+            wait: if True, then this does not return until all the outstanding futures have been
+                resolved.
+            cancel_futures: if True, then all the outstanding futures are canceled, and their tasks are
+                canceled in the task queue if they have not yet been selected by a worker pool.
+        """
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                self._cancel_futures = True
+        self._wake.set()
+        if wait:
+            self._watcher.join()
+
+    def _cancel_tasks(self, futures: List[EQSQLFuture]):
+        with self._lock:
+            for future in futures:
+                self._pending.pop(future.eq_task_id, None)
+            status, _ = self.task_queue.cancel_tasks([future.eq_future for future in futures])
+        if status != ResultStatus.SUCCESS:
+            self.logger.warning(f'executor failed to cancel tasks {[future.eq_task_id for future in futures]}')
+
+    def _resolve(self, futures: Iterable[Future]):
+        """Sets the results of the executor futures of the completed task queue futures,
+        calling their done callbacks."""
+        with self._lock:
+            resolved = [(ft, self._pending.pop(ft.eq_task_id)) for ft in futures if ft.eq_task_id in self._pending]
+        # callbacks are called outside of the lock, so they can block
+        # without blocking submission
+        for ft, future in resolved:
+            if not future.set_running_or_notify_cancel():
+                continue
+            _, result = ft._result
+            try:
+                value = result if self.decode is None else self.decode(result)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(value)
+
+    def _sweep(self) -> List[Future]:
+        """Checks all the outstanding tasks for completion with a single as_completed sweep.
+
+        Returns:
+            The completed task queue futures.
+        """
+        with self._lock:
+            fts = [future.eq_future for future in self._pending.values()]
+            completed = []
+            try:
+                # as_completed checks all the futures once before timing out
+                for ft in self.task_queue.as_completed(fts, timeout=0.0, sleep=0):
+                    completed.append(ft)
+            except TimeoutError:
+                pass
+        aborted = [ft for ft in completed if ft._result[1] == EQ_ABORT]
+        if len(aborted) > 0:
+            self.logger.warning(f'executor failed to query the results of {len(aborted)} tasks, retrying')
+        return [ft for ft in completed if ft._result[1] != EQ_ABORT]
+
+    def _watch(self):
+        while True:
+            self._wake.clear()
+            with self._lock:
+                canceled = [future for future in self._pending.values()
+                            if future.cancelled() or self._cancel_futures]
+            if len(canceled) > 0:
+                for future in canceled:
+                    future.cancel()
+                    # notifies any waiters on the canceled future
+                    future.set_running_or_notify_cancel()
+                self._cancel_tasks(canceled)
+
+            if len(self._pending) > 0:
+                try:
+                    self._resolve(self._sweep())
+                except Exception:
+                    self.logger.error(f'executor watcher error {traceback.format_exc()}')
+            elif self._shutdown:
+                return
+
+            if len(self._pending) > 0 or not self._shutdown:
+                self._wake.wait(self.sleep if len(self._pending) > 0 else None)
@@ -0,0 +1,377 @@
+"""Compact, NumPy backed container for the tasks of a local task queue.
+
+NumPy is an optional dependency and must be installed to use this module,
+e.g., ``pip install numpy``.
+"""
+import time
+import traceback
+from itertools import islice
+from typing import Generator, Iterable, Iterator, List, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError('FutureSet requires numpy, e.g., pip install numpy') from e
+
+from eqsql.task_queues.core import Future, ResultStatus, TaskStatus, TimeoutError
+from eqsql.task_queues.local_queue import LocalTaskQueue, _out_channel
+
+# cached status of a task whose status has not been queried
+UNKNOWN_STATUS = -1
+
+_TERMINAL = np.array([TaskStatus.COMPLETE.value, TaskStatus.CANCELED.value], dtype=np.int8)
+
+
+def _array_literal(values: np.ndarray) -> str:
+    """Formats the array of integers as a Postgres array literal. Passing this as a query
+    parameter is much faster than having psycopg2 adapt the equivalent list."""
+    return '{' + ','.join(map(str, values.tolist())) + '}'
+
+
+class FutureSet:
+
+    def __init__(self, task_queue: LocalTaskQueue, eq_task_ids: Iterable[int], tag: str = None,
+                 status: TaskStatus = None, priority: int = None):
+        """A set of tasks, stored as NumPy arrays of task ids, cached statuses and priorities, and a
+        completion bitmap, rather than as individual :py:class:`Futures <eqsql.task_queues.core.Future>`.
+        The bulk operations (:py:func:`statuses`, :py:func:`priorities`, :py:func:`update_priorities`,
+        :py:func:`cancel` and :py:func:`completed`) are each a single set-based SQL statement, regardless
+        of the number of tasks. :py:class:`Futures <eqsql.task_queues.core.Future>` are only created
+        when a task is accessed by index. FutureSets can be created directly from the task ids, with
+        :py:func:`from_futures`, or by submitting tasks with :py:func:`submit`.
+
+        Args:
+            task_queue: the task queue that submitted the tasks.
+            eq_task_ids: the ids of the tasks. The ids must be unique.
+            tag: the metadata tag of the tasks.
+            status: the known status of all the tasks, if any.
+            priority: the known priority of all the tasks, if any.
+        """
+        self.task_queue = task_queue
+        self.tag = tag
+        self.eq_task_ids = np.fromiter(eq_task_ids, dtype=np.int64)
+        n = len(self.eq_task_ids)
+        self._status = np.full(n, UNKNOWN_STATUS if status is None else status.value, dtype=np.int8)
+        self._priority = np.full(n, 0 if priority is None else priority, dtype=np.int32)
+        self._completed = np.zeros(n, dtype=bool)
+        # index -> result, populated as tasks complete
+        self._results = {}
+        self._order = np.argsort(self.eq_task_ids, kind='stable')
+        self._sorted_ids = self.eq_task_ids[self._order]
+
+    @classmethod
+    def from_futures(cls, futures: Iterable[Future], tag: str = None) -> 'FutureSet':
+        """Creates a FutureSet from the specified :py:class:`Futures <eqsql.task_queues.core.Future>`, which
+        must all have been submitted by the same task queue. Any results already retrieved by the futures
+        are kept.
+
+        Args:
+            futures: the futures to create the FutureSet from.
+            tag: the metadata tag of the tasks.
+
+        Returns:
+            The FutureSet containing the futures' tasks, in the order of the futures.
+        """
+        futures = list(futures)
+        if len(futures) == 0:
+            raise ValueError('Cannot create a FutureSet from an empty list of futures')
+        fs = cls(futures[0].eq_sql, (ft.eq_task_id for ft in futures), tag)
+        for i, ft in enumerate(futures):
+            if ft._result is not None and ft._result[0] == ResultStatus.SUCCESS:
+                fs._completed[i] = True
+                fs._status[i] = TaskStatus.COMPLETE.value
+                fs._results[i] = ft._result[1]
+            elif ft._task_status is not None:
+                fs._status[i] = ft._task_status.value
+        return fs
+
+    @classmethod
+    def submit(cls, task_queue: LocalTaskQueue, exp_id: str, eq_type: int, payload: Iterable[str],
+               priority: int = 0, tag: str = None, chunk_size: int = 10000) -> Tuple[ResultStatus, 'FutureSet']:
+        """Submits work of the specified type and priority with the specified payloads, returning the
+        :py:class:`status <eqsql.task_queues.core.ResultStatus>` and a FutureSet of the submitted tasks.
+        As with :py:func:`LocalTaskQueue.submit_tasks <eqsql.task_queues.local_queue.LocalTaskQueue.submit_tasks>`,
+        all the payloads are submitted in a single transaction, using multi-row inserts of at most ``chunk_size``
+        payloads each, and, if the task queue caches results, the tasks with a cached result are completed with
+        that result, but no :py:class:`Futures <eqsql.task_queues.core.Future>` are created.
+
+        Args:
+            task_queue: the task queue to submit the work to.
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: the work payloads
+            priority: the priority of this work
+            tag: an optional metadata tag for the tasks
+            chunk_size: the maximum number of payloads to insert per statement.
+
+        Returns:
+            A tuple containing the status of the submission and the FutureSet of the submitted tasks. The
+            submission is a single transaction, so if the submission fails, the FutureSet will be empty.
+        """
+        if chunk_size < 1:
+            raise ValueError(f'Invalid chunk_size: chunk_size must be greater than 0: chunk_size = {chunk_size}')
+
+        eq_task_ids = []
+        payloads = iter(payload)
+        try:
+            with task_queue.db.conn:
+                with task_queue.db.conn.cursor() as cur:
+                    while True:
+                        chunk = list(islice(payloads, chunk_size))
+                        if len(chunk) == 0:
+                            break
+                        eq_task_ids.append(np.array(task_queue._submit_chunk(cur, exp_id, eq_type, chunk,
+                                                                             priority, tag), dtype=np.int64))
+                    task_queue._notify(cur, _out_channel(eq_type))
+        except Exception:
+            task_queue.logger.error(f'submit_tasks error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, cls(task_queue, [], tag))
+
+        ids = np.concatenate(eq_task_ids) if len(eq_task_ids) > 0 else []
+        # tasks with a cached result are already complete
+        status = TaskStatus.QUEUED if task_queue.result_cache is None else None
+        return (ResultStatus.SUCCESS, cls(task_queue, ids, tag, status=status, priority=priority))
+
+    def __len__(self) -> int:
+        return len(self.eq_task_ids)
+
+    def _future(self, idx: int) -> Future:
+        ft = Future(self.task_queue, int(self.eq_task_ids[idx]), self.tag)
+        if self._completed[idx]:
+            ft._result = (ResultStatus.SUCCESS, self._results[idx])
+        if self._status[idx] in _TERMINAL:
+            ft._task_status = TaskStatus(self._status[idx])
+        return ft
+
+    def __getitem__(self, idx: Union[int, slice, np.ndarray]) -> Union[Future, List[Future]]:
+        """Gets the :py:class:`Future <eqsql.task_queues.core.Future>` at the specified index, or a
+        list of the futures for a slice, or an array of indices or a boolean mask.
+        """
+        if isinstance(idx, slice):
+            return [self._future(i) for i in range(*idx.indices(len(self)))]
+        if isinstance(idx, np.ndarray):
+            if idx.dtype == bool:
+                idx = np.flatnonzero(idx)
+            return [self._future(i) for i in idx]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('FutureSet index out of range')
+        return self._future(idx)
+
+    def __iter__(self) -> Iterator[Future]:
+        for i in range(len(self)):
+            yield self._future(i)
+
+    def _indices(self, eq_task_ids: Iterable[int]) -> np.ndarray:
+        """Gets the indices of the specified task ids in this FutureSet."""
+        ids = np.fromiter(eq_task_ids, dtype=np.int64)
+        return self._order[np.searchsorted(self._sorted_ids, ids)]
+
+    def _mask(self, mask: np.ndarray = None) -> np.ndarray:
+        return np.ones(len(self), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+
+    def statuses(self) -> Union[np.ndarray, None]:
+        """Gets the status of each task as an array of :py:class:`TaskStatus <eqsql.task_queues.core.TaskStatus>`
+        values. Completed and canceled statuses are cached, and only the tasks with other statuses are queried.
+
+        Returns:
+            An int8 array of the status values, in task order, or None if the query fails.
+        """
+        query = ~np.isin(self._status, _TERMINAL)
+        if np.any(query):
+            try:
+                with self.task_queue.db.conn:
+                    with self.task_queue.db.conn.cursor() as cur:
+                        cur.execute('select eq_task_id, eq_status from eq_tasks where eq_task_id = any(%s::integer[])',
+                                    (_array_literal(self.eq_task_ids[query]),))
+                        rows = cur.fetchall()
+            except Exception:
+                self.task_queue.logger.error(f'query_status error: {traceback.format_exc()}')
+                return None
+
+            if len(rows) > 0:
+                ids, statuses = zip(*rows)
+                self._status[self._indices(ids)] = statuses
+        return self._status.copy()
+
+    def priorities(self) -> Union[np.ndarray, None]:
+        """Gets the priority of each task.
+
+        Returns:
+            An int32 array of the priorities, in task order, or None if the query fails.
+        """
+        try:
+            with self.task_queue.db.conn:
+                with self.task_queue.db.conn.cursor() as cur:
+                    cur.execute('select eq_task_id, eq_priority from eq_tasks where eq_task_id = any(%s::integer[])',
+                                (_array_literal(self.eq_task_ids),))
+                    rows = cur.fetchall()
+        except Exception:
+            self.task_queue.logger.error(f'query_priority error: {traceback.format_exc()}')
+            return None
+
+        if len(rows) > 0:
+            ids, priorities = zip(*rows)
+            self._priority[self._indices(ids)] = priorities
+        return self._priority.copy()
+
+    def update_priorities(self, new_priority: Union[int, np.ndarray],
+                          mask: np.ndarray = None) -> Tuple[ResultStatus, np.ndarray]:
+        """Updates the priorities of the tasks that are still queued.
+
+        Args:
+            new_priority: the new priority. If this is a single integer then all the tasks are updated to
+                that priority, otherwise this is an array with the priority of each task, in task order.
+            mask: an optional boolean array selecting the tasks to update.
+
+        Returns:
+            A tuple containing the status of the update and a boolean array indicating which tasks'
+            priorities were updated. On failure, no priorities are updated.
+        """
+        mask = self._mask(mask)
+        priorities = np.broadcast_to(np.asarray(new_priority, dtype=np.int32), (len(self),))
+        updated = np.zeros(len(self), dtype=bool)
+        try:
+            with self.task_queue.db.conn:
+                with self.task_queue.db.conn.cursor() as cur:
+                    cur.execute("""
+                        with updated as (
+                            update emews_queue_out as q set eq_priority = u.priority,
+                                aging_key = q.aging_key + u.priority - q.eq_priority
+                            from unnest(%s::integer[], %s::integer[]) as u (eq_task_id, priority)
+                            where q.eq_task_id = u.eq_task_id
+                            returning q.eq_task_id, q.eq_priority
+                        ), tasks as (
+                            update eq_tasks as t set eq_priority = updated.eq_priority
+                            from updated where t.eq_task_id = updated.eq_task_id
+                        )
+                        select eq_task_id from updated
+                        """, (_array_literal(self.eq_task_ids[mask]), _array_literal(priorities[mask])))
+                    ids = [row[0] for row in cur.fetchall()]
+        except Exception:
+            self.task_queue.logger.error(f'update_priority error: {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, updated)
+
+        updated[self._indices(ids)] = True
+        self._priority[updated] = priorities[updated]
+        return (ResultStatus.SUCCESS, updated)
+
+    def cancel(self, mask: np.ndarray = None) -> Tuple[ResultStatus, np.ndarray]:
+        """Cancels the tasks that are still queued, by removing them from the output queue.
+
+        Args:
+            mask: an optional boolean array selecting the tasks to cancel.
+
+        Returns:
+            A tuple containing the status of the cancelation and a boolean array indicating
+            which tasks were canceled.
+        """
+        mask = self._mask(mask)
+        canceled = np.zeros(len(self), dtype=bool)
+        try:
+            with self.task_queue.db.conn:
+                with self.task_queue.db.conn.cursor() as cur:
+                    # delete should lock all the rows, so they can't be selected
+                    cur.execute("""
+                        with deleted as (
+                            delete from emews_queue_out where eq_task_id = any(%s::integer[]) returning eq_task_id
+                        )
+                        update eq_tasks as t set eq_status = %s from deleted
+                        where t.eq_task_id = deleted.eq_task_id returning t.eq_task_id
+                        """, (_array_literal(self.eq_task_ids[mask]), TaskStatus.CANCELED.value))
+                    ids = [row[0] for row in cur.fetchall()]
+        except Exception:
+            self.task_queue.logger.error(f'cancel task error: {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, canceled)
+
+        canceled[self._indices(ids)] = True
+        self._status[canceled] = TaskStatus.CANCELED.value
+        return (ResultStatus.SUCCESS, canceled)
+
+    def completed(self, limit: int = None) -> Union[np.ndarray, None]:
+        """Retrieves the results of any tasks that have completed since the last call, popping them
+        off of the input queue, and returns the completion bitmap.
+
+        Args:
+            limit: the maximum number of newly completed task results to retrieve.
+
+        Returns:
+            A boolean array indicating which tasks have completed, or None if the query fails.
+        """
+        if self._pop(limit) is None:
+            return None
+        return self._completed.copy()
+
+    def _pop(self, limit: int = None) -> Union[np.ndarray, None]:
+        """Pops the results of the completed tasks, returning the indices of the newly completed tasks."""
+        pending = ~self._completed & (self._status != TaskStatus.CANCELED.value)
+        if not np.any(pending):
+            return np.empty(0, dtype=np.intp)
+        try:
+            rows = self.task_queue._pop_results(_array_literal(self.eq_task_ids[pending]), limit)
+        except Exception:
+            self.task_queue.logger.error(f'query_result error {traceback.format_exc()}')
+            return None
+
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.intp)
+        ids, results = zip(*rows)
+        indices = self._indices(ids)
+        self._completed[indices] = True
+        self._status[indices] = TaskStatus.COMPLETE.value
+        self._results.update(zip(indices.tolist(), results))
+        return np.sort(indices)
+
+    def result(self, idx: int) -> Union[str, None]:
+        """Gets the result of the task at the specified index, if it has been retrieved by :py:func:`completed`
+        or :py:func:`as_completed`.
+
+        Returns:
+            The task's result, or None if the result has not been retrieved.
+        """
+        return self._results.get(idx)
+
+    def results(self, indices: Iterable[int] = None) -> List[Union[str, None]]:
+        """Gets the results of the tasks at the specified indices, or of all the tasks if indices is None.
+        The result of a task whose result has not been retrieved is None.
+        """
+        if indices is None:
+            indices = range(len(self))
+        return [self._results.get(i) for i in indices]
+
+    def as_completed(self, timeout: float = None, n: int = None,
+                     sleep: float = 0.5) -> Generator[np.ndarray, None, None]:
+        """Returns a generator that yields arrays of the indices of the tasks that have completed
+        since the previous check. Each check for completed tasks is a single query. Tasks that have already
+        completed are not yielded. A :py:class:`TimeoutError <eqsql.task_queues.core.TimeoutError>` is raised
+        if the tasks do not complete within the specified ``timeout`` duration.
+
+        Args:
+            timeout: if the time taken for the tasks to complete is greater than this value, then
+                raise :py:class:`TimeoutError <eqsql.task_queues.core.TimeoutError>`.
+            n: yield the indices of at most this many completed tasks and then stop iteration.
+            sleep: the time, in seconds, to sleep between each check.
+
+        Yields:
+            Arrays of the indices of newly completed tasks.
+        """
+        start_time = time.time()
+        n_completed = 0
+        while True:
+            limit = None if n is None else n - n_completed
+            # a failed query is logged, and retried on the next check
+            indices = self._pop(limit)
+            if indices is not None and len(indices) > 0:
+                n_completed += len(indices)
+                yield indices
+
+            remaining = ~self._completed & (self._status != TaskStatus.CANCELED.value)
+            if n_completed == n or not np.any(remaining):
+                return
+
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TimeoutError(f'as_completed timed out after {timeout} seconds')
+
+            if sleep > 0:
+                time.sleep(sleep)
@@ -4,10 +4,10 @@ from random import shuffle
 from globus_compute_sdk import Executor
 from globus_compute_sdk.errors.error_types import TaskExecutionFailed
 
-from eqsql.task_queues.core import ResultStatus, TaskStatus, Future, TimeoutError
+from eqsql.task_queues.core import ResultStatus, TaskStatus, Future, TimeoutError, _get_future_results, _map_tasks
 from eqsql.task_queues.remote_funcs import _submit_tasks, _get_status, _get_priorities, _get_worker_pools
 from eqsql.task_queues.remote_funcs import _update_priorities, _query_result, _cancel_tasks, _clear_queues
-from eqsql.task_queues.remote_funcs import _are_queues_empty, _as_completed, DBParameters
+from eqsql.task_queues.remote_funcs import _are_queues_empty, _as_completed, _get_results, DBParameters
 
 
 class GCTaskQueue:
@@ -106,6 +106,55 @@ class GCTaskQueue:
         gc_ft = self.gcx.submit(_query_result, self.db_params, eq_task_id, delay, timeout)
         return gc_ft.result()
 
+    def get_results(self, futures: Iterable[Future], consume: bool = True) -> List[Tuple[Future, str]]:
+        """Gets the results of those of the specified tasks whose results are available, with a
+        single query, without waiting for the results. See
+        :py:func:`LocalTaskQueue.get_results <eqsql.task_queues.local_queue.LocalTaskQueue.get_results>`.
+
+        Args:
+            futures: the futures of the tasks to get the results of.
+            consume: if True, the results are popped off of the input queue and cached in their
+                futures, otherwise they are left in the input queue.
+
+        Returns:
+            A List of (Future, result) tuples, in the order of the specified futures, for the futures
+            whose results are available, or None if the query fails.
+        """
+        def query(eq_task_ids):
+            rows = self.gcx.submit(_get_results, self.db_params, eq_task_ids, consume).result()
+            return None if rows is None else dict(rows)
+
+        return _get_future_results(futures, query, consume)
+
+    def map(self, exp_id: str, eq_type: int, payload: Iterable[str], window: int = 1000, ordered: bool = True,
+            priority: int = 0, tag: str = None, timeout: float = None,
+            sleep: float = 0.5) -> Generator[Union[str, Tuple[int, str]], None, None]:
+        """Returns a generator that submits a task for each of the payloads, and yields the task results,
+        with at most ``window`` tasks in flight at a time. The tasks are submitted with
+        :py:func:`submit_tasks` as the window frees up, and the in flight tasks are checked for completion
+        with :py:func:`get_results`. See
+        :py:func:`LocalTaskQueue.map <eqsql.task_queues.local_queue.LocalTaskQueue.map>`.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: an iterable of the work payloads
+            window: the maximum number of tasks in flight.
+            ordered: if True, the results are yielded in payload order, otherwise they are yielded
+                as the tasks complete.
+            priority: the priority of the tasks
+            tag: an optional metadata tag for the tasks
+            timeout: if not None, a :py:class:`TimeoutError` is raised if all the results have not been
+                yielded this many seconds after the first result is requested.
+            sleep: the time, in seconds, to sleep between checks for completed tasks.
+
+        Yields:
+            If ordered is True, the task results in payload order, otherwise (index, result) tuples,
+            where index is the position of the task's payload in the payloads, as the tasks complete.
+        """
+        return _map_tasks(self, exp_id, eq_type, payload, window=window, ordered=ordered, priority=priority,
+                          tag=tag, timeout=timeout, sleep=sleep)
+
     def get_priorities(self, futures: Iterable[Future]) -> List[Tuple[Future, int]]:
         """Gets the priorities of the specified tasks.
 
@@ -4,25 +4,209 @@ service (e.g., Globus Computer or a RESTful API)"""
 
 
 from random import random
+import hashlib
+import io
+import json
 import traceback
 import logging
+import select
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import Iterable, Tuple, Dict, List, Generator, Union
+from itertools import islice
+from typing import Iterable, Iterator, Tuple, Dict, List, Generator, Union, Sequence, TextIO
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 
 from eqsql import db_tools
 from eqsql.db_tools import WorkflowSQL
 from eqsql.task_queues.core import ResultStatus, TaskStatus, TimeoutError
 from eqsql.task_queues.core import EQ_ABORT, EQ_STOP, EQ_TIMEOUT
-from eqsql.task_queues.core import Future, TaskQueue
+from eqsql.task_queues.core import Future, TaskQueue, _get_future_results, _map_tasks
 
 
 _log_id = 1
 
+# the maximum time to wait for a notification before polling the queue again,
+# in case a notification is missed or the pushing task queue doesn't notify
+MAX_NOTIFY_WAIT = 30.0
+
+# the minimum time between evictions of expired and excess cached results
+CACHE_PRUNE_INTERVAL = 10.0
+
+# watch sets that have not been popped from for this many seconds are deleted
+WATCH_MAX_IDLE = 3600.0
+
+
+def _out_channel(eq_type: int) -> str:
+    """Gets the name of the notification channel for pushes of the specified
+    task type to the output queue.
+    """
+    return f'eq_out_{eq_type}'
+
+
+def _in_channel(eq_task_id: int) -> str:
+    """Gets the name of the notification channel for pushes of the specified
+    task to the input queue.
+    """
+    return f'eq_in_{eq_task_id}'
+
+
+def _copy_escape(payload: str) -> str:
+    """Escapes the specified payload for COPY's text format."""
+    return payload.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+
+def _to_ranges(eq_task_ids: List[int]) -> List[range]:
+    """Compresses the specified sorted task ids into a list of contiguous ranges."""
+    ranges = []
+    start = prev = None
+    for eq_task_id in eq_task_ids:
+        if prev is not None and eq_task_id == prev + 1:
+            prev = eq_task_id
+            continue
+        if start is not None:
+            ranges.append(range(start, prev + 1))
+        start = prev = eq_task_id
+    if start is not None:
+        ranges.append(range(start, prev + 1))
+    return ranges
+
+
+def _cache_key(eq_type: int, payload: str, scope: str = None) -> str:
+    """Gets the result cache key of a task of the specified type and payload. JSON payloads
+    are normalized, so that payloads that differ only in key order or whitespace have the
+    same key.
+
+    Args:
+        eq_type: the type of the task
+        payload: the task payload
+        scope: the experiment id to which the key is scoped, or None for a key shared
+            by all experiments.
+
+    Returns:
+        The hex digest of the hash of the scope, type, and normalized payload.
+    """
+    try:
+        normalized = json.dumps(json.loads(payload), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        normalized = payload
+    scope = '' if scope is None else scope
+    return hashlib.sha256(f'{scope}\0{eq_type}\0{normalized}'.encode()).hexdigest()
+
+
+def _type_weights(eq_type: Union[int, List[int]],
+                  weights: Dict[int, float] = None) -> Tuple[List[int], List[float]]:
+    """Gets the task types and the weight of each type for a pop of the specified type or types.
+
+    Args:
+        eq_type: a task type, or a list of task types.
+        weights: an optional dictionary of task type to weight. The weight of a type
+            that is not in the dictionary is 0.
+
+    Returns:
+        A two element tuple of the list of task types and the list of their weights.
+    """
+    eq_types = [eq_type] if isinstance(eq_type, int) else [int(t) for t in eq_type]
+    if len(eq_types) == 0:
+        raise ValueError('Invalid eq_type: at least one task type must be specified')
+    weights = {} if weights is None else weights
+    unknown = set(weights) - set(eq_types)
+    if len(unknown) > 0:
+        raise ValueError(f'Invalid weights: weights specified for unqueried task types {sorted(unknown)}')
+    return (eq_types, [float(weights.get(t, 0)) for t in eq_types])
+
+
+def _sql_pop_out(eq_type: Union[int, List[int]], n: int, weights: Dict[int, float] = None,
+                 worker_pool: str = None, lease_duration: float = None, pool_labels: List[str] = None,
+                 fair_share: bool = False) -> Tuple[str, Tuple]:
+    """Gets the call of the server-side function that pops up to n tasks of the specified type or
+    types off of the output queue, marking them as running on the specified worker pool: eq_pop_out_fair
+    for a fair share pop, otherwise eq_pop_out_types (see workflow.sql). These functions are the
+    only implementation of the output queue pop, and are called by LocalTaskQueue, with and
+    without server_functions, and by AsyncLocalTaskQueue, so that all of them pop tasks in the same order.
+
+    Args:
+        eq_type: the type, or list of types, of the tasks to pop.
+        n: the maximum number of tasks to pop.
+        weights: an optional dictionary of task type to the weight added to the
+            priority of the tasks of that type.
+        worker_pool: the id of the worker pool popping the tasks.
+        lease_duration: if not None, the popped tasks are leased for this many seconds.
+        pool_labels: the labels, in addition to the worker pool id, of the targeted tasks to pop.
+        fair_share: if True, share the popped tasks between experiments in proportion to their weights.
+
+    Returns:
+        A two element tuple of the sql query and its parameters. The query returns
+        the (eq_task_id, json_out) rows of the popped tasks, ordered by eq_task_id.
+    """
+    eq_types, type_weights = _type_weights(eq_type, weights)
+    fn = 'eq_pop_out_fair' if fair_share else 'eq_pop_out_types'
+    sql_pop = (f'select * from {fn}(%s::integer[], %s::double precision[], %s::integer, %s::text, '
+               '%s::double precision, %s::text[])')
+    labels = [] if pool_labels is None else list(pool_labels)
+    return (sql_pop, (eq_types, type_weights, n, worker_pool, lease_duration, labels))
+
+
+class FutureSequence(Sequence):
+
+    def __init__(self, task_queue: 'LocalTaskQueue', tag: str = None):
+        """A sequence of :py:class:`Futures <Future>` whose task ids are stored as ranges,
+        such that the memory required is independent of the number of tasks. The
+        :py:class:`Futures <Future>` are created when accessed. FutureSequences are
+        returned by :py:func:`LocalTaskQueue.submit_stream`.
+
+        Args:
+            task_queue: the task queue that submitted the tasks
+            tag: the metadata tag of the tasks
+        """
+        self.task_queue = task_queue
+        self.tag = tag
+        self.ranges: List[range] = []
+        self._len = 0
+
+    def _extend(self, ranges: List[range]):
+        for r in ranges:
+            if len(self.ranges) > 0 and self.ranges[-1].stop == r.start:
+                self.ranges[-1] = range(self.ranges[-1].start, r.stop)
+            else:
+                self.ranges.append(r)
+            self._len += len(r)
+
+    @property
+    def eq_task_ids(self) -> Iterator[int]:
+        """Gets an iterator over the task ids in this FutureSequence."""
+        for r in self.ranges:
+            yield from r
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Future, List[Future]]:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self._len))]
+        if idx < 0:
+            idx += self._len
+        if idx < 0 or idx >= self._len:
+            raise IndexError('FutureSequence index out of range')
+        for r in self.ranges:
+            if idx < len(r):
+                return Future(self.task_queue, r[idx], self.tag)
+            idx -= len(r)
+
+    def __iter__(self) -> Iterator[Future]:
+        for eq_task_id in self.eq_task_ids:
+            yield Future(self.task_queue, eq_task_id, self.tag)
+
 
 class LocalTaskQueue:
 
-    def __init__(self, db: WorkflowSQL, logger: logging.Logger):
+    def __init__(self, db: WorkflowSQL, logger: logging.Logger, notify: bool = False,
+                 server_functions: bool = False, lease_duration: float = None, fair_share: bool = False,
+                 pool_labels: List[str] = None, result_cache: str = None, cache_ttl: float = None,
+                 cache_max_size: int = None):
         """Creates an LocalTaskQueue task queue connected to the specified database, logging to
         the specified logger. LocalTaskQueue tasks queues should be created with
         :py:func:`init_task_queue`.
@@ -30,9 +214,53 @@ class LocalTaskQueue:
         Args:
             db: the database to submit and retrieve tasks from
             logger: the logger to use for logging
+            notify: if True, pushes onto the output and input queues send a Postgres
+                NOTIFY, and queue pops wait for those notifications rather than sleeping
+                between polls. Pops fall back to polling if notifications are unavailable.
+            server_functions: if True, submitting a task, and querying for a task result,
+                are each performed by a single call to a server-side function
+                (see workflow.sql), rather than by multiple statements issued by this LocalTaskQueue.
+                Querying for tasks, and reporting tasks, always call the server-side functions.
+            lease_duration: if not None, tasks queried for by this LocalTaskQueue are leased for this
+                many seconds. The worker pool running the tasks should renew their leases before they
+                expire with :py:func:`renew_leases`, and running tasks whose leases have
+                expired can be requeued with :py:func:`requeue_expired`.
+            fair_share: if True, tasks queried for by this LocalTaskQueue are shared between the experiments
+                with queued tasks in proportion to the experiments' weights (see :py:func:`set_exp_weights`),
+                rather than being taken strictly in priority order. The next task is taken from the
+                experiment with the fewest running tasks relative to its weight, and each experiment's
+                tasks are taken in priority order.
+            pool_labels: the labels, in addition to the querying worker pool's id, of the targeted
+                tasks queried for by this LocalTaskQueue. Tasks submitted with a ``target_pool``
+                are only returned by queries from the worker pool with that id, or from a
+                LocalTaskQueue with that pool label.
+            result_cache: if not None, the tasks submitted by this LocalTaskQueue with :py:func:`submit_task`
+                and :py:func:`submit_tasks` are memoized: the result of a task is cached when it is reported,
+                and a later submission of the same type and JSON-equivalent payload returns an already
+                completed :py:class:`Future`, without queueing a task. The cached result is pushed
+                onto the input queue, and read like the result of any other completed task.
+                ``'experiment'`` scopes the cached results to the submitting experiment, and
+                ``'global'`` shares them between experiments.
+            cache_ttl: if not None, cached results older than this many seconds are not used, and are
+                evicted from the cache.
+            cache_max_size: if not None, the oldest cached results in excess of this number are evicted
+                from the cache.
         """
+        if result_cache not in (None, 'experiment', 'global'):
+            raise ValueError(f"Invalid result_cache: result_cache must be None, 'experiment' or 'global': "
+                             f"result_cache = {result_cache}")
         self.db = db
         self.logger = logger
+        self.notify = notify
+        self.server_functions = server_functions
+        self.lease_duration = lease_duration
+        self.fair_share = fair_share
+        self.pool_labels = [] if pool_labels is None else list(pool_labels)
+        self.result_cache = result_cache
+        self.cache_ttl = cache_ttl
+        self.cache_max_size = cache_max_size
+        self._cache_pruned = 0.0
+        self._channels = set()
 
     def close(self):
         """Closes the DB connection, and terminates this :py:class:`LocalTaskQueue` instance.
@@ -40,36 +268,7 @@ class LocalTaskQueue:
         if self.db:
             self.db.close()
         self.db = None
-
-    def _sql_pop_out_q(self, eq_type: int, n: int = 1) -> str:
-        """
-        Generates sql for a queue pop from emews_queue_out
-        From:
-        https://www.2ndquadrant.com/en/blog/what-is-select-skip-locked-for-in-postgresql-9-5
-        Can only select 1 column from the subquery,
-        but we return * from the deleted row.
-        See workflow.sql for the returned queue row
-
-        Args:
-            eq_type: the work type to pop.
-            n: the maximum number of eq_task_ids the sql query
-                should return.
-        Returns:
-            The sql query to pop from the out queue.
-        """
-        code = f"""
-        DELETE FROM emews_queue_OUT
-        WHERE  eq_task_id = any( array(
-        SELECT eq_task_id
-        FROM emews_queue_OUT
-        WHERE eq_task_type = {eq_type}
-        ORDER BY eq_priority DESC, eq_task_id ASC
-        FOR UPDATE SKIP LOCKED
-        LIMIT {n}
-        ))
-        RETURNING *;
-        """
-        return code
+        self._channels.clear()
 
     def _sql_pop_in_q(self, eq_task_id) -> str:
         """
@@ -100,38 +299,6 @@ class LocalTaskQueue:
         """
         return code
 
-    def pop_out_queue(self, cur, eq_type: int, n: int, delay: float,
-                      timeout: float) -> Tuple[ResultStatus, Union[int, str]]:
-        """Pops the highest priority task of the specified work type off
-        of the db out queue.
-
-        This call repeatedly polls for a task of the specified type. The polling
-        interval is specified by
-        the delay such that the first interval is defined by the initial delay value
-        which is then incremented after each poll. The polling will
-        timeout after the amount of time specified by the timout value is has elapsed.
-
-        Args:
-            eq_type: the type of the work to pop from the queue
-            n: the maximum number of tasks to pop from the queue
-            delay: the initial polling delay value
-            timeout: the duration after which this call will timeout
-                and return. If timeout is None, there is no limit to
-                the wait time.
-
-        Returns: A two element tuple where the first elements is one of
-            ResultStatus.SUCCESS or ResultStatus.FAILURE. On success the
-            second element will be the popped eq task id. On failure, the second
-            element will be one of EQ_ABORT or EQ_TIMEOUT depending on the
-            cause of the failure.
-        """
-        sql_pop = self._sql_pop_out_q(eq_type, n)
-        # print(sql_pop)
-        res = self._queue_pop(cur, sql_pop, delay, timeout)
-        self.logger.debug(f'pop_out_queue sql:\n{sql_pop}')
-        self.logger.debug(f'pop_out_queue: {res}')
-        return res
-
     def pop_in_queue(self, cur, eq_task_id: int, delay: float, timeout: float) -> Tuple[ResultStatus, Union[int, str]]:
         """Pops the specified task off of the db in queue.
 
@@ -155,12 +322,105 @@ class LocalTaskQueue:
             cause of the failure.
         """
         sql_pop = self._sql_pop_in_q(eq_task_id)
-        res = self._queue_pop(cur, sql_pop, delay, timeout)
+        channel = _in_channel(eq_task_id)
+        try:
+            res = self._queue_pop(cur, sql_pop, delay, timeout, [channel])
+        finally:
+            self._unlisten(channel)
         self.logger.debug(f'pop_in_queue: {res}')
         return res
 
+    def _listen(self, channels: Iterable[str]) -> bool:
+        """LISTENs for notifications on the specified channels using the
+        database's listener connection.
+
+        Args:
+            channels: the names of the channels to listen on
+
+        Returns:
+            True if notifications can be received on the channels, otherwise
+            False, in which case queue pops should fall back to polling.
+        """
+        if not self.notify:
+            return False
+        try:
+            conn = self.db.connect_listener()
+            with conn.cursor() as cur:
+                for channel in channels:
+                    if channel not in self._channels:
+                        cur.execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel)))
+                        self._channels.add(channel)
+            return True
+        except Exception:
+            self.logger.warning(f'listen error, falling back to polling {traceback.format_exc()}')
+            self._reset_listener()
+            return False
+
+    def _unlisten(self, channel: str):
+        """Stops LISTENing for notifications on the specified channel.
+        """
+        if channel in self._channels:
+            self._channels.remove(channel)
+            try:
+                with self.db.listen_conn.cursor() as cur:
+                    cur.execute(sql.SQL('UNLISTEN {}').format(sql.Identifier(channel)))
+            except Exception:
+                self.logger.warning(f'unlisten error {traceback.format_exc()}')
+                self._reset_listener()
+
+    def _reset_listener(self):
+        self._channels.clear()
+        if self.db is not None:
+            self.db.close_listener()
+
+    def _notify(self, cur, channel: str):
+        """Sends a notification on the specified channel. The notification is delivered
+        when the transaction that cur is part of commits. Identical notifications
+        within a transaction are delivered once, so a bulk push results in a single
+        notification.
+        """
+        if self.notify:
+            cur.execute('select pg_notify(%s, %s)', (channel, ''))
+
+    def _wait_for_notify(self, channels: Iterable[str], wait: float) -> bool:
+        """Blocks on the listener connection's socket until a notification arrives on one of the
+        specified channels, or the wait duration has elapsed.
+
+        Args:
+            channels: the channels to wait for a notification on
+            wait: the maximum duration to wait
+
+        Returns:
+            True if a notification was received, otherwise False.
+        """
+        conn = self.db.listen_conn
+        end = time.time() + wait
+        try:
+            while True:
+                received = False
+                for notification in conn.notifies:
+                    if notification.channel in channels:
+                        received = True
+                # discard notifications for the waited on channels and any channels
+                # that are no longer listened to
+                conn.notifies[:] = [n for n in conn.notifies
+                                    if n.channel not in channels and n.channel in self._channels]
+                remaining = end - time.time()
+                if received or remaining <= 0:
+                    return received
+                if select.select([conn], [], [], remaining) != ([], [], []):
+                    conn.poll()
+        except Exception:
+            self.logger.warning(f'notification wait error, falling back to polling {traceback.format_exc()}')
+            self._reset_listener()
+            remaining = end - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            return False
+
     def _queue_pop(self, cur, sql_pop: str, delay: float,
-                   timeout: float) -> Tuple[ResultStatus, Union[List[int], str]]:
+                   timeout: float, channels: List[str] = None, params: Tuple = None,
+                   column: Union[int, None] = 1) -> Tuple[ResultStatus, Union[List[int], str]]:
         """Performs the actual queue pop as defined the sql string.
 
         This call repeatedly attempts the pop operation by executing sql until
@@ -169,6 +429,9 @@ class LocalTaskQueue:
         the delay such that the first interval is defined by the initial delay value
         which is then incremented after each poll. The polling will
         timeout after the amount of time specified by the timout value is has elapsed.
+        If this LocalTaskQueue is in notify mode, then rather than sleeping between polls,
+        this waits for a notification on the specified channels, until the timeout
+        or :py:data:`MAX_NOTIFY_WAIT` has elapsed.
 
         Args:
             cur: the db cursor to execute the sql with
@@ -177,30 +440,44 @@ class LocalTaskQueue:
             timeout: the duration after which this call will timeout
                 and return. If timeout is None, there is no limit to
                 the wait time.
+            channels: the notification channels on which pushes to the
+                queue are announced.
+            params: the parameters, if any, of the sql query
+            column: the column of the popped rows to return, or None to return
+                the entire rows.
 
         Returns: A two element tuple where the first elements is one of
             ResultStatus.SUCCESS or ResultStatus.FAILURE. On success the
-            second element will be a list of the popped eq_task_ids.
+            second element will be a list of the popped eq_task_ids (or rows).
             On failure, the second
             element will be one of EQ_ABORT or EQ_TIMEOUT depending on the
             cause of the failure.
         """
         start = time.time()
         results = []
+        # listen before the first pop so a push between the pop and the
+        # wait is not missed
+        listening = channels is not None and self._listen(channels)
         try:
             while True:
-                cur.execute(sql_pop)
+                cur.execute(sql_pop, params)
                 # returns task_type, task_id, priority
-                results = [res[1] for res in cur.fetchall()]
+                results = [res if column is None else res[column] for res in cur.fetchall()]
                 # print(f'Results: {results}')
                 if len(results) > 0:
                     break  # got good data
                 if timeout is not None:
                     if time.time() - start > timeout:
                         return (ResultStatus.FAILURE, EQ_TIMEOUT)
-                time.sleep(delay)
-                if delay < 30:
-                    delay += 0.25
+                if listening and self.db.listen_conn is not None:
+                    wait = MAX_NOTIFY_WAIT
+                    if timeout is not None:
+                        wait = min(wait, max(0, timeout - (time.time() - start)) + 0.01)
+                    self._wait_for_notify(channels, wait)
+                else:
+                    time.sleep(delay)
+                    if delay < 30:
+                        delay += 0.25
         except Exception as e:
             self.logger.error(f'queue_pop error {traceback.format_exc()}')
             raise e
@@ -209,7 +486,7 @@ class LocalTaskQueue:
 
     def push_out_queue(self, cur, eq_task_id: int, eq_type: int, priority: int = 0):
         """Pushes the specified task onto the output queue with
-        the specified priority.
+        the specified priority, and the task's target worker pool, if any.
 
         Args:
             cur: the database cursor used to execute the sql push
@@ -219,98 +496,93 @@ class LocalTaskQueue:
         """
         try:
             # queue_push("emews_queue_OUT", eq_type, eq_task_id, priority)
-            insert_cmd = db_tools.format_insert('emews_queue_out', ["eq_task_type", "eq_task_id",
-                                                "eq_priority"])
-            cur.execute(insert_cmd, [eq_type, eq_task_id, priority])
+            insert_cmd = """insert into emews_queue_out (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key,
+                                                         target_pool)
+                            select %s, %s, %s, (select exp_id from eq_exp_id_tasks where eq_task_id = %s limit 1),
+                                %s - eq_aging_offset(%s), (select target_pool from eq_tasks where eq_task_id = %s)"""
+            cur.execute(insert_cmd, [eq_type, eq_task_id, priority, eq_task_id, priority, eq_type, eq_task_id])
             update_cmd = db_tools.format_update('eq_tasks', ['eq_status'], where='eq_task_id=%s')
             cur.execute(update_cmd, [TaskStatus.QUEUED.value, eq_task_id])
+            self._notify(cur, _out_channel(eq_type))
 
         except Exception as e:
             self.logger.error(f'push_out_queue error {traceback.format_exc()}')
             raise e
 
-    def push_in_queue(self, cur, eq_task_id: int, eq_type: int) -> ResultStatus:
-        """Pushes the specified task onto the input queue.
-
-        Args:
-            cur: the database cursor used to execute the sql push
-            eq_task_id: the id of the task
-            eq_type: the type of the task
-        Returns:
-            ResultStatus.SUCCESS if the task was successfully pushed
-            onto the input queue, otherwise ResultStatus.FAILURE.
-        """
-        try:
-            cmd = db_tools.format_insert('emews_queue_IN', ["eq_task_type", "eq_task_id"])
-            cur.execute(cmd, [eq_type, eq_task_id])
-            return ResultStatus.SUCCESS
-        except Exception:
-            self.logger.error(f'push_in_queue error {traceback.format_exc()}')
-            return ResultStatus.FAILURE
-
-    def _insert_task(self, cur, exp_id: str, eq_type: int, payload: str, priority: int) -> int:
-        """Inserts the specified payload to the database, creating
-        a task entry for it and returning its assigned task id
+    def _insert_tasks(self, cur, exp_id: str, eq_type: int, payloads: List[str], priority: int,
+                      tag: str = None, target_pool: str = None, cache_keys: List[str] = None,
+                      results: List[str] = None) -> List[int]:
+        """Inserts the specified payloads into the database, creating task entries for them
+        in the tasks table, pushing them onto the output queue, and returning their
+        assigned task ids. The ids are allocated in a single statement, and
+        the tasks are inserted with a single multi-row insert. Tasks with a cached result
+        are inserted as complete with that result, and are pushed onto the input queue rather
+        than the output queue, so that their results are read like those of any other completed task.
 
         Args:
             cur: the database cursor used to execute the insert
-            exp_id: the id of the experiment that this task is part of
-            eq_type: the work type of this task
-            payload: the task payload
+            exp_id: the id of the experiment that these tasks are part of
+            eq_type: the work type of these tasks
+            payloads: the task payloads
+            priority: the priority of these tasks
+            tag: an optional metadata tag for the tasks
+            target_pool: the optional id or label of the worker pool to run the tasks
+            cache_keys: the optional result cache keys of the tasks, in payload order
+            results: the optional cached results of the tasks, in payload order, None
+                for a task without a cached result.
 
         Returns:
-            The task id assigned to this task if the insert
+            The task ids assigned to the tasks, in payload order, if the insert
             was successfull, otherwise raise an exception.
         """
         try:
-            cur.execute("select nextval('emews_id_generator');")
-            rs = cur.fetchone()
-            eq_task_id = rs[0]
+            cur.execute("select nextval('emews_id_generator') from generate_series(1, %s);", (len(payloads),))
+            eq_task_ids = sorted(rs[0] for rs in cur.fetchall())
             ts = datetime.now(timezone.utc).astimezone().isoformat()
-            insert_cmd = db_tools.format_insert("eq_tasks", ["eq_task_id", "eq_task_type",
-                                                "json_out", "time_created", "eq_priority"])
-            cur.execute(insert_cmd, [eq_task_id, eq_type, payload, ts, priority])
-            insert_cmd = db_tools.format_insert("eq_exp_id_tasks", ["exp_id", "eq_task_id"])
-            cur.execute(insert_cmd, [exp_id, eq_task_id])
-        except Exception as e:
-            self.logger.error(f'insert_task error {traceback.format_exc()}')
-            raise e
-
-        return eq_task_id
-
-    def select_task_payload(self, cur, eq_task_ids: Iterable[int], worker_pool_id: str = 'default') -> List[Tuple[int, str]]:
-        """Selects the ``json_out`` payload associated with the specified task ids in
-        the ``eq_tasks`` table, setting the start time of the tasks to
-        the current time, the status of the tasks to :py:class:`TaskStatus.RUNNING`, and the
-        worker_pool to the specified worker_pool.
 
-        Args:
-            cur: the database cursor used to execute the sql select
-            eq_task_ids: the ids of the tasks to get the json_out for
-            worker_pool_id: the id of the worker pool asking for the payload
-
-        Returns:
-            If successful, a list of tuples containing an ``eq_task_id`` and
-            the ``json_out`` payload, otherwise raise an exception.
-        """
-
-        placeholders = ', '.join(['%s'] * len(eq_task_ids))
-        task_ids = list(eq_task_ids)
-        try:
-            query = f'select eq_task_id, json_out from eq_tasks where eq_task_id in ({placeholders}) ORDER BY eq_task_id ASC'
-            cur.execute(query, task_ids)
-            result = [(rs[0], rs[1]) for rs in cur.fetchall()]
-            # cmd = db_tools.format_select("eq_tasks", "json_out", 'eq_task_id=%s')
-            # cur.execute(cmd, (eq_task_id,))
-            # rs = cur.fetchone()
-            ts = datetime.now(timezone.utc).astimezone().isoformat()
-            cmd = f'update eq_tasks set eq_status=%s, worker_pool=%s, time_start=%s where eq_task_id in ({placeholders})'
-            cur.execute(cmd, [TaskStatus.RUNNING.value, worker_pool_id, ts] + task_ids)
-            return result
+            def literal(val):
+                # execute_values treats % as a placeholder prefix so escape any in the literal
+                return sql.Literal(val).as_string(cur).replace('%', '%%')
+
+            tag_cte = ''
+            if tag is not None:
+                tag_cte = f'tags as (insert into eq_task_tags (eq_task_id, tag) select eq_task_id, {literal(tag)} from inserted),'
+            # the %s is filled in by execute_values with the multi-row VALUES list
+            insert_cmd = f"""
+                with inserted as (
+                    insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status,
+                                          target_pool, cache_key, json_in, time_stop)
+                    values %s returning eq_task_id, eq_task_type, eq_priority, eq_status, target_pool
+                ),
+                exp_ids as (insert into eq_exp_id_tasks (exp_id, eq_task_id)
+                            select {literal(exp_id)}, eq_task_id from inserted),
+                {tag_cte}
+                queued as (insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key,
+                                                        target_pool)
+                           select eq_task_type, eq_task_id, eq_priority, {literal(exp_id)}, eq_priority - aging_offset,
+                               target_pool
+                           from inserted, (select eq_aging_offset({literal(eq_type)})) as a (aging_offset)
+                           where eq_status = {TaskStatus.QUEUED.value}),
+                completed as (insert into emews_queue_IN (eq_task_type, eq_task_id)
+                              select eq_task_type, eq_task_id from inserted
+                              where eq_status = {TaskStatus.COMPLETE.value})
+                select 1;
+                """
+            if cache_keys is None:
+                cache_keys = [None] * len(payloads)
+            if results is None:
+                results = [None] * len(payloads)
+            values = [(eq_task_id, eq_type, payload, ts, priority,
+                       TaskStatus.QUEUED.value if result is None else TaskStatus.COMPLETE.value, target_pool,
+                       cache_key, result, None if result is None else ts)
+                      for eq_task_id, payload, cache_key, result in zip(eq_task_ids, payloads, cache_keys, results)]
+            execute_values(cur, insert_cmd, values, page_size=len(values))
         except Exception as e:
-            self.logger.error(f'select_task_payload error {traceback.format_exc()}')
+            self.logger.error(f'insert_tasks error {traceback.format_exc()}')
             raise e
 
+        return eq_task_ids
+
     def select_task_result(self, cur, eq_task_id: int) -> str:
         """Selects the result (``json_in``) payload associated with the specified task id in
         the ``eq_tasks`` table.
@@ -344,24 +616,6 @@ class LocalTaskQueue:
             self.logger.error(f'_get error {traceback.format_exc()}')
             return (ResultStatus.FAILURE, [])
 
-    def update_task(self, cur, eq_task_id: int, payload: str):
-        """Updates the specified task in the ``eq_tasks`` table with the specified
-        result payload (the ``json_in``). This also updates the ``time_stop``
-        to the time when the update occurred.
-
-        Args:
-            eq_task_id: the id of the task to update
-            payload: the payload to update the task with
-        """
-        ts = datetime.now(timezone.utc).astimezone().isoformat()
-        try:
-            cmd = db_tools.format_update("eq_tasks", ['json_in', 'eq_status', 'time_stop'],
-                                         where='eq_task_id=%s')
-            cur.execute(cmd, [payload, TaskStatus.COMPLETE.value, ts, eq_task_id])
-        except Exception as e:
-            self.logger.error(f'update_task error {traceback.format_exc()}')
-            raise e
-
     def stop_worker_pool(self, eq_type: int) -> ResultStatus:
         """Stops any workers pools associated with the specified work type by
         pushing ``EQ_STOP`` into the queue.
@@ -386,8 +640,67 @@ class LocalTaskQueue:
             self.logger.error(f'stop_worker_pool error {traceback.format_exc()}')
             return ResultStatus.FAILURE
 
+    @contextmanager
+    def _autocommit_cursor(self):
+        """Context manager for a cursor whose statements each run in their own
+        transaction. A server-side function call executed with this cursor
+        takes a single round trip, with no separate BEGIN or COMMIT.
+        """
+        conn = self.db.conn
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                yield cur
+        finally:
+            conn.autocommit = False
+
+    def _prune_cache(self, cur, ttl: float = None, max_size: int = None):
+        """Evicts the cached results that are older than ttl seconds, and the oldest cached results
+        in excess of max_size.
+        """
+        if ttl is not None:
+            cur.execute('delete from eq_result_cache where time_cached < now() - make_interval(secs => %s)', (ttl,))
+        if max_size is not None:
+            cur.execute("""delete from eq_result_cache where cache_key = any(array(
+                               select cache_key from eq_result_cache
+                               order by time_cached desc, cache_key offset %s))""", (max_size,))
+
+    def _lookup_cache(self, cur, exp_id: str, eq_type: int, payloads: List[str]) -> Tuple[List[str], List[str]]:
+        """Gets the result cache keys of the specified payloads, and their cached results, if this
+        LocalTaskQueue caches results. Expired and excess cached results are evicted first,
+        at most once every CACHE_PRUNE_INTERVAL seconds.
+
+        Returns:
+            A two element tuple of the list of cache keys, and the list of cached results, with
+            None for the payloads that do not have a cached result, in payload order, or (None, None)
+            if this LocalTaskQueue does not cache results.
+        """
+        if self.result_cache is None:
+            return (None, None)
+
+        if (self.cache_ttl is not None or self.cache_max_size is not None) and \
+                time.time() - self._cache_pruned > CACHE_PRUNE_INTERVAL:
+            self._prune_cache(cur, self.cache_ttl, self.cache_max_size)
+            self._cache_pruned = time.time()
+
+        scope = exp_id if self.result_cache == 'experiment' else None
+        cache_keys = [_cache_key(eq_type, payload, scope) for payload in payloads]
+        cur.execute("""select cache_key, json_in from eq_result_cache where cache_key = any(%s)
+                       and (%s::double precision is null or time_cached >= now() - make_interval(secs => %s))""",
+                    (cache_keys, self.cache_ttl, self.cache_ttl))
+        cached = dict(cur.fetchall())
+        return (cache_keys, [cached.get(cache_key) for cache_key in cache_keys])
+
+    def _submit_chunk(self, cur, exp_id: str, eq_type: int, payloads: List[str], priority: int,
+                      tag: str = None, target_pool: str = None) -> List[Future]:
+        """Inserts the specified payloads with :py:func:`_insert_tasks`, completing those with a cached
+        result, if this LocalTaskQueue caches results, and returns the ids of the tasks.
+        """
+        cache_keys, results = self._lookup_cache(cur, exp_id, eq_type, payloads)
+        return self._insert_tasks(cur, exp_id, eq_type, payloads, priority, tag, target_pool, cache_keys, results)
+
     def submit_task(self, exp_id: str, eq_type: int, payload: str, priority: int = 0,
-                    tag: str = None) -> Tuple[ResultStatus, Union[Future, None]]:
+                    tag: str = None, target_pool: str = None) -> Tuple[ResultStatus, Union[Future, None]]:
         """Submits work of the specified type and priority with the specified
         payload, returning the :py:class:`status <ResultStatus>` and the :py:class:`Future` encapsulating the submission.
 
@@ -397,31 +710,45 @@ class LocalTaskQueue:
             payload: the work payload
             priority: the priority of this work
             tag: an optional metadata tag for the task
+            target_pool: the optional id or label of the worker pool to run the task. A targeted task
+                is only returned by :py:func:`query_task` to the worker pool with that id, or to a
+                LocalTaskQueue with that pool label.
 
         Returns:
             A tuple containing the status (:py:class:`ResultStatus.FAILURE` or :py:class:`ResultStatus.SUCCESS`) of the submission
-            and if successful, a :py:class:`Future` representing the submitted task otherwise None.
+            and if successful, a :py:class:`Future` representing the submitted task otherwise None. If this
+            LocalTaskQueue caches results, and the task's result is cached, the :py:class:`Future` is
+            already complete, and its result is on the input queue.
         """
+        # result cache lookups are not performed by eq_submit
+        if self.server_functions and self.result_cache is None:
+            try:
+                with self._autocommit_cursor() as cur:
+                    cur.execute('select eq_submit(%s, %s, %s, %s, %s, %s, %s)',
+                                (exp_id, eq_type, payload, priority, tag, self.notify, target_pool))
+                    return (ResultStatus.SUCCESS, Future(self, cur.fetchone()[0], tag))
+            except Exception:
+                self.logger.error(f'submit_task error {traceback.format_exc()}')
+                return (ResultStatus.FAILURE, None)
+
         try:
             with self.db.conn:
                 with self.db.conn.cursor() as cur:
-                    eq_task_id = self._insert_task(cur, exp_id, eq_type, payload, priority)
-                    if tag is not None:
-                        cmd = db_tools.format_insert('eq_task_tags', ['eq_task_id', 'tag'])
-                        cur.execute(cmd, (eq_task_id, tag))
-                    self.push_out_queue(cur, eq_task_id, eq_type, priority)
+                    eq_task_id = self._submit_chunk(cur, exp_id, eq_type, [payload], priority, tag, target_pool)[0]
+                    self._notify(cur, _out_channel(eq_type))
                     return (ResultStatus.SUCCESS, Future(self, eq_task_id, tag))
         except Exception:
             self.logger.error(f'submit_task error {traceback.format_exc()}')
             return (ResultStatus.FAILURE, None)
 
     def submit_tasks(self, exp_id: str, eq_type: int, payload: List[str], priority: int = 0,
-                     tag: str = None) -> Tuple[ResultStatus, List[Future]]:
+                     tag: str = None, chunk_size: int = 10000,
+                     target_pool: str = None) -> Tuple[ResultStatus, List[Future]]:
         """Submits work of the specified type and priority with the specified
         payloads, returning the :py:class:`status <ResultStatus>` and the :py:class:`futures <Future>`
         encapsulating the submission.
-        This is essentially a convenience wrapper around :py:func:`~LocalTaskQueue.submit_task` for submitting
-        a list of payloads.
+        All the payloads are submitted in a single transaction, using multi-row
+        inserts of at most ``chunk_size`` payloads each.
 
         Args:
             exp_id: the id of the experiment of which the work is part.
@@ -429,29 +756,144 @@ class LocalTaskQueue:
             payload: a list of the work payloads
             priority: the priority of this work
             tag: an optional metadata tag for the tasks
+            chunk_size: the maximum number of payloads to insert per statement.
+            target_pool: the optional id or label of the worker pool to run the tasks.
+                See :py:func:`submit_task`.
 
         Returns:
             A tuple containing the status (:py:class:`ResultStatus.FAILURE` or :py:class:`ResultStatus.SUCCESS`)
-            of the submission and the list of :py:class:`futures <Future>` for the submitted tasks. If the submission fails,
-            the list of :py:class:`futures <Future>` will contain the :py:class:`futures <Future>` that submitted sucessfully.
+            of the submission and the list of :py:class:`futures <Future>` for the submitted tasks. The submission
+            is a single transaction, so if the submission fails, the list of :py:class:`futures <Future>` will be empty.
+            If this LocalTaskQueue caches results, the :py:class:`futures <Future>` of the tasks whose results are
+            cached are already complete.
         """
+        if chunk_size < 1:
+            raise ValueError(f'Invalid chunk_size: chunk_size must be greater than 0: chunk_size = {chunk_size}')
+
         fts = []
-        for task in payload:
-            rs, ft = self.submit_task(exp_id, eq_type, task, priority, tag)
-            if rs != ResultStatus.SUCCESS:
-                break
-            fts.append(ft)
-        return (rs, fts)
-
-    def query_more_tasks(self, eq_type: int, eq_task_ids: Iterable[int], batch_size: int, threshold: int = 1,
-                         worker_pool: str = 'default', delay: float = 0.5, timeout: float = 2.0) -> Tuple[List[int], List[Dict]]:
-        """Queries for tasks of the specified type, returning up to batch_size number of tasks. The
+        payloads = iter(payload)
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    while True:
+                        chunk = list(islice(payloads, chunk_size))
+                        if len(chunk) == 0:
+                            break
+                        fts.extend(Future(self, eq_task_id, tag) for eq_task_id in
+                                   self._submit_chunk(cur, exp_id, eq_type, chunk, priority, tag, target_pool))
+                    self._notify(cur, _out_channel(eq_type))
+        except Exception:
+            self.logger.error(f'submit_tasks error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+        return (ResultStatus.SUCCESS, fts)
+
+    def _stage_chunk(self, cur, payloads: List[str]):
+        """Creates, if necessary, the temporary staging table, and COPYs the payloads into it.
+        The staging table is emptied when the transaction commits.
+        """
+        cur.execute('create temporary table if not exists eq_submit_stage '
+                    '(ord bigserial, json_out text) on commit delete rows')
+        buf = io.StringIO(''.join(f'{_copy_escape(payload)}\n' for payload in payloads))
+        cur.copy_expert('copy eq_submit_stage (json_out) from stdin', buf)
+
+    def submit_stream(self, exp_id: str, eq_type: int, payload_iter: Union[Iterable[str], TextIO], priority: int = 0,
+                      tag: str = None, chunk_size: int = 50000,
+                      target_pool: str = None) -> Tuple[ResultStatus, FutureSequence]:
+        """Submits work of the specified type and priority with the payloads produced
+        by the specified iterator or text file, returning the :py:class:`status <ResultStatus>` and a
+        :py:class:`FutureSequence` of the :py:class:`futures <Future>` encapsulating the submission.
+        The payloads are streamed into the database in chunks of ``chunk_size`` payloads, each
+        of which is loaded with ``COPY`` into a staging table and moved into the tasks and queue
+        tables with set-based SQL. Each chunk is a separate transaction, so the memory used
+        on both the client and the database server is bounded by the chunk size, regardless of the
+        number of payloads.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload_iter: an iterable of work payloads, or a text file containing
+                one payload per line.
+            priority: the priority of this work
+            tag: an optional metadata tag for the tasks
+            chunk_size: the number of payloads to submit per transaction.
+            target_pool: the optional id or label of the worker pool to run the tasks.
+                See :py:func:`submit_task`.
+
+        Returns:
+            A tuple containing the status (:py:class:`ResultStatus.FAILURE` or :py:class:`ResultStatus.SUCCESS`)
+            of the submission and a :py:class:`FutureSequence` of the :py:class:`futures <Future>` for the submitted
+            tasks. If the submission fails, the :py:class:`FutureSequence` will contain the
+            :py:class:`futures <Future>` from the chunks that submitted successfully.
+        """
+        if chunk_size < 1:
+            raise ValueError(f'Invalid chunk_size: chunk_size must be greater than 0: chunk_size = {chunk_size}')
+
+        if hasattr(payload_iter, 'read'):
+            payload_iter = (line.rstrip('\n') for line in payload_iter if len(line.strip()) > 0)
+        payloads = iter(payload_iter)
+
+        tag_cte = ''
+        if tag is not None:
+            tag_cte = 'tags as (insert into eq_task_tags (eq_task_id, tag) select eq_task_id, %(tag)s from inserted),'
+        fan_out = f"""
+            with staged as (
+                select nextval('emews_id_generator') as eq_task_id, json_out
+                from (select json_out from eq_submit_stage order by ord) as s
+            ),
+            inserted as (
+                insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status,
+                                      target_pool)
+                select eq_task_id, %(eq_type)s, json_out, %(ts)s, %(priority)s, %(status)s, %(target_pool)s from staged
+                returning eq_task_id, eq_task_type, eq_priority, target_pool
+            ),
+            exp_ids as (insert into eq_exp_id_tasks (exp_id, eq_task_id)
+                        select %(exp_id)s, eq_task_id from inserted),
+            {tag_cte}
+            queued as (insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key,
+                                                    target_pool)
+                       select eq_task_type, eq_task_id, eq_priority, %(exp_id)s, eq_priority - aging_offset,
+                           target_pool
+                       from inserted, (select eq_aging_offset(%(eq_type)s)) as a (aging_offset)
+                       returning eq_task_id)
+            select array_agg(eq_task_id order by eq_task_id) from queued;
+            """
+
+        fts = FutureSequence(self, tag)
+        try:
+            while True:
+                chunk = list(islice(payloads, chunk_size))
+                if len(chunk) == 0:
+                    break
+                with self.db.conn:
+                    with self.db.conn.cursor() as cur:
+                        self._stage_chunk(cur, chunk)
+                        ts = datetime.now(timezone.utc).astimezone().isoformat()
+                        cur.execute(fan_out, {'eq_type': eq_type, 'ts': ts, 'priority': priority,
+                                              'status': TaskStatus.QUEUED.value, 'exp_id': exp_id, 'tag': tag,
+                                              'target_pool': target_pool})
+                        eq_task_ids = cur.fetchone()[0]
+                        self._notify(cur, _out_channel(eq_type))
+                fts._extend(_to_ranges(eq_task_ids))
+        except Exception:
+            self.logger.error(f'submit_stream error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, fts)
+
+        return (ResultStatus.SUCCESS, fts)
+
+    def query_more_tasks(self, eq_type: Union[int, List[int]], eq_task_ids: Iterable[int], batch_size: int,
+                         threshold: int = 1, worker_pool: str = 'default', delay: float = 0.5, timeout: float = 2.0,
+                         weights: Dict[int, float] = None) -> Tuple[List[int], List[Dict]]:
+        """Queries for tasks of the specified type or types, returning up to batch_size number of tasks. The
         exact number of task to return is batch_size - *X* where *X* is the number of currently running tasks
         from those in eq_task_ids. The intention here is that a worker pool may have a limited amount
         of capacity and should not get more tasks than that capacity. eq_task_ids keeps track of the number
         tasks the worker pool is working on and batch_size is the maximum amount of work (tasks)
         the worker pool wants to execute. When the difference between batch size and the number of
-        running tasks is greater than the threshold then query for tasks.
+        running tasks is greater than the threshold then query for tasks. If this LocalTaskQueue has a lease
+        duration, the leases of the running tasks are renewed. Tasks whose leases have been lost, and that
+        the worker pool may still be running, are counted as running until they are reported, by any
+        worker pool, or canceled.
 
         The query repeatedly polls for tasks. The polling
         interval is specified by
@@ -460,7 +902,7 @@ class LocalTaskQueue:
         timeout after the amount of time specified by the timout value is has elapsed.
 
         Args:
-            eq_type: the type of the work to query for.
+            eq_type: the type of the work to query for, or a list of types. See :py:func:`query_task`.
             eq_task_ids: the possibly running task ids used to determine the number of tasks to return.
             batch_size: the maximum amount of tasks to return
             threshold: the number of free "slots" (difference between running workers and batch_size)
@@ -470,7 +912,8 @@ class LocalTaskQueue:
             delay: the initial polling delay value
             timeout: the duration after which the query will timeout. If timeout is None, there is no limit to
                 the wait time.
-
+            weights: an optional dictionary of work type to weight when querying for several types.
+                See :py:func:`query_task`.
 
         Returns:
             A two element Tuple where the first element is a List of the ids of the currently running tasks
@@ -488,7 +931,22 @@ class LocalTaskQueue:
                              f'or equal to batch_size: threshold = {threshold}, batch_size = {batch_size}')
 
         running_tasks = []
-        if len(eq_task_ids) > 0:
+        if len(eq_task_ids) > 0 and self.lease_duration is not None:
+            status, renewed = self.renew_leases(eq_task_ids, worker_pool)
+            if status != ResultStatus.SUCCESS:
+                return ([], [{'type': 'status', 'payload': EQ_ABORT}])
+            renewed = set(renewed)
+            lost = [eq_task_id for eq_task_id in eq_task_ids if eq_task_id not in renewed]
+            statuses = self._query_status(lost) if len(lost) > 0 else []
+            if statuses is None:
+                return ([], [{'type': 'status', 'payload': EQ_ABORT}])
+            # the worker pool may still be running the tasks whose leases were lost, so
+            # they fill a slot until they are reported or canceled
+            unfinished = set(eq_task_id for eq_task_id, task_status in statuses
+                             if task_status not in (TaskStatus.COMPLETE, TaskStatus.CANCELED))
+            running_tasks = [eq_task_id for eq_task_id in eq_task_ids
+                             if eq_task_id in renewed or eq_task_id in unfinished]
+        elif len(eq_task_ids) > 0:
             statuses = self._query_status(eq_task_ids)
             if statuses is None:
                 return ([], [{'type': 'status', 'payload': EQ_ABORT}])
@@ -500,7 +958,8 @@ class LocalTaskQueue:
         n_query = batch_size - len(running_tasks)
         # print(f'n_query: {n_query}', flush=True)
         if n_query >= threshold:
-            new_tasks = self.query_task(eq_type, n=n_query, worker_pool=worker_pool, delay=delay, timeout=timeout)
+            new_tasks = self.query_task(eq_type, n=n_query, worker_pool=worker_pool, delay=delay, timeout=timeout,
+                                        weights=weights)
             if n_query == 1:
                 if 'eq_task_id' in new_tasks:
                     return (running_tasks + [new_tasks['eq_task_id']], [new_tasks])
@@ -517,9 +976,21 @@ class LocalTaskQueue:
         else:
             return (running_tasks, [])
 
-    def query_task(self, eq_type: int, n: int = 1, worker_pool: str = 'default', delay: float = 0.5, timeout: float = 2.0) -> Union[List[Dict], Dict]:
+    def query_task(self, eq_type: Union[int, List[int]], n: int = 1, worker_pool: str = 'default', delay: float = 0.5,
+                   timeout: float = 2.0, weights: Dict[int, float] = None) -> Union[List[Dict], Dict]:
         """Queries for the highest priority task of the specified type.
 
+        If the task type has an aging rate (see :py:func:`set_aging_rates`), a task's priority
+        is its effective priority, which grows with the time the task has been queued.
+
+        Only untargeted tasks, and tasks submitted with a ``target_pool`` of ``worker_pool`` or of one
+        of this LocalTaskQueue's pool labels, are returned.
+
+        If eq_type is a list of types, a single query returns the highest priority tasks of any of those
+        types. The tasks of each type can be weighted, so that, for example, a type with a weight of
+        10 is preferred over a type with a weight of 0 unless the latter's tasks have a priority more
+        than 10 greater.
+
         The query repeatedly polls for n number of tasks. The polling
         interval is specified by
         the delay such that the first interval is defined by the initial delay value
@@ -527,12 +998,15 @@ class LocalTaskQueue:
         timeout after the amount of time specified by the timout value is has elapsed.
 
         Args:
-            eq_type: the type of the task to query for
+            eq_type: the type of the task to query for, or a list of types
             n: the maximum number of tasks to query for
-            worker_pool: the id of the worker pool query for the tasks
+            worker_pool: the id of the worker pool query for the tasks. Tasks targeted at this id are returned
+                in addition to the untargeted tasks.
             delay: the initial polling delay value
             timeout: the duration after which the query will timeout. If timeout is None, there is no limit to
                 the wait time.
+            weights: an optional dictionary of task type to the weight added to the priority of the tasks of
+                that type, when querying for several types. The weight of a type that is not in the dictionary is 0.
 
         Returns:
             If ``n == 1``, a single dictionary will be returned, otherwise
@@ -544,59 +1018,98 @@ class LocalTaskQueue:
             then the dictionary will be:  ``{'type': 'work', 'eq_task_id': eq_task_id,
             'payload': P}`` where ``P`` is the parameters for the work to be done.
         """
+        # invalid types or weights raise a ValueError rather than aborting the query
+        eq_types, _ = _type_weights(eq_type, weights)
+        sql_pop, params = _sql_pop_out(eq_type, n, weights, worker_pool, self.lease_duration, self.pool_labels,
+                                       self.fair_share)
         try:
-            with self.db.conn:
-                with self.db.conn.cursor() as cur:
-                    status, result = self.pop_out_queue(cur, eq_type, n, delay, timeout)
-                    self.logger.info(f'MSG: {status} {result}')
-                    if status == ResultStatus.SUCCESS:
-                        eq_task_ids = result
-                        payloads = self.select_task_payload(cur, eq_task_ids, worker_pool)
-                        results = []
-                        for task_id, payload in payloads:
-                            if payload == EQ_STOP:
-                                results.append({'type': 'status', 'payload': EQ_STOP})
-                            else:
-                                results.append({'type': 'work', 'eq_task_id': task_id,
-                                                'payload': payload})
-                        if n == 1:
-                            return results[0]
-                        else:
-                            return results
-                    else:
-                        # timed out
-                        return {'type': 'status', 'payload': result}
+            # each poll is a single call to the pop function in its own transaction, so that
+            # the lease expiry and the aged priorities are computed at the time of the poll
+            with self._autocommit_cursor() as cur:
+                status, result = self._queue_pop(cur, sql_pop, delay, timeout, [_out_channel(t) for t in eq_types],
+                                                 params, column=None)
+                self.logger.info(f'MSG: {status} {result}')
+                if status == ResultStatus.SUCCESS:
+                    return self._task_msgs(result, n)
+                else:
+                    # timed out
+                    return {'type': 'status', 'payload': result}
         except Exception:
+            self.logger.error(f'query_task error {traceback.format_exc()}')
             return {'type': 'status', 'payload': EQ_ABORT}
 
-    def report_task(self, eq_task_id: int, eq_type: int, result: str) -> ResultStatus:
-        """Reports the result of the specified task of the specified type
+    def _task_msgs(self, payloads: List[Tuple[int, str]], n: int) -> Union[List[Dict], Dict]:
+        """Converts the specified task ids and payloads into the messages returned
+        by :py:func:`query_task`.
+        """
+        results = []
+        for task_id, payload in payloads:
+            if payload == EQ_STOP:
+                results.append({'type': 'status', 'payload': EQ_STOP})
+            else:
+                results.append({'type': 'work', 'eq_task_id': task_id,
+                                'payload': payload})
+        if n == 1:
+            return results[0]
+        else:
+            return results
+
+    def report_task(self, eq_task_id: int, eq_type: int, result: str, worker_pool: str = None) -> ResultStatus:
+        """Reports the result of the specified task of the specified type. The report is only
+        accepted if the task is running, on the specified worker pool if one is specified.
+        See :py:func:`report_tasks`.
 
         Args:
             eq_task_id: the id of the task whose results are being reported.
             eq_type: the type of the task whose results are being reported.
             result: the result of the task.
+            worker_pool: if not None, the id of the worker pool reporting the task.
         Returns:
             :py:class:`ResultStatus.SUCCESS` if the task was successfully reported, otherwise
-            :py:class:`ResultStatus.FAILURE`.
+            :py:class:`ResultStatus.FAILURE`, including when the report is rejected.
         """
-        # We do this is in two transactions so if push_in_queue fails, we don't
-        # rollback update_task and lose a task result.
-        try:
-            with self.db.conn:
-                with self.db.conn.cursor() as cur:
-                    self.update_task(cur, eq_task_id, result)
-        except Exception:
-            self.logger.error(f'report_task error {traceback.format_exc()}')
-            return ResultStatus.FAILURE
+        status, rejected = self.report_tasks([(eq_task_id, eq_type, result)], worker_pool)
+        return ResultStatus.FAILURE if len(rejected) > 0 else status
+
+    def report_tasks(self, results: Iterable[Tuple[int, int, str]],
+                     worker_pool: str = None) -> Tuple[ResultStatus, List[int]]:
+        """Reports the results of the specified tasks. The results are stored, and the tasks
+        pushed onto the input queue, by a single call to the eq_report_tasks server-side function
+        (see workflow.sql), in a single transaction.
+
+        Only the reports of running tasks, and if worker_pool is not None, of tasks running on that
+        worker pool, are accepted, together with the late reports of tasks whose leases expired, and that
+        have been requeued but not queried for again, which are removed from the output queue. The reports
+        of other tasks are rejected, and their results discarded: for example, the late report of a
+        requeued task that is running on another worker pool, or a second report of a task. If the
+        report fails, none of the results are stored, and the tasks can be reported again.
+
+        Args:
+            results: the results to report as (eq_task_id, eq_type, result) tuples.
+            worker_pool: if not None, the id of the worker pool reporting the tasks.
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` of the report, and the ids of the tasks
+            whose reports were rejected.
+        """
+        results = list(results)
+        if len(results) == 0:
+            return (ResultStatus.SUCCESS, [])
 
+        ids = [eq_task_id for eq_task_id, _, _ in results]
         try:
-            with self.db.conn:
-                with self.db.conn.cursor() as cur:
-                    return self.push_in_queue(cur, eq_task_id, eq_type)
+            with self._autocommit_cursor() as cur:
+                cur.execute('select eq_task_id from eq_report_tasks(%s::integer[], %s::text[], %s, %s)',
+                            (ids, [result for _, _, result in results], worker_pool, self.notify))
+                accepted = set(row[0] for row in cur.fetchall())
         except Exception:
-            self.logger.error(f'report_task error {traceback.format_exc()}')
-            return ResultStatus.FAILURE
+            self.logger.error(f'report_tasks error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+        rejected = [eq_task_id for eq_task_id in ids if eq_task_id not in accepted]
+        if len(rejected) > 0:
+            self.logger.warning(f'report_tasks: rejected the reports of {len(rejected)} tasks that are no longer '
+                                f'running{"" if worker_pool is None else " on " + worker_pool}: {rejected}')
+        return (ResultStatus.SUCCESS, rejected)
 
     def are_queues_empty(self, eq_type: int = None) -> bool:
         """Returns whether or not either of the input or output queues are empty,
@@ -643,6 +1156,329 @@ class LocalTaskQueue:
                     cur.execute(update_query)
                     cur.execute(f'delete from {table}')
 
+    def renew_leases(self, eq_task_ids: Iterable[int], worker_pool: str = 'default',
+                     lease_duration: float = None) -> Tuple[ResultStatus, List[int]]:
+        """Renews the leases of the specified running tasks in a single statement. This is
+        the worker pool heartbeat, and should be called well before the leases expire. Only
+        tasks that are still running on the specified worker pool with an unexpired lease are renewed.
+        A task that is not renewed has been requeued, or completed, or canceled, and its result should be
+        discarded.
+
+        Args:
+            eq_task_ids: the ids of the tasks whose leases to renew.
+            worker_pool: the id of the worker pool running the tasks.
+            lease_duration: the new lease duration in seconds, from now. If this is None,
+                the LocalTaskQueue's lease duration is used.
+
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` of the renewal and the ids of the tasks
+            whose leases were renewed.
+        """
+        lease_duration = self.lease_duration if lease_duration is None else lease_duration
+        if lease_duration is None:
+            raise ValueError('A lease duration is required to renew leases')
+        ids = list(eq_task_ids)
+        if len(ids) == 0:
+            return (ResultStatus.SUCCESS, [])
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    cur.execute("""
+                        update eq_tasks set lease_expiry = now() + make_interval(secs => %s)
+                        where eq_task_id = any(%s) and eq_status = %s and worker_pool = %s
+                            and lease_expiry >= now()
+                        returning eq_task_id
+                        """, (lease_duration, ids, TaskStatus.RUNNING.value, worker_pool))
+                    return (ResultStatus.SUCCESS, sorted(row[0] for row in cur.fetchall()))
+        except Exception:
+            self.logger.error(f'renew_leases error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+    def requeue_expired(self, eq_type: int = None) -> Tuple[ResultStatus, List[int]]:
+        """Pushes the running tasks whose leases have expired back onto the output queue, with
+        their stored priority, and marks them as :py:class:`TaskStatus.REQUEUED`. This is performed
+        by the eq_requeue_expired server-side function in a single statement, and can be called
+        periodically by any process, e.g., by a :py:class:`LeaseReaper`.
+
+        Args:
+            eq_type: if not None, only requeue tasks of this type.
+
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` of the requeue and the ids of the
+            requeued tasks.
+        """
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    cur.execute('select eq_task_id from eq_requeue_expired(%s, %s)', (eq_type, self.notify))
+                    requeued = [row[0] for row in cur.fetchall()]
+        except Exception:
+            self.logger.error(f'requeue_expired error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+        if len(requeued) > 0:
+            self.logger.warning(f'requeued {len(requeued)} tasks with expired leases: {requeued}')
+        return (ResultStatus.SUCCESS, requeued)
+
+    def set_exp_weights(self, weights: Dict[str, float]) -> ResultStatus:
+        """Sets the weights of the specified experiments for fair share scheduling. An experiment's
+        share of the tasks queried for by a fair share LocalTaskQueue is proportional to its weight.
+        Experiments without a weight have a weight of 1.
+
+        Args:
+            weights: a dictionary of experiment id to weight. A weight of None removes the
+                experiment's weight.
+
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the weights were set, otherwise
+            :py:class:`ResultStatus.FAILURE`.
+        """
+        if any(weight is not None and weight <= 0 for weight in weights.values()):
+            raise ValueError(f'Invalid weights: weights must be greater than 0: weights = {weights}')
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    removed = [exp_id for exp_id, weight in weights.items() if weight is None]
+                    if len(removed) > 0:
+                        cur.execute('delete from eq_exp_weights where exp_id = any(%s)', (removed,))
+                    updated = [(exp_id, float(weight)) for exp_id, weight in weights.items() if weight is not None]
+                    if len(updated) > 0:
+                        execute_values(cur, """insert into eq_exp_weights (exp_id, weight) values %s
+                                               on conflict (exp_id) do update set weight = excluded.weight""",
+                                       updated)
+            return ResultStatus.SUCCESS
+        except Exception:
+            self.logger.error(f'set_exp_weights error {traceback.format_exc()}')
+            return ResultStatus.FAILURE
+
+    def get_exp_weights(self) -> Dict[str, float]:
+        """Gets the weights of the experiments that have a fair share scheduling weight.
+
+        Returns:
+            A dictionary of experiment id to weight, or None if the query fails.
+        """
+        status, rows = self._get('select exp_id, weight from eq_exp_weights')
+        if status != ResultStatus.SUCCESS:
+            return None
+        return dict(rows)
+
+    def set_aging_rates(self, rates: Dict[int, float]) -> ResultStatus:
+        """Sets the priority aging rates of the specified task types. The effective priority of a
+        queued task of a type with an aging rate is its priority plus the rate times the number of
+        seconds it has been in the output queue, so that low priority tasks are eventually
+        popped even while higher priority tasks continue to be submitted. The tasks of a type without an
+        aging rate are popped in priority order.
+
+        The effective priority is computed by the queue pop from the time the task was enqueued. The
+        queued tasks of the specified types are updated with the new rates when this is called.
+
+        Args:
+            rates: a dictionary of task type to the increase in effective priority per second.
+                A rate of None removes the type's aging rate.
+
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the rates were set, otherwise
+            :py:class:`ResultStatus.FAILURE`.
+        """
+        if any(rate is not None and rate < 0 for rate in rates.values()):
+            raise ValueError(f'Invalid rates: rates must be greater than or equal to 0: rates = {rates}')
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    removed = [eq_type for eq_type, rate in rates.items() if rate is None]
+                    if len(removed) > 0:
+                        cur.execute('delete from eq_task_aging where eq_task_type = any(%s)', (removed,))
+                    updated = [(eq_type, float(rate)) for eq_type, rate in rates.items() if rate is not None]
+                    if len(updated) > 0:
+                        execute_values(cur, """insert into eq_task_aging (eq_task_type, rate) values %s
+                                               on conflict (eq_task_type) do update set rate = excluded.rate""",
+                                       updated)
+                    cur.execute("""update emews_queue_OUT q
+                                   set aging_key = q.eq_priority - coalesce(a.rate, 0) * extract(epoch from q.time_enqueued)
+                                   from unnest(%s::integer[]) as t (eq_type)
+                                   left join eq_task_aging a on a.eq_task_type = t.eq_type
+                                   where q.eq_task_type = t.eq_type""", (list(rates),))
+            return ResultStatus.SUCCESS
+        except Exception:
+            self.logger.error(f'set_aging_rates error {traceback.format_exc()}')
+            return ResultStatus.FAILURE
+
+    def get_aging_rates(self) -> Dict[int, float]:
+        """Gets the priority aging rates of the task types that have one.
+
+        Returns:
+            A dictionary of task type to aging rate, or None if the query fails.
+        """
+        status, rows = self._get('select eq_task_type, rate from eq_task_aging')
+        if status != ResultStatus.SUCCESS:
+            return None
+        return dict(rows)
+
+    def prune_result_cache(self, ttl: float = None, max_size: int = None) -> ResultStatus:
+        """Evicts cached task results from the result cache. Task queues created with a ``cache_ttl``
+        or ``cache_max_size`` evict cached results when submitting tasks, so this is only necessary
+        to evict results immediately, or with other limits.
+
+        Args:
+            ttl: if not None, evict the cached results older than this many seconds.
+            max_size: if not None, evict the oldest cached results in excess of this number.
+
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the results were evicted, otherwise
+            :py:class:`ResultStatus.FAILURE`.
+        """
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    self._prune_cache(cur, ttl, max_size)
+            return ResultStatus.SUCCESS
+        except Exception:
+            self.logger.error(f'prune_result_cache error {traceback.format_exc()}')
+            return ResultStatus.FAILURE
+
+    def clear_result_cache(self, exp_id: str = None) -> ResultStatus:
+        """Clears the result cache, or evicts the cached results of the specified experiment's tasks.
+
+        Args:
+            exp_id: if not None, only evict the cached results of this experiment's tasks.
+
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the results were evicted, otherwise
+            :py:class:`ResultStatus.FAILURE`.
+        """
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    cur.execute('delete from eq_result_cache where %s::text is null or exp_id = %s', (exp_id, exp_id))
+            return ResultStatus.SUCCESS
+        except Exception:
+            self.logger.error(f'clear_result_cache error {traceback.format_exc()}')
+            return ResultStatus.FAILURE
+
+    def _pop_results(self, eq_task_ids: Union[Sequence[int], str], limit: int = None) -> List[Tuple[int, str]]:
+        """Pops any of the specified tasks that are in the input queue off of the queue,
+        returning their results. This is a single query regardless of the number of tasks.
+
+        Args:
+            eq_task_ids: the ids of the tasks to pop, or a Postgres array literal
+                (e.g., ``'{1,2,3}'``) of the ids.
+            limit: the maximum number of tasks to pop
+
+        Returns:
+            A List of (eq_task_id, result) tuples for the popped tasks.
+
+        Raises:
+            Exception: if the query fails.
+        """
+        with self.db.conn:
+            with self.db.conn.cursor() as cur:
+                cur.execute("""
+                    with popped as (
+                        delete from emews_queue_IN
+                        where eq_task_id = any(array(
+                            select eq_task_id from emews_queue_IN
+                            where eq_task_id = any(%s::integer[])
+                            order by eq_task_id
+                            for update skip locked
+                            limit %s))
+                        returning eq_task_id
+                    )
+                    select t.eq_task_id, t.json_in from popped
+                    join eq_tasks t on t.eq_task_id = popped.eq_task_id
+                    """, (eq_task_ids if isinstance(eq_task_ids, str) else list(eq_task_ids), limit))
+                return cur.fetchall()
+
+    def _create_watch(self, eq_task_ids: Iterable[int]) -> int:
+        """Creates a watch set of the specified tasks, whose completed tasks can then be popped
+        with :py:func:`_pop_watched` without resending their ids. Watch sets that have not been popped from
+        for WATCH_MAX_IDLE seconds, e.g., those of a client that has gone away, are deleted.
+
+        Args:
+            eq_task_ids: the ids of the tasks to watch.
+
+        Returns:
+            The id of the watch set, or None if its creation fails.
+        """
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    cur.execute("""with abandoned as (
+                                       delete from eq_watches
+                                       where time_polled < now() - make_interval(secs => %s)
+                                       returning watch_id)
+                                   delete from eq_watch_tasks w using abandoned
+                                   where w.watch_id = abandoned.watch_id""", (WATCH_MAX_IDLE,))
+                    cur.execute("insert into eq_watches (watch_id) values (nextval('eq_watch_id_generator')) "
+                                "returning watch_id")
+                    watch_id = cur.fetchone()[0]
+                    cur.execute('insert into eq_watch_tasks (watch_id, eq_task_id) '
+                                'select %s, unnest(%s::integer[]) on conflict do nothing',
+                                (watch_id, list(eq_task_ids)))
+                    return watch_id
+        except Exception:
+            self.logger.error(f'_create_watch error {traceback.format_exc()}')
+            return None
+
+    def _pop_watched(self, watch_id: int, limit: int = None) -> List[Tuple[int, TaskStatus, str]]:
+        """Pops any of the tasks in the specified watch set that are in the input queue off of the
+        queue, removing them from the watch set, and returns their results. This is a single query
+        regardless of the number of tasks in the watch set.
+
+        Args:
+            watch_id: the id of the watch set.
+            limit: the maximum number of tasks to pop
+
+        Returns:
+            A List of (eq_task_id, task status, result) tuples for the popped tasks.
+
+        Raises:
+            Exception: if the query fails.
+        """
+        with self.db.conn:
+            with self.db.conn.cursor() as cur:
+                cur.execute("""
+                    with polled as (
+                        update eq_watches set time_polled = now() where watch_id = %(watch_id)s
+                    ),
+                    popped as (
+                        delete from emews_queue_IN
+                        where eq_task_id = any(array(
+                            select i.eq_task_id from emews_queue_IN i
+                            join eq_watch_tasks w on w.eq_task_id = i.eq_task_id and w.watch_id = %(watch_id)s
+                            order by i.eq_task_id
+                            for update of i skip locked
+                            limit %(limit)s))
+                        returning eq_task_id
+                    ),
+                    unwatched as (
+                        delete from eq_watch_tasks w using popped
+                        where w.watch_id = %(watch_id)s and w.eq_task_id = popped.eq_task_id
+                    )
+                    select t.eq_task_id, t.eq_status, t.json_in from popped
+                    join eq_tasks t on t.eq_task_id = popped.eq_task_id
+                    """, {'watch_id': watch_id, 'limit': limit})
+                return [(eq_task_id, TaskStatus(status), result) for eq_task_id, status, result in cur.fetchall()]
+
+    def _delete_watch(self, watch_id: int) -> ResultStatus:
+        """Deletes the specified watch set.
+
+        Args:
+            watch_id: the id of the watch set.
+
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the watch set was deleted, otherwise
+            :py:class:`ResultStatus.FAILURE`.
+        """
+        try:
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    cur.execute('delete from eq_watches where watch_id = %s', (watch_id,))
+                    cur.execute('delete from eq_watch_tasks where watch_id = %s', (watch_id,))
+            return ResultStatus.SUCCESS
+        except Exception:
+            self.logger.error(f'_delete_watch error {traceback.format_exc()}')
+            return ResultStatus.FAILURE
+
     def _query_status(self, eq_task_ids: Iterable[int]) -> List[Tuple[int, TaskStatus]]:
         """Queries for the status (queued, running, etc.) of the specified tasks
 
@@ -685,6 +1521,87 @@ class LocalTaskQueue:
             return [(id_map[item[0]], item[1]) for item in result]
         return result
 
+    def _get_results(self, eq_task_ids: Iterable[int], consume: bool = True) -> List[Tuple[int, str]]:
+        """Gets the results of any of the specified tasks that are in the input queue
+        with a single query, popping them off of the queue if consume is True.
+
+        Args:
+            eq_task_ids: the ids of the tasks to get the results of
+            consume: if True, the tasks are popped off of the input queue.
+
+        Returns:
+            A List of (eq_task_id, result) tuples for the tasks in the input queue,
+            or None if the query fails.
+        """
+        ids = list(eq_task_ids)
+        try:
+            if consume:
+                return self._pop_results(ids)
+            with self.db.conn:
+                with self.db.conn.cursor() as cur:
+                    cur.execute("""select t.eq_task_id, t.json_in from emews_queue_IN q
+                                   join eq_tasks t on t.eq_task_id = q.eq_task_id
+                                   where q.eq_task_id = any(%s::integer[])
+                                   order by q.eq_task_id""", (ids,))
+                    return cur.fetchall()
+        except Exception:
+            self.logger.error(f'get_results error: {traceback.format_exc()}')
+            return None
+
+    def get_results(self, futures: Iterable[Future], consume: bool = True) -> List[Tuple[Future, str]]:
+        """Gets the results of those of the specified tasks whose results are available, with a
+        single query regardless of the number of tasks. Unlike :py:func:`query_result`, this does not
+        wait for the results.
+
+        If consume is True, the results are popped off of the input queue, and cached in their
+        :py:class:`Futures <Future>`, so that the futures are done and their ``result`` returns
+        the cached result. If consume is False, the results are left in the input queue, and
+        are not cached. The cached results of futures that already have a result are returned without
+        querying for them.
+
+        Args:
+            futures: the futures of the tasks to get the results of.
+            consume: if True, pop the results off of the input queue.
+
+        Returns:
+            A List of (Future, result) tuples, in the order of the specified futures, for the futures
+            whose results are available, or None if the query fails.
+        """
+        def query(eq_task_ids):
+            rows = self._get_results(eq_task_ids, consume)
+            return None if rows is None else dict(rows)
+
+        return _get_future_results(futures, query, consume)
+
+    def map(self, exp_id: str, eq_type: int, payload: Iterable[str], window: int = 1000, ordered: bool = True,
+            priority: int = 0, tag: str = None, timeout: float = None,
+            sleep: float = 0.5) -> Generator[Union[str, Tuple[int, str]], None, None]:
+        """Returns a generator that submits a task for each of the payloads, and yields the task results,
+        with at most ``window`` tasks in flight at a time. The tasks are submitted with
+        :py:func:`submit_tasks` as the window frees up, and the in flight tasks are checked for completion
+        with :py:func:`get_results`. If the generator is closed before it is exhausted, the tasks
+        still in flight are canceled.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: an iterable of the work payloads
+            window: the maximum number of tasks in flight.
+            ordered: if True, the results are yielded in payload order, otherwise they are yielded
+                as the tasks complete.
+            priority: the priority of the tasks
+            tag: an optional metadata tag for the tasks
+            timeout: if not None, a :py:class:`TimeoutError` is raised if all the results have not been
+                yielded this many seconds after the first result is requested.
+            sleep: the time, in seconds, to sleep between checks for completed tasks.
+
+        Yields:
+            If ordered is True, the task results in payload order, otherwise (index, result) tuples,
+            where index is the position of the task's payload in the payloads, as the tasks complete.
+        """
+        return _map_tasks(self, exp_id, eq_type, payload, window=window, ordered=ordered, priority=priority,
+                          tag=tag, timeout=timeout, sleep=sleep)
+
     def _cancel_tasks(self, eq_task_ids: Iterable[int]) -> Tuple[ResultStatus, int]:
         """Cancels the specified tasks by removing them from the output queue and
         marking their status as canceled.
@@ -759,8 +1676,10 @@ class LocalTaskQueue:
                 with self.db.conn.cursor() as cur:
                     if isinstance(new_priority, int):
                         placeholders = ', '.join(['%s'] * len(ids))
-                        query = f'update emews_queue_out set eq_priority = %s where eq_task_id in ({placeholders}) returning eq_task_id'
-                        cur.execute(query, (new_priority,) + ids)
+                        # the aging key moves with the priority
+                        query = (f'update emews_queue_out set eq_priority = %s, aging_key = aging_key + %s - eq_priority '
+                                 f'where eq_task_id in ({placeholders}) returning eq_task_id')
+                        cur.execute(query, (new_priority, new_priority) + ids)
                         affected_ids = tuple([x[0] for x in cur.fetchall()])
                         if len(affected_ids) > 0:
                             placeholders = ', '.join(['%s'] * len(affected_ids))
@@ -771,7 +1690,7 @@ class LocalTaskQueue:
                             raise ValueError("Number of task ids and updated priorities must be equal")
                         placeholders = ', '.join(['(%s, %s)'] * len(ids))
                         query = f"""update emews_queue_out as u set
-                                eq_priority = u2.priority
+                                eq_priority = u2.priority, aging_key = u.aging_key + u2.priority - u.eq_priority
                                 from (values
                                 {placeholders}
                                 ) as u2(id, priority) where u2.id = eq_task_id returning eq_task_id;
@@ -875,6 +1794,18 @@ class LocalTaskQueue:
             for the failure (``EQ_TIMEOUT``, or ``EQ_ABORT``)
         """
         try:
+            if self.server_functions:
+                channel = _in_channel(eq_task_id)
+                try:
+                    with self._autocommit_cursor() as cur:
+                        msg = self._queue_pop(cur, 'select * from eq_pop_in(%s)', delay, timeout, [channel],
+                                              (eq_task_id,), column=None)
+                finally:
+                    self._unlisten(channel)
+                if msg[0] != ResultStatus.SUCCESS:
+                    return msg
+                return (ResultStatus.SUCCESS, msg[1][0][1])
+
             with self.db.conn:
                 with self.db.conn.cursor() as cur:
                     msg = self.pop_in_queue(cur, eq_task_id, delay, timeout)
@@ -956,9 +1887,9 @@ class LocalTaskQueue:
     def as_completed(self, futures: List[Future], pop: bool = False, timeout: float = None, n: int = None,
                      batch_size: int = 1, sleep: float = 0) -> Generator[Future, None, None]:
         """Returns a generator over the :py:class:`Futures <Future>` in the ``futures`` argument that yields
-        Futures as they complete. The  :py:class:`Futures <Future>` are checked for completion by iterating over all of the
-        ones that have not yet completed and checking for a result. At the end of each iteration, the
-        ``timeout`` is checked. Note that adding or removing :py:class:`Futures <Future>`
+        Futures as they complete. The  :py:class:`Futures <Future>` are checked for completion by querying
+        for the results of all the ones that have not yet completed with a single query. After each such
+        query, the ``timeout`` is checked. Note that adding or removing :py:class:`Futures <Future>`
         to or from the ``futures`` argument List while iterating may have no effect on this call.
         A :py:class:`TimeoutError` will be raised if the futures do not complete within the specified ``timeout`` duration.
 
@@ -985,48 +1916,221 @@ class LocalTaskQueue:
         completed_tasks = set()
         wk_futures = [f for f in futures]
         n_futures = len(wk_futures)
-        n_completed = 0
         batch = []
-        n_batch = 0
 
         while True:
-            for f in wk_futures:
-                if f.eq_task_id not in completed_tasks:
-                    status, result_str = f.result(timeout=0.0)
-                    if status == ResultStatus.SUCCESS or result_str == EQ_ABORT:
-                        completed_tasks.add(f.eq_task_id)
-                        batch.append(f)
-                        n_batch += 1
-
-                        if n_batch == batch_size:
-                            for ft in batch:
-                                if pop:
-                                    futures.remove(ft)
-                                yield ft
-
-                            batch.clear()
-                            n_batch = 0
-
-                        n_completed = len(completed_tasks)
-                        if n_completed == n_futures or n_completed == n:
-                            if n_batch > 0:
-                                for ft in batch:
-                                    if pop:
-                                        futures.remove(ft)
-                                    yield ft
-
-                            # Python docs: return rather than raise StopIteration
-                            return
-
-                if timeout is not None and time.time() - start_time > timeout:
-                    raise TimeoutError(f'as_completed timed out after {timeout} seconds')
+            pending = [f for f in wk_futures if f.eq_task_id not in completed_tasks]
+            # futures with a result already complete, the rest are checked
+            # for a result with a single query
+            to_query = [f.eq_task_id for f in pending if f._result is None or f._result[0] != ResultStatus.SUCCESS]
+            limit = None
+            if n is not None:
+                limit = n - len(completed_tasks) - (len(pending) - len(to_query))
+            results = {}
+            aborted = False
+            if len(to_query) > 0 and (limit is None or limit > 0):
+                try:
+                    results = dict(self._pop_results(to_query, limit))
+                except Exception:
+                    self.logger.error(f'as_completed error {traceback.format_exc()}')
+                    aborted = True
+
+            for f in pending:
+                if f.eq_task_id in results:
+                    f._result = (ResultStatus.SUCCESS, results[f.eq_task_id])
+                elif aborted and (f._result is None or f._result[0] != ResultStatus.SUCCESS):
+                    f._result = (ResultStatus.FAILURE, EQ_ABORT)
+                elif f._result is None or f._result[0] != ResultStatus.SUCCESS:
+                    continue
+
+                completed_tasks.add(f.eq_task_id)
+                batch.append(f)
+                n_completed = len(completed_tasks)
+                done = n_completed == n_futures or n_completed == n
+                if len(batch) == batch_size or done:
+                    for ft in batch:
+                        if pop:
+                            futures.remove(ft)
+                        yield ft
+                    batch.clear()
+
+                if done:
+                    # Python docs: return rather than raise StopIteration
+                    return
+
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TimeoutError(f'as_completed timed out after {timeout} seconds')
 
             if sleep > 0:
                 time.sleep(sleep)
 
 
+class BufferedReporter:
+
+    def __init__(self, task_queue: LocalTaskQueue, max_size: int = 100, max_wait: float = 1.0,
+                 worker_pool: str = None):
+        """Buffers task results, reporting them in batches with :py:func:`LocalTaskQueue.report_tasks`.
+        The buffered results are reported when max_size results have been buffered, or when
+        :py:func:`report` or :py:func:`flush_if_due` is called and the oldest buffered result has
+        been buffered for at least max_wait seconds. Results that fail to be reported remain
+        buffered and are reported again on the next flush.
+
+        A BufferedReporter can be used as a context manager, flushing any buffered results on exit.
+
+        Args:
+            task_queue: the task queue to report the results with.
+            max_size: the number of buffered results that triggers a flush.
+            max_wait: the maximum duration, in seconds, that a result is buffered before
+                a call to report or flush_if_due flushes it.
+            worker_pool: the id of the worker pool running the tasks. If not None, the reports
+                of tasks that are no longer running on this worker pool are rejected. See
+                :py:func:`LocalTaskQueue.report_tasks`.
+        """
+        self.task_queue = task_queue
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.worker_pool = worker_pool
+        self._buffer = []
+        self._first_buffered = 0.0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+    def report(self, eq_task_id: int, eq_type: int, result: str) -> ResultStatus:
+        """Buffers the result of the specified task, and flushes the buffer if it is full
+        or due.
+
+        Args:
+            eq_task_id: the id of the task whose results are being reported.
+            eq_type: the type of the task whose results are being reported.
+            result: the result of the task.
+        Returns:
+            The :py:class:`ResultStatus` of the flush, or :py:class:`ResultStatus.SUCCESS` if
+            the buffer was not flushed.
+        """
+        with self._lock:
+            if len(self._buffer) == 0:
+                self._first_buffered = time.time()
+            self._buffer.append((eq_task_id, eq_type, result))
+            if len(self._buffer) >= self.max_size:
+                return self.flush()
+            return self.flush_if_due()
+
+    def flush_if_due(self) -> ResultStatus:
+        """Flushes the buffer if the oldest buffered result has been buffered for at least
+        max_wait seconds.
+
+        Returns:
+            The :py:class:`ResultStatus` of the flush, or :py:class:`ResultStatus.SUCCESS` if
+            the buffer was not flushed.
+        """
+        with self._lock:
+            if self.is_due():
+                return self.flush()
+            return ResultStatus.SUCCESS
+
+    def is_due(self) -> bool:
+        """Returns True if the oldest buffered result has been buffered for at least
+        max_wait seconds, otherwise False.
+        """
+        return len(self._buffer) > 0 and time.time() - self._first_buffered >= self.max_wait
+
+    def flush(self) -> ResultStatus:
+        """Reports all the buffered results.
+
+        Returns:
+            The :py:class:`ResultStatus` of :py:func:`LocalTaskQueue.report_tasks`. The results
+            whose reports were rejected are discarded.
+        """
+        with self._lock:
+            if len(self._buffer) == 0:
+                return ResultStatus.SUCCESS
+            status, _ = self.task_queue.report_tasks(self._buffer, self.worker_pool)
+            if status == ResultStatus.SUCCESS:
+                self._buffer = []
+            else:
+                # retry the failed results after another max_wait
+                self._first_buffered = time.time()
+            return status
+
+
+class LeaseReaper:
+
+    def __init__(self, host: str, user: str, port: int, db_name: str, password: str = None,
+                 interval: float = 10.0, eq_type: int = None, notify: bool = False, log_level=logging.WARN):
+        """Periodically requeues the running tasks whose leases have expired (see
+        :py:func:`LocalTaskQueue.requeue_expired`) in a background thread, with its own
+        :py:class:`LocalTaskQueue`. A LeaseReaper can be used as a context manager, starting the
+        thread on entry and stopping it on exit.
+
+        Args:
+            host: the eqsql database host
+            user: the eqsql database user
+            port: the eqsql database port
+            db_name: the eqsql database name
+            password: the eqdql database password (if there is one)
+            interval: the time, in seconds, between each check for expired leases.
+            eq_type: if not None, only requeue tasks of this type.
+            notify: if True, notify the waiting worker pools when tasks are requeued.
+            log_level: the logging threshold level.
+        """
+        self.interval = interval
+        self.eq_type = eq_type
+        self._queue_args = (host, user, port, db_name, password)
+        self._queue_kwargs = {'log_level': log_level, 'notify': notify}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def start(self):
+        """Starts requeueing expired tasks every interval seconds."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='eqsql-lease-reaper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops requeueing expired tasks, and waits for the reaper thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        task_queue = None
+        while not self._stop.is_set():
+            try:
+                if task_queue is None:
+                    task_queue = init_task_queue(*self._queue_args, **self._queue_kwargs)
+                status, _ = task_queue.requeue_expired(self.eq_type)
+                if status != ResultStatus.SUCCESS and task_queue.db.conn.closed:
+                    # connection lost, so recreate the queue on the next check
+                    task_queue.close()
+                    task_queue = None
+            except db_tools.ConnectionException:
+                logging.getLogger(__name__).error(f'LeaseReaper connection error {traceback.format_exc()}')
+            self._stop.wait(self.interval)
+        if task_queue is not None:
+            task_queue.close()
+
+
 def init_task_queue(host: str, user: str, port: int, db_name: str, password: str = None, retry_threshold=0,
-                    log_level=logging.WARN) -> TaskQueue:
+                    log_level=logging.WARN, notify: bool = False, server_functions: bool = False,
+                    lease_duration: float = None, fair_share: bool = False, pool_labels: List[str] = None,
+                    result_cache: str = None, cache_ttl: float = None, cache_max_size: int = None,
+                    pooled: bool = False) -> TaskQueue:
     """Initializes and returns an :py:class:`LocalTaskQueue` class instance with the specified parameters.
 
     Args:
@@ -1040,6 +2144,27 @@ def init_task_queue(host: str, user: str, port: int, db_name: str, password: str
             then retry ``retry_threshold`` many times to establish a connection. There
             will be random few second delay betwen each retry.
         log_level: the logging threshold level.
+        notify: if True, use Postgres LISTEN / NOTIFY to wake queue pops when tasks
+            are pushed, rather than sleep polling. Both the pushing and popping task queues
+            should be in notify mode.
+        server_functions: if True, use the server-side functions defined in workflow.sql to
+            submit and report tasks, and query for task results, in a single call each. Querying
+            for tasks always uses the server-side pop functions.
+        lease_duration: if not None, tasks queried for by the task queue are leased for this many seconds.
+            See :py:func:`LocalTaskQueue.renew_leases` and :py:func:`LocalTaskQueue.requeue_expired`.
+        fair_share: if True, tasks queried for by the task queue are shared between experiments in proportion
+            to their weights. See :py:func:`LocalTaskQueue.set_exp_weights`.
+        pool_labels: the labels, in addition to the querying worker pool's id, of the targeted tasks queried
+            for by the task queue. See :py:func:`LocalTaskQueue.submit_task`.
+        result_cache: if not None, ``'experiment'`` or ``'global'``, the task queue memoizes the results
+            of the tasks it submits, scoped to the submitting experiment or shared between experiments.
+            See :py:class:`LocalTaskQueue`.
+        cache_ttl: if not None, the age in seconds after which cached results are evicted.
+        cache_max_size: if not None, the maximum number of cached results.
+        pooled: if True, the task queue borrows its connection from the process-wide connection pool
+            (see :py:func:`get_pool <eqsql.db_tools.get_pool>`) and returns it when closed, rather than
+            opening its own connection. At most ``db_tools.POOL_MAX_SIZE`` pooled task queues can be
+            open at once for the same database.
     Returns:
         An :py:class:`LocalTaskQueue` instance
     """
@@ -1053,7 +2178,7 @@ def init_task_queue(host: str, user: str, port: int, db_name: str, password: str
     while True:
         try:
             db = db_tools.WorkflowSQL(host=host, user=user, port=port, dbname=db_name, password=password,
-                                      log_level=log_level, envs=False)
+                                      log_level=log_level, envs=False, pooled=pooled)
             db.connect()
             break
         except db_tools.ConnectionException as e:
@@ -1062,4 +2187,6 @@ def init_task_queue(host: str, user: str, port: int, db_name: str, password: str
                 raise e
             time.sleep(random() * 4)
 
-    return LocalTaskQueue(db, logger)
+    return LocalTaskQueue(db, logger, notify=notify, server_functions=server_functions,
+                          lease_duration=lease_duration, fair_share=fair_share, pool_labels=pool_labels,
+                          result_cache=result_cache, cache_ttl=cache_ttl, cache_max_size=cache_max_size)
@@ -1,9 +1,12 @@
 
-from typing import Tuple, Union, List
+from typing import Tuple, Union, List, Dict, Iterator
+from contextlib import contextmanager
 from dataclasses import dataclass
+import threading
 import time
+import traceback
 
-from eqsql.task_queues.core import ResultStatus, EQ_ABORT, TimeoutError, TaskStatus
+from eqsql.task_queues.core import ResultStatus, EQ_ABORT, EQ_TIMEOUT, TimeoutError, TaskStatus, TaskQueue
 
 
 @dataclass
@@ -25,115 +28,293 @@ class DBParameters:
                             vals['password'], vals['port'], vals['retry'])
 
 
+# The maximum number of idle task queues cached for each set of database parameters
+QUEUE_CACHE_SIZE = 16
+# Cached task queues that have been idle for longer than this many seconds are discarded
+QUEUE_CACHE_MAX_IDLE = 300.0
+
+# The minimum time between the polls of a watch set by _next_watched, and
+# of the output queue by _query_tasks
+WATCH_MIN_SLEEP = 0.05
+
+# (host, port, user, db_name, password) -> [(idle task queue, time returned)]
+_queues: Dict[Tuple, List[Tuple[TaskQueue, float]]] = {}
+_queues_lock = threading.Lock()
+
+
+def _evict_queues():
+    # assumes the lock is held
+    now = time.time()
+    for key in list(_queues):
+        idle = [(task_queue, returned) for task_queue, returned in _queues[key]
+                if now - returned <= QUEUE_CACHE_MAX_IDLE]
+        if len(idle) == 0:
+            del _queues[key]
+        else:
+            _queues[key] = idle
+
+
+@contextmanager
+def _task_queue(db_params: DBParameters, **settings) -> Iterator[TaskQueue]:
+    """Context manager for a :py:class:`LocalTaskQueue <eqsql.task_queues.local_queue.LocalTaskQueue>`
+    connected to the specified database. The task queue is taken from a cache of idle task queues, if
+    there is one for the database, and returned to the cache on exit, so that the functions
+    called repeatedly by a long running process, e.g., the emews_service, do not create a
+    task queue, and its logger, per call. An idle cached task queue holds no connection: its connection
+    is borrowed from the process-wide connection pool (see
+    :py:func:`get_pool <eqsql.db_tools.get_pool>`), which reuses and health checks warm connections,
+    while the task queue is in use.
+
+    Args:
+        db_params: the parameters of the database to connect to.
+        settings: task queue attributes, e.g., ``lease_duration``, to set while the task queue
+            is in use. They are reset to their previous values before the task queue is cached.
+    """
+    from eqsql.task_queues import local_queue
+    key = (db_params.host, db_params.port, db_params.user, db_params.db_name, db_params.password)
+    task_queue = None
+    with _queues_lock:
+        _evict_queues()
+        idle = _queues.get(key)
+        if idle:
+            task_queue = idle.pop()[0]
+
+    if task_queue is not None:
+        try:
+            task_queue.db.connect()
+        except Exception:
+            task_queue = None
+    if task_queue is None:
+        task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
+                                                 password=db_params.password,
+                                                 retry_threshold=db_params.retry_threshold, pooled=True)
+    defaults = {name: getattr(task_queue, name) for name in settings}
+    for name, value in settings.items():
+        setattr(task_queue, name, value)
+    try:
+        yield task_queue
+    finally:
+        for name, value in defaults.items():
+            setattr(task_queue, name, value)
+        # return the connection to the pool
+        task_queue.db.close()
+        with _queues_lock:
+            idle = _queues.setdefault(key, [])
+            if len(idle) < QUEUE_CACHE_SIZE:
+                idle.append((task_queue, time.time()))
+
+
 def _submit_tasks(db_params: DBParameters, exp_id: str, eq_type: int, payload: List[str], priority: int = 0,
                   tag: str = None) -> Tuple[ResultStatus, List[int]]:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result_status, fts = task_queue.submit_tasks(exp_id, eq_type, payload, priority, tag)
-    task_queue.close()
+    with _task_queue(db_params) as task_queue:
+        result_status, fts = task_queue.submit_tasks(exp_id, eq_type, payload, priority, tag)
     return (result_status, [ft.eq_task_id for ft in fts])
 
 
 def _get_status(db_params: DBParameters, eq_task_ids: List[int]) -> List[Tuple[int, TaskStatus]]:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue._query_status(eq_task_ids)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue._query_status(eq_task_ids)
 
 
 def _clear_queues(db_params: DBParameters):
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    task_queue.clear_queues()
-    task_queue.close()
+    with _task_queue(db_params) as task_queue:
+        task_queue.clear_queues()
 
 
 def _get_priorities(db_params: DBParameters, eq_task_ids: List[int]):
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue._get_priorities(eq_task_ids)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue._get_priorities(eq_task_ids)
 
 
 def _update_priorities(db_params: DBParameters, eq_task_ids: List[int], new_priority: Union[int, List[int]]) -> Tuple[ResultStatus, int]:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue._update_priorities(eq_task_ids, new_priority)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue._update_priorities(eq_task_ids, new_priority)
 
 
 def _query_result(db_params: DBParameters, eq_task_id: int, delay: float = 0.5,
                   timeout: float = 2.0) -> Tuple[ResultStatus, str]:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue.query_result(eq_task_id, delay, timeout)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue.query_result(eq_task_id, delay, timeout)
+
+
+def _get_results(db_params: DBParameters, eq_task_ids: List[int], consume: bool = True) -> List[Tuple[int, str]]:
+    with _task_queue(db_params) as task_queue:
+        return task_queue._get_results(eq_task_ids, consume)
 
 
 def _get_worker_pools(db_params: DBParameters, eq_task_ids: List[int]) -> List[Tuple[int, Union[str, None]]]:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue._get_worker_pools(eq_task_ids)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue._get_worker_pools(eq_task_ids)
 
 
 def _cancel_tasks(db_params: DBParameters, eq_task_ids: List[int]):
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue._cancel_tasks(eq_task_ids)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue._cancel_tasks(eq_task_ids)
 
 
 def _are_queues_empty(db_params: DBParameters, eq_type: int = None) -> bool:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
-    result = task_queue.are_queues_empty(eq_type)
-    task_queue.close()
-    return result
+    with _task_queue(db_params) as task_queue:
+        return task_queue.are_queues_empty(eq_type)
 
 
 def _as_completed(db_params: DBParameters, eq_task_ids: List[int], completed_tasks: List[int],
                   timeout: float = None, n_required: int = 1, batch_size: int = 1,
                   sleep: float = 0) -> List[Tuple[int, TaskStatus, ResultStatus, str]]:
-    from eqsql.task_queues import local_queue
-    task_queue = local_queue.init_task_queue(db_params.host, db_params.user, db_params.port, db_params.db_name,
-                                             password=db_params.password, retry_threshold=db_params.retry_threshold)
     completed_task_set = set(completed_tasks)
     start_time = time.time()
     batch = []
+    n_batch = min(batch_size, n_required)
 
-    while True:
-        for eq_task_id in eq_task_ids:
-            if eq_task_id not in completed_task_set:
-                result_status, result_str = task_queue.query_result(eq_task_id, timeout=0.0)
-                if result_status == ResultStatus.SUCCESS or result_str == EQ_ABORT:
-                    query_result = task_queue._query_status([eq_task_id])
-                    task_status = None if query_result is None else query_result[0][1]
-                    batch.append((eq_task_id, task_status, result_status, result_str))
+    with _task_queue(db_params) as task_queue:
+        while True:
+            # check all the pending tasks for results with a single query
+            pending = [eq_task_id for eq_task_id in eq_task_ids if eq_task_id not in completed_task_set]
+            try:
+                results = [(eq_task_id, ResultStatus.SUCCESS, result_str) for eq_task_id, result_str in
+                           task_queue._pop_results(pending, n_batch - len(batch))]
+            except Exception:
+                task_queue.logger.error(f'_as_completed error {traceback.format_exc()}')
+                results = [(eq_task_id, ResultStatus.FAILURE, EQ_ABORT) for eq_task_id in
+                           pending[:n_batch - len(batch)]]
+
+            if len(results) > 0:
+                query_result = task_queue._query_status([eq_task_id for eq_task_id, _, _ in results])
+                task_statuses = {} if query_result is None else dict(query_result)
+                for eq_task_id, result_status, result_str in results:
+                    batch.append((eq_task_id, task_statuses.get(eq_task_id), result_status, result_str))
                     completed_task_set.add(eq_task_id)
 
-                    n_batch = len(batch)
-                    if n_batch == batch_size or n_batch == n_required:
-                        task_queue.close()
-                        return batch
+                if len(batch) == n_batch:
+                    return batch
 
             if timeout is not None and time.time() - start_time > timeout:
                 raise TimeoutError(f'as_completed timed out after {timeout} seconds')
 
-        if sleep > 0:
-            time.sleep(sleep)
+            if sleep > 0:
+                time.sleep(max(sleep, WATCH_MIN_SLEEP))
+
+
+def _watch_tasks(db_params: DBParameters, eq_task_ids: List[int]) -> int:
+    with _task_queue(db_params) as task_queue:
+        return task_queue._create_watch(eq_task_ids)
+
+
+def _next_watched(db_params: DBParameters, watch_id: int, n: int = 1, timeout: float = 0.0,
+                  sleep: float = 0.5) -> List[Tuple[int, TaskStatus, ResultStatus, str]]:
+    """Long polls the specified watch set for completed tasks, returning when n tasks have completed,
+    or when the timeout has elapsed. The watch set is polled every sleep seconds, but at most every
+    WATCH_MIN_SLEEP seconds, and the task queue, and its connection, are only held while polling.
+
+    Returns:
+        A list of up to n (eq_task_id, task status, result status, result) tuples, which is empty
+        if no tasks complete within the timeout, or None if polling fails before any tasks have
+        been popped. The tasks popped before a failure are returned, as their pops have been
+        committed and they can't be popped again.
+    """
+    start_time = time.time()
+    batch = []
+    while True:
+        with _task_queue(db_params) as task_queue:
+            try:
+                popped = task_queue._pop_watched(watch_id, n - len(batch))
+            except Exception:
+                task_queue.logger.error(f'_next_watched error {traceback.format_exc()}')
+                return batch if len(batch) > 0 else None
+        batch.extend((eq_task_id, task_status, ResultStatus.SUCCESS, result_str)
+                     for eq_task_id, task_status, result_str in popped)
+
+        if len(batch) == n or time.time() - start_time >= timeout:
+            return batch
+
+        time.sleep(max(sleep, WATCH_MIN_SLEEP))
+
+
+def _close_watch(db_params: DBParameters, watch_id: int) -> ResultStatus:
+    with _task_queue(db_params) as task_queue:
+        return task_queue._delete_watch(watch_id)
+
+
+def _pool_settings(lease_duration: float = None, fair_share: bool = False, pool_labels: List[str] = None) -> Dict:
+    return {'lease_duration': lease_duration, 'fair_share': fair_share,
+            'pool_labels': [] if pool_labels is None else list(pool_labels)}
+
+
+def _query_tasks(db_params: DBParameters, eq_type: Union[int, List[int]], n: int = 1, worker_pool: str = 'default',
+                 timeout: float = 0.0, sleep: float = 0.5, weights: Dict[int, float] = None,
+                 lease_duration: float = None, fair_share: bool = False,
+                 pool_labels: List[str] = None) -> List[Dict]:
+    """Long polls the output queue for up to n tasks of the specified type or types for the specified
+    worker pool, returning when any are popped, or when the timeout has elapsed. The queue is polled every
+    sleep seconds, but at most every WATCH_MIN_SLEEP seconds, and the task queue, and its connection, are
+    only held while polling. The lease_duration, fair_share and pool_labels are those of the worker pool's
+    task queue. See :py:func:`LocalTaskQueue.query_task <eqsql.task_queues.local_queue.LocalTaskQueue.query_task>`.
+
+    Returns:
+        A list of the task messages returned by the query, which is a single ``EQ_TIMEOUT``
+        status message if no tasks are popped within the timeout, or a single ``EQ_ABORT`` status
+        message if the query fails.
+    """
+    start_time = time.time()
+    settings = _pool_settings(lease_duration, fair_share, pool_labels)
+    while True:
+        with _task_queue(db_params, **settings) as task_queue:
+            msgs = task_queue.query_task(eq_type, n=n, worker_pool=worker_pool, delay=0.0, timeout=0.0,
+                                         weights=weights)
+        if not isinstance(msgs, list):
+            msgs = [msgs]
+        if msgs[0]['type'] == 'work' or msgs[0]['payload'] != EQ_TIMEOUT or time.time() - start_time >= timeout:
+            return msgs
+
+        time.sleep(max(sleep, WATCH_MIN_SLEEP))
+
+
+def _query_more_tasks(db_params: DBParameters, eq_type: Union[int, List[int]], eq_task_ids: List[int],
+                      batch_size: int, threshold: int = 1, worker_pool: str = 'default', timeout: float = 0.0,
+                      sleep: float = 0.5, weights: Dict[int, float] = None, lease_duration: float = None,
+                      fair_share: bool = False, pool_labels: List[str] = None) -> Tuple[List[int], List[Dict]]:
+    """Queries for the tasks to bring the specified worker pool's running tasks up to batch_size, long
+    polling the output queue, as with :py:func:`_query_tasks`, if there are none. See
+    :py:func:`LocalTaskQueue.query_more_tasks <eqsql.task_queues.local_queue.LocalTaskQueue.query_more_tasks>`.
+
+    Returns:
+        A tuple of the ids of the running tasks, including the new tasks, and the messages of
+        the new tasks.
+    """
+    start_time = time.time()
+    settings = _pool_settings(lease_duration, fair_share, pool_labels)
+    with _task_queue(db_params, **settings) as task_queue:
+        running, msgs = task_queue.query_more_tasks(eq_type, eq_task_ids, batch_size, threshold=threshold,
+                                                    worker_pool=worker_pool, delay=0.0, timeout=0.0,
+                                                    weights=weights)
+    if len(msgs) == 0 or msgs[0]['type'] == 'work' or msgs[0]['payload'] != EQ_TIMEOUT:
+        return (running, msgs)
+
+    remaining = max(0.0, timeout - (time.time() - start_time))
+    msgs = _query_tasks(db_params, eq_type, batch_size - len(running), worker_pool, remaining, sleep, weights,
+                        lease_duration, fair_share, pool_labels)
+    return (running + [msg['eq_task_id'] for msg in msgs if msg['type'] == 'work'], msgs)
+
+
+def _report_tasks(db_params: DBParameters, results: List[Tuple[int, int, str]],
+                  worker_pool: str = None) -> Tuple[ResultStatus, List[int]]:
+    with _task_queue(db_params) as task_queue:
+        return task_queue.report_tasks(results, worker_pool)
+
+
+def _heartbeat(db_params: DBParameters, eq_task_ids: List[int], worker_pool: str = 'default',
+               lease_duration: float = None) -> Tuple[ResultStatus, List[int]]:
+    """Renews the leases of the specified tasks running on the specified worker pool, or if
+    lease_duration is None, checks which of them are still running.
+
+    Returns:
+        A tuple of the :py:class:`ResultStatus` and the ids of the tasks whose leases were renewed,
+        or that are still running.
+    """
+    with _task_queue(db_params) as task_queue:
+        if lease_duration is not None:
+            return task_queue.renew_leases(eq_task_ids, worker_pool, lease_duration)
+        statuses = task_queue._query_status(eq_task_ids)
+        if statuses is None:
+            return (ResultStatus.FAILURE, [])
+        return (ResultStatus.SUCCESS, sorted(eq_task_id for eq_task_id, status in statuses
+                                             if status == TaskStatus.RUNNING))
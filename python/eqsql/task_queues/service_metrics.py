@@ -0,0 +1,143 @@
+"""Request and database connection pool metrics of the emews_service. The metrics are kept in
+shared memory, created before the service's worker processes are forked, so that each
+worker records its own requests, and any worker can report the metrics of all of them.
+"""
+import multiprocessing as mp
+from bisect import bisect_left
+from typing import Dict, List
+
+# the upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# the connection pool stats (see eqsql.db_tools.pool_stats) reported for each worker
+POOL_STATS = ('in_use', 'idle', 'opening', 'max_size')
+
+# the endpoint of requests that do not match a route
+OTHER = 'other'
+
+# per endpoint counters: requests, server errors, latency sum, and then the
+# bucket counts, including the final +Inf bucket
+_REQUESTS = 0
+_ERRORS = 1
+_LATENCY_SUM = 2
+_BUCKETS = 3
+
+
+class ServiceMetrics:
+
+    def __init__(self, endpoints: List[str], n_workers: int = 1):
+        """Creates the shared metrics of the specified endpoints served by the specified number of workers.
+
+        Args:
+            endpoints: the endpoints whose requests are counted. Requests to other endpoints are
+                counted as ``OTHER``.
+            n_workers: the number of worker processes.
+        """
+        self.endpoints = list(endpoints) + [OTHER]
+        self.n_workers = n_workers
+        self._index = {endpoint: i for i, endpoint in enumerate(self.endpoints)}
+        self._width = _BUCKETS + len(LATENCY_BUCKETS) + 1
+        self._lock = mp.Lock()
+        self._requests = mp.RawArray('d', len(self.endpoints) * self._width)
+        self._in_flight = mp.RawArray('l', n_workers)
+        self._pools = mp.RawArray('l', n_workers * len(POOL_STATS))
+
+    def record(self, endpoint: str, seconds: float, status_code: int):
+        """Records a request to the specified endpoint.
+
+        Args:
+            endpoint: the endpoint of the request.
+            seconds: the time taken to handle the request.
+            status_code: the HTTP status code of the response. Codes of 500 and
+                above are counted as errors.
+        """
+        offset = self._index.get(endpoint, self._index[OTHER]) * self._width
+        bucket = offset + _BUCKETS + bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self._requests[offset + _REQUESTS] += 1
+            if status_code >= 500:
+                self._requests[offset + _ERRORS] += 1
+            self._requests[offset + _LATENCY_SUM] += seconds
+            self._requests[bucket] += 1
+
+    def add_in_flight(self, worker: int, n: int):
+        """Adds n, which may be negative, to the number of requests in flight on the specified worker."""
+        with self._lock:
+            self._in_flight[worker] += n
+
+    def set_pool_stats(self, worker: int, stats: Dict[str, int]):
+        """Sets the connection pool stats of the specified worker."""
+        offset = worker * len(POOL_STATS)
+        with self._lock:
+            for i, name in enumerate(POOL_STATS):
+                self._pools[offset + i] = stats.get(name, 0)
+
+    def snapshot(self) -> Dict:
+        """Returns the current metrics as a dictionary.
+
+        Returns:
+            A dictionary with the number of ``workers``, and the ``endpoints``, ``in_flight``
+            and ``db_pools`` metrics. ``endpoints`` maps each endpoint with requests
+            to its ``requests``, ``errors``, ``latency_sum``, and the cumulative counts of the
+            latency histogram ``buckets``, as (upper bound, count) pairs with a final upper bound of
+            None. ``in_flight`` and ``db_pools`` contain the number of requests in flight, and the
+            connection pool stats, of each worker.
+        """
+        with self._lock:
+            requests = list(self._requests)
+            in_flight = list(self._in_flight)
+            pools = list(self._pools)
+
+        endpoints = {}
+        for i, endpoint in enumerate(self.endpoints):
+            counts = requests[i * self._width: (i + 1) * self._width]
+            if counts[_REQUESTS] == 0:
+                continue
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(LATENCY_BUCKETS + (None,), counts[_BUCKETS:]):
+                cumulative += int(count)
+                buckets.append((bound, cumulative))
+            endpoints[endpoint] = {'requests': int(counts[_REQUESTS]), 'errors': int(counts[_ERRORS]),
+                                   'latency_sum': counts[_LATENCY_SUM], 'buckets': buckets}
+
+        n_stats = len(POOL_STATS)
+        db_pools = [dict(zip(POOL_STATS, pools[w * n_stats: (w + 1) * n_stats])) for w in range(self.n_workers)]
+        return {'workers': self.n_workers, 'endpoints': endpoints, 'in_flight': in_flight, 'db_pools': db_pools}
+
+    def render(self) -> str:
+        """Returns the current metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ['# HELP eqsql_service_workers The number of service worker processes.',
+                 '# TYPE eqsql_service_workers gauge',
+                 f'eqsql_service_workers {snapshot["workers"]}',
+                 '# HELP eqsql_service_requests_total The number of requests handled.',
+                 '# TYPE eqsql_service_requests_total counter']
+        endpoints = snapshot['endpoints']
+        for endpoint, m in endpoints.items():
+            lines.append(f'eqsql_service_requests_total{{endpoint="{endpoint}"}} {m["requests"]}')
+        lines += ['# HELP eqsql_service_request_errors_total The number of requests that failed with a server error.',
+                  '# TYPE eqsql_service_request_errors_total counter']
+        for endpoint, m in endpoints.items():
+            lines.append(f'eqsql_service_request_errors_total{{endpoint="{endpoint}"}} {m["errors"]}')
+        lines += ['# HELP eqsql_service_request_seconds The time taken to handle the requests.',
+                  '# TYPE eqsql_service_request_seconds histogram']
+        for endpoint, m in endpoints.items():
+            for bound, count in m['buckets']:
+                le = '+Inf' if bound is None else bound
+                lines.append(f'eqsql_service_request_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {count}')
+            lines.append(f'eqsql_service_request_seconds_sum{{endpoint="{endpoint}"}} {m["latency_sum"]}')
+            lines.append(f'eqsql_service_request_seconds_count{{endpoint="{endpoint}"}} {m["requests"]}')
+        lines += ['# HELP eqsql_service_in_flight The number of requests being handled.',
+                  '# TYPE eqsql_service_in_flight gauge']
+        for worker, n in enumerate(snapshot['in_flight']):
+            lines.append(f'eqsql_service_in_flight{{worker="{worker}"}} {n}')
+        lines += ['# HELP eqsql_service_db_connections The database connections of the worker connection pools.',
+                  '# TYPE eqsql_service_db_connections gauge']
+        for worker, stats in enumerate(snapshot['db_pools']):
+            for state in ('in_use', 'idle', 'opening'):
+                lines.append(f'eqsql_service_db_connections{{worker="{worker}",state="{state}"}} {stats[state]}')
+        lines += ['# HELP eqsql_service_db_pool_max_size The maximum size of the worker connection pools.',
+                  '# TYPE eqsql_service_db_pool_max_size gauge']
+        for worker, stats in enumerate(snapshot['db_pools']):
+            lines.append(f'eqsql_service_db_pool_max_size{{worker="{worker}"}} {stats["max_size"]}')
+        return '\n'.join(lines) + '\n'
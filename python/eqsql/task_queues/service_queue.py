@@ -1,20 +1,99 @@
-from typing import Tuple, Union, List, Generator, Iterable
+from typing import Dict, Tuple, Union, List, Generator, Iterable
+import logging
 import requests
 import json
-from random import shuffle
+import time
+import traceback
 
 
 from eqsql.task_queues.remote_funcs import DBParameters
-from eqsql.task_queues.core import ResultStatus, TaskStatus, Future, TimeoutError
+from eqsql.task_queues.core import ResultStatus, TaskStatus, Future, TimeoutError, _get_future_results, _map_tasks
+from eqsql.task_queues.core import EQ_ABORT, EQ_TIMEOUT
+from eqsql.task_queues import wire
 
+# the maximum time, in seconds, that the service waits for completed tasks
+# before responding to a single as_completed request
+WATCH_POLL_TIMEOUT = 20.0
+# the maximum time, in seconds, that the service waits for queued tasks
+# before responding to a single worker pool query
+POOL_POLL_TIMEOUT = 20.0
+
+logger = logging.getLogger(__name__)
 
-class ServiceTaskQueue:
-    """Task queue protocol for submitting, manipulating and
-    retrieving tasks"""
 
-    def __init__(self, service_url: str, db_params: DBParameters):
+class ServiceClient:
+
+    def __init__(self, service_url: str, db_params: DBParameters, content_type: str = None,
+                 compress: bool = True):
+        """Creates a client that sends its requests to the specified service. The requests
+        are sent over a persistent (keep-alive) HTTP session. The content type and compression
+        of the messages are negotiated with the service on the first request. See
+        :py:mod:`eqsql.task_queues.wire`.
+
+        Args:
+            service_url: the url of the emews_service.
+            db_params: the parameters of the database that the service connects to.
+            content_type: the content type of the messages, ``wire.MSGPACK`` or ``wire.JSON``. If None,
+                the preferred content type supported by both this and the service is used.
+            compress: if True, large messages are compressed with the preferred compression
+                supported by both this and the service.
+        """
+        if content_type is not None and content_type not in wire.content_types():
+            raise ValueError(f'Unsupported content type: {content_type}')
         self.db_params = db_params.to_dict()
         self.api_host = service_url
+        self.session = requests.Session()
+        self.content_type = content_type
+        self.compress = compress
+        # (content type, compression), negotiated with the service on the first request
+        self._wire = None
+
+    def _negotiate(self):
+        response = self.session.get(f'{self.api_host}/wire')
+        if response.status_code == 404:
+            # the service predates the wire format, so send JSON encoded JSON strings
+            self._wire = (None, None)
+            return
+
+        formats = response.json()
+        supported = wire.content_types() if self.content_type is None else [self.content_type]
+        content_type = wire.negotiate(formats['content_types'], supported)
+        if content_type is None:
+            content_type = wire.JSON
+        compression = None
+        if self.compress:
+            compression = wire.negotiate(formats['compressions'], wire.compressions())
+        self._wire = (content_type, compression)
+
+    def _post(self, endpoint: str, msg: Dict):
+        """Posts the specified message to the specified service endpoint, and returns the decoded response."""
+        if self._wire is None:
+            self._negotiate()
+        content_type, compression = self._wire
+        api_url = f'{self.api_host}/{endpoint}'
+        if content_type is None:
+            response = self.session.post(api_url, json=json.dumps(msg))
+            return response.json()
+
+        body, applied = wire.encode(msg, content_type, compression)
+        headers = {'Content-Type': content_type, 'Accept': f'{content_type}, {wire.JSON}'}
+        if applied is not None:
+            headers[wire.COMPRESSION_HEADER] = applied
+        if compression is not None:
+            headers[wire.ACCEPT_COMPRESSION_HEADER] = compression
+        response = self.session.post(api_url, data=body, headers=headers)
+        response.raise_for_status()
+        response_type = response.headers.get('Content-Type', wire.JSON).split(';')[0].strip()
+        return wire.decode(response.content, response_type, response.headers.get(wire.COMPRESSION_HEADER))
+
+    def close(self):
+        """Closes the HTTP session of this client."""
+        self.session.close()
+
+
+class ServiceTaskQueue(ServiceClient):
+    """Task queue protocol for submitting, manipulating and
+    retrieving tasks"""
 
     def submit_task(self, exp_id: str, eq_type: int, payload: str, priority: int = 0,
                     tag: str = None) -> Tuple[ResultStatus, Union[Future, None]]:
@@ -34,9 +113,7 @@ class ServiceTaskQueue:
         """
         msg = {'db_params': self.db_params, 'exp_id': exp_id, 'eq_type': eq_type, 'payload': [payload],
                'priority': priority, 'tag': tag}
-        api_url = f'{self.api_host}/submit_tasks'
-        response = requests.post(api_url, json=json.dumps(msg))
-        status, task_ids = response.json()
+        status, task_ids = self._post('submit_tasks', msg)
         if status == ResultStatus.SUCCESS:
             return (status, Future(self, task_ids[0], tag))
         else:
@@ -62,9 +139,7 @@ class ServiceTaskQueue:
         """
         msg = {'db_params': self.db_params, 'exp_id': exp_id, 'eq_type': eq_type, 'payload': payload,
                'priority': priority, 'tag': tag}
-        api_url = f'{self.api_host}/submit_tasks'
-        response = requests.post(api_url, json=json.dumps(msg))
-        status, task_ids = response.json()
+        status, task_ids = self._post('submit_tasks', msg)
         if status == ResultStatus.SUCCESS:
             return (status, [Future(self, task_id, tag) for task_id in task_ids])
 
@@ -79,9 +154,7 @@ class ServiceTaskQueue:
         """
         ft_map = {ft.eq_task_id: ft for ft in futures}
         msg = {'db_params': self.db_params, 'task_ids': [ft.eq_task_id for ft in futures]}
-        api_url = f'{self.api_host}/cancel_tasks'
-        response = requests.post(api_url, json=json.dumps(msg))
-        result = response.json()
+        result = self._post('cancel_tasks', msg)
         if result[0] == ResultStatus.SUCCESS:
             for eq_task_id in result[1]:
                 ft_map[eq_task_id]._task_status = TaskStatus.CANCELED
@@ -108,9 +181,57 @@ class ServiceTaskQueue:
             for the failure (``EQ_TIMEOUT``, or ``EQ_ABORT``)
         """
         msg = {'db_params': self.db_params, 'eq_task_id': eq_task_id, 'delay': delay, 'timeout': timeout}
-        api_url = f'{self.api_host}/query_result'
-        response = requests.post(api_url, json=json.dumps(msg))
-        return response.json()[0]
+        return self._post('query_result', msg)[0]
+
+    def get_results(self, futures: Iterable[Future], consume: bool = True) -> List[Tuple[Future, str]]:
+        """Gets the results of those of the specified tasks whose results are available, with a
+        single query, without waiting for the results. See
+        :py:func:`LocalTaskQueue.get_results <eqsql.task_queues.local_queue.LocalTaskQueue.get_results>`.
+
+        Args:
+            futures: the futures of the tasks to get the results of.
+            consume: if True, the results are popped off of the input queue and cached in their
+                futures, otherwise they are left in the input queue.
+
+        Returns:
+            A List of (Future, result) tuples, in the order of the specified futures, for the futures
+            whose results are available, or None if the query fails.
+        """
+        def query(eq_task_ids):
+            msg = {'db_params': self.db_params, 'task_ids': eq_task_ids, 'consume': consume}
+            result = self._post('get_results', msg)
+            return None if result['status'] == 'fail' else dict(result['result'])
+
+        return _get_future_results(futures, query, consume)
+
+    def map(self, exp_id: str, eq_type: int, payload: Iterable[str], window: int = 1000, ordered: bool = True,
+            priority: int = 0, tag: str = None, timeout: float = None,
+            sleep: float = 0.5) -> Generator[Union[str, Tuple[int, str]], None, None]:
+        """Returns a generator that submits a task for each of the payloads, and yields the task results,
+        with at most ``window`` tasks in flight at a time. The tasks are submitted with
+        :py:func:`submit_tasks` as the window frees up, and the in flight tasks are checked for completion
+        with :py:func:`get_results`. See
+        :py:func:`LocalTaskQueue.map <eqsql.task_queues.local_queue.LocalTaskQueue.map>`.
+
+        Args:
+            exp_id: the id of the experiment of which the work is part.
+            eq_type: the type of work
+            payload: an iterable of the work payloads
+            window: the maximum number of tasks in flight.
+            ordered: if True, the results are yielded in payload order, otherwise they are yielded
+                as the tasks complete.
+            priority: the priority of the tasks
+            tag: an optional metadata tag for the tasks
+            timeout: if not None, a :py:class:`TimeoutError` is raised if all the results have not been
+                yielded this many seconds after the first result is requested.
+            sleep: the time, in seconds, to sleep between checks for completed tasks.
+
+        Yields:
+            If ordered is True, the task results in payload order, otherwise (index, result) tuples,
+            where index is the position of the task's payload in the payloads, as the tasks complete.
+        """
+        return _map_tasks(self, exp_id, eq_type, payload, window=window, ordered=ordered, priority=priority,
+                          tag=tag, timeout=timeout, sleep=sleep)
 
     def get_priorities(self, futures: Iterable[Future]) -> List[Tuple[Future, int]]:
         """Gets the priorities of the specified tasks.
@@ -124,9 +245,7 @@ class ServiceTaskQueue:
         """
         id_map = {ft.eq_task_id: ft for ft in futures}
         msg = {'db_params': self.db_params, 'task_ids': [ft.eq_task_id for ft in futures]}
-        api_url = f'{self.api_host}/get_priorities'
-        response = requests.post(api_url, json=json.dumps(msg))
-        result = response.json()
+        result = self._post('get_priorities', msg)
         if result['status'] == 'fail':
             return ResultStatus.FAILURE
 
@@ -149,9 +268,7 @@ class ServiceTaskQueue:
                 otherwise (ResultStatus.FAILURE, []).
         """
         msg = {'db_params': self.db_params, 'task_ids': [ft.eq_task_id for ft in futures], 'new_priority': new_priority}
-        api_url = f'{self.api_host}/update_priorities'
-        response = requests.post(api_url, json=json.dumps(msg))
-        result = response.json()
+        result = self._post('update_priorities', msg)
         if result['status'] == "fail":
             return (ResultStatus.FAILURE, [])
         return result['result']
@@ -167,9 +284,7 @@ class ServiceTaskQueue:
             True if the queues are empty, otherwise False.
         """
         msg = {'db_params': self.db_params, 'eq_type': eq_type}
-        api_url = f'{self.api_host}/are_queues_empty'
-        response = requests.post(api_url, json=json.dumps(msg))
-        return response.json()[0] == 1
+        return self._post('are_queues_empty', msg)[0] == 1
 
     def get_worker_pools(self, futures: List[Future]) -> List[Tuple[Future, Union[str, None]]]:
         """Gets the worker pools on which the specified list of :py:class:`Futures <Future>` are running, if any.
@@ -184,9 +299,8 @@ class ServiceTaskQueue:
         id_map = {ft.eq_task_id: ft for ft in futures}
         ids = tuple(ft.eq_task_id for ft in futures)
         msg = {'db_params': self.db_params, 'task_ids': ids}
-        api_url = f'{self.api_host}/get_worker_pools'
-        response = requests.post(api_url, json=json.dumps(msg))
-        return [(id_map[eq_task_id], worker_pool) for eq_task_id, worker_pool in response.json()]
+        result = self._post('get_worker_pools', msg)
+        return [(id_map[eq_task_id], worker_pool) for eq_task_id, worker_pool in result]
 
     def pop_completed(self, futures: List[Future], timeout=None, sleep: float = 0) -> Future:
         """Pops and returns the first completed future from the specified List
@@ -210,9 +324,14 @@ class ServiceTaskQueue:
     def as_completed(self, futures: List[Future], pop: bool = False, timeout: float = None, n: int = None,
                      batch_size: int = 1, sleep: float = 0) -> Generator[Future, None, None]:
         """Returns a generator over the :py:class:`Futures <Future>` in the ``futures`` argument that yields
-        Futures as they complete. The  :py:class:`Futures <Future>` are checked for completion by iterating over all of the
-        ones that have not yet completed and checking for a result. At the end of each iteration, the
-        ``timeout`` is checked. Note that adding or removing :py:class:`Futures <Future>`
+        Futures as they complete. The ids of the :py:class:`Futures <Future>` that have not yet completed
+        are sent to the service once, as a watch set, and the service is then long polled for the
+        completed tasks in the watch set, so the size of each request is independent of the number
+        of :py:class:`Futures <Future>`. The service checks the whole watch set for completed tasks with
+        a single query every ``sleep`` seconds, and responds when ``batch_size`` tasks have completed,
+        or after at most ``WATCH_POLL_TIMEOUT`` seconds. After each response, the ``timeout`` is checked.
+        A ``timeout`` of 0 checks the futures once with a single :py:func:`get_results` request.
+        Note that adding or removing :py:class:`Futures <Future>`
         to or from the ``futures`` argument List while iterating may have no effect on this call.
         A :py:class:`TimeoutError` will be raised if the futures do not complete within the specified ``timeout`` duration.
 
@@ -222,11 +341,11 @@ class ServiceTaskQueue:
             timeout: if the time taken for futures to completed is greater than this value, then
                 raise :py:class:`TimeoutError`.
             n: yield this many completed Futures and then stop iteration.
-            batch_size: retrieve this many completed futures, before yielding. Assuming a batch_size > 1,
-                the remotely executing code will retrieve this many results before returning them to the
+            batch_size: retrieve up to this many completed futures, before yielding. Assuming a batch_size > 1,
+                the service will wait for this many results before returning them to the
                 locally executing code. Consequently, this greatly reduces communication overhead, and
                 can improve the performance of a remote queue.
-            sleep: the time, in seconds, to sleep between each iteration over all the Futures.
+            sleep: the time, in seconds, that the service sleeps between each check of the watch set.
 
         Yields:
         :py:class:`Futures <Future>` in the ``futures`` argument as they complete.
@@ -238,51 +357,87 @@ class ServiceTaskQueue:
                     status, result = ft.result()
                     // do something with result
         """
+        start_time = time.time()
         id_map = {ft.eq_task_id: ft for ft in futures}
-        api_url = f'{self.api_host}/as_completed'
-        n_completed = 0
         n_futures = len(futures)
-        completed_tasks = []
-        if n is None:
-            n_required = n_futures
-        else:
-            n_required = n_futures if n_futures < n else n
-        total_required = n_required
+        n_required = n_futures if n is None else min(n, n_futures)
+        n_completed = 0
 
-        while True:
-            eq_task_ids = [ft.eq_task_id for ft in futures]
-            # _as_completed iterates through the list of task_ids
-            # we shuffle so not biasing the members at the front of the list
-            shuffle(eq_task_ids)
-            msg = {'db_params': self.db_params, 'task_ids': eq_task_ids, 'timeout': timeout, 'batch_size': batch_size,
-                   'n_required': n_required, 'sleep': sleep, 'completed_tasks': completed_tasks}
-            response = requests.post(api_url, json=json.dumps(msg))
-            result = response.json()
-
-            if result['status'] == "timeout_error":
-                raise TimeoutError(f'as_completed timed out after {timeout} seconds')
-
-            batch = result['result']
-            for task_id, task_status, result_status, task_result in batch:
-
-                ft = id_map[task_id]
-                ft._result = (result_status, task_result)
-                ft._task_status = TaskStatus.COMPLETE if task_status == TaskStatus.COMPLETE else None
+        # futures with a result are already complete
+        for ft in [ft for ft in futures if ft._result is not None and ft._result[0] == ResultStatus.SUCCESS]:
+            if n_completed == n_required:
+                return
+            del id_map[ft.eq_task_id]
+            if pop:
+                futures.remove(ft)
+            n_completed += 1
+            yield ft
+
+        if n_completed == n_required:
+            return
+
+        if timeout is not None and timeout <= 0:
+            # a single check of the futures, e.g., a sweep by an executor, needs only one request
+            # rather than the creation, poll and deletion of a watch set
+            pending = list(id_map.values())
+            found = self.get_results(pending)
+            if found is None:
+                # as with a failed query by LocalTaskQueue.as_completed, the pending futures are aborted
+                found = [(ft, EQ_ABORT) for ft in pending[:min(batch_size, n_required - n_completed)]]
+                for ft, _ in found:
+                    ft._result = (ResultStatus.FAILURE, EQ_ABORT)
+            for ft, _ in found:
+                if n_completed == n_required:
+                    return
                 if pop:
                     futures.remove(ft)
-                else:
-                    # task_ids to query are gathered from the futures
-                    # if popped then we don't need to track it as completed
-                    # as it won't be part of the task_ids
-                    completed_tasks.append(ft.eq_task_id)
-                yield ft
-
                 n_completed += 1
-                if n_completed == n_futures or n_completed == n:
-                    # Python docs: return rather than raise StopIteration
-                    return
-
-            n_required = total_required - n_completed
+                yield ft
+            if n_completed == n_required:
+                return
+            raise TimeoutError(f'as_completed timed out after {timeout} seconds')
+
+        # the ids are sent once, and the completed tasks then popped from the watch set by its id
+        msg = {'db_params': self.db_params, 'task_ids': list(id_map)}
+        result = self._post('watch_tasks', msg)
+        if result['status'] != 'ok':
+            raise RuntimeError('as_completed failed to create a watch set')
+        watch_id = result['watch_id']
+
+        try:
+            while True:
+                wait = WATCH_POLL_TIMEOUT
+                if timeout is not None:
+                    wait = min(wait, max(0.0, timeout - (time.time() - start_time)))
+                msg = {'db_params': self.db_params, 'watch_id': watch_id,
+                       'n': min(batch_size, n_required - n_completed), 'timeout': wait, 'sleep': sleep}
+                result = self._post('next_watched', msg)
+                if result['status'] == 'ok':
+                    batch = [(id_map[task_id], task_status, result_status, task_result)
+                             for task_id, task_status, result_status, task_result in result['result']]
+                else:
+                    # as with a failed query by LocalTaskQueue.as_completed, the pending futures are aborted
+                    batch = [(ft, None, ResultStatus.FAILURE, EQ_ABORT) for ft in
+                             list(id_map.values())[:min(batch_size, n_required - n_completed)]]
+
+                for ft, task_status, result_status, task_result in batch:
+                    del id_map[ft.eq_task_id]
+                    ft._result = (result_status, task_result)
+                    ft._task_status = TaskStatus.COMPLETE if task_status == TaskStatus.COMPLETE else None
+                    if pop:
+                        futures.remove(ft)
+                    n_completed += 1
+                    yield ft
+
+                    if n_completed == n_required:
+                        # Python docs: return rather than raise StopIteration
+                        return
+
+                if timeout is not None and time.time() - start_time > timeout:
+                    raise TimeoutError(f'as_completed timed out after {timeout} seconds')
+        finally:
+            msg = {'db_params': self.db_params, 'watch_id': watch_id}
+            self._post('close_watch', msg)
 
     def get_status(self, futures: Iterable[Future]) -> List[Tuple[Future, TaskStatus]]:
         """Gets the status (queued, running, etc.) of the specified tasks
@@ -297,10 +452,8 @@ class ServiceTaskQueue:
         """
         ft_map = {ft.eq_task_id: ft for ft in futures}
         task_ids = [ft.eq_task_id for ft in futures]
-        api_url = f'{self.api_host}/get_status'
         msg = {'db_params': self.db_params, 'task_ids': task_ids}
-        response = requests.post(api_url, json=json.dumps(msg))
-        results = response.json()
+        results = self._post('get_status', msg)
 
         if results is None:
             # TODO: better error handling - logger would have reported error remotely
@@ -317,8 +470,203 @@ class ServiceTaskQueue:
         return ret
 
 
+class ServicePoolQueue(ServiceClient):
+    """Worker pool side task queue that queries for and reports tasks through the emews_service,
+    for worker pools that cannot connect to the database. It provides the worker pool methods of
+    :py:class:`LocalTaskQueue <eqsql.task_queues.local_queue.LocalTaskQueue>`, so it can be used in
+    place of one by a worker pool, e.g., with a
+    :py:class:`BufferedReporter <eqsql.task_queues.local_queue.BufferedReporter>`. Queries for tasks
+    long poll the service, which waits for up to ``POOL_POLL_TIMEOUT`` seconds for queued tasks
+    before responding, so a query for many tasks, or a report of many results, is a single request.
+    """
+
+    def __init__(self, service_url: str, db_params: DBParameters, lease_duration: float = None,
+                 fair_share: bool = False, pool_labels: List[str] = None, content_type: str = None,
+                 compress: bool = True):
+        """Creates a ServicePoolQueue. ServicePoolQueues should be created with :py:func:`init_pool_queue`.
+
+        Args:
+            service_url: the url of the emews_service.
+            db_params: the parameters of the database that the service connects to.
+            lease_duration: if not None, tasks queried for by this ServicePoolQueue are leased for
+                this many seconds. See :py:func:`renew_leases`.
+            fair_share: if True, tasks queried for are shared between experiments in proportion to
+                their weights.
+            pool_labels: the labels, in addition to the querying worker pool's id, of the targeted
+                tasks queried for by this ServicePoolQueue.
+            content_type: the content type of the messages. See :py:class:`ServiceClient`.
+            compress: if True, large messages are compressed. See :py:class:`ServiceClient`.
+        """
+        super().__init__(service_url, db_params, content_type=content_type, compress=compress)
+        self.lease_duration = lease_duration
+        self.fair_share = fair_share
+        self.pool_labels = [] if pool_labels is None else list(pool_labels)
+        self.logger = logger
+
+    def _poll(self, endpoint: str, msg: Dict, timeout: Union[float, None]):
+        """Long polls the specified query endpoint until it returns tasks, or the timeout has elapsed.
+
+        Returns:
+            A tuple of the running task ids, if any, and the task messages, or None if the request fails.
+        """
+        msg.update({'db_params': self.db_params, 'lease_duration': self.lease_duration,
+                    'fair_share': self.fair_share, 'pool_labels': self.pool_labels})
+        running = None
+        start_time = time.time()
+        while True:
+            msg['timeout'] = POOL_POLL_TIMEOUT
+            if timeout is not None:
+                msg['timeout'] = min(POOL_POLL_TIMEOUT, max(0.0, timeout - (time.time() - start_time)))
+            try:
+                result = self._post(endpoint, msg)
+            except requests.RequestException:
+                self.logger.error(f'{endpoint} error {traceback.format_exc()}')
+                return None
+            if result['status'] == 'invalid':
+                raise ValueError(result['error'])
+
+            if endpoint == 'query_more_tasks':
+                running, msgs = result['result']
+                msg['task_ids'] = running
+            else:
+                msgs = result['result']
+            timed_out = len(msgs) == 1 and msgs[0]['type'] == 'status' and msgs[0]['payload'] == EQ_TIMEOUT
+            if not timed_out or (timeout is not None and time.time() - start_time >= timeout):
+                return (running, msgs)
+
+    def query_task(self, eq_type: Union[int, List[int]], n: int = 1, worker_pool: str = 'default', delay: float = 0.5,
+                   timeout: float = 2.0, weights: Dict[int, float] = None) -> Union[List[Dict], Dict]:
+        """Queries for the highest priority tasks of the specified type or types. See
+        :py:func:`LocalTaskQueue.query_task <eqsql.task_queues.local_queue.LocalTaskQueue.query_task>`.
+
+        Args:
+            eq_type: the type of the task to query for, or a list of types
+            n: the maximum number of tasks to query for
+            worker_pool: the id of the worker pool querying for the tasks.
+            delay: the time, in seconds, that the service sleeps between polls of the queue.
+            timeout: the duration after which the query will timeout. If timeout is None, there is no limit to
+                the wait time.
+            weights: an optional dictionary of task type to the weight added to the priority of the tasks of
+                that type, when querying for several types.
+
+        Returns:
+            If ``n == 1``, or the query times out or fails, a single dictionary, otherwise a List of
+            dictionaries, in the format returned by
+            :py:func:`LocalTaskQueue.query_task <eqsql.task_queues.local_queue.LocalTaskQueue.query_task>`.
+        """
+        msg = {'eq_type': eq_type, 'n': n, 'worker_pool': worker_pool, 'sleep': delay, 'weights': weights}
+        result = self._poll('query_tasks', msg, timeout)
+        if result is None:
+            return {'type': 'status', 'payload': EQ_ABORT}
+        msgs = result[1]
+        if n == 1 or (len(msgs) == 1 and msgs[0]['payload'] in (EQ_TIMEOUT, EQ_ABORT)):
+            return msgs[0]
+        return msgs
+
+    def query_more_tasks(self, eq_type: Union[int, List[int]], eq_task_ids: Iterable[int], batch_size: int,
+                         threshold: int = 1, worker_pool: str = 'default', delay: float = 0.5, timeout: float = 2.0,
+                         weights: Dict[int, float] = None) -> Tuple[List[int], List[Dict]]:
+        """Queries for up to batch_size tasks less the number of the specified tasks that are still running,
+        renewing the leases of the running tasks if this ServicePoolQueue has a lease duration. See
+        :py:func:`LocalTaskQueue.query_more_tasks <eqsql.task_queues.local_queue.LocalTaskQueue.query_more_tasks>`.
+
+        Args:
+            eq_type: the type of the work to query for, or a list of types.
+            eq_task_ids: the possibly running task ids used to determine the number of tasks to return.
+            batch_size: the maximum amount of tasks to return
+            threshold: the number of free "slots" that must be available before tasks are queried for.
+            worker_pool: the id of the worker pool querying for the tasks
+            delay: the time, in seconds, that the service sleeps between polls of the queue.
+            timeout: the duration after which the query will timeout. If timeout is None, there is no limit to
+                the wait time.
+            weights: an optional dictionary of work type to weight when querying for several types.
+
+        Returns:
+            A two element Tuple where the first element is a List of the ids of the currently running tasks
+            plus the ids of any new tasks, and the second element is a List of the task message dictionaries.
+        """
+        msg = {'eq_type': eq_type, 'task_ids': list(eq_task_ids), 'batch_size': batch_size, 'threshold': threshold,
+               'worker_pool': worker_pool, 'sleep': delay, 'weights': weights}
+        result = self._poll('query_more_tasks', msg, timeout)
+        if result is None:
+            return ([], [{'type': 'status', 'payload': EQ_ABORT}])
+        return result
+
+    def report_task(self, eq_task_id: int, eq_type: int, result: str, worker_pool: str = None) -> ResultStatus:
+        """Reports the result of the specified task of the specified type. The report is only
+        accepted if the task is running, on the specified worker pool if one is specified.
+
+        Args:
+            eq_task_id: the id of the task whose results are being reported.
+            eq_type: the type of the task whose results are being reported.
+            result: the result of the task.
+            worker_pool: if not None, the id of the worker pool reporting the task.
+        Returns:
+            :py:class:`ResultStatus.SUCCESS` if the task was successfully reported, otherwise
+            :py:class:`ResultStatus.FAILURE`, including when the report is rejected.
+        """
+        status, rejected = self.report_tasks([(eq_task_id, eq_type, result)], worker_pool)
+        return ResultStatus.FAILURE if len(rejected) > 0 else status
+
+    def report_tasks(self, results: Iterable[Tuple[int, int, str]],
+                     worker_pool: str = None) -> Tuple[ResultStatus, List[int]]:
+        """Reports the results of the specified tasks with a single request. See
+        :py:func:`LocalTaskQueue.report_tasks <eqsql.task_queues.local_queue.LocalTaskQueue.report_tasks>`.
+
+        Args:
+            results: the results to report as (eq_task_id, eq_type, result) tuples.
+            worker_pool: if not None, the id of the worker pool reporting the tasks.
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` of the report, and the ids of the tasks
+            whose reports were rejected.
+        """
+        results = list(results)
+        if len(results) == 0:
+            return (ResultStatus.SUCCESS, [])
+        msg = {'db_params': self.db_params, 'results': results, 'worker_pool': worker_pool}
+        try:
+            result = self._post('report_tasks', msg)
+        except requests.RequestException:
+            self.logger.error(f'report_tasks error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+        # services that predate rejected reports respond with the status alone
+        rejected = result[1] if len(result) > 1 else []
+        return (ResultStatus(result[0]), rejected)
+
+    def renew_leases(self, eq_task_ids: Iterable[int], worker_pool: str = 'default',
+                     lease_duration: float = None) -> Tuple[ResultStatus, List[int]]:
+        """Sends the worker pool heartbeat for the specified running tasks, renewing their leases. See
+        :py:func:`LocalTaskQueue.renew_leases <eqsql.task_queues.local_queue.LocalTaskQueue.renew_leases>`.
+        If neither this ServicePoolQueue nor the call has a lease duration, the heartbeat
+        returns those of the tasks that are still running.
+
+        Args:
+            eq_task_ids: the ids of the tasks whose leases to renew.
+            worker_pool: the id of the worker pool running the tasks.
+            lease_duration: the new lease duration in seconds, from now. If this is None,
+                the ServicePoolQueue's lease duration is used.
+
+        Returns:
+            A tuple containing the :py:class:`ResultStatus` of the renewal and the ids of the tasks
+            whose leases were renewed.
+        """
+        lease_duration = self.lease_duration if lease_duration is None else lease_duration
+        ids = list(eq_task_ids)
+        if len(ids) == 0:
+            return (ResultStatus.SUCCESS, [])
+        msg = {'db_params': self.db_params, 'task_ids': ids, 'worker_pool': worker_pool,
+               'lease_duration': lease_duration}
+        try:
+            status, renewed = self._post('heartbeat', msg)
+            return (ResultStatus(status), renewed)
+        except requests.RequestException:
+            self.logger.error(f'renew_leases error {traceback.format_exc()}')
+            return (ResultStatus.FAILURE, [])
+
+
 def init_task_queue(service_url: str, db_host: str, db_user: str, db_port: int,
-                    db_name: str, password: str = None, retry_threshold=0) -> ServiceTaskQueue:
+                    db_name: str, password: str = None, retry_threshold=0, content_type: str = None,
+                    compress: bool = True) -> ServiceTaskQueue:
     """Initializes and returns an :py:class:`LocalTaskQueue` class instance with the specified parameters.
 
     Args:
@@ -331,8 +679,40 @@ def init_task_queue(service_url: str, db_host: str, db_user: str, db_port: int,
             (e.g, there are currently too many connections),
             then retry ``retry_threshold`` many times to establish a connection. There
             will be random few second delay betwen each retry.
+        content_type: the content type of the messages sent to the service, ``wire.MSGPACK`` or
+            ``wire.JSON``. If None, the preferred content type supported by the service is used.
+        compress: if True, large messages to and from the service are compressed.
     Returns:
         An :py:class:`ServiceTaskQueue` instance
     """
     db_params = DBParameters(db_user, db_host, db_name, password, db_port, retry_threshold)
-    return ServiceTaskQueue(service_url, db_params)
+    return ServiceTaskQueue(service_url, db_params, content_type=content_type, compress=compress)
+
+
+def init_pool_queue(service_url: str, db_host: str, db_user: str, db_port: int, db_name: str,
+                    password: str = None, retry_threshold=0, lease_duration: float = None, fair_share: bool = False,
+                    pool_labels: List[str] = None, content_type: str = None,
+                    compress: bool = True) -> ServicePoolQueue:
+    """Initializes and returns a :py:class:`ServicePoolQueue` class instance, for a worker pool
+    that queries for and reports tasks through the emews_service at the specified url.
+
+    Args:
+        service_url: the url of the emews_service.
+        db_host: the eqsql database host
+        db_user: the eqsql database user
+        db_port: the eqsql database port
+        db_name: the eqsql database name
+        password: the eqdql database password (if there is one)
+        retry_threshold: the number of times the service retries establishing a database connection.
+        lease_duration: if not None, tasks queried for are leased for this many seconds.
+        fair_share: if True, tasks queried for are shared between experiments in proportion to their weights.
+        pool_labels: the labels, in addition to the querying worker pool's id, of the targeted tasks queried for.
+        content_type: the content type of the messages sent to the service, ``wire.MSGPACK`` or
+            ``wire.JSON``. If None, the preferred content type supported by the service is used.
+        compress: if True, large messages to and from the service are compressed.
+    Returns:
+        A :py:class:`ServicePoolQueue` instance
+    """
+    db_params = DBParameters(db_user, db_host, db_name, password, db_port, retry_threshold)
+    return ServicePoolQueue(service_url, db_params, lease_duration=lease_duration, fair_share=fair_share,
+                            pool_labels=pool_labels, content_type=content_type, compress=compress)
@@ -0,0 +1,129 @@
+"""Wire format of the messages exchanged by a :py:class:`ServiceTaskQueue <eqsql.task_queues.service_queue.ServiceTaskQueue>`
+and the emews_service. A message is encoded once, as msgpack if msgpack is installed on both
+ends, and otherwise as JSON, and large messages are compressed, with zstd if zstandard is installed
+on both ends, and otherwise with gzip. The content type and the compression of a message are
+specified in its ``Content-Type`` and ``X-EQSQL-Compression`` headers. The compression header is
+used rather than ``Content-Encoding``, so that the HTTP client does not decompress the responses itself.
+
+msgpack and zstandard are optional dependencies, e.g., ``pip install msgpack zstandard``.
+"""
+import gzip
+import json
+from typing import Any, Iterable, List, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# request and response headers
+COMPRESSION_HEADER = 'X-EQSQL-Compression'
+ACCEPT_COMPRESSION_HEADER = 'X-EQSQL-Accept-Compression'
+
+# messages smaller than this, in bytes, are not compressed
+COMPRESS_THRESHOLD = 4096
+
+
+def content_types() -> List[str]:
+    """Returns the content types that can be encoded and decoded here, in order of preference."""
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def compressions() -> List[str]:
+    """Returns the compressions that can be applied and removed here, in order of preference."""
+    return [ZSTD, GZIP] if zstandard is not None else [GZIP]
+
+
+def negotiate(offered: Iterable[str], supported: List[str]) -> Union[str, None]:
+    """Returns the first of the supported values that is also offered, or None
+    if there are none.
+
+    Args:
+        offered: the values offered by the other end.
+        supported: the values supported here, in order of preference.
+    """
+    offered = set(offered)
+    for value in supported:
+        if value in offered:
+            return value
+    return None
+
+
+def parse_header_list(header: Union[str, None]) -> List[str]:
+    """Parses a comma separated header value, such as an ``Accept`` header, into a list of
+    its values, ignoring any parameters (e.g., ``;q=0.9``)."""
+    if not header:
+        return []
+    return [value.split(';')[0].strip() for value in header.split(',') if value.strip()]
+
+
+def compress(body: bytes, compression: str) -> bytes:
+    if compression == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if compression == GZIP:
+        return gzip.compress(body, compresslevel=1)
+    raise ValueError(f'Unsupported compression: {compression}')
+
+
+def decompress(body: bytes, compression: str) -> bytes:
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd compressed message, but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(body)
+    if compression == GZIP:
+        return gzip.decompress(body)
+    raise ValueError(f'Unsupported compression: {compression}')
+
+
+def encode(obj: Any, content_type: str, compression: str = None) -> Tuple[bytes, Union[str, None]]:
+    """Encodes the specified object as the specified content type, compressing it if a
+    compression is specified and the encoded object is at least ``COMPRESS_THRESHOLD`` bytes.
+
+    Args:
+        obj: the object to encode. Tuples are encoded as lists.
+        content_type: the content type to encode as: ``MSGPACK`` or ``JSON``.
+        compression: the compression to apply to large messages, or None.
+
+    Returns:
+        A tuple of the encoded message and the compression that was applied to it, or None
+        if the message was not compressed.
+    """
+    if content_type == MSGPACK:
+        body = msgpack.packb(obj)
+    else:
+        body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    if compression is not None and len(body) >= COMPRESS_THRESHOLD:
+        return compress(body, compression), compression
+    return body, None
+
+
+def decode(body: bytes, content_type: str, compression: str = None) -> Any:
+    """Decodes a message encoded with :py:func:`encode`.
+
+    Args:
+        body: the encoded message.
+        content_type: the content type of the message.
+        compression: the compression applied to the message, or None.
+
+    Returns:
+        The decoded object. Note that encoded tuples are decoded as lists.
+    """
+    if compression:
+        body = decompress(body, compression)
+    if content_type == MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack encoded message, but msgpack is not installed')
+        return msgpack.unpackb(body, strict_map_key=False)
+    return json.loads(body)
@@ -39,7 +39,40 @@ create table eq_tasks (
        /* time this task finished (json_in) */
        time_stop  timestamp,
        /* tracks priority of task so it can be restarted with correct priority */
-       eq_priority integer
+       eq_priority integer,
+       /* time the running task's lease expires, if it is leased */
+       lease_expiry timestamptz,
+       /* the id or label of the worker pool the task is targeted at, or null if
+          any worker pool can run it */
+       target_pool text,
+       /* the task's key in eq_result_cache, if it was submitted with result caching */
+       cache_key text
+);
+
+/* The weights of the experiments for fair share scheduling */
+create table eq_exp_weights (
+       exp_id text PRIMARY KEY,
+       /* the experiment's share relative to the other experiments, experiments
+          without a weight have a weight of 1 */
+       weight double precision not null check (weight > 0)
+);
+
+/* The priority aging rates of the task types */
+create table eq_task_aging (
+       eq_task_type integer PRIMARY KEY,
+       /* the increase in the effective priority of a queued task per second */
+       rate double precision not null check (rate >= 0)
+);
+
+/* The cached results of the tasks submitted with result caching */
+create table eq_result_cache (
+       /* hash of the task type, the scope, and the normalized payload */
+       cache_key text PRIMARY KEY,
+       eq_task_type integer not null,
+       /* the experiment of the task whose result this is */
+       exp_id text,
+       json_in text not null,
+       time_cached timestamptz not null default now()
 );
 
 create table eq_task_tags (
@@ -54,13 +87,394 @@ create table emews_queue_OUT(
        /* the task type */
        eq_task_type integer,
        /* eq_id */
+       eq_task_id integer PRIMARY KEY,
+       eq_priority integer,
+       /* the experiment id of the task, used for fair share scheduling */
+       exp_id text,
+       /* the time the task was pushed onto the queue */
+       time_enqueued timestamptz not null default now(),
+       /* eq_priority - the aging rate of the task's type * the epoch time_enqueued,
+          the task's effective priority is aging_key + rate * now */
+       aging_key double precision not null,
+       /* the id or label of the worker pool the task is targeted at, or null if
+          any worker pool can run it */
+       target_pool text
+);
+
+/* The watch sets, see LocalTaskQueue._create_watch */
+create sequence eq_watch_id_generator start 1 no cycle;
+
+create table eq_watches (
+       watch_id integer PRIMARY KEY,
+       /* the time the watch set was created or last popped from, for the
+          eviction of abandoned watch sets */
+       time_polled timestamptz not null default now()
+);
+
+/* The ids of the tasks in each watch set that have not yet been popped */
+create table eq_watch_tasks (
+       watch_id integer,
        eq_task_id integer,
-       eq_priority integer
+       PRIMARY KEY (watch_id, eq_task_id)
 );
 
 create table emews_queue_IN(
        /* the task type */
        eq_task_type integer,
        /*  eq_id */
-       eq_task_id integer
+       eq_task_id integer PRIMARY KEY
 );
+
+/* Matches the ORDER BY of the out queue pop so that the pop
+   is an index scan rather than a sequential scan and sort
+*/
+create index emews_queue_out_pop_idx on emews_queue_OUT
+       (eq_task_type, aging_key DESC, eq_task_id ASC) where target_pool is null;
+
+/* The highest priority tasks of each experiment, for fair share scheduling */
+create index emews_queue_out_exp_pop_idx on emews_queue_OUT
+       (eq_task_type, exp_id, aging_key DESC, eq_task_id ASC) where target_pool is null;
+
+/* The highest priority tasks targeted at each worker pool id or label */
+create index emews_queue_out_target_idx on emews_queue_OUT
+       (target_pool, eq_task_type, aging_key DESC, eq_task_id ASC) where target_pool is not null;
+
+create index eq_tasks_status_idx on eq_tasks (eq_status);
+
+create index eq_exp_id_tasks_exp_id_idx on eq_exp_id_tasks (exp_id);
+
+create index eq_exp_id_tasks_task_id_idx on eq_exp_id_tasks (eq_task_id);
+
+/* Finds the running tasks whose leases have expired */
+create index eq_tasks_lease_idx on eq_tasks (lease_expiry) where eq_status = 1;
+
+/* The oldest cached results, for ttl and size eviction */
+create index eq_result_cache_time_idx on eq_result_cache (time_cached);
+
+/* Server-side functions for the task queue's hot operations, see
+   LocalTaskQueue's server_functions mode. Status values are those of
+   eqsql.task_queues.core.TaskStatus and ResultStatus.
+*/
+
+/* The aging rate of the specified type times the current time in epoch seconds.
+   A task pushed onto the output queue now has an aging_key of its priority minus this. */
+create or replace function eq_aging_offset(p_eq_type integer) returns double precision as $$
+    select coalesce((select rate from eq_task_aging where eq_task_type = p_eq_type), 0) * extract(epoch from now());
+$$ language sql stable;
+
+/* Submits a task, returning its id */
+create or replace function eq_submit(p_exp_id text, p_eq_type integer, p_payload text,
+                                     p_priority integer, p_tag text, p_notify boolean,
+                                     p_target_pool text default null)
+returns integer as $$
+declare
+    task_id integer;
+begin
+    task_id := nextval('emews_id_generator');
+    insert into eq_tasks (eq_task_id, eq_task_type, json_out, time_created, eq_priority, eq_status, target_pool)
+        values (task_id, p_eq_type, p_payload, localtimestamp, p_priority, 0, p_target_pool);
+    insert into eq_exp_id_tasks (exp_id, eq_task_id) values (p_exp_id, task_id);
+    if p_tag is not null then
+        insert into eq_task_tags (eq_task_id, tag) values (task_id, p_tag);
+    end if;
+    insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key, target_pool)
+        values (p_eq_type, task_id, p_priority, p_exp_id, p_priority - eq_aging_offset(p_eq_type), p_target_pool);
+    if p_notify then
+        perform pg_notify('eq_out_' || p_eq_type, '');
+    end if;
+    return task_id;
+end;
+$$ language plpgsql;
+
+/* Pops up to p_n of the highest priority tasks of any of the specified types off
+   of the output queue, marks them as running on the specified worker pool, and
+   returns their ids and payloads. Each type's weight, from the corresponding
+   element of p_weights, is added to the priority of the tasks of that type. Only
+   untargeted tasks, and tasks targeted at p_worker_pool or one of p_labels, are
+   popped. The highest priority tasks of each type are found with the
+   emews_queue_out_pop_idx index, and those of each target with the
+   emews_queue_out_target_idx index. If p_lease is not null, the tasks are leased
+   for p_lease seconds. */
+create or replace function eq_pop_out_types(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                            p_worker_pool text, p_lease double precision default null,
+                                            p_labels text[] default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            with types as (
+                select u.eq_type, u.weight + eq_aging_offset(u.eq_type) as boost
+                from unnest(p_eq_types, p_weights) as u(eq_type, weight)
+            )
+            select q.eq_task_id from (
+                select c.eq_task_id, c.aging_key + t.boost as priority
+                from types t cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = t.eq_type and target_pool is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+                union all
+                select c.eq_task_id, c.aging_key + t.boost
+                from types t cross join unnest(array_append(p_labels, p_worker_pool)) as g(target)
+                cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where target_pool = g.target and eq_task_type = t.eq_type
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+            ) q
+            order by q.priority desc, q.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* Pops up to p_n of the highest priority tasks of the specified type off of the
+   output queue, marks them as running on the specified worker pool, and returns
+   their ids and payloads. A task's priority is its effective priority,
+   aging_key + rate * now, if its type has an aging rate in eq_task_aging.
+   The tasks are those popped by eq_pop_out_types for the single type. */
+create or replace function eq_pop_out(p_eq_type integer, p_n integer, p_worker_pool text,
+                                      p_lease double precision default null, p_labels text[] default null)
+returns table (eq_task_id integer, json_out text) as $$
+    select * from eq_pop_out_types(array[p_eq_type], array[0::double precision], p_n, p_worker_pool,
+                                   p_lease, p_labels);
+$$ language sql;
+
+/* Pops up to p_n tasks of any of the specified types off of the output queue,
+   sharing the tasks between the experiments that have queued tasks in proportion
+   to their weights in eq_exp_weights, marks them as running on the specified
+   worker pool, and returns their ids and payloads. The next task goes to the
+   experiment with the fewest running tasks, of the specified types, relative to
+   its weight, and an experiment's tasks are popped in order of priority plus the
+   weight, from p_weights, of their type. Queued tasks with no experiment, e.g.,
+   EQ_STOP, are popped last. Only untargeted tasks, and tasks targeted at
+   p_worker_pool or one of p_labels, are popped. If p_lease is not null, the
+   tasks are leased for p_lease seconds. */
+create or replace function eq_pop_out_fair(p_eq_types integer[], p_weights double precision[], p_n integer,
+                                           p_worker_pool text, p_lease double precision default null,
+                                           p_labels text[] default null)
+returns table (eq_task_id integer, json_out text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_OUT
+        where eq_task_id = any(array(
+            with recursive types as (
+                select u.eq_type, u.weight + eq_aging_offset(u.eq_type) as boost
+                from unnest(p_eq_types, p_weights) as u(eq_type, weight)
+            ),
+            /* the experiments with queued untargeted tasks of each type, found
+               with one index probe per experiment */
+            exps as (
+                select t.eq_type, f.exp_id from types t cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is not null and target_pool is null
+                    order by exp_id limit 1) f
+                union all
+                select e.eq_type, f.exp_id from exps e cross join lateral (
+                    select exp_id from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id > e.exp_id and target_pool is null
+                    order by exp_id limit 1) f
+            ),
+            candidates as (
+                select c.eq_task_id, c.aging_key + t.boost as priority, e.exp_id
+                from exps e join types t on t.eq_type = e.eq_type
+                cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = e.eq_type and exp_id = e.exp_id and target_pool is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+                union all
+                select c.eq_task_id, c.aging_key + t.boost, null
+                from types t cross join lateral (
+                    select eq_task_id, aging_key from emews_queue_OUT
+                    where eq_task_type = t.eq_type and exp_id is null and target_pool is null
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+                union all
+                select c.eq_task_id, c.aging_key + t.boost, c.exp_id
+                from types t cross join unnest(array_append(p_labels, p_worker_pool)) as g(target)
+                cross join lateral (
+                    select eq_task_id, aging_key, exp_id from emews_queue_OUT
+                    where target_pool = g.target and eq_task_type = t.eq_type
+                    order by aging_key desc, eq_task_id asc
+                    for update skip locked
+                    limit p_n) c
+            ),
+            usage as (
+                select x.exp_id, count(*) as running
+                from eq_tasks s join eq_exp_id_tasks x on x.eq_task_id = s.eq_task_id
+                where s.eq_status = 1 and s.eq_task_type = any(p_eq_types)
+                group by x.exp_id
+            )
+            select ranked.eq_task_id from (
+                select c.eq_task_id, c.priority,
+                    case when c.exp_id is null then 'Infinity'::double precision
+                    else (coalesce(u.running, 0) + row_number() over (partition by c.exp_id
+                                                                      order by c.priority desc, c.eq_task_id asc))
+                         / coalesce(w.weight, 1) end as share
+                from candidates c
+                left join usage u on u.exp_id = c.exp_id
+                left join eq_exp_weights w on w.exp_id = c.exp_id
+            ) ranked
+            order by ranked.share asc, ranked.priority desc, ranked.eq_task_id asc
+            limit p_n))
+        returning eq_task_id
+    ), started as (
+        update eq_tasks t set eq_status = 1, worker_pool = p_worker_pool, time_start = localtimestamp,
+            lease_expiry = now() + make_interval(secs => p_lease)
+        from popped where t.eq_task_id = popped.eq_task_id
+        returning t.eq_task_id, t.json_out
+    )
+    select started.eq_task_id, started.json_out from started order by started.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* Reports the results of the specified tasks and pushes the tasks onto the input
+   queue, in a single transaction, returning the ids of the tasks whose reports were
+   accepted. The reports of running tasks, and, if p_worker_pool is not null, of tasks
+   running on that worker pool, are accepted. So are the late reports of tasks whose
+   leases expired and that were requeued, but not yet popped again: these are deleted from
+   the output queue in the same transaction, so that they don't run twice. The reports
+   of other tasks, e.g., a requeued task that has been popped by another worker pool,
+   or a task that has already been reported or canceled, are rejected and their
+   results discarded, so that a late report neither completes a task that is running
+   elsewhere nor pushes a task onto the input queue twice. If the push fails,
+   no reports are accepted, and the tasks can be reported again. */
+create or replace function eq_report_tasks(p_eq_task_ids integer[], p_results text[], p_worker_pool text,
+                                           p_notify boolean)
+returns table (eq_task_id integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id in
+        with reclaimed as (
+            delete from emews_queue_OUT o using eq_tasks t
+            where o.eq_task_id = any(p_eq_task_ids) and t.eq_task_id = o.eq_task_id and t.eq_status = 4
+            returning o.eq_task_id
+        ), reported as (
+            update eq_tasks t set json_in = v.json_in, eq_status = 2, time_stop = localtimestamp,
+                lease_expiry = null
+            from unnest(p_eq_task_ids, p_results) as v (eq_task_id, json_in)
+            where t.eq_task_id = v.eq_task_id
+                and ((t.eq_status = 1 and (p_worker_pool is null or t.worker_pool = p_worker_pool))
+                     or t.eq_task_id in (select reclaimed.eq_task_id from reclaimed))
+            returning t.eq_task_id, t.eq_task_type
+        )
+        insert into emews_queue_IN (eq_task_type, eq_task_id)
+        select reported.eq_task_type, reported.eq_task_id from reported
+        returning emews_queue_IN.eq_task_id
+    loop
+        if p_notify then
+            perform pg_notify('eq_in_' || eq_task_id, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
+
+/* Reports the result of a task with eq_report_tasks. p_eq_type is unused, the task's
+   stored type is pushed onto the input queue. Returns 0 if the report is accepted,
+   and 1 if it is rejected. */
+create or replace function eq_report(p_eq_task_id integer, p_eq_type integer, p_result text,
+                                     p_notify boolean, p_worker_pool text default null)
+returns integer as $$
+    select case when exists (select 1 from eq_report_tasks(array[p_eq_task_id], array[p_result],
+                                                            p_worker_pool, p_notify))
+           then 0 else 1 end;
+$$ language sql;
+
+/* Pops the specified task off of the input queue, returning its id and result,
+   or no rows if the task is not in the input queue */
+create or replace function eq_pop_in(p_eq_task_id integer)
+returns table (eq_task_id integer, json_in text) as $$
+#variable_conflict use_column
+begin
+    return query
+    with popped as (
+        delete from emews_queue_IN
+        where eq_task_id = (
+            select eq_task_id from emews_queue_IN
+            where eq_task_id = p_eq_task_id
+            for update skip locked)
+        returning eq_task_id
+    )
+    select t.eq_task_id, t.json_in from eq_tasks t join popped on t.eq_task_id = popped.eq_task_id;
+end;
+$$ language plpgsql;
+
+/* Pushes the running tasks whose leases have expired back onto the output
+   queue with their stored priority and target, marking them as requeued, and returns
+   their ids and types. If p_eq_type is not null, only tasks of that type
+   are requeued. */
+create or replace function eq_requeue_expired(p_eq_type integer, p_notify boolean)
+returns table (eq_task_id integer, eq_task_type integer) as $$
+#variable_conflict use_column
+begin
+    for eq_task_id, eq_task_type in
+        with expired as (
+            update eq_tasks t set eq_status = 4, worker_pool = null, lease_expiry = null
+            where t.eq_task_id = any(array(
+                select eq_task_id from eq_tasks
+                where eq_status = 1 and lease_expiry < now()
+                    and (p_eq_type is null or eq_task_type = p_eq_type)
+                for update skip locked))
+            returning t.eq_task_id, t.eq_task_type, t.eq_priority, t.target_pool
+        )
+        insert into emews_queue_OUT (eq_task_type, eq_task_id, eq_priority, exp_id, aging_key, target_pool)
+        select expired.eq_task_type, expired.eq_task_id, expired.eq_priority,
+            (select x.exp_id from eq_exp_id_tasks x where x.eq_task_id = expired.eq_task_id limit 1),
+            expired.eq_priority - eq_aging_offset(expired.eq_task_type), expired.target_pool
+        from expired
+        on conflict do nothing
+        returning emews_queue_OUT.eq_task_id, emews_queue_OUT.eq_task_type
+    loop
+        if p_notify then
+            /* identical notifications are delivered once per transaction */
+            perform pg_notify('eq_out_' || eq_task_type, '');
+        end if;
+        return next;
+    end loop;
+end;
+$$ language plpgsql;
+
+/* Stores the reported result of a task that has a cache key in eq_result_cache,
+   replacing any existing result for the key */
+create or replace function eq_cache_result() returns trigger as $$
+begin
+    insert into eq_result_cache (cache_key, eq_task_type, exp_id, json_in)
+        values (new.cache_key, new.eq_task_type,
+                (select x.exp_id from eq_exp_id_tasks x where x.eq_task_id = new.eq_task_id limit 1), new.json_in)
+        on conflict (cache_key) do update
+        set json_in = excluded.json_in, exp_id = excluded.exp_id, time_cached = now();
+    return null;
+end;
+$$ language plpgsql;
+
+create trigger eq_tasks_cache_result after update of json_in on eq_tasks
+    for each row when (new.cache_key is not null and new.json_in is not null and new.eq_status = 2)
+    execute function eq_cache_result();
+
+/* The schema version of this database. Existing databases are
+   brought up to date by db_tools.migrate_eqsql_tables, which applies
+   the scripts in migrations/ whose number is greater than this version.
+*/
+create table eq_schema_version (
+       version integer
+);
+
+insert into eq_schema_version values (10);
@@ -1,15 +1,37 @@
+import asyncio
+import concurrent.futures
 import unittest
 import json
 import logging
 import os
 import shutil
+import io
+import sys
+import threading
+import time
 
 from eqsql.task_queues import local_queue
-from eqsql.task_queues.core import ResultStatus, TaskStatus, TimeoutError
+from eqsql.task_queues.core import Future, ResultStatus, TaskStatus, TimeoutError
 from eqsql.task_queues.core import EQ_TIMEOUT, EQ_STOP, EQ_ABORT
 from eqsql.db_tools import reset_db, init_eqsql_db, start_db, stop_db, is_db_running
+from eqsql.db_tools import migrate_eqsql_tables, SCHEMA_VERSION, ConnectionPool, ConnectionException, get_pool
+from eqsql.task_queues import emews_service, remote_funcs, wire
+from eqsql.task_queues.remote_funcs import _as_completed, DBParameters
+from eqsql.task_queues.service_metrics import OTHER, ServiceMetrics
+from eqsql.task_queues.executor import EQSQLExecutor
 from eqsql.cfg import parse_yaml_cfg
 
+try:
+    from eqsql.task_queues import async_queue
+except ImportError:
+    async_queue = None
+
+try:
+    import numpy as np
+    from eqsql.task_queues import future_set
+except ImportError:
+    future_set = None
+
 # Assumes the existence of a testing database
 # with these characteristics
 host = 'localhost'
@@ -19,6 +41,7 @@ db_name = 'eqsql_test_db'
 password = None
 
 db_path = './test_data/db/eqsql_test'
+swift_ext = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../swift-t/ext')
 pg_bin = '/home/nick/sfw/postgres-14.18/bin'
 
 
@@ -59,6 +82,63 @@ class EQTests(unittest.TestCase):
         self.assertFalse(ft.done())
         self.assertEqual('x', ft.tag)
 
+    def test_submit_tasks(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        payloads = [create_payload(i) for i in range(25)]
+        result_status, fts = self.eq_sql.submit_tasks('test_%s', 0, payloads, priority=3, tag='x%',
+                                                      chunk_size=10)
+        self.assertEqual(ResultStatus.SUCCESS, result_status)
+        self.assertEqual(list(range(1, 26)), [ft.eq_task_id for ft in fts])
+        for ft in fts:
+            self.assertEqual('x%', ft.tag)
+            self.assertEqual(TaskStatus.QUEUED, ft.status)
+
+        status, rows = self.eq_sql._get('select t.eq_task_id, t.json_out, t.eq_priority, e.exp_id, g.tag from eq_tasks t '
+                                        'join eq_exp_id_tasks e on e.eq_task_id = t.eq_task_id '
+                                        'join eq_task_tags g on g.eq_task_id = t.eq_task_id order by t.eq_task_id')
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual([(i + 1, payloads[i], 3, 'test_%s', 'x%') for i in range(25)], rows)
+
+        # popped in submission order
+        results = self.eq_sql.query_task(0, n=25, timeout=0)
+        self.assertEqual(payloads, [result['payload'] for result in results])
+
+        # empty submission
+        result_status, fts = self.eq_sql.submit_tasks('test', 0, [])
+        self.assertEqual(ResultStatus.SUCCESS, result_status)
+        self.assertEqual([], fts)
+
+    def test_submit_stream(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        # payloads that require escaping for COPY
+        payloads = [json.dumps({'x': i, 's': 'a\tb\\c\nd'}) for i in range(25)]
+        result_status, fts = self.eq_sql.submit_stream('test_stream', 0, (p for p in payloads), priority=2,
+                                                       tag='s', chunk_size=10)
+        self.assertEqual(ResultStatus.SUCCESS, result_status)
+        self.assertEqual(25, len(fts))
+        self.assertEqual([range(1, 26)], fts.ranges)
+        self.assertEqual(list(range(1, 26)), [ft.eq_task_id for ft in fts])
+        self.assertEqual(25, fts[-1].eq_task_id)
+        self.assertEqual([2, 3], [ft.eq_task_id for ft in fts[1:3]])
+        self.assertEqual('s', fts[0].tag)
+        self.assertEqual(2, fts[0].priority)
+        self.assertEqual(TaskStatus.QUEUED, fts[0].status)
+
+        status, rows = self.eq_sql._get("select count(*) from eq_exp_id_tasks where exp_id = 'test_stream'")
+        self.assertEqual(25, rows[0][0])
+        results = self.eq_sql.query_task(0, n=25, timeout=0)
+        self.assertEqual(payloads, [result['payload'] for result in results])
+
+        # one payload per line from a file
+        f = io.StringIO('\n'.join(payloads[:5]) + '\n')
+        result_status, fts = self.eq_sql.submit_stream('test_stream', 0, f)
+        self.assertEqual(ResultStatus.SUCCESS, result_status)
+        self.assertEqual([range(26, 31)], fts.ranges)
+        results = self.eq_sql.query_task(0, n=5, timeout=0)
+        self.assertEqual(payloads[:5], [result['payload'] for result in results])
+
     def test_query_priority(self):
         self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
         clear_db()
@@ -348,6 +428,373 @@ class EQTests(unittest.TestCase):
             self.assertEqual(ft.eq_task_id, task_id)
             self.assertEqual(payload, result['payload'])
 
+    def test_multi_type_query(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        for server_functions in (False, True):
+            clear_db()
+            pool = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions)
+            try:
+                fts = {}
+                for eq_type, priorities in ((0, [1, 5]), (1, [3, 2]), (2, [9])):
+                    for priority in priorities:
+                        _, ft = self.eq_sql.submit_task('eq_test', eq_type, create_payload(), priority=priority)
+                        fts[(eq_type, priority)] = ft.eq_task_id
+
+                # the highest priority tasks of either type, type 2 isn't queried for
+                tasks = pool.query_task([0, 1], n=3, timeout=0.0)
+                self.assertEqual([fts[(0, 5)], fts[(1, 3)], fts[(1, 2)]], [task['eq_task_id'] for task in tasks])
+                # type 0's weight makes its priority 1 task 11
+                tasks = pool.query_task([2, 0], n=1, timeout=0.0, weights={0: 10})
+                self.assertEqual(fts[(0, 1)], tasks['eq_task_id'])
+
+                running, tasks = pool.query_more_tasks([0, 1, 2], [], batch_size=2, timeout=0.0)
+                self.assertEqual([fts[(2, 9)]], running)
+                result = pool.query_task([0, 1], timeout=0.0)
+                self.assertEqual(EQ_TIMEOUT, result['payload'])
+
+                # a stop message of any of the types is returned
+                pool.stop_worker_pool(1)
+                self.assertEqual(EQ_STOP, pool.query_task([0, 1], timeout=0.0)['payload'])
+            finally:
+                pool.close()
+
+        with self.assertRaises(ValueError):
+            self.eq_sql.query_task([], timeout=0.0)
+        with self.assertRaises(ValueError):
+            self.eq_sql.query_task([0, 1], timeout=0.0, weights={2: 1})
+
+    def test_fair_share(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        for server_functions in (False, True):
+            clear_db()
+            pool = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions,
+                                               fair_share=True)
+            try:
+                _, big = self.eq_sql.submit_tasks('big', 0, [create_payload(i) for i in range(20)], priority=5)
+                _, small = self.eq_sql.submit_tasks('small', 0, [create_payload(i) for i in range(4)])
+                self.eq_sql.stop_worker_pool(0)
+                _, other = self.eq_sql.submit_task('small', 1, create_payload())
+
+                # equal shares despite big's priority
+                tasks = pool.query_task(0, n=4, timeout=0.0)
+                self.assertEqual([big[0].eq_task_id, big[1].eq_task_id, small[0].eq_task_id, small[1].eq_task_id],
+                                 [task['eq_task_id'] for task in tasks])
+
+                self.assertEqual(ResultStatus.SUCCESS, pool.set_exp_weights({'small': 3, 'big': 2}))
+                self.assertEqual({'small': 3.0, 'big': 2.0}, pool.get_exp_weights())
+                self.assertEqual(ResultStatus.SUCCESS, pool.set_exp_weights({'big': None}))
+                self.assertEqual({'small': 3.0}, pool.get_exp_weights())
+                # 2 running each, so small's next tasks have shares of 1 and 1.33, and big's 3, 4 ...
+                tasks = pool.query_task([0, 1], n=4, timeout=0.0)
+                self.assertEqual([big[2].eq_task_id, small[2].eq_task_id, small[3].eq_task_id, other.eq_task_id],
+                                 [task['eq_task_id'] for task in tasks])
+
+                # completed tasks no longer count towards an experiment's share
+                for ft in small:
+                    pool.report_task(ft.eq_task_id, 0, '{}')
+                self.eq_sql.submit_tasks('small', 0, [create_payload(i) for i in range(2)])
+                tasks = pool.query_task(0, n=3, timeout=0.0)
+                self.assertEqual(2, len([task for task in tasks if task['eq_task_id'] > big[-1].eq_task_id]))
+
+                # the stop message is popped once there are no other tasks
+                tasks = pool.query_task(0, n=20, timeout=0.0)
+                self.assertEqual(17, len(tasks))
+                self.assertEqual(EQ_STOP, tasks[-1]['payload'])
+            finally:
+                pool.close()
+
+        with self.assertRaises(ValueError):
+            self.eq_sql.set_exp_weights({'small': 0})
+
+    def test_priority_aging(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        for server_functions in (False, True):
+            clear_db()
+            pool = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions)
+            try:
+                _, old_0 = self.eq_sql.submit_task('eq_test', 0, create_payload(), priority=0)
+                _, old_1 = self.eq_sql.submit_task('eq_test', 1, create_payload(), priority=0)
+                # queued tasks are updated with the rate
+                self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.set_aging_rates({0: 10.0}))
+                self.assertEqual({0: 10.0}, self.eq_sql.get_aging_rates())
+                time.sleep(0.3)
+                _, new_0 = self.eq_sql.submit_tasks('eq_test', 0, [create_payload()], priority=2)
+                _, new_1 = self.eq_sql.submit_task('eq_test', 1, create_payload(), priority=2)
+
+                # old_0's effective priority is at least 3, type 1 doesn't age
+                self.assertEqual(old_0.eq_task_id, pool.query_task(0, timeout=0.0)['eq_task_id'])
+                self.assertEqual(new_1.eq_task_id, pool.query_task(1, timeout=0.0)['eq_task_id'])
+                # effective priorities are compared across types
+                self.assertEqual(new_0[0].eq_task_id, pool.query_task([0, 1], timeout=0.0)['eq_task_id'])
+
+                # the aging continues from the updated priority
+                _, low = self.eq_sql.submit_task('eq_test', 0, create_payload(), priority=0)
+                time.sleep(0.3)
+                _, high = self.eq_sql.submit_task('eq_test', 0, create_payload(), priority=2)
+                self.eq_sql.update_priorities([low], -5)
+                self.assertEqual(high.eq_task_id, pool.query_task(0, timeout=0.0)['eq_task_id'])
+                self.assertEqual(-5, low.priority)
+
+                self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.set_aging_rates({0: None}))
+                self.assertEqual({}, self.eq_sql.get_aging_rates())
+            finally:
+                pool.close()
+
+        with self.assertRaises(ValueError):
+            self.eq_sql.set_aging_rates({0: -1})
+
+    def test_target_pool(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        for server_functions, fair_share in ((False, False), (True, False), (False, True), (True, True)):
+            clear_db()
+            pool = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions,
+                                               fair_share=fair_share)
+            gpu_pool = local_queue.init_task_queue(host, user, port, db_name, password,
+                                                   server_functions=server_functions, fair_share=fair_share,
+                                                   pool_labels=['gpu'])
+            try:
+                _, untargeted = self.eq_sql.submit_task('eq_test', 0, create_payload(), priority=0)
+                _, to_a = self.eq_sql.submit_task('eq_test', 0, create_payload(), priority=5, target_pool='pool_a')
+                _, to_gpu = self.eq_sql.submit_tasks('eq_test', 0, [create_payload()] * 2, priority=3,
+                                                     target_pool='gpu')
+                _, to_b = self.eq_sql.submit_stream('eq_test', 0, [create_payload()], priority=10,
+                                                    target_pool='pool_b')
+
+                # only the untargeted task for a pool with no targeted tasks
+                tasks = pool.query_task(0, n=10, worker_pool='pool_x', timeout=0.0)
+                self.assertEqual([untargeted.eq_task_id], [task['eq_task_id'] for task in tasks])
+                # the pool's own tasks and those of its label, in priority order
+                self.assertEqual(to_a.eq_task_id,
+                                 gpu_pool.query_task(0, worker_pool='pool_a', timeout=0.0)['eq_task_id'])
+                self.assertEqual(sorted(ft.eq_task_id for ft in to_gpu),
+                                 sorted(task['eq_task_id'] for task in
+                                        gpu_pool.query_task(0, n=10, worker_pool='pool_a', timeout=0.0)))
+                self.assertEqual(EQ_TIMEOUT, pool.query_task([0, 1], worker_pool='pool_a', timeout=0.0)['payload'])
+                _, tasks = pool.query_more_tasks(0, [], batch_size=10, worker_pool='pool_b', timeout=0.0)
+                self.assertEqual([to_b[0].eq_task_id], [task['eq_task_id'] for task in tasks])
+                self.assertEqual(('pool_b', TaskStatus.RUNNING), (to_b[0].worker_pool, to_b[0].status))
+            finally:
+                pool.close()
+                gpu_pool.close()
+
+    def test_pop_order(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+
+        def submit():
+            clear_db()
+            self.eq_sql.set_exp_weights({'a': 2})
+            self.eq_sql.set_aging_rates({1: 0.001})
+            for i, (exp_id, eq_type) in enumerate([('a', 0), ('b', 0), ('a', 1), ('b', 1)]):
+                self.eq_sql.submit_tasks(exp_id, eq_type, [create_payload(j) for j in range(4)], priority=i * 10)
+                self.eq_sql.submit_task(exp_id, eq_type, create_payload(), priority=i * 10 + 5, target_pool='gpu')
+                self.eq_sql.submit_task(exp_id, eq_type, create_payload(), priority=i * 10 + 7, target_pool='P2')
+
+        def pop(query_task):
+            order = []
+            while True:
+                tasks = query_task([0, 1], n=3, worker_pool='P1', timeout=0.0, weights={0: 15})
+                if not isinstance(tasks, list):
+                    return order
+                order.append([task['eq_task_id'] for task in tasks])
+
+        async def pop_async(fair_share):
+            task_queue = await async_queue.init_task_queue(host, user, port, db_name, password, pool_labels=['gpu'],
+                                                           fair_share=fair_share)
+            try:
+                order = []
+                while True:
+                    tasks = await task_queue.query_task([0, 1], n=3, worker_pool='P1', timeout=0.0, weights={0: 15})
+                    if not isinstance(tasks, list):
+                        return order
+                    order.append([task['eq_task_id'] for task in tasks])
+            finally:
+                await task_queue.close()
+
+        for fair_share in (False, True):
+            orders = []
+            for server_functions in (False, True):
+                submit()
+                pool = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions,
+                                                   fair_share=fair_share, pool_labels=['gpu'])
+                try:
+                    orders.append(pop(pool.query_task))
+                finally:
+                    pool.close()
+            if async_queue is not None:
+                submit()
+                orders.append(asyncio.run(pop_async(fair_share)))
+
+            # the tasks targeted at P2 are not popped
+            self.assertEqual(20, sum(len(ids) for ids in orders[0]))
+            for order in orders[1:]:
+                self.assertEqual(orders[0], order)
+
+        self.eq_sql.set_exp_weights({'a': None})
+        self.eq_sql.set_aging_rates({1: None})
+
+    def test_get_results(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(10)])
+        self.assertEqual([], self.eq_sql.get_results(fts))
+
+        tasks = self.eq_sql.query_task(0, n=6, timeout=0.0)
+        self.eq_sql.report_tasks([(task['eq_task_id'], 0, json.dumps({'r': task['eq_task_id']})) for task in tasks])
+
+        # peek at the results, leaving them in the input queue
+        results = self.eq_sql.get_results(fts, consume=False)
+        self.assertEqual([ft.eq_task_id for ft in fts[:6]], [ft.eq_task_id for ft, _ in results])
+        self.assertTrue(all(ft._result is None for ft in fts))
+        self.assertFalse(self.eq_sql.are_queues_empty())
+
+        results = self.eq_sql.get_results(reversed(fts))
+        self.assertEqual([ft.eq_task_id for ft in reversed(fts[:6])], [ft.eq_task_id for ft, _ in results])
+        for ft, result in results:
+            self.assertEqual(ft.eq_task_id, json.loads(result)['r'])
+            self.assertEqual((ResultStatus.SUCCESS, result), ft.result(timeout=0.0))
+        self.assertEqual(0, self.eq_sql._get('select count(*) from emews_queue_IN')[1][0][0])
+
+        # cached results are returned without querying
+        self.assertEqual(results[::-1], self.eq_sql.get_results(fts))
+        self.assertEqual(results[:2], self.eq_sql.get_results([ft for ft, _ in results[:2]]))
+
+    def test_map(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        pool_queue = local_queue.init_task_queue(host, user, port, db_name, password)
+        window = 4
+        in_flight = []
+        done = threading.Event()
+
+        def work():
+            while not done.is_set():
+                # tasks queued, running, or with an unconsumed result
+                _, rows = pool_queue._get('select (select count(*) from eq_tasks where eq_status in (0, 1)) + '
+                                          '(select count(*) from emews_queue_IN)')
+                in_flight.append(rows[0][0])
+                tasks = pool_queue.query_task(0, n=3, timeout=0.0)
+                if isinstance(tasks, list):
+                    # report out of order
+                    pool_queue.report_tasks([(task['eq_task_id'], 0, json.dumps({'x': json.loads(task['payload'])['x']}))
+                                             for task in reversed(tasks)])
+                time.sleep(0.01)
+
+        t = threading.Thread(target=work)
+        t.start()
+        try:
+            payloads = (create_payload(i) for i in range(25))
+            results = [json.loads(r)['x'] for r in self.eq_sql.map('eq_test', 0, payloads, window=window, sleep=0.01)]
+            self.assertEqual(list(range(25)), results)
+
+            results = list(self.eq_sql.map('eq_test', 0, [create_payload(i) for i in range(25)], window=window,
+                                           ordered=False, sleep=0.01))
+            self.assertEqual(list(range(25)), sorted(idx for idx, _ in results))
+            for idx, r in results:
+                self.assertEqual(idx, json.loads(r)['x'])
+        finally:
+            done.set()
+            t.join()
+            pool_queue.close()
+        self.assertTrue(max(in_flight) <= window)
+        self.assertTrue(self.eq_sql.are_queues_empty())
+
+        # the tasks in flight are canceled on timeout
+        with self.assertRaises(TimeoutError):
+            next(self.eq_sql.map('eq_test', 0, [create_payload(i) for i in range(25)], window=window,
+                                 timeout=0.2, sleep=0.05))
+        _, rows = self.eq_sql._get('select eq_status, count(*) from eq_tasks where eq_status != %s group by eq_status',
+                                   TaskStatus.COMPLETE.value)
+        self.assertEqual([(TaskStatus.CANCELED.value, window)], rows)
+        self.assertTrue(self.eq_sql.are_queues_empty())
+
+    def test_result_cache(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password, result_cache='experiment')
+        clear_db()
+        pool_queue = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=True)
+
+        def cache_size():
+            return self.eq_sql._get('select count(*) from eq_result_cache')[1][0][0]
+
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(0), create_payload(1)])
+        self.assertTrue(all(ft.status == TaskStatus.QUEUED for ft in fts))
+        tasks = pool_queue.query_task(0, n=2, timeout=0.0)
+        self.assertEqual(0, cache_size())
+        for task in tasks:
+            pool_queue.report_task(task['eq_task_id'], 0, json.dumps({'r': task['eq_task_id']}))
+        self.assertEqual(2, cache_size())
+        for ft in fts:
+            self.assertEqual(ft.eq_task_id, json.loads(ft.result(timeout=0.0)[1])['r'])
+
+        # a json equivalent payload is completed with the cached result, without queueing
+        payload = json.dumps({'z': 'foo', 'y': 7.3, 'x': 0}, indent=2)
+        status, ft = self.eq_sql.submit_task('eq_test', 0, payload)
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertTrue(ft.done())
+        self.assertEqual(TaskStatus.COMPLETE, ft.status)
+        # the cached result is read from the database like that of any completed task
+        self.assertEqual((ResultStatus.SUCCESS, json.dumps({'r': fts[0].eq_task_id})),
+                         self.eq_sql.query_result(ft.eq_task_id, timeout=0.0))
+        self.assertTrue(self.eq_sql.are_queues_empty())
+        _, ft = self.eq_sql.submit_task('eq_test', 0, payload)
+        self.assertEqual((ResultStatus.SUCCESS, json.dumps({'r': fts[0].eq_task_id})),
+                         Future(self.eq_sql, ft.eq_task_id).result(timeout=0.0))
+        _, ft = self.eq_sql.submit_task('eq_test', 0, payload)
+        self.assertEqual([(ft, json.dumps({'r': fts[0].eq_task_id}))], self.eq_sql.get_results([ft]))
+        self.assertEqual((ResultStatus.SUCCESS, json.dumps({'r': fts[0].eq_task_id})), ft.result(timeout=0.0))
+        self.assertTrue(self.eq_sql.are_queues_empty())
+
+        # hits and misses in a single submission
+        _, hits = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(1), create_payload(2), create_payload(0)])
+        self.assertEqual([True, False, True], [ft.done() for ft in hits])
+        self.assertEqual([hits[0], hits[2]], list(self.eq_sql.as_completed(hits, n=2)))
+        result = self.eq_sql.query_task(0, timeout=0.0)
+        self.assertEqual(hits[1].eq_task_id, result['eq_task_id'])
+        self.eq_sql.report_tasks([(result['eq_task_id'], 0, json.dumps({'r': 2}))])
+        self.assertEqual(3, cache_size())
+        self.assertEqual(hits, list(self.eq_sql.as_completed(hits)))
+
+        if future_set is not None:
+            # tasks submitted as a FutureSet are memoized too
+            _, fs = future_set.FutureSet.submit(self.eq_sql, 'eq_test', 0, [create_payload(2), create_payload(3)])
+            self.assertEqual([TaskStatus.COMPLETE, TaskStatus.QUEUED], fs.statuses().tolist())
+            self.assertEqual([True, False], fs.completed().tolist())
+            self.assertEqual([json.dumps({'r': 2}), None], fs.results())
+            fs.cancel()
+
+        # the cached results are scoped to the experiment
+        _, ft = self.eq_sql.submit_task('eq_test_2', 0, create_payload(0))
+        self.assertEqual(TaskStatus.QUEUED, ft.status)
+        ft.cancel()
+        global_queue = local_queue.init_task_queue(host, user, port, db_name, password, result_cache='global')
+        _, ft = global_queue.submit_task('eq_test', 0, create_payload(0))
+        self.assertEqual(TaskStatus.QUEUED, ft.status)
+        ft.cancel()
+
+        # uncached submissions do not use the cache
+        _, ft = pool_queue.submit_task('eq_test', 0, create_payload(0))
+        self.assertEqual(TaskStatus.QUEUED, ft.status)
+        ft.cancel()
+
+        # eviction
+        self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.prune_result_cache(max_size=2))
+        self.assertEqual(2, cache_size())
+        self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.clear_result_cache('eq_test_2'))
+        self.assertEqual(2, cache_size())
+        ttl_queue = local_queue.init_task_queue(host, user, port, db_name, password, result_cache='experiment',
+                                                cache_ttl=0.5)
+        time.sleep(1)
+        _, ft = ttl_queue.submit_task('eq_test', 0, create_payload(2))
+        self.assertEqual(TaskStatus.QUEUED, ft.status)
+        ft.cancel()
+        self.assertEqual(0, cache_size())
+        self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.clear_result_cache())
+
+        for task_queue in (pool_queue, global_queue, ttl_queue):
+            task_queue.close()
+
+        with self.assertRaises(ValueError):
+            local_queue.init_task_queue(host, user, port, db_name, password, result_cache='task')
+
     def test_no_work(self):
         self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
         clear_db()
@@ -498,6 +945,307 @@ class EQTests(unittest.TestCase):
         self.assertEqual(10, count)
         self.eq_sql.close()
 
+    def test_as_completed_sweep(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        _, fs = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(10)])
+        for task in self.eq_sql.query_task(0, n=10, timeout=0.0):
+            self.eq_sql.report_task(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']}))
+
+        # only n results are popped off the input queue
+        completed = list(self.eq_sql.as_completed(fs, n=2, timeout=5))
+        self.assertEqual(fs[:2], completed)
+        for ft in completed:
+            self.assertEqual((ResultStatus.SUCCESS, json.dumps({'j': ft.eq_task_id})), ft.result(timeout=0.0))
+        status, rows = self.eq_sql._get('select count(*) from emews_queue_IN')
+        self.assertEqual(8, rows[0][0])
+
+        # futures with results complete without the input queue
+        completed = list(self.eq_sql.as_completed(fs, batch_size=3, timeout=5))
+        self.assertEqual(10, len(completed))
+        self.assertEqual(set(fs), set(completed))
+        for ft in completed:
+            self.assertEqual((ResultStatus.SUCCESS, json.dumps({'j': ft.eq_task_id})), ft.result(timeout=0.0))
+
+        # remote as_completed
+        _, fs = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(10)])
+        for task in self.eq_sql.query_task(0, n=5, timeout=0.0):
+            self.eq_sql.report_task(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']}))
+        db_params = DBParameters(user, host, db_name, password, port)
+        task_ids = [ft.eq_task_id for ft in fs]
+        batch = _as_completed(db_params, task_ids, task_ids[:1], timeout=5, n_required=10, batch_size=3)
+        self.assertEqual([(task_id, TaskStatus.COMPLETE, ResultStatus.SUCCESS, json.dumps({'j': task_id}))
+                          for task_id in task_ids[1:4]], batch)
+        batch = _as_completed(db_params, task_ids, task_ids[:4], timeout=5, n_required=1, batch_size=3)
+        self.assertEqual([task_ids[4]], [task_id for task_id, _, _, _ in batch])
+        with self.assertRaises(TimeoutError):
+            _as_completed(db_params, task_ids, task_ids[:5], timeout=0.2, n_required=5, batch_size=1)
+
+    def test_watch_set(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        db_params = DBParameters(user, host, db_name, password, port)
+        _, fs = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(10)])
+        _, other = self.eq_sql.submit_task('eq_test', 0, create_payload())
+        task_ids = [ft.eq_task_id for ft in fs]
+        watch_id = remote_funcs._watch_tasks(db_params, task_ids)
+        self.assertIsNotNone(watch_id)
+
+        # times out with no completed tasks
+        start = time.time()
+        self.assertEqual([], remote_funcs._next_watched(db_params, watch_id, n=2, timeout=0.3, sleep=0.1))
+        self.assertGreater(time.time() - start, 0.25)
+
+        for task in self.eq_sql.query_task(0, n=6, timeout=0.0):
+            self.eq_sql.report_task(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']}))
+        batch = remote_funcs._next_watched(db_params, watch_id, n=4, timeout=5, sleep=0.1)
+        self.assertEqual([(task_id, TaskStatus.COMPLETE, ResultStatus.SUCCESS, json.dumps({'j': task_id}))
+                          for task_id in task_ids[:4]], batch)
+        # the popped tasks are removed from the watch set, and unwatched tasks are not popped
+        batch = remote_funcs._next_watched(db_params, watch_id, n=4, timeout=0.2, sleep=0.1)
+        self.assertEqual(task_ids[4:6], [task_id for task_id, _, _, _ in batch])
+        self.eq_sql.report_task(other.eq_task_id, 0, json.dumps({}))
+        self.assertEqual([], remote_funcs._next_watched(db_params, watch_id, n=1, timeout=0.0))
+        _, rows = self.eq_sql._get('select eq_task_id from eq_watch_tasks where watch_id = %s order by eq_task_id',
+                                   watch_id)
+        self.assertEqual(task_ids[6:], [row[0] for row in rows])
+
+        # a failed poll returns the tasks already popped rather than losing them
+        for task in self.eq_sql.query_task(0, n=2, timeout=0.0):
+            self.eq_sql.report_task(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']}))
+        pop_watched = local_queue.LocalTaskQueue._pop_watched
+        polls = []
+
+        def failing_pop_watched(task_queue, watch_id, limit=None):
+            polls.append(watch_id)
+            if len(polls) > 1:
+                raise ValueError('poll failed')
+            return pop_watched(task_queue, watch_id, 1)
+
+        local_queue.LocalTaskQueue._pop_watched = failing_pop_watched
+        try:
+            batch = remote_funcs._next_watched(db_params, watch_id, n=2, timeout=5, sleep=0.1)
+            self.assertEqual([task_ids[6]], [task_id for task_id, _, _, _ in batch])
+            self.assertIsNone(remote_funcs._next_watched(db_params, watch_id, n=2, timeout=5, sleep=0.1))
+        finally:
+            local_queue.LocalTaskQueue._pop_watched = pop_watched
+        batch = remote_funcs._next_watched(db_params, watch_id, n=2, timeout=0.0)
+        self.assertEqual([task_ids[7]], [task_id for task_id, _, _, _ in batch])
+
+        self.assertEqual(ResultStatus.SUCCESS, remote_funcs._close_watch(db_params, watch_id))
+        self.assertEqual((ResultStatus.SUCCESS, [(0, 0)]),
+                         self.eq_sql._get('select (select count(*) from eq_watches), (select count(*) from eq_watch_tasks)'))
+
+        # abandoned watch sets are deleted
+        watch_id = self.eq_sql._create_watch(task_ids)
+        max_idle = local_queue.WATCH_MAX_IDLE
+        local_queue.WATCH_MAX_IDLE = 0
+        try:
+            time.sleep(0.01)
+            other_id = self.eq_sql._create_watch(task_ids[:1])
+        finally:
+            local_queue.WATCH_MAX_IDLE = max_idle
+        self.assertEqual((ResultStatus.SUCCESS, [(other_id, 1)]),
+                         self.eq_sql._get('select watch_id, count(*) from eq_watch_tasks group by watch_id'))
+        self.assertNotEqual(watch_id, other_id)
+
+    def test_remote_pool_funcs(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        db_params = DBParameters(user, host, db_name, password, port)
+
+        # long polls an empty queue until the timeout
+        start = time.time()
+        msgs = remote_funcs._query_tasks(db_params, 0, n=4, timeout=0.3, sleep=0.1)
+        self.assertEqual([{'type': 'status', 'payload': EQ_TIMEOUT}], msgs)
+        self.assertGreater(time.time() - start, 0.25)
+
+        # returns as soon as tasks are submitted
+        timer = threading.Timer(0.2, self.eq_sql.submit_tasks, ('eq_test', 0, [create_payload(i) for i in range(6)]))
+        timer.start()
+        start = time.time()
+        msgs = remote_funcs._query_tasks(db_params, 0, n=4, worker_pool='P1', timeout=10, sleep=0.05,
+                                         lease_duration=30)
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(4, len(msgs))
+        self.assertTrue(all(msg['type'] == 'work' for msg in msgs))
+        task_ids = [msg['eq_task_id'] for msg in msgs]
+        # the worker pool settings are not left on the cached task queues
+        for task_queue, _ in remote_funcs._queues[(host, port, user, db_name, password)]:
+            self.assertIsNone(task_queue.lease_duration)
+
+        status, renewed = remote_funcs._heartbeat(db_params, task_ids, 'P1', lease_duration=30)
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual(sorted(task_ids), renewed)
+        self.assertEqual((ResultStatus.SUCCESS, []), remote_funcs._heartbeat(db_params, task_ids, 'P2', 30))
+
+        # 2 of the running tasks complete, so 4 more are queried for, of which 2 are queued
+        results = [(eq_task_id, 0, json.dumps({'j': eq_task_id})) for eq_task_id in task_ids[:2]]
+        self.assertEqual((ResultStatus.SUCCESS, []), remote_funcs._report_tasks(db_params, results, 'P1'))
+        status, renewed = remote_funcs._heartbeat(db_params, task_ids, 'P1')
+        self.assertEqual(sorted(task_ids[2:]), renewed)
+        running, msgs = remote_funcs._query_more_tasks(db_params, 0, task_ids, 6, worker_pool='P1', timeout=0.0)
+        self.assertEqual(2, len(msgs))
+        self.assertEqual(task_ids[2:] + [msg['eq_task_id'] for msg in msgs], running)
+
+        # long polls for more tasks when none are queued
+        start = time.time()
+        running, msgs = remote_funcs._query_more_tasks(db_params, 0, running, 6, worker_pool='P1', timeout=0.3,
+                                                       sleep=0.1)
+        self.assertEqual(4, len(running))
+        self.assertEqual([{'type': 'status', 'payload': EQ_TIMEOUT}], msgs)
+        self.assertGreater(time.time() - start, 0.25)
+        # the pool is full
+        self.assertEqual((running, []), remote_funcs._query_more_tasks(db_params, 0, running, 4, threshold=1))
+        with self.assertRaises(ValueError):
+            remote_funcs._query_more_tasks(db_params, 0, running, 4, threshold=5)
+
+    def test_remote_task_queue_cache(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        db_params = DBParameters(user, host, db_name, password, port)
+        key = (host, port, user, db_name, password)
+        remote_funcs._queues.clear()
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(4)])
+        task_ids = [ft.eq_task_id for ft in fts]
+
+        self.assertEqual([(eq_task_id, TaskStatus.QUEUED) for eq_task_id in task_ids],
+                         remote_funcs._get_status(db_params, task_ids))
+        # the idle cached task queue has returned its connection to the pool
+        self.assertEqual(1, len(remote_funcs._queues[key]))
+        task_queue = remote_funcs._queues[key][0][0]
+        self.assertIsNone(task_queue.db.conn)
+        self.assertEqual(ResultStatus.SUCCESS, remote_funcs._update_priorities(db_params, task_ids, 3)[0])
+        self.assertEqual([(eq_task_id, 3) for eq_task_id in task_ids],
+                         remote_funcs._get_priorities(db_params, task_ids))
+        self.assertEqual([(task_queue, remote_funcs._queues[key][0][1])], remote_funcs._queues[key])
+
+        # concurrent calls use separate task queues, which are then cached
+        with remote_funcs._task_queue(db_params) as tq1:
+            with remote_funcs._task_queue(db_params) as tq2:
+                self.assertIsNot(tq1.db.conn, tq2.db.conn)
+        self.assertEqual(2, len(remote_funcs._queues[key]))
+
+        # idle eviction
+        max_idle = remote_funcs.QUEUE_CACHE_MAX_IDLE
+        remote_funcs.QUEUE_CACHE_MAX_IDLE = 0
+        try:
+            time.sleep(0.01)
+            self.assertFalse(remote_funcs._are_queues_empty(db_params))
+            self.assertEqual(1, len(remote_funcs._queues[key]))
+            self.assertNotIn(remote_funcs._queues[key][0][0], (tq1, tq2))
+        finally:
+            remote_funcs.QUEUE_CACHE_MAX_IDLE = max_idle
+
+    def test_wire_format(self):
+        msg = {'task_ids': list(range(2000)), 'payload': [create_payload(i) for i in range(100)], 'tag': None}
+        for content_type in wire.content_types():
+            for compression in wire.compressions() + [None]:
+                body, applied = wire.encode(msg, content_type, compression)
+                self.assertEqual(compression, applied)
+                self.assertEqual(msg, wire.decode(body, content_type, applied))
+            # small messages are not compressed
+            body, applied = wire.encode({'eq_type': 0}, content_type, wire.GZIP)
+            self.assertIsNone(applied)
+            self.assertEqual({'eq_type': 0}, wire.decode(body, content_type))
+        self.assertEqual(wire.GZIP, wire.negotiate(['gzip', 'br'], wire.compressions()))
+        self.assertIsNone(wire.negotiate(['br'], wire.compressions()))
+        self.assertEqual([wire.JSON, 'text/html'], wire.parse_header_list('application/json, text/html;q=0.9'))
+
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        db_params = DBParameters(user, host, db_name, password, port).to_dict()
+        client = emews_service.app.test_client()
+        formats = client.get('/wire').get_json()
+        self.assertEqual(wire.content_types(), formats['content_types'])
+        self.assertEqual(wire.compressions(), formats['compressions'])
+
+        payloads = [create_payload(i) for i in range(500)]
+        msg = {'db_params': db_params, 'exp_id': 'eq_test', 'eq_type': 0, 'payload': payloads,
+               'priority': 0, 'tag': None}
+        # a JSON encoded JSON string, as sent by clients that predate the wire format
+        response = client.post('/submit_tasks', json=json.dumps(msg))
+        self.assertEqual(wire.JSON, response.mimetype)
+        self.assertIsNone(response.headers.get(wire.COMPRESSION_HEADER))
+        status, legacy_ids = response.get_json()
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual(500, len(legacy_ids))
+
+        # compressed request and response
+        body, applied = wire.encode(msg, wire.JSON, wire.GZIP)
+        self.assertEqual(wire.GZIP, applied)
+        response = client.post('/submit_tasks', data=body,
+                               headers={'Content-Type': wire.JSON, 'Accept': wire.JSON,
+                                        wire.COMPRESSION_HEADER: wire.GZIP,
+                                        wire.ACCEPT_COMPRESSION_HEADER: wire.GZIP})
+        status, task_ids = wire.decode(response.data, response.mimetype, response.headers.get(wire.COMPRESSION_HEADER))
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual(500, len(task_ids))
+
+        msg = {'db_params': db_params, 'task_ids': legacy_ids + task_ids}
+        body, _ = wire.encode(msg, wire.JSON)
+        response = client.post('/get_status', data=body,
+                               headers={'Content-Type': wire.JSON, wire.ACCEPT_COMPRESSION_HEADER: wire.GZIP})
+        self.assertEqual(wire.GZIP, response.headers.get(wire.COMPRESSION_HEADER))
+        statuses = wire.decode(response.data, response.mimetype, wire.GZIP)
+        self.assertEqual([[eq_task_id, TaskStatus.QUEUED] for eq_task_id in legacy_ids + task_ids],
+                         sorted(statuses))
+
+    def test_service_metrics(self):
+        metrics = ServiceMetrics(['/submit_tasks', '/get_status'], n_workers=2)
+        metrics.record('/submit_tasks', 0.003, 200)
+        metrics.record('/submit_tasks', 0.2, 500)
+        metrics.record('/unknown', 100.0, 404)
+        metrics.add_in_flight(1, 2)
+        metrics.set_pool_stats(1, {'in_use': 1, 'idle': 3, 'opening': 0, 'max_size': 32})
+        snapshot = metrics.snapshot()
+        self.assertEqual(2, snapshot['workers'])
+        # endpoints without requests are omitted
+        self.assertEqual({'/submit_tasks', OTHER}, set(snapshot['endpoints']))
+        submit = snapshot['endpoints']['/submit_tasks']
+        self.assertEqual(2, submit['requests'])
+        self.assertEqual(1, submit['errors'])
+        self.assertAlmostEqual(0.203, submit['latency_sum'])
+        buckets = dict(submit['buckets'])
+        self.assertEqual(0, buckets[0.0025])
+        self.assertEqual(1, buckets[0.005])
+        self.assertEqual(1, buckets[0.1])
+        self.assertEqual(2, buckets[0.25])
+        self.assertEqual(2, buckets[None])
+        self.assertEqual([(None, 1)], snapshot['endpoints'][OTHER]['buckets'][-1:])
+        self.assertEqual(0, snapshot['endpoints'][OTHER]['errors'])
+        self.assertEqual([0, 2], snapshot['in_flight'])
+        self.assertEqual([{'in_use': 0, 'idle': 0, 'opening': 0, 'max_size': 0},
+                          {'in_use': 1, 'idle': 3, 'opening': 0, 'max_size': 32}], snapshot['db_pools'])
+
+        text = metrics.render()
+        self.assertIn('eqsql_service_requests_total{endpoint="/submit_tasks"} 2', text)
+        self.assertIn('eqsql_service_request_errors_total{endpoint="/submit_tasks"} 1', text)
+        self.assertIn('eqsql_service_request_seconds_bucket{endpoint="/submit_tasks",le="+Inf"} 2', text)
+        self.assertIn('eqsql_service_db_connections{worker="1",state="idle"} 3', text)
+
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        db_params = DBParameters(user, host, db_name, password, port).to_dict()
+        client = emews_service.app.test_client()
+        before = client.get('/metrics', query_string={'format': 'json'}).get_json()
+        n = before['endpoints'].get('/get_status', {'requests': 0})['requests']
+        _, ft = self.eq_sql.submit_task('eq_test', 0, create_payload(0))
+        for _ in range(3):
+            response = client.post('/get_status', json={'db_params': db_params, 'task_ids': [ft.eq_task_id]})
+            self.assertEqual(200, response.status_code)
+
+        after = client.get('/metrics', query_string={'format': 'json'}).get_json()
+        self.assertEqual(n + 3, after['endpoints']['/get_status']['requests'])
+        self.assertEqual(n + 3, after['endpoints']['/get_status']['buckets'][-1][1])
+        # the db connection pools of this process, including that of the remote functions
+        self.assertGreater(after['db_pools'][0]['idle'], 0)
+
+        response = client.get('/metrics')
+        self.assertEqual('text/plain', response.mimetype)
+        self.assertIn('eqsql_service_requests_total{endpoint="/get_status"}', response.get_data(as_text=True))
+
     def test_as_completed_abort(self):
         self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
         clear_db()
@@ -837,6 +1585,617 @@ class EQTests(unittest.TestCase):
             exp_status = TaskStatus.COMPLETE if ft.eq_task_id < 4 else TaskStatus.CANCELED
             self.assertEqual(exp_status, ft.status)
 
+    def test_notify(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password, notify=True)
+        clear_db()
+        pool_queue = local_queue.init_task_queue(host, user, port, db_name, password, notify=True)
+
+        fts = []
+
+        def submit():
+            time.sleep(1)
+            fts.append(self.eq_sql.submit_task('eq_test', 0, create_payload())[1])
+
+        # the large delay means a polling pop would sleep past the submit
+        t = threading.Thread(target=submit)
+        t.start()
+        start = time.time()
+        result = pool_queue.query_task(0, delay=20, timeout=10)
+        self.assertLess(time.time() - start, 5)
+        t.join()
+        self.assertEqual('work', result['type'])
+        self.assertEqual(fts[0].eq_task_id, result['eq_task_id'])
+
+        def report():
+            time.sleep(1)
+            pool_queue.report_task(result['eq_task_id'], 0, json.dumps({'j': 1}))
+
+        t = threading.Thread(target=report)
+        t.start()
+        start = time.time()
+        status, result_str = fts[0].result(delay=20, timeout=10)
+        self.assertLess(time.time() - start, 5)
+        t.join()
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual({'j': 1}, json.loads(result_str))
+        self.assertEqual(set([local_queue._out_channel(0)]), pool_queue._channels)
+        self.assertEqual(set(), self.eq_sql._channels)
+
+        # times out without a notification
+        start = time.time()
+        result = pool_queue.query_task(0, delay=20, timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(EQ_TIMEOUT, result['payload'])
+        pool_queue.close()
+
+    def test_server_functions(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=True)
+        clear_db()
+
+        fts = []
+        for i in range(4):
+            status, ft = self.eq_sql.submit_task('eq_test', 0, create_payload(i), priority=i, tag='sf')
+            self.assertEqual(ResultStatus.SUCCESS, status)
+            self.assertEqual(TaskStatus.QUEUED, ft.status)
+            self.assertEqual('sf', ft.tag)
+            fts.append(ft)
+        status, rows = self.eq_sql._get("select count(*) from eq_exp_id_tasks where exp_id = 'eq_test'")
+        self.assertEqual(4, rows[0][0])
+
+        # highest priority first
+        result = self.eq_sql.query_task(0, worker_pool='sf_pool', timeout=0.0)
+        self.assertEqual('work', result['type'])
+        self.assertEqual(fts[3].eq_task_id, result['eq_task_id'])
+        self.assertEqual(create_payload(3), result['payload'])
+        self.assertEqual(TaskStatus.RUNNING, fts[3].status)
+        self.assertEqual('sf_pool', fts[3].worker_pool)
+
+        results = self.eq_sql.query_task(0, n=5, timeout=0.0)
+        self.assertEqual(sorted(ft.eq_task_id for ft in fts[:3]), [r['eq_task_id'] for r in results])
+
+        result = self.eq_sql.query_task(0, timeout=0.0)
+        self.assertEqual(EQ_TIMEOUT, result['payload'])
+
+        self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.report_task(fts[3].eq_task_id, 0, json.dumps({'j': 3})))
+        self.assertEqual(TaskStatus.COMPLETE, fts[3].status)
+        status, result_str = fts[3].result(timeout=0.0)
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual({'j': 3}, json.loads(result_str))
+        # popped off the input queue
+        self.assertEqual((ResultStatus.FAILURE, EQ_TIMEOUT), self.eq_sql.query_result(fts[3].eq_task_id, timeout=0.0))
+
+        # stop message
+        self.eq_sql.stop_worker_pool(0)
+        result = self.eq_sql.query_task(0, timeout=0.0)
+        self.assertEqual(EQ_STOP, result['payload'])
+
+        # a second report of a task is rejected, and the first result kept
+        self.assertEqual(ResultStatus.SUCCESS, self.eq_sql.report_task(fts[2].eq_task_id, 0, '{}'))
+        self.assertEqual(ResultStatus.FAILURE, self.eq_sql.report_task(fts[2].eq_task_id, 0, '{"a": 1}'))
+        self.assertEqual((ResultStatus.SUCCESS, '{}'), fts[2].result(timeout=0.0))
+
+    def test_report_tasks(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(5)])
+        _, ft = self.eq_sql.submit_task('eq_test', 1, create_payload())
+        fts.append(ft)
+        self.eq_sql.query_task(0, n=5, timeout=0.0)
+        self.eq_sql.query_task(1, timeout=0.0)
+
+        results = [(ft.eq_task_id, ft.eq_task_id // 6, json.dumps({'j': ft.eq_task_id})) for ft in fts[:3]]
+        # results with quotes and % require escaping
+        results.append((fts[5].eq_task_id, 1, "{'%s': 'it''s'}"))
+        self.assertEqual((ResultStatus.SUCCESS, []), self.eq_sql.report_tasks(results))
+        self.assertEqual((ResultStatus.SUCCESS, []), self.eq_sql.report_tasks([]))
+        for eq_task_id, _, result in results:
+            self.assertEqual((ResultStatus.SUCCESS, result), self.eq_sql.query_result(eq_task_id, timeout=0.0))
+        self.assertEqual(TaskStatus.COMPLETE, fts[0].status)
+        self.assertEqual(TaskStatus.RUNNING, fts[3].status)
+
+        # second reports of tasks are rejected, and the tasks aren't pushed twice
+        self.assertEqual((ResultStatus.SUCCESS, []), self.eq_sql.report_tasks([(fts[3].eq_task_id, 0, '{}')]))
+        self.assertEqual((ResultStatus.SUCCESS, [fts[3].eq_task_id]),
+                         self.eq_sql.report_tasks([(fts[3].eq_task_id, 0, '{"a": 1}'), (fts[4].eq_task_id, 0, '{}')]))
+        self.assertEqual((ResultStatus.SUCCESS, '{}'), fts[3].result(timeout=0.0))
+        self.assertEqual((ResultStatus.FAILURE, EQ_TIMEOUT), self.eq_sql.query_result(fts[3].eq_task_id, timeout=0.0))
+        self.assertEqual((ResultStatus.SUCCESS, '{}'), fts[4].result(timeout=0.0))
+
+    def test_buffered_reporter(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(5)])
+        self.eq_sql.query_task(0, n=5, timeout=0.0)
+
+        reporter = local_queue.BufferedReporter(self.eq_sql, max_size=2, max_wait=0.5)
+        self.assertEqual(ResultStatus.SUCCESS, reporter.report(fts[0].eq_task_id, 0, '{}'))
+        self.assertEqual(1, len(reporter))
+        self.assertEqual(TaskStatus.RUNNING, fts[0].status)
+        # flushed by count
+        reporter.report(fts[1].eq_task_id, 0, '{}')
+        self.assertEqual(0, len(reporter))
+        self.assertEqual(TaskStatus.COMPLETE, fts[0].status)
+        self.assertEqual(TaskStatus.COMPLETE, fts[1].status)
+
+        # flushed by time
+        reporter.report(fts[2].eq_task_id, 0, '{}')
+        self.assertEqual(ResultStatus.SUCCESS, reporter.flush_if_due())
+        self.assertEqual(1, len(reporter))
+        time.sleep(0.5)
+        reporter.flush_if_due()
+        self.assertEqual(0, len(reporter))
+        self.assertEqual(TaskStatus.COMPLETE, fts[2].status)
+
+        # flushed on exit
+        with reporter:
+            reporter.report(fts[3].eq_task_id, 0, '{}')
+        self.assertEqual(TaskStatus.COMPLETE, fts[3].status)
+
+        # results that fail to be reported stay buffered
+        failing_queue = local_queue.init_task_queue(host, user, port, db_name, password)
+        failing_queue.db.conn.close()
+        reporter.task_queue = failing_queue
+        reporter.report(fts[4].eq_task_id, 0, '{}')
+        self.assertEqual(ResultStatus.FAILURE, reporter.flush())
+        self.assertEqual(1, len(reporter))
+        failing_queue.close()
+        reporter.task_queue = self.eq_sql
+        self.assertEqual(ResultStatus.SUCCESS, reporter.flush())
+        self.assertEqual(TaskStatus.COMPLETE, fts[4].status)
+
+        # the reports of tasks that aren't running on the reporter's worker pool are rejected
+        _, ft = self.eq_sql.submit_task('eq_test', 0, create_payload())
+        self.eq_sql.query_task(0, worker_pool='p1', timeout=0.0)
+        with local_queue.BufferedReporter(self.eq_sql, worker_pool='p2') as reporter:
+            reporter.report(ft.eq_task_id, 0, '{}')
+        self.assertEqual(TaskStatus.RUNNING, ft.status)
+        with local_queue.BufferedReporter(self.eq_sql, worker_pool='p1') as reporter:
+            reporter.report(ft.eq_task_id, 0, '{}')
+        self.assertEqual(TaskStatus.COMPLETE, ft.status)
+
+    @unittest.skipIf(not os.path.exists(swift_ext), 'requires the swift-t extension')
+    def test_swift_buffered_reports(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        env = {'DB_HOST': host, 'DB_USER': user, 'DB_PORT': str(port), 'DB_NAME': db_name,
+               'EQ_REPORT_BUFFER_SIZE': '10', 'EQ_REPORT_BUFFER_WAIT': '0.5'}
+        old_env = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        sys.path.insert(0, swift_ext)
+        try:
+            import eqsql_swift
+            _, ft = self.eq_sql.submit_task('eq_test', 0, create_payload())
+            self.assertEqual(f'work|{create_payload()}|{ft.eq_task_id}', eqsql_swift.query_task(0, 'p1', 1.0))
+            # rejected, as the task is running on p1
+            eqsql_swift.report_task(ft.eq_task_id, 0, '{"j": 0}', worker_pool='p2')
+            eqsql_swift.report_task(ft.eq_task_id, 0, '{"j": 1}', worker_pool='p1')
+            self.assertEqual(TaskStatus.RUNNING, ft.status)
+
+            # a query of the empty queue doesn't hold the buffered result for the query timeout
+            query = threading.Thread(target=eqsql_swift.query_task, args=(0, 'p1', 5.0))
+            start = time.time()
+            query.start()
+            try:
+                while ft.status != TaskStatus.COMPLETE and time.time() - start < 5.0:
+                    time.sleep(0.05)
+                self.assertLess(time.time() - start, 0.5)
+                _, rows = self.eq_sql._get('select eq_task_id from emews_queue_IN')
+                self.assertEqual([(ft.eq_task_id,)], rows)
+                self.assertEqual((ResultStatus.SUCCESS, '{"j": 1}'), ft.result(timeout=0.0))
+            finally:
+                self.eq_sql.stop_worker_pool(0)
+                query.join()
+        finally:
+            sys.path.remove(swift_ext)
+            for k, v in old_env.items():
+                if v is None:
+                    del os.environ[k]
+                else:
+                    os.environ[k] = v
+            if 'eqsql_swift' in sys.modules:
+                eqsql_swift = sys.modules['eqsql_swift']
+                with eqsql_swift._task_queue_lock:
+                    if eqsql_swift._task_queue is not None:
+                        eqsql_swift._close_eqsql(eqsql_swift._task_queue)
+                        eqsql_swift._task_queue = None
+                    eqsql_swift._reporter = None
+
+    def test_leases(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(4)], priority=3)
+        _, ft = self.eq_sql.submit_task('eq_test', 0, create_payload(), priority=1)
+        fts.append(ft)
+
+        for server_functions in (False, True):
+            pool = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions,
+                                               lease_duration=0.5)
+            try:
+                tasks = pool.query_task(0, n=2, worker_pool='p1', timeout=0.0)
+                ids = [task['eq_task_id'] for task in tasks]
+                status, rows = self.eq_sql._get('select count(*) from eq_tasks where eq_task_id = any(%s) and '
+                                                'lease_expiry > now()', ids)
+                self.assertEqual(2, rows[0][0])
+                # heartbeat
+                time.sleep(0.3)
+                self.assertEqual((ResultStatus.SUCCESS, ids), pool.renew_leases(ids, 'p1'))
+                self.assertEqual((ResultStatus.SUCCESS, []), pool.renew_leases(ids, 'p2'))
+                time.sleep(0.3)
+                # still leased after the renewal
+                self.assertEqual((ResultStatus.SUCCESS, []), self.eq_sql.requeue_expired())
+                pool.report_task(ids[1], 0, '{}')
+                time.sleep(0.6)
+                # the completed task isn't requeued
+                self.assertEqual((ResultStatus.SUCCESS, []), pool.renew_leases(ids, 'p1'))
+                self.assertEqual((ResultStatus.SUCCESS, [ids[0]]), self.eq_sql.requeue_expired())
+                self.assertEqual((ResultStatus.SUCCESS, []), self.eq_sql.requeue_expired())
+                ft = [ft for ft in fts if ft.eq_task_id == ids[0]][0]
+                self.assertEqual(TaskStatus.REQUEUED, ft.status)
+                self.assertEqual(3, ft.priority)
+                self.assertIsNone(ft.worker_pool)
+                self.assertEqual((ResultStatus.SUCCESS, '{}'), self.eq_sql.query_result(ids[1], timeout=0.0))
+            finally:
+                pool.close()
+
+        # the requeued tasks are popped again with their original priority
+        self.assertEqual(fts[0].eq_task_id, self.eq_sql.query_task(0, timeout=0.0)['eq_task_id'])
+        self.assertEqual(TaskStatus.RUNNING, fts[0].status)
+
+        # query_more_tasks renews the leases of the running tasks
+        clear_db()
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(4)])
+        pool = local_queue.init_task_queue(host, user, port, db_name, password, lease_duration=0.4)
+        reaper = local_queue.LeaseReaper(host, user, port, db_name, password, interval=0.05)
+        try:
+            with reaper:
+                running, tasks = pool.query_more_tasks(0, [], batch_size=2, timeout=0.0)
+                self.assertEqual([fts[0].eq_task_id, fts[1].eq_task_id], running)
+                for _ in range(4):
+                    time.sleep(0.2)
+                    running, tasks = pool.query_more_tasks(0, running, batch_size=2, timeout=0.0)
+                    self.assertEqual(([fts[0].eq_task_id, fts[1].eq_task_id], []), (running, tasks))
+                time.sleep(0.6)
+                # the reaper requeues the tasks once the heartbeats stop
+                self.assertEqual(TaskStatus.REQUEUED, fts[0].status)
+                running, tasks = pool.query_more_tasks(0, running, batch_size=2, timeout=0.0)
+                self.assertEqual([fts[0].eq_task_id, fts[1].eq_task_id], running)
+            self.assertIsNone(reaper._thread)
+        finally:
+            pool.close()
+
+    def test_late_report(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        for server_functions in (False, True):
+            clear_db()
+            _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(3)])
+            p1 = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions,
+                                             lease_duration=0.2)
+            p2 = local_queue.init_task_queue(host, user, port, db_name, password, server_functions=server_functions)
+            try:
+                ids = [task['eq_task_id'] for task in p1.query_task(0, n=3, worker_pool='p1', timeout=0.0)]
+                time.sleep(0.3)
+                self.assertEqual((ResultStatus.SUCCESS, ids), self.eq_sql.requeue_expired())
+
+                # the late report of a requeued task that hasn't been queried for again is accepted,
+                # and the task removed from the output queue
+                self.assertEqual((ResultStatus.SUCCESS, []), p1.report_tasks([(ids[0], 0, '{"late": 0}')], 'p1'))
+                self.assertEqual(TaskStatus.COMPLETE, fts[0].status)
+                self.assertEqual((ResultStatus.SUCCESS, '{"late": 0}'), fts[0].result(timeout=0.0))
+
+                # the requeued tasks still fill p1's slots until they are reported
+                running, tasks = p1.query_more_tasks(0, ids, batch_size=2, worker_pool='p1', timeout=0.0)
+                self.assertEqual((ids[1:], []), (running, tasks))
+
+                # another pool runs the rest, and their late reports are rejected
+                tasks = p2.query_task(0, n=3, worker_pool='p2', timeout=0.0)
+                self.assertEqual(ids[1:], [task['eq_task_id'] for task in tasks])
+                self.assertEqual((ResultStatus.SUCCESS, ids[1:]), p1.report_tasks([(ids[1], 0, '{"late": 1}'),
+                                                                                   (ids[2], 0, '{"late": 2}')], 'p1'))
+                self.assertEqual(ResultStatus.FAILURE, p1.report_task(ids[0], 0, '{"late": 0}'))
+                self.assertEqual(TaskStatus.RUNNING, fts[1].status)
+                self.assertEqual((ResultStatus.SUCCESS, []), p2.report_tasks([(ids[1], 0, '{"j": 1}')], 'p2'))
+                running, tasks = p1.query_more_tasks(0, ids[1:], batch_size=3, worker_pool='p1', timeout=0.0)
+                self.assertEqual([ids[2]], running)
+                self.assertEqual(EQ_TIMEOUT, tasks[0]['payload'])
+                self.assertEqual((ResultStatus.SUCCESS, []), p2.report_tasks([(ids[2], 0, '{"j": 2}')], 'p2'))
+                self.assertEqual((ResultStatus.SUCCESS, '{"j": 1}'), fts[1].result(timeout=0.0))
+                self.assertEqual((ResultStatus.SUCCESS, '{"j": 2}'), fts[2].result(timeout=0.0))
+                # each result is pushed once, and nothing is left on the output queue
+                self.assertTrue(self.eq_sql.are_queues_empty())
+            finally:
+                p1.close()
+                p2.close()
+
+    def test_executor(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        worker_queue = local_queue.init_task_queue(host, user, port, db_name, password)
+
+        def work(n):
+            for task in worker_queue.query_task(0, n=n, timeout=0.0):
+                x = json.loads(task['payload'])['x']
+                worker_queue.report_task(task['eq_task_id'], 0, json.dumps(x * 2))
+
+        executor = EQSQLExecutor(self.eq_sql, 'eq_test', 0, decode=json.loads, sleep=0.05)
+        try:
+            callbacks = []
+            futures = [executor.submit(create_payload, i) for i in range(10)]
+            for future in futures:
+                future.add_done_callback(lambda f: callbacks.append(threading.current_thread()))
+            _, not_done = concurrent.futures.wait(futures, timeout=0.2)
+            self.assertEqual(10, len(not_done))
+
+            self.assertTrue(futures[9].cancel())
+            work(9)
+            done, not_done = concurrent.futures.wait(futures, timeout=5)
+            self.assertEqual(10, len(done))
+            self.assertEqual([i * 2 for i in range(9)], [future.result() for future in futures[:9]])
+            self.assertTrue(futures[9].cancelled())
+            time.sleep(0.2)
+            self.assertEqual(TaskStatus.CANCELED, futures[9].eq_future.status)
+            self.assertEqual(10, len(callbacks))
+            # cancel calls the callback immediately, those of resolved futures
+            # are called from the watcher thread
+            self.assertEqual([threading.current_thread()] + [executor._watcher] * 9, callbacks)
+
+            results = executor.map(create_payload, [10, 11, 12], timeout=5)
+            work(3)
+            self.assertEqual([20, 22, 24], list(results))
+            with self.assertRaises(concurrent.futures.TimeoutError):
+                list(executor.map(create_payload, [1], timeout=0.2))
+
+            future = executor.submit_payload('not json', priority=2)
+            self.assertEqual(2, future.eq_future.priority)
+            worker_queue.query_task(0, n=2, timeout=0.0)
+            worker_queue.report_task(future.eq_task_id, 0, 'not json')
+            self.assertIsInstance(future.exception(timeout=5), json.JSONDecodeError)
+
+            future = executor.submit(create_payload, 13)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            worker_queue.close()
+        self.assertTrue(future.cancelled())
+        self.assertFalse(executor._watcher.is_alive())
+        with self.assertRaises(RuntimeError):
+            executor.submit(create_payload, 14)
+
+    @unittest.skipIf(future_set is None, 'requires numpy')
+    def test_future_set(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+        status, fs = future_set.FutureSet.submit(self.eq_sql, 'eq_test', 0, [create_payload(i) for i in range(25)],
+                                                 priority=1, tag='t', chunk_size=10)
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual(25, len(fs))
+        self.assertEqual(list(range(1, 26)), fs.eq_task_ids.tolist())
+        self.assertEqual([TaskStatus.QUEUED] * 25, fs.statuses().tolist())
+        self.assertEqual([1] * 25, fs.priorities().tolist())
+
+        # lower the priority of the first 10, so 10 - 19 are selected next
+        mask = np.arange(25) < 10
+        status, updated = fs.update_priorities(0, mask)
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual(mask.tolist(), updated.tolist())
+        status, updated = fs.update_priorities(np.arange(25) % 3, ~mask)
+        self.assertEqual([0] * 10 + (np.arange(10, 25) % 3).tolist(), fs.priorities().tolist())
+        self.assertEqual(2, fs[-2].priority)
+
+        tasks = self.eq_sql.query_task(0, n=10, timeout=0.0)
+        ids = sorted(task['eq_task_id'] for task in tasks)
+        self.assertEqual([11, 12, 14, 15, 17, 18, 20, 21, 23, 24], ids)
+        self.assertEqual(TaskStatus.RUNNING, fs.statuses()[11])
+
+        status, canceled = fs.cancel(np.arange(25) < 15)
+        self.assertEqual(ResultStatus.SUCCESS, status)
+        self.assertEqual(list(range(10)) + [12], np.flatnonzero(canceled).tolist())
+        statuses = fs.statuses()
+        self.assertTrue(np.all(statuses[canceled] == TaskStatus.CANCELED))
+        self.assertTrue(fs[0].done())
+
+        self.assertEqual([False] * 25, fs.completed().tolist())
+        self.eq_sql.report_tasks([(eq_task_id, 0, json.dumps({'j': eq_task_id})) for eq_task_id in ids[:4]])
+        completed = fs.completed()
+        self.assertEqual([10, 11, 13, 14], np.flatnonzero(completed).tolist())
+        self.assertEqual(json.dumps({'j': 11}), fs.result(10))
+        self.assertEqual((ResultStatus.SUCCESS, json.dumps({'j': 14})), fs[13].result(timeout=0.0))
+        self.assertEqual(TaskStatus.COMPLETE, fs.statuses()[10])
+
+        self.eq_sql.report_tasks([(eq_task_id, 0, json.dumps({'j': eq_task_id})) for eq_task_id in ids[4:]])
+        batches = list(fs.as_completed(n=3, sleep=0))
+        self.assertEqual([[16, 17, 19]], [b.tolist() for b in batches])
+        batches = []
+        with self.assertRaises(TimeoutError):
+            for b in fs.as_completed(timeout=0.2, sleep=0.1):
+                batches.append(b.tolist())
+        self.assertEqual([[20, 22, 23]], batches)
+        # cancel the remaining queued tasks
+        self.assertEqual([15, 18, 21, 24], np.flatnonzero(fs.cancel()[1]).tolist())
+        self.assertEqual([], [b.tolist() for b in fs.as_completed(timeout=1)])
+        self.assertEqual(10, np.count_nonzero(fs.completed()))
+        self.assertEqual([json.dumps({'j': i + 1}) if c else None for i, c in enumerate(fs.completed())],
+                         fs.results())
+
+        # existing futures
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(3)])
+        self.eq_sql.query_task(0, n=3, timeout=0.0)
+        self.eq_sql.report_task(fts[1].eq_task_id, 0, '{}')
+        fts[1].result(timeout=0.0)
+        fs = future_set.FutureSet.from_futures(fts)
+        self.assertEqual([False, True, False], fs.completed().tolist())
+        self.assertEqual('{}', fs.result(1))
+        self.assertEqual([fts[0].eq_task_id], [ft.eq_task_id for ft in fs[np.array([True, False, False])]])
+
+    @unittest.skipIf(async_queue is None, 'requires psycopg 3')
+    def test_async_queue(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+
+        async def work(task_queue):
+            # a worker reporting the result of each task it receives
+            while True:
+                task = await task_queue.query_task(0, timeout=5.0)
+                if task['type'] != 'work':
+                    return task['payload']
+                payload = json.loads(task['payload'])
+                await task_queue.report_task(task['eq_task_id'], 0, json.dumps({'x2': payload['x'] * 2}))
+
+        async def run(notify):
+            clear_db()
+            task_queue = await async_queue.init_task_queue(host, user, port, db_name, password, notify=notify)
+            try:
+                status, fts = await task_queue.submit_tasks('eq_test', 0, [create_payload(i) for i in range(10)],
+                                                            priority=1, tag='t')
+                self.assertEqual(ResultStatus.SUCCESS, status)
+                self.assertEqual(list(range(1, 11)), [ft.eq_task_id for ft in fts])
+                self.assertEqual(TaskStatus.QUEUED, await fts[0].status())
+                self.assertEqual(1, await fts[0].priority())
+                self.assertEqual((ResultStatus.FAILURE, EQ_TIMEOUT), await fts[0].result(timeout=0.0))
+
+                worker = asyncio.ensure_future(work(task_queue))
+                # the awaited futures are woken as the worker reports
+                self.assertEqual((ResultStatus.SUCCESS, json.dumps({'x2': 0})), await fts[0])
+                completed = [ft async for ft in task_queue.as_completed(fts[1:], timeout=10)]
+                self.assertEqual(set(fts[1:]), set(completed))
+                for ft in completed:
+                    _, result = await ft.result()
+                    self.assertEqual({'x2': (ft.eq_task_id - 1) * 2}, json.loads(result))
+                self.assertEqual('default', await fts[0].worker_pool())
+                self.assertTrue(await fts[0].done())
+
+                self.assertEqual(ResultStatus.SUCCESS, await task_queue.stop_worker_pool(0))
+                self.assertEqual(EQ_STOP, await asyncio.wait_for(worker, 10))
+                self.assertTrue(await task_queue.are_queues_empty())
+                results = await task_queue.get_results(fts)
+                self.assertEqual([(ft, ft._result[1]) for ft in fts], results)
+
+                _, ft = await task_queue.submit_task('eq_test', 0, create_payload())
+                self.assertTrue(await ft.cancel())
+                self.assertEqual(TaskStatus.CANCELED, await ft.status())
+                # reports of tasks that aren't running on the reporting pool are rejected
+                self.assertEqual((ResultStatus.SUCCESS, [ft.eq_task_id]),
+                                 await task_queue.report_tasks([(ft.eq_task_id, 0, '{}')]))
+                _, ft2 = await task_queue.submit_task('eq_test', 0, create_payload())
+                await task_queue.query_task(0, worker_pool='p1', timeout=0.0)
+                self.assertEqual(ResultStatus.FAILURE, await task_queue.report_task(ft2.eq_task_id, 0, '{}', 'p2'))
+                self.assertEqual(ResultStatus.SUCCESS, await task_queue.report_task(ft2.eq_task_id, 0, '{}', 'p1'))
+                self.assertEqual((ResultStatus.SUCCESS, '{}'), await ft2.result(timeout=0.0))
+                with self.assertRaises(TimeoutError):
+                    [ft async for ft in task_queue.as_completed([ft], timeout=0.5, sleep=0.1)]
+                self.assertEqual(0, len(task_queue._waiters))
+            finally:
+                await task_queue.close()
+
+        asyncio.run(run(False))
+        asyncio.run(run(True))
+
+    def test_migrate(self):
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        clear_db()
+
+        def get_indexes():
+            status, rows = self.eq_sql._get("select indexname from pg_indexes where schemaname = 'public'")
+            self.assertEqual(ResultStatus.SUCCESS, status)
+            return set(row[0] for row in rows)
+
+        indexes = get_indexes()
+        self.assertTrue({'emews_queue_out_pkey', 'emews_queue_in_pkey', 'emews_queue_out_pop_idx',
+                         'eq_tasks_status_idx', 'eq_exp_id_tasks_exp_id_idx'}.issubset(indexes))
+        # already up to date so this is a no-op
+        self.assertEqual(SCHEMA_VERSION, migrate_eqsql_tables(user, db_name, host, port, password))
+
+        # revert to the unversioned schema and migrate it
+        with self.eq_sql.db.conn:
+            with self.eq_sql.db.conn.cursor() as cur:
+                cur.execute("""
+                    drop table eq_schema_version;
+                    drop index emews_queue_out_pop_idx, eq_tasks_status_idx, eq_exp_id_tasks_exp_id_idx;
+                    alter table emews_queue_out drop constraint emews_queue_out_pkey;
+                    alter table emews_queue_in drop constraint emews_queue_in_pkey;
+                """)
+        self.assertFalse('emews_queue_out_pop_idx' in get_indexes())
+
+        _, ft = self.eq_sql.submit_task('eq_test', 0, create_payload())
+        self.assertEqual(SCHEMA_VERSION, migrate_eqsql_tables(user, db_name, host, port, password))
+        self.assertEqual(indexes, get_indexes())
+        result = self.eq_sql.query_task(0, timeout=0.0)
+        self.assertEqual(ft.eq_task_id, result['eq_task_id'])
+
+    def test_connection_pool(self):
+        # task queues are unpooled by default
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password)
+        self.assertIsNone(self.eq_sql.db.pool)
+        self.eq_sql.close()
+
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password, pooled=True)
+        clear_db()
+        # task queues share the pooled connection
+        conn = self.eq_sql.db.conn
+        self.assertIs(get_pool(host, user, db_name, port, password), self.eq_sql.db.pool)
+        self.eq_sql.close()
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password, pooled=True)
+        self.assertIs(conn, self.eq_sql.db.conn)
+        # an open transaction is rolled back when the connection is returned
+        self.eq_sql.db.conn.cursor().execute("insert into eq_task_tags values (1, 'rolled back')")
+        self.eq_sql.close()
+        self.eq_sql = local_queue.init_task_queue(host, user, port, db_name, password, pooled=True)
+        self.assertEqual((ResultStatus.SUCCESS, [(0,)]), self.eq_sql._get('select count(*) from eq_task_tags'))
+
+        kwargs = {'dbname': db_name, 'host': host, 'user': user, 'port': port}
+        pool = ConnectionPool(max_size=2, check_after=0, **kwargs)
+        c1 = pool.getconn()
+        c2 = pool.getconn()
+        self.assertIsNot(c1, c2)
+        # at max size
+        start = time.time()
+        with self.assertRaises(ConnectionException):
+            pool.getconn(timeout=0.2)
+        self.assertGreater(time.time() - start, 0.15)
+        t = threading.Timer(0.2, pool.putconn, (c2,))
+        t.start()
+        self.assertIs(c2, pool.getconn(timeout=5))
+        t.join()
+
+        # health check replaces broken connections
+        with c1.cursor() as cur:
+            cur.execute('select pg_backend_pid()')
+            backend_pid = cur.fetchone()[0]
+        pool.putconn(c1)
+        self.eq_sql._get('select pg_terminate_backend(%s)', backend_pid)
+        c3 = pool.getconn()
+        self.assertIsNot(c1, c3)
+        with c3.cursor() as cur:
+            cur.execute('select 1')
+            self.assertEqual(1, cur.fetchone()[0])
+
+        # idle eviction
+        pool.putconn(c3)
+        pool.max_idle = 0
+        time.sleep(0.01)
+        c4 = pool.getconn()
+        self.assertIsNot(c3, c4)
+        self.assertTrue(c3.closed)
+
+        # a forked child opens its own connection, and leaves the parent's alone
+        pool.putconn(c4)
+        pool.max_idle = 300
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                c5 = pool.getconn()
+                code = 0 if c5 is not c4 and pool._is_healthy(c5) else 1
+                pool.putconn(c5)
+                pool.closeall()
+            finally:
+                os._exit(code)
+        _, code = os.waitpid(pid, 0)
+        self.assertEqual(0, code)
+        self.assertIs(c4, pool.getconn())
+        self.assertTrue(pool._is_healthy(c4))
+        pool.putconn(c4)
+        pool.closeall()
+        self.assertTrue(c4.closed)
+
 
 class CFGTests(unittest.TestCase):
 
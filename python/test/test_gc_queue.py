@@ -211,6 +211,30 @@ class GCTaskQueueTests(unittest.TestCase):
                 else:
                     self.assertIsNone(p)
 
+    def test_get_results(self):
+        with Executor(endpoint_id=gcx_endpoint) as gcx:
+            self.eq_sql = gc_queue.init_task_queue(gcx, host, user, port, db_name)
+            clear_db(gcx)
+
+            payloads = [create_payload(i) for i in range(8)]
+            submit_status, fts = self.eq_sql.submit_tasks('eq_test', 0, payloads, priority=0)
+            self.assertEqual(ResultStatus.SUCCESS, submit_status)
+            self.assertEqual([], self.eq_sql.get_results(fts))
+
+            # Add 4 results as if worker pool had done them
+            for _ in range(4):
+                result = gcx.submit(query_task, self.eq_sql.db_params, eq_type=0, timeout=0).result()
+                task_id = result['eq_task_id']
+                gcx.submit(report_task, self.eq_sql.db_params, eq_task_id=task_id, eq_type=0,
+                           result=json.dumps({'j': task_id})).result()
+
+            self.assertEqual(4, len(self.eq_sql.get_results(fts, consume=False)))
+            results = self.eq_sql.get_results(fts)
+            self.assertEqual(4, len(results))
+            for ft, result_str in results:
+                self.assertEqual(ft.eq_task_id, json.loads(result_str)['j'])
+                self.assertEqual((ResultStatus.SUCCESS, result_str), ft.result(timeout=0))
+
     def test_as_completed(self):
         with Executor(endpoint_id=gcx_endpoint) as gcx:
             self.eq_sql = gc_queue.init_task_queue(gcx, host, user, port, db_name)
@@ -2,8 +2,11 @@ import unittest
 import json
 import os
 import shutil
+import threading
 
-from eqsql.task_queues import service_queue
+import requests
+
+from eqsql.task_queues import local_queue, remote_funcs, service_queue, wire
 from eqsql.task_queues.core import ResultStatus, TaskStatus, TimeoutError
 from eqsql.task_queues.core import EQ_TIMEOUT
 from eqsql.task_queues.remote_funcs import DBParameters
@@ -100,6 +103,149 @@ class ServiceTests(unittest.TestCase):
         self.assertEqual(TaskStatus.COMPLETE, task_status)
         self.assertTrue(ft.done())
 
+    def test_get_results(self):
+        self.eq_sql = service_queue.init_task_queue(service_url, host, user, port, db_name)
+        clear_db()
+
+        payloads = [create_payload(i) for i in range(8)]
+        submit_status, fts = self.eq_sql.submit_tasks('eq_test', 0, payloads, priority=0)
+        self.assertEqual(ResultStatus.SUCCESS, submit_status)
+        self.assertEqual([], self.eq_sql.get_results(fts))
+
+        # Add 4 results as if worker pool had done them
+        for _ in range(4):
+            result = query_task(DBParameters.from_dict(self.eq_sql.db_params), eq_type=0, timeout=0)
+            task_id = result['eq_task_id']
+            report_task(DBParameters.from_dict(self.eq_sql.db_params), eq_task_id=task_id,
+                        eq_type=0, result=json.dumps({'j': task_id}))
+
+        self.assertEqual(4, len(self.eq_sql.get_results(fts, consume=False)))
+        results = self.eq_sql.get_results(fts)
+        self.assertEqual(4, len(results))
+        for ft, result_str in results:
+            self.assertEqual(ft.eq_task_id, json.loads(result_str)['j'])
+            self.assertEqual((ResultStatus.SUCCESS, result_str), ft.result(timeout=0))
+
+    def test_wire_formats(self):
+        db_params = DBParameters(user, host, db_name, password, port)
+        # None is the JSON encoded JSON strings sent to services that predate the wire format
+        for content_type in wire.content_types() + [None]:
+            for compress in [True, False]:
+                clear_db()
+                eq_sql = service_queue.init_task_queue(service_url, host, user, port, db_name,
+                                                       content_type=content_type, compress=compress)
+                if content_type is None:
+                    eq_sql._wire = (None, None)
+                # large enough to be compressed
+                payloads = [create_payload(i) for i in range(500)]
+                submit_status, fts = eq_sql.submit_tasks('eq_test', 0, payloads, tag='t')
+                self.assertEqual(ResultStatus.SUCCESS, submit_status)
+                self.assertEqual(500, len(fts))
+
+                tasks = query_task(db_params, eq_type=0, n=500, timeout=0)
+                self.assertEqual(500, len(tasks))
+                self.assertEqual(sorted(payloads), sorted(task['payload'] for task in tasks))
+                tq = local_queue.init_task_queue(host, user, port, db_name)
+                tq.report_tasks([(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']})) for task in tasks])
+                tq.close()
+
+                results = eq_sql.get_results(fts)
+                self.assertEqual(500, len(results))
+                for ft, result_str in results:
+                    self.assertEqual(ft.eq_task_id, json.loads(result_str)['j'])
+                for _, status in eq_sql.get_status(fts):
+                    self.assertEqual(TaskStatus.COMPLETE, status)
+                eq_sql.close()
+
+        with self.assertRaises(ValueError):
+            service_queue.init_task_queue(service_url, host, user, port, db_name, content_type='text/xml')
+
+    def test_metrics(self):
+        clear_db()
+        before = requests.get(f'{service_url}/metrics', params={'format': 'json'}).json()
+        n = before['endpoints'].get('/submit_tasks', {'requests': 0})['requests']
+        self.eq_sql = service_queue.init_task_queue(service_url, host, user, port, db_name)
+        for i in range(3):
+            submit_status, _ = self.eq_sql.submit_task('eq_test', 0, create_payload(i))
+            self.assertEqual(ResultStatus.SUCCESS, submit_status)
+
+        after = requests.get(f'{service_url}/metrics', params={'format': 'json'}).json()
+        submit = after['endpoints']['/submit_tasks']
+        self.assertEqual(n + 3, submit['requests'])
+        self.assertEqual(0, submit['errors'])
+        self.assertEqual(n + 3, submit['buckets'][-1][1])
+        self.assertEqual(after['workers'], len(after['db_pools']))
+        self.assertTrue(any(stats['idle'] > 0 for stats in after['db_pools']))
+        # this request
+        self.assertEqual(1, sum(after['in_flight']))
+
+        text = requests.get(f'{service_url}/metrics').text
+        self.assertIn('eqsql_service_requests_total{endpoint="/submit_tasks"}', text)
+        self.assertIn('# TYPE eqsql_service_request_seconds histogram', text)
+
+    def test_pool_queue(self):
+        clear_db()
+        self.eq_sql = service_queue.init_task_queue(service_url, host, user, port, db_name)
+        pool = service_queue.init_pool_queue(service_url, host, user, port, db_name, lease_duration=30)
+
+        msg = pool.query_task(0, timeout=0.2, delay=0.05)
+        self.assertEqual({'type': 'status', 'payload': EQ_TIMEOUT}, msg)
+
+        # long polls until tasks are submitted
+        payloads = [create_payload(i) for i in range(8)]
+        timer = threading.Timer(0.3, self.eq_sql.submit_tasks, ('eq_test', 0, payloads))
+        timer.start()
+        msgs = pool.query_task(0, n=3, worker_pool='P1', delay=0.05, timeout=10)
+        timer.join()
+        self.assertEqual(3, len(msgs))
+        task_ids = [msg['eq_task_id'] for msg in msgs]
+        self.assertEqual(payloads[:3], [msg['payload'] for msg in msgs])
+        msg = pool.query_task(0, worker_pool='P1')
+        self.assertEqual('work', msg['type'])
+        task_ids.append(msg['eq_task_id'])
+
+        self.assertEqual((ResultStatus.SUCCESS, sorted(task_ids)), pool.renew_leases(task_ids, 'P1'))
+        self.assertEqual(ResultStatus.SUCCESS, pool.report_task(task_ids[0], 0, json.dumps({'j': 0}), 'P1'))
+        # reports of tasks that aren't running on the pool are rejected
+        self.assertEqual((ResultStatus.SUCCESS, [task_ids[0], task_ids[3]]),
+                         pool.report_tasks([(task_ids[0], 0, '{}'), (task_ids[3], 0, '{}')], 'P2'))
+        with local_queue.BufferedReporter(pool, max_size=10) as reporter:
+            for eq_task_id in task_ids[1:3]:
+                reporter.report(eq_task_id, 0, json.dumps({'j': eq_task_id}))
+        statuses = dict(remote_funcs._get_status(DBParameters.from_dict(pool.db_params), task_ids))
+        self.assertEqual([TaskStatus.COMPLETE] * 3 + [TaskStatus.RUNNING], [statuses[i] for i in task_ids])
+
+        # 1 task running, so a batch of 4 queries for 3 of the 4 queued tasks
+        running, msgs = pool.query_more_tasks(0, task_ids, 4, worker_pool='P1', timeout=5)
+        self.assertEqual(3, len(msgs))
+        self.assertEqual([task_ids[3]] + [msg['eq_task_id'] for msg in msgs], running)
+        self.assertEqual((running, []), pool.query_more_tasks(0, running, 4, worker_pool='P1'))
+        with self.assertRaises(ValueError):
+            pool.query_more_tasks(0, running, 4, threshold=5)
+        pool.close()
+
+    def test_map(self):
+        self.eq_sql = service_queue.init_task_queue(service_url, host, user, port, db_name)
+        clear_db()
+        db_params = DBParameters.from_dict(self.eq_sql.db_params)
+        done = threading.Event()
+
+        def work():
+            while not done.is_set():
+                result = query_task(db_params, eq_type=0, timeout=0.1)
+                if result['type'] == 'work':
+                    x = json.loads(result['payload'])['x']
+                    report_task(db_params, eq_task_id=result['eq_task_id'], eq_type=0, result=json.dumps({'x': x}))
+
+        t = threading.Thread(target=work)
+        t.start()
+        try:
+            results = self.eq_sql.map('eq_test', 0, (create_payload(i) for i in range(12)), window=4, sleep=0.1)
+            self.assertEqual(list(range(12)), [json.loads(r)['x'] for r in results])
+        finally:
+            done.set()
+            t.join()
+
     def test_as_completed(self):
         self.eq_sql = service_queue.init_task_queue(service_url, host, user, port,
                                                     db_name)
@@ -165,6 +311,59 @@ class ServiceTests(unittest.TestCase):
 
         self.assertEqual(10, count)
 
+    def test_as_completed_watch(self):
+        self.eq_sql = service_queue.init_task_queue(service_url, host, user, port, db_name)
+        clear_db()
+        db_params = DBParameters.from_dict(self.eq_sql.db_params)
+        submit_status, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(500)])
+        self.assertEqual(ResultStatus.SUCCESS, submit_status)
+        done = threading.Event()
+
+        def work():
+            task_queue = local_queue.init_task_queue(host, user, port, db_name)
+            while not done.is_set():
+                tasks = task_queue.query_task(0, n=50, timeout=0.1)
+                if isinstance(tasks, list):
+                    task_queue.report_tasks([(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']}))
+                                             for task in tasks])
+            task_queue.close()
+
+        t = threading.Thread(target=work)
+        t.start()
+        try:
+            completed = list(self.eq_sql.as_completed(fts, timeout=30, batch_size=50, sleep=0.1))
+        finally:
+            done.set()
+            t.join()
+        self.assertEqual(set(fts), set(completed))
+        for ft in completed:
+            self.assertEqual((ResultStatus.SUCCESS, json.dumps({'j': ft.eq_task_id})), ft.result(timeout=0))
+        # the watch set is deleted when the iteration ends
+        with remote_funcs._task_queue(db_params) as task_queue:
+            self.assertEqual((ResultStatus.SUCCESS, [(0,)]), task_queue._get('select count(*) from eq_watch_tasks'))
+
+        # a zero timeout checks the futures with a single request, and no watch set
+        _, fts = self.eq_sql.submit_tasks('eq_test', 0, [create_payload(i) for i in range(3)])
+        task_queue = local_queue.init_task_queue(host, user, port, db_name)
+        for task in task_queue.query_task(0, n=2, timeout=0.0):
+            task_queue.report_task(task['eq_task_id'], 0, json.dumps({'j': task['eq_task_id']}))
+        task_queue.close()
+        post = self.eq_sql._post
+        endpoints = []
+
+        def recording_post(endpoint, msg):
+            endpoints.append(endpoint)
+            return post(endpoint, msg)
+
+        self.eq_sql._post = recording_post
+        completed = []
+        with self.assertRaises(TimeoutError):
+            for ft in self.eq_sql.as_completed(fts, timeout=0.0):
+                completed.append(ft)
+        self.assertEqual(fts[:2], completed)
+        self.assertEqual(['get_results'], endpoints)
+        self.assertEqual((ResultStatus.SUCCESS, json.dumps({'j': fts[0].eq_task_id})), fts[0].result(timeout=0))
+
     def test_as_completed_pop(self):
         self.eq_sql = service_queue.init_task_queue(service_url, host, user, port,
                                                     db_name)
@@ -54,13 +54,16 @@ except ValueError as e:
 eq_task_id = %i
 eq_type = %i
 payload = r'%s'
+worker_pool_id = '%s'
 
-eqsql_swift.report_task(eq_task_id, eq_type, payload, retry_threshold=retry_threshold)
+eqsql_swift.report_task(eq_task_id, eq_type, payload, retry_threshold=retry_threshold, worker_pool=worker_pool_id)
 """;
 
-(void v) eq_task_report(int eq_task_id, int eq_type, string result_payload) {
+// If worker_pool_id is not empty, the report is rejected if the task is no longer
+// running on that worker pool, e.g., if its lease expired and it was requeued
+(void v) eq_task_report(int eq_task_id, int eq_type, string result_payload, string worker_pool_id="") {
     // trace("code: " + code_put % (eq_type, eq_ids));
-    python_persist(code_put % (eq_task_id, eq_type, result_payload)) =>
+    python_persist(code_put % (eq_task_id, eq_type, result_payload, worker_pool_id)) =>
         v = propagate();
 }
 
@@ -100,6 +103,33 @@ eqsql_swift.init_task_querier('%s', %d, %d, %d, query_timeout, retry_threshold)
     @location=loc _void_py(code) => v = propagate();
 }
 
+string init_types_querier_string = """
+import eqsql_swift
+import os
+
+try:
+    retry_threshold = int(os.environ.get('EQ_DB_RETRY_THRESHOLD', 10))
+except ValueError as e:
+    print("ENV VAR: EQ_DB_RETRY_THRESHOLD must be an integer")
+    raise e
+
+try:
+    query_timeout = float(os.environ.get('EQ_QUERY_TASK_TIMEOUT', 120.0))
+except ValueError as e:
+    print("ENV VAR: EQ_QUERY_TASK_TIMEOUT must be a float")
+    raise e
+
+work_types, weights = eqsql_swift.parse_work_types('%s')
+eqsql_swift.init_task_querier('%s', %d, %d, work_types, query_timeout, retry_threshold, weights)
+""";
+
+// work_types is a comma separated list of work types, each optionally followed
+// by a colon and a weight added to the priority of the tasks of that type, e.g., "1,2:10"
+(void v) eq_init_batch_types_querier(location loc, string worker_pool, int batch_size, int threshold, string work_types) {
+    string code = init_types_querier_string % (work_types, worker_pool, batch_size, threshold);
+    @location=loc _void_py(code) => v = propagate();
+}
+
 (void v) eq_stop_batch_querier(location loc){
     stop_string = "eqsql_swift.stop_task_querier()";
     @location=loc _void_py(stop_string) => v = propagate();
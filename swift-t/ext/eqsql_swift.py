@@ -1,4 +1,5 @@
 """ Utility functions for interfacing swift code with database queues"""
+import atexit
 import logging
 import traceback
 import threading
@@ -6,15 +7,64 @@ import time
 import multiprocessing as mp
 import os
 import json
+from typing import Dict, List, Tuple, Union
 
-from eqsql.task_queues import local_queue
-from eqsql.task_queues.core import ABORT_MSG
+from eqsql.task_queues import local_queue, service_queue
+from eqsql.task_queues.core import ABORT_MSG, EQ_ABORT, EQ_TIMEOUT, ResultStatus
 
 password = None
 check_password = True
 
+# The task queue used by query_task and report_task, created on first use and
+# kept open between calls. It is closed after being idle for EQ_DB_IDLE_TIMEOUT
+# seconds (default 300), and recreated if its connection fails.
+_task_queue: local_queue.LocalTaskQueue = None
+_task_queue_lock = threading.Lock()
+_last_used = 0.0
+_reaper: threading.Thread = None
+# wakes the reaper to schedule a flush of newly buffered reports
+_reaper_wake = threading.Event()
+# Buffers report_task results when EQ_REPORT_BUFFER_SIZE > 1, reporting them
+# together when the buffer is full, or after EQ_REPORT_BUFFER_WAIT seconds (default 1.0)
+_reporter: local_queue.BufferedReporter = None
 
-def _create_eqsql(retry_threshold: int = 0, log_level=logging.WARN):
+
+def _idle_timeout() -> float:
+    timeout = os.getenv('EQ_DB_IDLE_TIMEOUT')
+    if timeout is None or timeout == '':
+        return 300.0
+    return float(timeout)
+
+
+def _report_buffer() -> Tuple[int, float]:
+    size = os.getenv('EQ_REPORT_BUFFER_SIZE')
+    wait = os.getenv('EQ_REPORT_BUFFER_WAIT')
+    size = 1 if size is None or size == '' else int(size)
+    wait = 1.0 if wait is None or wait == '' else float(wait)
+    return size, wait
+
+
+def _lease_duration() -> Union[float, None]:
+    # EQ_LEASE_DURATION leases the tasks queried for by the task querier (init_task_querier)
+    # for that many seconds. The leases are renewed by each query of the querier, which may
+    # wait for up to its query timeout plus 20 seconds between queries. The tasks queried for
+    # by query_task are not leased, as nothing renews their leases.
+    duration = os.getenv('EQ_LEASE_DURATION')
+    if duration is None or duration == '':
+        return None
+    return float(duration)
+
+
+def _has_buffered_reports() -> bool:
+    return _reporter is not None and len(_reporter) > 0
+
+
+def _flush_reports(eq_sql: local_queue.LocalTaskQueue) -> ResultStatus:
+    _reporter.task_queue = eq_sql
+    return _reporter.flush()
+
+
+def _create_eqsql(retry_threshold: int = 0, log_level=logging.WARN, lease_duration: float = None):
     host = os.getenv('DB_HOST')
     user = os.getenv('DB_USER')
     if os.getenv('DB_PORT') is None or os.getenv('DB_PORT') == '':
@@ -31,79 +81,220 @@ def _create_eqsql(retry_threshold: int = 0, log_level=logging.WARN):
                 password = fin.readline().strip()
 
     db_name = os.getenv('DB_NAME')
-    return local_queue.init_task_queue(host, user, port, db_name, password, retry_threshold, log_level)
+    # EQ_DB_NOTIFY=1 uses LISTEN / NOTIFY rather than polling to wait for tasks
+    notify = os.getenv('EQ_DB_NOTIFY', '0') == '1'
+    # EQ_FAIR_SHARE=1 shares the queried tasks between experiments in proportion
+    # to their weights, rather than taking them strictly in priority order
+    fair_share = os.getenv('EQ_FAIR_SHARE', '0') == '1'
+    # EQ_POOL_LABELS is a comma separated list of the labels, in addition to the
+    # worker pool id, of the targeted tasks queried for by this worker pool
+    pool_labels = [label.strip() for label in os.getenv('EQ_POOL_LABELS', '').split(',') if label.strip() != '']
+    # EQ_SERVICE_URL queries for and reports tasks through the emews_service at that url,
+    # for worker pools that cannot connect to the database
+    service_url = os.getenv('EQ_SERVICE_URL')
+    if service_url is not None and service_url != '':
+        return service_queue.init_pool_queue(service_url, host, user, port, db_name, password, retry_threshold,
+                                             lease_duration=lease_duration, fair_share=fair_share,
+                                             pool_labels=pool_labels)
+    return local_queue.init_task_queue(host, user, port, db_name, password, retry_threshold, log_level,
+                                       notify=notify, lease_duration=lease_duration, fair_share=fair_share,
+                                       pool_labels=pool_labels)
+
+
+def _connection_lost(eq_sql: local_queue.LocalTaskQueue) -> bool:
+    # a ServicePoolQueue's HTTP session reconnects by itself
+    return isinstance(eq_sql, local_queue.LocalTaskQueue) and eq_sql.db.conn.closed
+
+
+def _close_eqsql(eq_sql: local_queue.LocalTaskQueue):
+    try:
+        eq_sql.close()
+    except Exception:
+        pass
+
+
+def _reap_idle():
+    """Flushes any buffered reports when they are due, and closes the module task queue,
+    and its connection, once it has been idle for longer than the idle timeout.
+    """
+    global _task_queue, _reaper
+    timeout = _idle_timeout()
+    while True:
+        with _task_queue_lock:
+            if _has_buffered_reports() and _reporter.is_due():
+                try:
+                    _call_eqsql(_flush_reports, lambda status: status == ResultStatus.FAILURE, 0, logging.WARN,
+                                touch=False)
+                except Exception:
+                    print(f'eq_swift.report_task error {traceback.format_exc()}', flush=True)
+            if _task_queue is None:
+                _reaper = None
+                return
+            idle = time.time() - _last_used
+            if idle >= timeout and not _has_buffered_reports():
+                _close_eqsql(_task_queue)
+                _task_queue = None
+                _reaper = None
+                return
+            wait = timeout - idle
+            if _has_buffered_reports():
+                wait = min(wait, _reporter.max_wait) if wait > 0 else _reporter.max_wait
+            _reaper_wake.clear()
+        _reaper_wake.wait(wait)
+
+
+@atexit.register
+def _flush_at_exit():
+    with _task_queue_lock:
+        if _has_buffered_reports():
+            _call_eqsql(_flush_reports, lambda status: status == ResultStatus.FAILURE, 0, logging.WARN)
 
 
-def query_task(eq_work_type: int, worker_pool: str, query_timeout: float = 120.0,
-               retry_threshold: int = 0, log_level=logging.WARN):
-    eq_sql: local_queue.LocalTaskQueue = None
+def _call_eqsql(f, failed, retry_threshold: int, log_level, touch: bool = True):
+    """Calls f with the module task queue, creating the queue if necessary. If f fails
+    because the queue's connection has been lost, the queue is recreated and f called again.
+    The caller must hold the _task_queue_lock.
+
+    Args:
+        f: the function to call with the task queue
+        failed: a function that returns True if the result of f indicates a failure
+        retry_threshold: the connection retry_threshold
+        log_level: the task queue log level
+        touch: if True, the call counts as a use of the queue for the idle timeout
+
+    Returns:
+        The result of f.
+    """
+    global _task_queue, _last_used, _reaper
+    for attempt in range(2):
+        if _task_queue is None:
+            _task_queue = _create_eqsql(retry_threshold, log_level)
+        eq_sql = _task_queue
+        try:
+            result = f(eq_sql)
+        except Exception:
+            result = None
+            if attempt == 1:
+                raise
+        finally:
+            if touch:
+                _last_used = time.time()
+        if result is None or (failed(result) and _connection_lost(eq_sql)):
+            # connection lost, so discard the queue and try again with a new one
+            eq_sql.logger.warning('eq_swift: task queue connection lost, reconnecting')
+            _close_eqsql(eq_sql)
+            _task_queue = None
+            if attempt == 0:
+                continue
+        break
+
+    if _task_queue is not None and _reaper is None:
+        _reaper = threading.Thread(target=_reap_idle, daemon=True)
+        _reaper.start()
+    return result
+
+
+def query_task(eq_work_type: Union[int, List[int]], worker_pool: str, query_timeout: float = 120.0,
+               retry_threshold: int = 0, log_level=logging.WARN, weights: Dict[int, float] = None):
+    def query(eq_sql):
+        if _has_buffered_reports():
+            msg_map = eq_sql.query_task(eq_work_type, worker_pool=worker_pool, timeout=0.0, weights=weights)
+            if msg_map['type'] == 'work' or msg_map['payload'] != EQ_TIMEOUT:
+                return msg_map
+            # the reaper can't flush the buffered reports while the lock is held for the
+            # long poll, so they are reported now rather than held for the query timeout
+            _flush_reports(eq_sql)
+        return eq_sql.query_task(eq_work_type, worker_pool=worker_pool, timeout=query_timeout, weights=weights)
+
     try:
-        eq_sql = _create_eqsql(retry_threshold, log_level)
-        eq_sql.logger.debug('swift out_get')
-        # result is a msg map
-        msg_map = eq_sql.query_task(eq_work_type, worker_pool=worker_pool, timeout=query_timeout)
+        with _task_queue_lock:
+            # result is a msg map
+            msg_map = _call_eqsql(query, lambda msg_map: msg_map['payload'] == EQ_ABORT, retry_threshold, log_level)
         items = [msg_map['type'], msg_map['payload']]
         if msg_map['type'] == 'work':
             items.append(str(msg_map['eq_task_id']))
         # result_str should be returned via swift's python persist
-        eq_sql.logger.debug('swift out_get done')
         return '|'.join(items)
     except Exception:
-        if eq_sql is None:
-            print(f'eq_swift.query_task error {traceback.format_exc()}', flush=True)
-        else:
-            eq_sql.logger.error(f'eq_swift.query_task error {traceback.format_exc()}')
+        print(f'eq_swift.query_task error {traceback.format_exc()}', flush=True)
         # result_str returned via swift's python persist
         # ABORT_MSG = json.dumps({'type': 'status', 'payload': EQ_ABORT})
         abort_msg = json.loads(ABORT_MSG)
         return "|".join([abort_msg['type'], abort_msg['payload']])
-    finally:
-        if eq_sql is not None:
-            eq_sql.close()
 
 
 def report_task(eq_task_id: int, eq_work_type: int, result_payload: str,
-                retry_threshold: int = 0, log_level=logging.WARN):
-    eq_sql = None
+                retry_threshold: int = 0, log_level=logging.WARN, worker_pool: str = None):
+    global _reporter
+    buffer_size, buffer_wait = _report_buffer()
+    # the report is rejected if the task is no longer running on the worker pool, e.g.,
+    # if its lease expired and it was requeued and queried for by another worker pool
+    worker_pool = None if worker_pool is None or worker_pool == '' else worker_pool
+    buffered = []
+
+    def buffered_report(eq_sql):
+        _reporter.task_queue = eq_sql
+        if _reporter.worker_pool != worker_pool:
+            # the buffered results are reported by the worker pool that ran them
+            status = _reporter.flush()
+            if status != ResultStatus.SUCCESS:
+                return status
+            _reporter.worker_pool = worker_pool
+        if len(buffered) == 0:
+            buffered.append(eq_task_id)
+            return _reporter.report(eq_task_id, eq_work_type, result_payload)
+        # a retry after a failed flush
+        return _reporter.flush()
+
     try:
-        eq_sql = _create_eqsql(retry_threshold, log_level)
-        # TODO this returns a ResultStatus, add FAILURE handling
-        eq_sql.report_task(eq_task_id, eq_work_type, result_payload)
+        with _task_queue_lock:
+            if buffer_size > 1:
+                if _reporter is None:
+                    _reporter = local_queue.BufferedReporter(None, max_size=buffer_size, max_wait=buffer_wait,
+                                                             worker_pool=worker_pool)
+                report = buffered_report
+            else:
+                def report(eq_sql):
+                    return eq_sql.report_task(eq_task_id, eq_work_type, result_payload, worker_pool)
+            # TODO this returns a ResultStatus, add FAILURE handling
+            _call_eqsql(report, lambda status: status == ResultStatus.FAILURE, retry_threshold, log_level)
+            if _has_buffered_reports():
+                _reaper_wake.set()
     except Exception:
-        if eq_sql is None:
-            print(f'eq_swift.report_task error {traceback.format_exc()}', flush=True)
-        else:
-            eq_sql.logger.error(f'eq_swift.report_task error {traceback.format_exc()}')
-    finally:
-        if eq_sql is not None:
-            eq_sql.close()
+        print(f'eq_swift.report_task error {traceback.format_exc()}', flush=True)
 
 
 _q = mp.Queue(1)
 _go = True
 
 
-def query_tasks_n(batch_size: int, threshold: int, work_type: int, worker_pool: str,
-                  timeout: float, retry_threshold: int, q: mp.Queue):
+def query_tasks_n(batch_size: int, threshold: int, work_type: Union[int, List[int]], worker_pool: str,
+                  timeout: float, retry_threshold: int, q: mp.Queue, weights: Dict[int, float] = None):
     running_task_ids = []
     wait = 0.25
+    # this thread's own long-lived task queue, recreated after an error
+    eq_sql = None
     while _go:
-        eq_sql = None
         try:
-            eq_sql = _create_eqsql(retry_threshold)
+            if eq_sql is None:
+                eq_sql = _create_eqsql(retry_threshold, lease_duration=_lease_duration())
             running_task_ids, tasks = eq_sql.query_more_tasks(work_type, running_task_ids,
                                                               batch_size=batch_size, threshold=threshold,
-                                                              worker_pool=worker_pool, timeout=timeout)
+                                                              worker_pool=worker_pool, timeout=timeout,
+                                                              weights=weights)
+            if _connection_lost(eq_sql):
+                # connection lost, so recreate the queue on the next query
+                _close_eqsql(eq_sql)
+                eq_sql = None
         except Exception:
             if eq_sql is None:
                 print(f'eq_swift.query_task_n error {traceback.format_exc()}', flush=True)
             else:
                 eq_sql.logger.error(f'eq_swift.query_task_n error {traceback.format_exc()}')
+                _close_eqsql(eq_sql)
+                eq_sql = None
             running_task_ids = []
             tasks = [json.loads(ABORT_MSG)]
-        finally:
-            if eq_sql is not None:
-                eq_sql.close()
 
         n_tasks = len(tasks)
         # print("TASKS: ", tasks, flush=True)
@@ -124,12 +315,31 @@ def query_tasks_n(batch_size: int, threshold: int, work_type: int, worker_pool:
             if wait < 20:
                 wait += 0.25
 
+    if eq_sql is not None:
+        _close_eqsql(eq_sql)
+
+
+def parse_work_types(work_types: str) -> Tuple[List[int], Dict[int, float]]:
+    """Parses a comma separated list of work types, each optionally followed by
+    a colon and its weight, e.g., '1,2:10,3', into a list of the work types and a
+    dictionary of their weights.
+    """
+    eq_types = []
+    weights = {}
+    for item in work_types.split(','):
+        eq_type, _, weight = item.strip().partition(':')
+        eq_types.append(int(eq_type))
+        if weight != '':
+            weights[int(eq_type)] = float(weight)
+    return (eq_types, weights)
+
 
-def init_task_querier(worker_pool: str, batch_size: int, threshold: int, work_type: int,
-                      timeout: float = 120, retry_threshold: int = 0):
-    # wait_info = WaitInfo
+def init_task_querier(worker_pool: str, batch_size: int, threshold: int, work_type: Union[int, List[int]],
+                      timeout: float = 120, retry_threshold: int = 0, weights: Dict[int, float] = None):
+    # work_type can be a list of types, queried for together with optional per type
+    # weights (see LocalTaskQueue.query_task)
     t = threading.Thread(target=query_tasks_n, args=(batch_size, threshold, work_type,
-                         worker_pool, timeout, retry_threshold, _q))
+                         worker_pool, timeout, retry_threshold, _q, weights))
     t.start()
 
 
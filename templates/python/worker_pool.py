@@ -3,12 +3,24 @@ import asyncio
 import argparse
 import os
 
-from eqsql import eq
+from eqsql.task_queues import local_queue, service_queue
+from eqsql.task_queues.core import EQ_ABORT, EQ_STOP, ResultStatus
 
 
 # IMPORTANT ENV VARIABLE:
 # * EQ_DB_RETRY_THRESHOLD sets the db connection retry threshold for querying and reporting
 # * EQ_QUERY_TASK_TIMEOUT sets the query task timeout.
+# * EQ_REPORT_BUFFER_SIZE sets the number of results reported together (default 100)
+# * EQ_REPORT_BUFFER_WAIT sets the maximum number of seconds a result is buffered before
+#   being reported (default 1.0)
+# * EQ_LEASE_DURATION if set, queried tasks are leased for this many seconds, and the
+#   leases of the running tasks are renewed every third of that duration
+# * EQ_FAIR_SHARE if 1, queried tasks are shared between experiments in proportion
+#   to their weights (see LocalTaskQueue.set_exp_weights), rather than taken in priority order
+# * EQ_POOL_LABELS a comma separated list of the labels, in addition to the worker pool id,
+#   of the targeted tasks (see LocalTaskQueue.submit_task) queried for by this worker pool
+# * EQ_SERVICE_URL if set, tasks are queried for and reported through the emews_service at
+#   this url, rather than directly with the database
 
 TASK_RESULT = 0
 DONE = 1
@@ -21,19 +33,21 @@ def do_work(rank, payload):
     pass
 
 
-async def get_tasks(work_type, q: asyncio.Queue, eq_sql: eq.EQSQL):
+async def get_tasks(work_type, q: asyncio.Queue, eq_sql: local_queue.LocalTaskQueue, running: set,
+                    worker_pool: str):
     while True:
-        msg_map = eq_sql.query_task(work_type, timeout=0)
+        msg_map = eq_sql.query_task(work_type, worker_pool=worker_pool, timeout=0)
         task_type = msg_map['type']
         payload = msg_map['payload']
         if task_type == 'work':
             # print(f'Task: {msg_map}', flush=True)
+            running.add(msg_map['eq_task_id'])
             await q.put(msg_map)
-        elif payload == eq.EQ_STOP:
+        elif payload == EQ_STOP:
             # print(f'Task: {msg_map}', flush=True)
             await q.put(msg_map)
             break
-        elif payload == eq.EQ_ABORT:
+        elif payload == EQ_ABORT:
             # TODO handle this better
             break
         await asyncio.sleep(0)
@@ -64,20 +78,42 @@ async def distribute_tasks(comm, q: asyncio.Queue):
     print('Distribute Tasks Done', flush=True)
 
 
-async def get_results(comm, work_type: int, eq_sql: eq.EQSQL):
+async def renew_leases(eq_sql: local_queue.LocalTaskQueue, running: set, done: asyncio.Event, worker_pool: str):
+    while not done.is_set():
+        try:
+            await asyncio.wait_for(done.wait(), eq_sql.lease_duration / 3)
+        except asyncio.TimeoutError:
+            pass
+        status, renewed = eq_sql.renew_leases(running, worker_pool)
+        if status == ResultStatus.SUCCESS:
+            # tasks whose leases were lost have been requeued
+            running.intersection_update(renewed)
+    print('Renew Leases Done', flush=True)
+
+
+async def get_results(comm, work_type: int, eq_sql: local_queue.LocalTaskQueue, running: set, worker_pool: str):
     live_ranks = comm.Get_size() - 1
-    while live_ranks > 0:
-        has_request = comm.iprobe(source=MPI.ANY_SOURCE, tag=RESULT)
-        if has_request:
-            result = comm.recv(source=MPI.ANY_SOURCE, tag=RESULT)
-            if result['type'] == DONE:
-                live_ranks -= 1
+    buffer_size = int(os.getenv('EQ_REPORT_BUFFER_SIZE', 100))
+    buffer_wait = float(os.getenv('EQ_REPORT_BUFFER_WAIT', 1.0))
+    # the reports of tasks that are no longer running on this pool, e.g., whose leases
+    # expired and that were requeued, are rejected
+    with local_queue.BufferedReporter(eq_sql, max_size=buffer_size, max_wait=buffer_wait,
+                                      worker_pool=worker_pool) as reporter:
+        while live_ranks > 0:
+            has_request = comm.iprobe(source=MPI.ANY_SOURCE, tag=RESULT)
+            if has_request:
+                result = comm.recv(source=MPI.ANY_SOURCE, tag=RESULT)
+                if result['type'] == DONE:
+                    live_ranks -= 1
+                else:
+                    eq_task_id = result['eq_task_id']
+                    payload = result['payload']
+                    running.discard(eq_task_id)
+                    reporter.report(eq_task_id, work_type, payload)
             else:
-                eq_task_id = result['eq_task_id']
-                payload = result['payload']
-                eq_sql.report_task(eq_task_id, work_type, payload)
+                reporter.flush_if_due()
 
-        await asyncio.sleep(0)
+            await asyncio.sleep(0)
 
     print('Get Results Done')
 
@@ -98,7 +134,7 @@ def run_worker(comm):
             msg = {'type': TASK_RESULT, 'eq_task_id': eq_task_id, 'payload': json_result}
             # print(f'Rank {rank} sending {msg}', flush=True)
             comm.send(msg, dest=0, tag=RESULT)
-        elif payload == eq.EQ_STOP:
+        elif payload == EQ_STOP:
             alive = False
             msg = {'type': DONE}
             comm.send(msg, dest=0, tag=RESULT)
@@ -106,18 +142,28 @@ def run_worker(comm):
     print(f'Rank {comm.Get_rank()} Done', flush=True)
 
 
-async def run_server(comm, work_type, eq_sql):
+async def run_server(comm, work_type, eq_sql, worker_pool):
     work_queue = asyncio.Queue()
     # qt = asyncio.create_task(get_tasks(work_type, work_queue))
     # dt = asyncio.create_task(distribute_tasks(comm, work_queue))
     # grt = asyncio.create_task(get_results(comm, work_type))
 
-    await asyncio.gather(get_tasks(work_type, work_queue, eq_sql),
-                         distribute_tasks(comm, work_queue),
-                         get_results(comm, work_type, eq_sql))
+    # the ids of the tasks queried for and not yet reported
+    running = set()
+    coros = [get_tasks(work_type, work_queue, eq_sql, running, worker_pool), distribute_tasks(comm, work_queue)]
+    if eq_sql.lease_duration is None:
+        await asyncio.gather(*coros, get_results(comm, work_type, eq_sql, running, worker_pool))
+    else:
+        done = asyncio.Event()
+
+        async def results():
+            await get_results(comm, work_type, eq_sql, running, worker_pool)
+            done.set()
+
+        await asyncio.gather(*coros, results(), renew_leases(eq_sql, running, done, worker_pool))
 
 
-def run(work_type: int):
+def run(work_type: int, worker_pool: str):
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     if rank == 0:
@@ -125,9 +171,20 @@ def run(work_type: int):
         user = os.getenv('DB_USER')
         port = int(os.getenv('DB_PORT'))
         db_name = os.getenv('DB_NAME')
-        eq_sql = eq.init_task_queue(host, user, port, db_name)
+        lease_duration = os.getenv('EQ_LEASE_DURATION')
+        lease_duration = None if lease_duration is None or lease_duration == '' else float(lease_duration)
+        fair_share = os.getenv('EQ_FAIR_SHARE', '0') == '1'
+        pool_labels = [label for label in os.getenv('EQ_POOL_LABELS', '').split(',') if label != '']
+        service_url = os.getenv('EQ_SERVICE_URL')
+        if service_url:
+            eq_sql = service_queue.init_pool_queue(service_url, host, user, port, db_name,
+                                                   lease_duration=lease_duration, fair_share=fair_share,
+                                                   pool_labels=pool_labels)
+        else:
+            eq_sql = local_queue.init_task_queue(host, user, port, db_name, lease_duration=lease_duration,
+                                                 fair_share=fair_share, pool_labels=pool_labels)
         try:
-            asyncio.run(run_server(comm, work_type, eq_sql))
+            asyncio.run(run_server(comm, work_type, eq_sql, worker_pool))
         finally:
             eq_sql.close()
     else:
@@ -137,5 +194,6 @@ def run(work_type: int):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Show stats for EXPID")
     parser.add_argument('work_type', type=int)
+    parser.add_argument('--worker_pool_id', default='default', help='the id of this worker pool')
     args = parser.parse_args()
-    run(args.work_type)
+    run(args.work_type, args.worker_pool_id)
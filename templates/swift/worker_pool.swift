@@ -60,7 +60,7 @@ loop()
       printf("RESULT: %s", result);
       // json_result = result_to_json(result);
       // printf("JSON RESULT: %s", json_result);
-      eq_task_report(eq_task_id, SIM_WORK_TYPE, json_result) => c = true;
+      eq_task_report(eq_task_id, SIM_WORK_TYPE, json_result, WORKER_POOL_ID) => c = true;
     }
   }
 
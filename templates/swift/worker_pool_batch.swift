@@ -23,6 +23,18 @@ string WORKER_POOL_ID = argv("worker_pool_id", "default");
 
 // IMPORTANT ENV VARIABLE:
 // * EQ_DB_RETRY_THRESHOLD sets the db connection retry threshold for querying and reporting
+// * EQ_REPORT_BUFFER_SIZE if > 1, task results are buffered and reported together
+//   when this many have been buffered
+// * EQ_REPORT_BUFFER_WAIT sets the maximum number of seconds a buffered result waits
+//   before being reported (default 1.0)
+// * EQ_LEASE_DURATION if set, queried tasks are leased for this many seconds and the
+//   leases are renewed by the task querier. Tasks whose leases expire (e.g., because this
+//   pool died) can then be requeued with LocalTaskQueue.requeue_expired or a LeaseReaper.
+//   This should be longer than the query timeout plus 20 seconds.
+// * EQ_FAIR_SHARE if 1, queried tasks are shared between experiments in proportion
+//   to their weights (see LocalTaskQueue.set_exp_weights), rather than taken in priority order
+// * EQ_POOL_LABELS a comma separated list of the labels, in addition to the worker pool id,
+//   of the targeted tasks (see LocalTaskQueue.submit_task) queried for by this worker pool
 
 
 (string result) run(string params) {
@@ -33,7 +45,7 @@ run(message msgs[]) {
   // printf("MSGS SIZE: %d", size(msgs));
   foreach msg, i in msgs {
     result_payload = run(msg.payload);
-    eq_task_report(msg.eq_task_id, WORK_TYPE, result_payload);
+    eq_task_report(msg.eq_task_id, WORK_TYPE, result_payload, WORKER_POOL_ID);
   }
 }
 
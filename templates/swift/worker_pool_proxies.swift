@@ -77,7 +77,7 @@ loop()
       }
       result = join(results, ",");
       json_result = result_to_json(result);
-      eq_task_report(eq_task_id, SIM_WORK_TYPE, json_result) => c = true;
+      eq_task_report(eq_task_id, SIM_WORK_TYPE, json_result, WORKER_POOL_ID) => c = true;
     }
   }
 